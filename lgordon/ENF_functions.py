@@ -33,6 +33,10 @@ import fnmatch
 from datetime import datetime
 import os
 import shutil
+import json
+import hashlib
+import io
+import sqlite3
 from scipy.stats import moment, sigmaclip
 
 import astropy
@@ -90,7 +94,108 @@ def load_feature_metafile(folderpath):
     return features
     
 
-def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel, version=0, save=True):
+# :: Batched periodograms ::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Lomb-Scargle periodograms of many light curves on the same time axis. The
+# >> trig tables cos(w t) and sin(w t) depend only on the time axis and the
+# >> frequency grid, so lombscargle_tables() computes them once, and
+# >> lombscargle_batch() turns a block of light curves into periodograms with
+# >> two matrix products. The phase offset tau of every frequency follows from
+# >> the sums of cos(2 w t) and sin(2 w t), so masked points (e.g. NaNs or
+# >> sigma-clipped points) only need those sums per light curve. Same results
+# >> as signal.lombscargle(t[mask], y[mask], freqs) for each light curve.
+# >> Large grids (e.g. 5000 frequencies of an 18000 point sector take 1.44 GB)
+# >> are built with chunk_size: only the sums are kept, and lombscargle_batch()
+# >> recomputes cos(w t) and sin(w t) chunk_size frequencies at a time.
+
+def lombscargle_tables(t, freqs, chunk_size=None):
+    '''Trig tables for lombscargle_batch(), for time axis t and angular
+    frequencies freqs. The tables take 16*len(freqs)*len(t) bytes, unless
+    chunk_size is given, in which case they are computed chunk_size
+    frequencies at a time (16*chunk_size*len(t) bytes) whenever they are
+    needed.'''
+    t = np.asarray(t, dtype='float64')
+    freqs = np.asarray(freqs, dtype='float64')
+    tables = {'freqs': freqs, 't': t, 'chunk_size': chunk_size,
+              'cos2': np.empty(len(freqs)), 'sin2': np.empty(len(freqs))}
+    step = len(freqs) if type(chunk_size) == type(None) else chunk_size
+    for i in range(0, len(freqs), max(step, 1)):
+        c, s = trig_chunk(tables, i, i+step)
+        # >> sums of cos(2wt) and sin(2wt) over all points
+        tables['cos2'][i:i+step] = np.sum(c**2 - s**2, axis=1)
+        tables['sin2'][i:i+step] = 2*np.sum(c*s, axis=1)
+        if type(chunk_size) == type(None):
+            tables['cos'], tables['sin'] = c, s
+    return tables
+
+def trig_chunk(tables, start, end):
+    '''cos(w t) and sin(w t) of frequencies start to end of tables (see
+    lombscargle_tables()), shape (end - start, len(t)).'''
+    if 'cos' in tables:
+        return tables['cos'][start:end], tables['sin'][start:end]
+    wt = np.outer(tables['freqs'][start:end], tables['t'])
+    return np.cos(wt), np.sin(wt)
+
+def lombscargle_batch(y, tables, mask=None, normalize=True, freq_chunk=500):
+    '''Lomb-Scargle periodograms of a block of light curves.
+    Parameters:
+        * y : light curves, shape (num_lc, len(t))
+        * tables : from lombscargle_tables(t, freqs)
+        * mask : boolean array shaped like y, False for points to leave out
+                 (default: use every point)
+        * normalize : same as in signal.lombscargle()
+        * freq_chunk : number of frequencies at a time for the sums over
+                       masked points (tables built with a chunk_size use
+                       their chunk_size instead)
+    Returns:
+        * pg : periodograms, shape (num_lc, len(freqs))
+    '''
+    y = np.asarray(y, dtype='float64').reshape(-1, len(tables['t']))
+    num_freqs = len(tables['freqs'])
+    if type(tables['chunk_size']) != type(None):
+        freq_chunk = tables['chunk_size']
+    elif type(mask) == type(None):
+        freq_chunk = num_freqs # >> one matrix product with the full tables
+    if type(mask) == type(None):
+        num_points = np.full((len(y), 1), y.shape[1], dtype='float64')
+        cos2, sin2 = tables['cos2'][None,:], tables['sin2'][None,:]
+    else:
+        mask = np.asarray(mask, dtype='bool').reshape(y.shape)
+        y = np.where(mask, y, 0.)
+        weights = mask.astype('float64')
+        num_points = np.sum(weights, axis=1, keepdims=True)
+        cos2 = np.empty((len(y), num_freqs))
+        sin2 = np.empty((len(y), num_freqs))
+    
+    yc = np.empty((len(y), num_freqs))
+    ys = np.empty((len(y), num_freqs))
+    for i in range(0, num_freqs, max(freq_chunk, 1)):
+        c, s = trig_chunk(tables, i, i+freq_chunk)
+        if type(mask) != type(None):
+            cos2[:,i:i+freq_chunk] = weights @ (c**2 - s**2).T
+            sin2[:,i:i+freq_chunk] = 2 * (weights @ (c*s).T)
+        yc[:,i:i+freq_chunk] = y @ c.T
+        ys[:,i:i+freq_chunk] = y @ s.T
+    
+    # >> rotate by the phase offset tau, tan(2 w tau) = sin2 / cos2
+    wtau = 0.5 * np.arctan2(sin2, cos2)
+    c, s = np.cos(wtau), np.sin(wtau)
+    yc, ys = c*yc + s*ys, c*ys - s*yc
+    r = np.hypot(cos2, sin2)
+    eps = np.finfo('float64').epsneg * num_points
+    cc = np.maximum((num_points + r) / 2, eps) # >> sum of cos^2(w(t-tau))
+    ss = np.maximum((num_points - r) / 2, eps) # >> sum of sin^2(w(t-tau))
+    
+    pg = yc**2 / cc + ys**2 / ss
+    if normalize:
+        pg /= np.sum(y**2, axis=1, keepdims=True)
+    else:
+        pg *= 0.5
+    return pg
+
+
+def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel, version=0, save=True,
+                                        ticid=None, n_workers=None, threads_per_worker=1,
+                                        catalog=None, query=False):
     """Produces the feature vectors for each light curve and saves them all
     into a single fits file. requires all light curves on the same time axis
     parameters:
@@ -101,8 +206,14 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
         * version = what version of feature vector to calculate for all. 
             default is 0
         * save = whether or not to save into a fits file
+        * ticid = TICIDs of the light curves, for the TLS period grids (version 1)
+        * n_workers, threads_per_worker = see featvec_tls_parallel() (version 1)
+        * catalog = dictionary with 'ID', 'rad' and 'mass' arrays of the TIC
+            catalog, for the TLS period grids
+        * query = whether to query catalog_info() for the targets that are not
+            in catalog (see tls_stellar_params())
     returns: list of feature vectors + fits file containing all feature vectors
-    requires: featvec()
+    requires: featvec_batch() (version 0), featvec_tls_parallel() (version 1)
     modified: [lcg 08212020]"""
     
 
@@ -117,11 +228,23 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
         intensities = mean_norm(intensities)
 
     print("Begining Feature Vector Creation Now")
-    for n in range(len(intensities)):
-        feature_vector = featvec(times, intensities[n], v=version)
-        feature_list.append(feature_vector)
-        
-        if n % 25 == 0: print(str(n) + " completed")
+    if version == 0:
+        feature_list = featvec_batch(times, intensities)
+    else:
+        # >> checkpointed, so a rerun picks up where it stopped
+        db_file = yourpath + "/" + filelabel + "_tls.db"
+        stellar_params = None
+        if type(ticid) != type(None):
+            con = open_tls_db(db_file)
+            stellar_params = tls_stellar_params(ticid, con, catalog=catalog,
+                                                query=query)
+            con.close()
+        else:
+            ticid = np.arange(len(intensities))
+        feature_list = featvec_tls_parallel(times, intensities, ticid, db_file,
+                                            stellar_params=stellar_params,
+                                            n_workers=n_workers,
+                                            threads_per_worker=threads_per_worker)
     
     feature_list = np.asarray(feature_list)
     
@@ -135,7 +258,8 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
     
     return feature_list
 
-def featvec(x_axis, sampledata, ticid=None, v=0): 
+def featvec(x_axis, sampledata, ticid=None, v=0, stellar_params=None,
+            use_threads=None, show_progress_bar=True): 
     """calculates the feature vector of a single light curve
         version 0: features 0-15
         version 1: features 0-19
@@ -177,6 +301,9 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
 
 	*** version 1 note: you may wish to go into the transitleastsquares's main.py file and
 	comment out all 'print' statements in order to save space while running this over lots of light curves
+	*** version 1 parameters: stellar_params = (radius, mass) of the star, to pick
+	the smallest period grid without querying catalog_info() for ticid (see
+	tls_stellar_params()); use_threads and show_progress_bar are passed to TLS
         modified [lcg 07202020]"""
     #empty feature vector
     featvec = []
@@ -250,34 +377,22 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
     
     #tls 
     elif v == 1: 
-        from transitleastsquares import transitleastsquares, period_grid, catalog_info
+        from transitleastsquares import transitleastsquares
         model = transitleastsquares(x_axis, sampledata)
         
-        if type(ticid) != type(None):
-            dt = np.max(x_axis) - np.min(x_axis)            
-            ab, mass, mass_min, mass_max, radius, radius_min, radius_max = catalog_info(TIC_ID=int(ticid))
-            # >> find smallest period grid
-            rm_set = []
-            grid_lengths = [period_grid(1, 1, dt).shape[0]]
-            rm_set.append([1,1])
-            
-            if not np.isnan(radius):                
-                grid_lengths.append(period_grid(radius, 1, dt).shape[0])
-                rm_set.append([radius, 1])
-                
-            if not np.isnan(mass):
-                grid_lengths.append(period_grid(1, mass, dt).shape[0])
-                rm_set.append([1, mass])
-                
-            
-            ind = np.argmin(grid_lengths)
-            R_star, M_star = rm_set[ind]
-            
+        # >> find smallest period grid
+        if type(stellar_params) == type(None) and type(ticid) != type(None):
+            stellar_params = tls_catalog_params(ticid)
+        if type(stellar_params) != type(None):
+            R_star, M_star = tls_grid_params(x_axis, *stellar_params)
         else:
             R_star, M_star = 1,1
         
-        results = model.power(show_progress_bar=True, R_star=R_star,
-                              M_star=M_star)
+        kwargs = {}
+        if type(use_threads) != type(None):
+            kwargs['use_threads'] = use_threads
+        results = model.power(show_progress_bar=show_progress_bar,
+                              R_star=R_star, M_star=M_star, **kwargs)
         featvec.append(results.period)
         featvec.append(results.duration)
         featvec.append((1 - results.depth))
@@ -285,6 +400,559 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
     
     return featvec 
 
+def lc_statistics(x_axis, flux, mask=None, percentiles=[5, 50, 95],
+                  batch_size=1000):
+    """Moments, slope and percentiles of many light curves on the same time
+    axis, batch_size light curves at a time. NaNs (and points where mask is
+    False) are left out.
+    parameters:
+        * x_axis = time axis
+        * flux = array of light curves, shape (num_lc, len(x_axis))
+        * mask = boolean array shaped like flux, False for points to leave out
+        * percentiles = percentiles to compute (as np.percentile())
+    returns: dictionary of arrays with one value per light curve:
+        'num_points', 'mean', 'variance', 'skewness' and 'kurtosis' (2nd, 3rd
+        and 4th central moments, as in featvec()), 'slope' (as in
+        stats.linregress()) and 'percentiles' (shape (num_lc,
+        len(percentiles)))"""
+    x_axis = np.asarray(x_axis, dtype='float64')
+    lc_stats = {}
+    for key in ['num_points', 'mean', 'variance', 'skewness', 'kurtosis',
+                'slope']:
+        lc_stats[key] = np.empty(len(flux))
+    lc_stats['percentiles'] = np.empty((len(flux), len(percentiles)))
+    
+    for i in range(0, len(flux), batch_size):
+        y = np.asarray(flux[i:i+batch_size], dtype='float64')
+        valid = np.isfinite(y)
+        if type(mask) != type(None):
+            valid = valid * np.asarray(mask[i:i+batch_size], dtype='bool')
+        num_points = np.sum(valid, axis=1)
+        
+        #moments
+        mean = np.sum(np.where(valid, y, 0.), axis=1) / num_points
+        dev = np.where(valid, y - mean[:,None], 0.)
+        dev_k = dev**2
+        for key in ['variance', 'skewness', 'kurtosis']:
+            lc_stats[key][i:i+batch_size] = np.sum(dev_k, axis=1) / num_points
+            dev_k *= dev
+        lc_stats['num_points'][i:i+batch_size] = num_points
+        lc_stats['mean'][i:i+batch_size] = mean
+        
+        #slope
+        x_mean = valid @ x_axis / num_points
+        x_dev = np.where(valid, x_axis[None,:] - x_mean[:,None], 0.)
+        lc_stats['slope'][i:i+batch_size] = np.sum(x_dev * dev, axis=1) / \
+            np.sum(x_dev**2, axis=1)
+        
+        # >> percentiles, interpolating linearly between the sorted points
+        # >> (NaNs are sorted to the end)
+        if len(percentiles) > 0:
+            y = np.sort(np.where(valid, y, np.nan), axis=1)
+            pos = np.asarray(percentiles)[None,:] / 100 * (num_points[:,None]-1)
+            lower = np.clip(np.floor(pos).astype('int'), 0, y.shape[1]-1)
+            upper = np.minimum(lower+1, np.maximum(num_points[:,None]-1, 0))
+            frac = pos - lower
+            lower = np.take_along_axis(y, lower, axis=1)
+            upper = np.take_along_axis(y, upper, axis=1)
+            lc_stats['percentiles'][i:i+batch_size] = \
+                lower + (upper - lower) * frac
+    
+    return lc_stats
+
+def featvec_tables(x_axis, chunk_size=500):
+    '''Lomb-Scargle tables (see lombscargle_tables()) of the two frequency
+    grids of featvec(v=0), for time axis x_axis. The 5000 frequency grid is
+    computed chunk_size frequencies at a time (all at once if chunk_size is
+    None).'''
+    return {'pg': lombscargle_tables(x_axis, np.linspace(0.6, 62.8, 5000),
+                                     chunk_size=chunk_size),
+            'pg2': lombscargle_tables(x_axis, np.linspace(62.8, 6283.2, 20))}
+
+def featvec_batch(x_axis, flux, mask=None, batch_size=500, tables=None):
+    """Version 0 feature vectors (see featvec()) of many light curves on the
+    same time axis, batch_size light curves at a time.
+    parameters:
+        * x_axis = time axis
+        * flux = array of light curves, shape (num_lc, len(x_axis))
+        * mask = boolean array shaped like flux, False for points to leave out
+            (e.g. sigma-clipped points). NaNs are always left out
+        * tables = featvec_tables(x_axis), to reuse the trig tables between
+            calls with the same time axis (or to change their chunk_size)
+    returns: array of feature vectors, shape (num_lc, 16). Features that
+        featvec() cannot compute (no relative maximum in a periodogram) are NaN
+    requires: featvec_tables(), lombscargle_batch(), lc_statistics()"""
+    x_axis = np.asarray(x_axis, dtype='float64')
+    if type(tables) == type(None):
+        tables = featvec_tables(x_axis)
+    periods = np.linspace(0.1, 10, 5000)
+    bands = [(457, 5000), (121, 457), (0, 121)] # >> 0.1-1, 1-3, 3-10 days
+    
+    features = np.empty((len(flux), 16))
+    for i in range(0, len(flux), batch_size):
+        y = np.asarray(flux[i:i+batch_size], dtype='float64')
+        m = np.isfinite(y)
+        if type(mask) != type(None):
+            m = m * np.asarray(mask[i:i+batch_size], dtype='bool')
+        lc_stats = lc_statistics(x_axis, y, mask=m, percentiles=[],
+                                 batch_size=len(y))
+        if np.all(m):
+            m = None
+        
+        #moments
+        moments = np.array([lc_stats['variance'], lc_stats['skewness'],
+                            lc_stats['kurtosis']]).T
+        features[i:i+batch_size, 0] = lc_stats['mean']
+        features[i:i+batch_size, 1:4] = moments
+        features[i:i+batch_size, 4:7] = np.log(np.abs(moments))
+        
+        #periods
+        for key, col in [('pg', 7), ('pg2', 15)]:
+            pg = lombscargle_batch(y, tables[key], mask=m)
+            # >> relative maxima, as argrelextrema(pg, np.greater)
+            peaks = (pg[:,1:-1] > pg[:,:-2]) * (pg[:,1:-1] > pg[:,2:])
+            peak_pg = np.where(peaks, pg[:,1:-1], -np.inf)
+            ind = np.argmax(peak_pg, axis=1)
+            max_power = np.where(np.any(peaks, axis=1),
+                                 peak_pg[np.arange(len(pg)), ind], np.nan)
+            period_max_power = np.where(np.any(peaks, axis=1),
+                                        2*np.pi / tables[key]['freqs'][ind+1],
+                                        np.nan)
+            if key == 'pg':
+                features[i:i+batch_size, 7] = max_power
+                features[i:i+batch_size, 8] = np.log(np.abs(max_power))
+                features[i:i+batch_size, 9] = period_max_power
+                
+                #integrates the whole 0.1-10 day range
+                for j, (start, end) in enumerate(bands):
+                    features[i:i+batch_size, 12+j] = \
+                        np.sum((pg[:,start+1:end] + pg[:,start:end-1]) * \
+                               np.diff(periods[start:end]), axis=1) / 2
+            else:
+                features[i:i+batch_size, 15] = period_max_power
+        
+        features[i:i+batch_size, 10] = lc_stats['slope']
+        features[i:i+batch_size, 11] = np.log(np.abs(lc_stats['slope']))
+        
+        print(str(min(i+batch_size, len(flux))) + " completed")
+    
+    return features
+
+# :: Feature cache :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Feature vectors are cached by content. Every light curve gets a 64-bit key
+# >> hashed from its identifier (e.g. TICID), sector, time axis and
+# >> preprocessed flux, so a changed light curve gets a new key. The cache of a
+# >> feature version and its parameters is the directory
+# >> cache_dir+'v<version>_<hash of parameters>/', with keys.npy,
+# >> features.npy and feature_cache_info.json (version, parameters and number
+# >> of rows), which is written last so that it never describes missing rows.
+
+def append_npy(fname, arr, num_rows=None):
+    '''Writes arr after the first num_rows rows of the .npy file fname (default
+    after all of its rows) and updates the shape in its header, without
+    reading the rows already in the file. Rows after num_rows, e.g. left by an
+    interrupted append, are overwritten.'''
+    with open(fname, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+        if fortran_order or arr.shape[1:] != tuple(shape[1:]):
+            raise ValueError('Can not append array of shape '+str(arr.shape)+\
+                             ' to '+fname)
+        if type(num_rows) == type(None):
+            num_rows = shape[0]
+        shape = (num_rows + len(arr),) + tuple(shape[1:])
+        header = io.BytesIO()
+        d = {'shape': shape, 'fortran_order': False,
+             'descr': np.lib.format.dtype_to_descr(dtype)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, d)
+        else:
+            np.lib.format.write_array_header_2_0(header, d)
+        if len(header.getvalue()) == offset:
+            row_size = int(np.prod(shape[1:], dtype='int64')) * dtype.itemsize
+            f.seek(offset + num_rows*row_size)
+            f.write(arr.tobytes())
+            f.truncate()
+            f.seek(0) # >> header last, so it never describes missing rows
+            f.write(header.getvalue())
+            return
+
+    # >> header grew (older numpy doesn't pad it), so rewrite the file
+    old = np.load(fname, mmap_mode='r')
+    new = np.lib.format.open_memmap(fname+'.tmp', mode='w+', dtype=dtype,
+                                    shape=shape)
+    for start in range(0, num_rows, 1000):
+        new[start:min(start+1000, num_rows)] = old[start:min(start+1000,
+                                                             num_rows)]
+    new[num_rows:] = arr
+    new.flush()
+    del old, new
+    os.replace(fname+'.tmp', fname)
+
+def feature_cache_subdir(cache_dir, version=0, params={}):
+    '''Directory of the cache of feature version version, computed with
+    params (dictionary of everything else the features depend on).'''
+    params = json.dumps(params, sort_keys=True, default=str)
+    params_hash = hashlib.blake2b(params.encode(), digest_size=8).hexdigest()
+    return cache_dir + 'v' + str(version) + '_' + params_hash + '/'
+
+def lc_keys(identifiers, time, flux, sector=None):
+    '''64-bit cache keys of light curves.
+    Parameters:
+        * identifiers : identifier of each light curve (TICID, Gaia ID, name),
+                        or None
+        * time : time axis of all light curves, or one time axis per light
+                 curve
+        * flux : light curves, as passed to the feature functions
+        * sector : sector number, or None
+    '''
+    identifiers = np.full(len(flux), '') if type(identifiers) == type(None) \
+        else np.asarray(identifiers)
+    if identifiers.dtype.kind in 'fiu': # >> 1234.0 and 1234 are the same
+        identifiers = identifiers.astype('int64')
+    shared_time = np.ndim(time[0]) == 0
+    if shared_time:
+        time_hash = hashlib.blake2b(np.ascontiguousarray(time, dtype='float64'),
+                                    digest_size=8).digest()
+    keys = np.empty(len(flux), dtype='uint64')
+    for i in range(len(flux)):
+        h = hashlib.blake2b(digest_size=8)
+        h.update((str(identifiers[i]) + '|' + str(sector) + '|').encode())
+        if shared_time:
+            h.update(time_hash)
+        else:
+            h.update(np.ascontiguousarray(time[i], dtype='float64'))
+        h.update(np.ascontiguousarray(flux[i], dtype='float64'))
+        keys[i] = np.frombuffer(h.digest(), dtype='uint64')[0]
+    return keys
+
+def open_feature_cache(subdir):
+    '''Returns the keys, feature vectors (memory-mapped) and info of the
+    feature cache in subdir (see feature_cache_subdir()), or None if it is
+    empty.'''
+    if not os.path.exists(subdir+'feature_cache_info.json'):
+        return None
+    with open(subdir+'feature_cache_info.json', 'r') as f:
+        info = json.load(f)
+    num_rows = info['num_rows']
+    keys = np.load(subdir+'keys.npy')[:num_rows]
+    features = np.load(subdir+'features.npy', mmap_mode='r')[:num_rows]
+    return keys, features, info
+
+def append_feature_cache(subdir, keys, features, version=0, params={}):
+    '''Adds feature vectors (with cache keys keys) to the feature cache in
+    subdir.'''
+    os.makedirs(subdir, exist_ok=True)
+    cache = open_feature_cache(subdir)
+    if type(cache) == type(None):
+        np.save(subdir+'keys.npy', np.asarray(keys, dtype='uint64'))
+        np.save(subdir+'features.npy', np.asarray(features, dtype='float64'))
+        num_rows = len(keys)
+    else:
+        num_rows = cache[2]['num_rows']
+        append_npy(subdir+'keys.npy', keys, num_rows=num_rows)
+        append_npy(subdir+'features.npy', features, num_rows=num_rows)
+        num_rows += len(keys)
+    info = {'version': version, 'params': params, 'num_rows': num_rows}
+    with open(subdir+'feature_cache_info.json', 'w') as f:
+        json.dump(info, f, default=str)
+
+def cached_features(identifiers, time, flux, compute, cache_dir, version=0,
+                    params={}, sector=None):
+    '''Feature vectors of light curves, looked up in the feature cache
+    (cache_dir, see above). Only light curves that are not in the cache are
+    computed, and their feature vectors are added to it.
+    Parameters:
+        * identifiers, time, flux, sector : see lc_keys()
+        * compute : function, compute(inds) returns the feature vectors of the
+                    light curves flux[inds]
+        * version, params : feature version and the parameters the features
+                            depend on (see feature_cache_subdir())
+    Returns:
+        * features : array of feature vectors, shape (len(flux),
+                     num_features)
+    '''
+    subdir = feature_cache_subdir(cache_dir, version, params)
+    keys = lc_keys(identifiers, time, flux, sector=sector)
+    cache = open_feature_cache(subdir)
+    rows = np.full(len(keys), -1)
+    if type(cache) != type(None) and len(cache[0]) > 0:
+        order = np.argsort(cache[0])
+        pos = np.minimum(np.searchsorted(cache[0], keys, sorter=order),
+                         len(order) - 1)
+        rows = np.where(cache[0][order[pos]] == keys, order[pos], -1)
+    
+    # >> compute every new light curve once
+    new = np.nonzero(rows == -1)[0]
+    new_keys, first, inverse = np.unique(keys[new], return_index=True,
+                                         return_inverse=True)
+    print(str(len(new_keys)) + ' of ' + str(len(keys)) + \
+          ' feature vectors not in ' + subdir)
+    if len(new_keys) > 0:
+        new_features = np.asarray(compute(new[first]), dtype='float64')
+        new_features = new_features.reshape(len(new_keys), -1)
+        append_feature_cache(subdir, new_keys, new_features, version, params)
+        cache = open_feature_cache(subdir)
+        rows[new] = cache[2]['num_rows'] - len(new_keys) + inverse.reshape(-1)
+    
+    return np.asarray(cache[1][rows])
+
+# :: Parallel TLS features :::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Version 1 (TLS) features take minutes per light curve, so
+# >> featvec_tls_parallel() runs featvec(v=1) on a pool of processes and
+# >> checkpoints every light curve in an SQLite database as soon as it is done.
+# >> A crashed or interrupted run started again with the same database skips
+# >> the light curves it already has (they are keyed by lc_keys(), so a changed
+# >> light curve is computed again). The database also caches the stellar
+# >> radius and mass of each TICID, which choose the TLS period grid (see
+# >> tls_grid_params()). They are taken from the TIC catalog if it is given;
+# >> targets that are not in it get the solar grid, unless query=True, which
+# >> queries catalog_info() once per target. Network errors fall back to the
+# >> solar grid as well (and are not cached, so they are queried again).
+# >> Each worker gets threads_per_worker threads (TLS use_threads, numba and
+# >> BLAS), so n_workers * threads_per_worker should be the number of cores.
+
+TLS_FEATURE_COLUMNS = ['period', 'duration', 'depth', 'power']
+
+def open_tls_db(db_file):
+    '''Opens (or creates) a TLS feature database. Returns an sqlite3
+    connection.'''
+    con = sqlite3.connect(db_file)
+    con.execute('CREATE TABLE IF NOT EXISTS stellar_params (ticid INTEGER '+\
+                'PRIMARY KEY, radius REAL, mass REAL)')
+    con.execute('CREATE TABLE IF NOT EXISTS tls_features (key TEXT PRIMARY '+\
+                'KEY, identifier TEXT, '+' REAL, '.join(TLS_FEATURE_COLUMNS)+\
+                ' REAL, time REAL)')
+    return con
+
+# >> errors of catalog_info() worth falling back on: connection errors and
+# >> timeouts (requests and urllib errors are OSErrors) and errors reported by
+# >> the service
+NETWORK_ERRORS = (OSError, RemoteServiceError)
+
+def tls_catalog_params(ticid, network_fallback=True):
+    '''Queries the stellar radius and mass of a TICID with catalog_info(). Both
+    are NaN (the solar grid, see tls_grid_params()) if the TICID is not in the
+    TIC, or if the query fails with a network error and network_fallback
+    (otherwise the error is raised).'''
+    from transitleastsquares import catalog_info
+    try:
+        ab, mass, mass_min, mass_max, radius, radius_min, radius_max = \
+            catalog_info(TIC_ID=int(ticid))
+    except IndexError:
+        return np.nan, np.nan
+    except NETWORK_ERRORS as e:
+        if not network_fallback:
+            raise
+        print('catalog_info() failed for TIC '+str(int(ticid))+' ('+str(e)+\
+              '), using solar values')
+        return np.nan, np.nan
+    params = [radius, mass]
+    for i in range(2):
+        if np.ma.is_masked(params[i]) or type(params[i]) == type(None):
+            params[i] = np.nan
+    return float(params[0]), float(params[1])
+
+def tls_stellar_params(ticid, con, catalog=None, query=False):
+    '''Stellar radius and mass of each TICID, from the TLS feature database.
+    TICIDs that are not in it are taken from catalog, or queried with
+    catalog_info() (if query), and added to the database.
+    Parameters:
+        * ticid : array of TICIDs
+        * con : returned by open_tls_db()
+        * catalog : dictionary with 'ID', 'rad' and 'mass' arrays, e.g.
+                    columns of the TIC catalog
+        * query : whether to query TICIDs that are neither in the database
+                  nor in catalog, one at a time (otherwise they are NaN)
+    Returns:
+        * params : array shape=(len(ticid), 2), radius and mass (NaN if
+                   unknown)
+    '''
+    ticid = np.asarray(ticid).astype('float').astype('int64')
+    params = np.full((len(ticid), 2), np.nan)
+    
+    # >> look up database
+    known = {}
+    unique = [int(t) for t in np.unique(ticid)]
+    for start in range(0, len(unique), 500):
+        chunk = unique[start:start+500]
+        query_str = 'SELECT ticid, radius, mass FROM stellar_params WHERE '+\
+            'ticid IN ('+','.join(['?']*len(chunk))+')'
+        for t, radius, mass in con.execute(query_str, chunk):
+            known[t] = (radius, mass)
+    
+    # >> add new TICIDs from catalog, then from catalog_info()
+    new = {}
+    if type(catalog) != type(None):
+        for t, radius, mass in zip(catalog['ID'], catalog['rad'],
+                                   catalog['mass']):
+            if int(t) > -1 and int(t) not in known:
+                new[int(t)] = (radius, mass)
+    con.executemany('INSERT OR REPLACE INTO stellar_params VALUES (?,?,?)',
+                    [(t, float(radius), float(mass)) \
+                     for t, (radius, mass) in new.items()])
+    con.commit()
+    known.update(new)
+    missing = [t for t in unique if t not in known]
+    if query and len(missing) > 0:
+        print('Querying stellar parameters of '+str(len(missing))+' targets')
+        for n, t in enumerate(missing):
+            try:
+                new[t] = tls_catalog_params(t, network_fallback=False)
+            except NETWORK_ERRORS as e:
+                print('Stopped querying stellar parameters ('+str(e)+\
+                      '), using solar values for the remaining targets')
+                break
+            con.execute('INSERT OR REPLACE INTO stellar_params VALUES '+\
+                        '(?,?,?)', (t, float(new[t][0]), float(new[t][1])))
+            con.commit() # >> so an interrupted run keeps its queries
+            if n % 100 == 0: print(str(n) + " completed")
+    known.update(new)
+    
+    for i in range(len(ticid)):
+        if int(ticid[i]) in known:
+            params[i] = known[int(ticid[i])]
+    return params
+
+def tls_grid_params(x_axis, radius, mass):
+    '''Returns the R_star, M_star (solar units) of the smallest TLS period
+    grid, out of the solar values and the star's radius or mass (NaN if
+    unknown).'''
+    from transitleastsquares import period_grid
+    dt = np.max(x_axis) - np.min(x_axis)
+    rm_set = [[1, 1]]
+    grid_lengths = [period_grid(1, 1, dt).shape[0]]
+    
+    if not np.isnan(radius):
+        grid_lengths.append(period_grid(radius, 1, dt).shape[0])
+        rm_set.append([radius, 1])
+    
+    if not np.isnan(mass):
+        grid_lengths.append(period_grid(1, mass, dt).shape[0])
+        rm_set.append([1, mass])
+    
+    return rm_set[np.argmin(grid_lengths)]
+
+def limit_threads(num_threads):
+    '''Worker initializer: limits the threads of numba and of the BLAS /
+    OpenMP libraries to num_threads. The libraries are loaded (numpy is
+    imported) before the initializer runs, so their thread pools are resized
+    with threadpoolctl; the environment variables only reach libraries that
+    are loaded later.'''
+    from threadpoolctl import threadpool_limits
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+    threadpool_limits(limits=num_threads)
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+def tls_featvec_worker(key, x_axis, flux, stellar_params, num_threads):
+    '''Version 1 feature vector of one light curve (NaNs are left out), run
+    by featvec_tls_parallel(). Light curves TLS fails on (with any error) get
+    NaNs.'''
+    flux = np.asarray(flux, dtype='float64')
+    valid = ~np.isnan(flux)
+    try:
+        features = featvec(x_axis[valid], flux[valid], v=1,
+                           stellar_params=stellar_params,
+                           use_threads=num_threads, show_progress_bar=False)
+    except Exception as e:
+        print('TLS failed on '+key+': '+type(e).__name__+': '+str(e))
+        features = [np.nan]*len(TLS_FEATURE_COLUMNS)
+    return key, features
+
+def featvec_tls_parallel(x_axis, flux, identifiers, db_file, stellar_params=None,
+                         n_workers=None, threads_per_worker=1,
+                         max_pending=None):
+    '''Version 1 (TLS) feature vectors of many light curves, computed in
+    parallel and checkpointed in db_file (see above).
+    Parameters:
+        * x_axis : time axis of all light curves, or one time axis per light
+                   curve
+        * flux : light curves (NaNs, e.g. sigma clipped points, are left out)
+        * identifiers : identifier (e.g. TICID) of each light curve, or None
+                        (the database then records row indices)
+        * db_file : TLS feature database (see open_tls_db())
+        * stellar_params : radius and mass of each light curve, returned by
+                           tls_stellar_params() (default solar)
+        * n_workers : number of processes (default is the number of CPUs
+                      divided by threads_per_worker)
+        * threads_per_worker : threads each process may use
+        * max_pending : number of light curves submitted to the workers at a
+                        time (default 2*n_workers), so that flux is not
+                        copied to the workers all at once
+    Light curves TLS fails on are recorded with NaN features.
+    Returns:
+        * features : array shape=(len(flux), 4), see TLS_FEATURE_COLUMNS
+    '''
+    import time
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    
+    if type(n_workers) == type(None):
+        n_workers = max(1, os.cpu_count() // threads_per_worker)
+    if type(max_pending) == type(None):
+        max_pending = 2*n_workers
+    if type(stellar_params) == type(None):
+        stellar_params = np.full((len(flux), 2), np.nan)
+    shared_time = np.ndim(x_axis[0]) == 0
+    keys = ['%016x'%key for key in lc_keys(identifiers, x_axis, flux)]
+    
+    # >> read checkpoint
+    con = open_tls_db(db_file)
+    done = {}
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start+500]
+        query = 'SELECT key, '+', '.join(TLS_FEATURE_COLUMNS)+\
+            ' FROM tls_features WHERE key IN ('+','.join(['?']*len(chunk))+')'
+        for row in con.execute(query, chunk):
+            done[row[0]] = row[1:]
+    todo = {}
+    for i, key in enumerate(keys):
+        if key not in done and key not in todo:
+            todo[key] = i
+    print(str(len(todo))+' of '+str(len(keys))+' light curves not in '+db_file)
+    
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=limit_threads,
+                                 initargs=(threads_per_worker,)) as executor:
+            # >> at most max_pending light curves in flight; flux is
+            # >> converted to float64 by the workers
+            queue = iter(todo.items())
+            pending = set()
+            n = 0
+            while True:
+                for key, i in queue:
+                    pending.add(executor.submit(
+                        tls_featvec_worker, key,
+                        np.asarray(x_axis if shared_time else x_axis[i]),
+                        np.asarray(flux[i]), stellar_params[i],
+                        threads_per_worker))
+                    if len(pending) >= max_pending:
+                        break
+                if len(pending) == 0:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, features = future.result()
+                    identifier = todo[key] if type(identifiers) == type(None) \
+                        else identifiers[todo[key]]
+                    con.execute('INSERT OR REPLACE INTO tls_features VALUES '+\
+                                '(?,?,?,?,?,?,?)',
+                                (key, str(identifier),
+                                 *[float(x) for x in features], time.time()))
+                    con.commit()
+                    done[key] = features
+                    if n % 25 == 0: print(str(n) + " completed")
+                    n += 1
+    con.close()
+    
+    return np.array([done[key] for key in keys], dtype='float64')
+
 ######### DEFUNCT
 
 def feature_gen_from_lc_fits(path, sector, feature_version=0):
@@ -33,6 +33,9 @@ import fnmatch
 from datetime import datetime
 import os
 import shutil
+import json
+import hashlib
+import warnings
 from scipy.stats import moment, sigmaclip
 
 import astropy
@@ -249,6 +252,536 @@ def load_group_from_fits(path, sector, camera, ccd):
     
     return time, intensities, targets
 
+# :: Target metadata :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> target_info is a structured array with one row per light curve:
+# >>   ticid (int64), sector, cam, ccd (uint8), and data_type, cadence (uint8
+# >>   codes, i.e. indices into DATA_TYPES and CADENCES)
+# >> e.g. target_info['cam'] gives the camera of every light curve.
+# >> The legacy target_info is a string array of [sector, cam, ccd, data_type,
+# >> cadence] for each light curve, shape=(num light curves, 5), and converts
+# >> both ways with to_target_info() and to_legacy_target_info().
+# >> Light curves combined from several sectors (combine_sectors_by_time_axis())
+# >> have one row per sector, shape=(num light curves, num sectors).
+
+DATA_TYPES = ['SPOC', 'FFI']
+CADENCES = ['2-minute', '20-second', '10-minute', '30-minute']
+TARGET_INFO_DTYPE = np.dtype([('ticid', 'int64'), ('sector', 'uint8'),
+                              ('cam', 'uint8'), ('ccd', 'uint8'),
+                              ('data_type', 'uint8'), ('cadence', 'uint8')])
+
+def make_target_info(ticid, sector, cam, ccd, data_type='SPOC',
+                     cadence='2-minute'):
+    '''Returns structured target_info (see above). sector, cam, ccd,
+    data_type and cadence can be given once for all light curves.'''
+    ticid = np.asarray(ticid).reshape(-1)
+    target_info = np.empty(len(ticid), dtype=TARGET_INFO_DTYPE)
+    target_info['ticid'] = ticid
+    target_info['sector'] = sector
+    target_info['cam'] = cam
+    target_info['ccd'] = ccd
+    target_info['data_type'] = category_codes(data_type, DATA_TYPES)
+    target_info['cadence'] = category_codes(cadence, CADENCES)
+    return target_info
+
+def category_codes(values, categories):
+    '''Returns the index of each value in categories.'''
+    values = np.asarray(values, dtype='str')
+    unique, inverse = np.unique(values, return_inverse=True)
+    unknown = [v for v in unique if v not in categories]
+    if len(unknown) > 0:
+        raise ValueError('Unknown categories: ' + ', '.join(unknown))
+    codes = np.array([categories.index(v) for v in unique], dtype='uint8')
+    return codes[inverse].reshape(values.shape)
+
+def is_structured_target_info(target_info):
+    '''Checks if target_info is structured (see above).'''
+    return type(target_info) == np.ndarray and \
+        target_info.dtype.names == TARGET_INFO_DTYPE.names
+
+def to_target_info(target_info, ticid=None):
+    '''Converts legacy target_info (string array of [sector, cam, ccd,
+    data_type, cadence]) to structured target_info. Structured target_info is
+    returned as it is.
+    Parameters:
+        * target_info : shape=(num light curves, 5)
+        * ticid : TICID of each light curve (set to 0 if not given)
+    '''
+    if is_structured_target_info(target_info):
+        return target_info
+    target_info = np.asarray(target_info, dtype='str').reshape(-1, 5)
+    if type(ticid) == type(None):
+        ticid = np.zeros(len(target_info), dtype='int64')
+    for col in range(3):
+        if not all([v.isdigit() and int(v) < 256 for v in \
+                    np.unique(target_info[:,col])]):
+            # >> e.g. target_info from combine_sectors_by_time_axis() before
+            # >> it was structured
+            raise ValueError('Can not convert ' + str(target_info[0]) + \
+                             ' to structured target_info')
+    return make_target_info(np.asarray(ticid).astype('int64'),
+                            target_info[:,0].astype('int'),
+                            target_info[:,1].astype('int'),
+                            target_info[:,2].astype('int'),
+                            target_info[:,3], target_info[:,4])
+
+def to_legacy_target_info(target_info):
+    '''Converts structured target_info to the legacy string array of [sector,
+    cam, ccd, data_type, cadence]. Legacy target_info is returned as it is.'''
+    if not is_structured_target_info(target_info):
+        return np.asarray(target_info)
+    target_info = target_info.reshape(-1)
+    return np.array([target_info['sector'].astype('str'),
+                     target_info['cam'].astype('str'),
+                     target_info['ccd'].astype('str'),
+                     np.array(DATA_TYPES)[target_info['data_type']],
+                     np.array(CADENCES)[target_info['cadence']]]).T
+
+def target_info_fields(target_info):
+    '''Returns sector, cam, ccd (int), data_type, cadence (str) of one light
+    curve, from either a row of structured target_info or legacy target_info.
+    For light curves combined from several sectors, returns the fields of the
+    first sector.'''
+    if isinstance(target_info, (np.void, np.ndarray)) and \
+        target_info.dtype.names == TARGET_INFO_DTYPE.names:
+        target_info = target_info.reshape(-1)[0]
+        return int(target_info['sector']), int(target_info['cam']), \
+            int(target_info['ccd']), DATA_TYPES[target_info['data_type']], \
+            CADENCES[target_info['cadence']]
+    sector, cam, ccd, data_type, cadence = np.asarray(target_info)[:5]
+    return int(sector), int(cam), int(ccd), str(data_type), str(cadence)
+
+# :: TICID index :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Joins on TICID: build the index of a TICID-keyed table (catalog, features,
+# >> bottleneck, labels) once with ticid_index(), then ticid_lookup() gives
+# >> the row of every TICID in one vectorized search, e.g.
+# >>     index = ticid_index(catalog['ID'])
+# >>     rows = ticid_lookup(index, ticid)
+# >>     catalog_rows = catalog.iloc[rows[rows > -1]]
+
+def ticid_index(ticid):
+    '''Sorted index over the TICID column of a table (given as float or int).
+    Returns:
+        * index : dictionary with sorted TICIDs ('ticid') and their rows
+                  ('rows')
+    '''
+    ticid = np.asarray(ticid).reshape(-1).astype('int64')
+    order = np.argsort(ticid, kind='stable')
+    return {'ticid': ticid[order], 'rows': order}
+
+def ticid_lookup(index, ticid, missing=-1):
+    '''Returns the row of each TICID in the table the index was built from
+    (the first row, if the TICID is repeated), and missing for TICIDs that
+    are not in the table.'''
+    ticid = np.asarray(ticid).astype('int64')
+    if len(index['ticid']) == 0:
+        return np.full(ticid.shape, missing, dtype='int64')
+    pos = np.searchsorted(index['ticid'], ticid)
+    pos = np.minimum(pos, len(index['ticid']) - 1)
+    found = index['ticid'][pos] == ticid
+    return np.where(found, index['rows'][pos], missing)
+
+def update_ticid_index(index, ticid, rows):
+    '''Adds TICIDs in rows of a table (e.g. rows appended to it) to an index
+    returned by ticid_index(), by merging instead of sorting the whole table
+    again. Rows already in the index stay first for repeated TICIDs.'''
+    ticid = np.asarray(ticid).reshape(-1).astype('int64')
+    rows = np.asarray(rows).reshape(-1).astype('int64')
+    order = np.argsort(ticid, kind='stable')
+    pos = np.searchsorted(index['ticid'], ticid[order], side='right')
+    return {'ticid': np.insert(index['ticid'], pos, ticid[order]),
+            'rows': np.insert(index['rows'], pos, rows[order])}
+
+def ticid_join(ticid_table, ticid, missing=-1):
+    '''Same as ticid_lookup(ticid_index(ticid_table), ticid), for one-off
+    joins.'''
+    return ticid_lookup(ticid_index(ticid_table), ticid, missing=missing)
+
+# :: Light curve store :::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> A sector's light curve store is a directory with one .npy file per array,
+# >> so that np.load(..., mmap_mode='r') maps it without reading it into RAM:
+# >>   * time.npy        : shape=(num data points)
+# >>   * flux.npy        : shape=(num light curves, num data points). Stored
+# >>                       row-major, so each light curve is contiguous on disk
+# >>                       and reading a subset of targets only reads those rows
+# >>   * ticid.npy       : int64, shape=(num light curves)
+# >>   * target_info.npy : structured target_info (see make_target_info()),
+# >>                       shape=(num light curves)
+# >>   * nan_mask.npy    : bit-packed NaN mask of flux (see pack_nan_mask()),
+# >>                       so NaN masks are computed without reading flux
+# >>   * ticid_index.npy : rows of the store sorted by TICID (see ticid_index())
+# >>   * store_info.json : shape, dtype, chunk size and row range of each group
+# >>                       (written last, so a half-converted store is ignored)
+# >> Stores written by bulk_download_to_store() in main/data_functions.py also
+# >> have
+# >>   * cols.npy        : index of each data point in the _lc.fits time axis
+# >>   * ingested_files.txt : _lc.fits files in the store (see ingest_to_store())
+# >> and their store_info.json records the normalization of flux (norm_type,
+# >> 'none' unless asked for)
+
+# >> number of bits set in each uint8
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype='uint8')
+
+def pack_nan_mask(flux):
+    '''Bit-packed NaN mask (8 data points per byte) of each light curve.
+    Returns:
+        * packed : uint8, shape=(num light curves, ceil(num data points / 8))
+    '''
+    return np.packbits(np.isnan(flux), axis=1)
+
+def write_store_info(store_dir, info):
+    '''Writes store_info.json atomically (temporary file, then renamed), so
+    an interrupted write leaves the previous store_info.json.'''
+    with open(store_dir+'store_info.json.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(store_dir+'store_info.json.tmp', store_dir+'store_info.json')
+
+def get_lc_store_dir(data_dir, sector, fast=False):
+    '''Returns the light curve store directory for a sector.'''
+    if fast:
+        return data_dir + 'Sector{sector}_20s/Sector{sector}_store/'.format(sector=sector)
+    else:
+        return data_dir + 'Sector{sector}/Sector{sector}_store/'.format(sector=sector)
+
+def convert_metafiles_to_store(data_dir, sector, cams=[1,2,3,4],
+                               ccds=[[1,2,3,4]]*4, data_type='SPOC',
+                               cadence='2-minute', fast=False, store_dir=None,
+                               chunk_size=1000):
+    '''Copies the SectorXCamXCCDX_lightcurves.fits metafiles of a sector into
+    a single light curve store (see above). Flux is copied chunk_size rows at a
+    time from memory-mapped fits files, so peak memory is set by chunk_size
+    rather than the size of the sector.
+    Parameters:
+        * data_dir, sector, cams, ccds, data_type, cadence, fast : same as
+          load_data_from_metafiles()
+        * store_dir : output directory, default is get_lc_store_dir()
+        * chunk_size : number of light curves copied at a time
+    Returns:
+        * store_dir
+    '''
+    if type(store_dir) == type(None):
+        store_dir = get_lc_store_dir(data_dir, sector, fast=fast)
+    os.makedirs(store_dir, exist_ok=True)
+
+    # >> get file names for each group
+    fnames = []
+    fname_info = []
+    for i in range(len(cams)):
+        cam = cams[i]
+        for ccd in ccds[i]:
+            if fast:
+                s = 'Sector{sector}_20s/Sector{sector}Cam{cam}CCD{ccd}/' + \
+                    'Sector{sector}Cam{cam}CCD{ccd}_lightcurves.fits'
+            else:
+                s = 'Sector{sector}/Sector{sector}Cam{cam}CCD{ccd}/' + \
+                    'Sector{sector}Cam{cam}CCD{ccd}_lightcurves.fits'
+            fnames.append(s.format(sector=sector, cam=cam, ccd=ccd))
+            fname_info.append([sector, cam, ccd, data_type, cadence])
+
+    # >> read shapes from headers only
+    num_rows = []
+    for i in range(len(fnames)):
+        with fits.open(data_dir + fnames[i], memmap=True) as hdul:
+            if i == 0:
+                x = np.array(hdul[0].data)
+                dtype = hdul[1].data.dtype.newbyteorder('=')
+            if hdul[1].header['NAXIS1'] != len(x):
+                raise ValueError(fnames[i] + ' has a different time axis')
+            num_rows.append(hdul[1].header['NAXIS2'])
+
+    # >> copy flux into store chunk by chunk
+    print('Writing light curve store to ' + store_dir)
+    flux = np.lib.format.open_memmap(store_dir+'flux.npy', mode='w+',
+                                     dtype=dtype,
+                                     shape=(int(np.sum(num_rows)), len(x)))
+    nan_mask = np.lib.format.open_memmap(store_dir+'nan_mask.npy', mode='w+',
+                                         dtype='uint8',
+                                         shape=(len(flux), (len(x)+7)//8))
+    ticid = []
+    target_info = []
+    groups = []
+    row = 0
+    for i in range(len(fnames)):
+        print('Converting ' + fnames[i] + '...')
+        with fits.open(data_dir + fnames[i], memmap=True) as hdul:
+            for start in range(0, num_rows[i], chunk_size):
+                stop = min(start + chunk_size, num_rows[i])
+                flux[row+start:row+stop] = hdul[1].data[start:stop]
+                nan_mask[row+start:row+stop] = \
+                    pack_nan_mask(flux[row+start:row+stop])
+            ticid.append(np.array(hdul[2].data).astype('int64'))
+            target_info.append(make_target_info(ticid[-1], *fname_info[i]))
+        groups.append([int(fname_info[i][1]), int(fname_info[i][2]),
+                       int(row), int(row + num_rows[i])])
+        row += num_rows[i]
+    flux.flush()
+    nan_mask.flush()
+    del flux, nan_mask
+
+    np.save(store_dir+'time.npy', x)
+    np.save(store_dir+'ticid.npy', np.concatenate(ticid))
+    np.save(store_dir+'target_info.npy', np.concatenate(target_info))
+    np.save(store_dir+'ticid_index.npy',
+            ticid_index(np.concatenate(ticid))['rows'])
+
+    store_info = {'sector': sector, 'data_type': data_type,
+                  'cadence': cadence, 'shape': [int(row), len(x)],
+                  'dtype': dtype.str, 'chunk_size': chunk_size,
+                  'groups': groups}
+    write_store_info(store_dir, store_info)
+
+    return store_dir
+
+def open_lc_store(store_dir, mode='r'):
+    '''Memory-maps a light curve store. Slicing store['flux'] only reads the
+    requested rows (and columns) from disk.
+    Parameters:
+        * store_dir : directory written by convert_metafiles_to_store()
+        * mode : mmap_mode passed to np.load ('r', 'r+' or 'c')
+    Only the rows counted in store_info.json are returned: rows appended by
+    an interrupted ingest_to_store() are ignored, and the TICID index is
+    rebuilt if it does not match them.
+    Returns:
+        * store : dictionary with keys 'time', 'flux', 'ticid', 'target_info'
+                  'index' (see ticid_index()) and 'info' (contents of
+                  store_info.json), and 'nan_mask' if the store has one
+    '''
+    if not os.path.exists(store_dir+'store_info.json'):
+        raise OSError('No light curve store in ' + store_dir)
+    store = {}
+    with open(store_dir+'store_info.json', 'r') as f:
+        store['info'] = json.load(f)
+    num_rows = store['info']['shape'][0]
+    store['dir'] = store_dir
+    store['time'] = np.load(store_dir+'time.npy')
+    store['flux'] = np.load(store_dir+'flux.npy', mmap_mode=mode)[:num_rows]
+    store['ticid'] = np.load(store_dir+'ticid.npy')[:num_rows]
+    # >> stores written before structured target_info have string arrays
+    store['target_info'] = \
+        to_target_info(np.load(store_dir+'target_info.npy')[:num_rows],
+                       store['ticid'])
+    if os.path.exists(store_dir+'nan_mask.npy'):
+        store['nan_mask'] = np.load(store_dir+'nan_mask.npy',
+                                    mmap_mode=mode)[:num_rows]
+    rows = None
+    if os.path.exists(store_dir+'ticid_index.npy'):
+        rows = np.load(store_dir+'ticid_index.npy')
+    if type(rows) != type(None) and len(rows) == num_rows:
+        store['index'] = {'ticid': store['ticid'][rows], 'rows': rows}
+    else:
+        store['index'] = ticid_index(store['ticid'])
+    return store
+
+def iterate_lc_store(store, rows=None, cols=None, chunk_size=None):
+    '''Yields (row indices, flux) for chunk_size light curves at a time.
+    Parameters:
+        * store : returned by open_lc_store()
+        * rows : indices of light curves to read (default all)
+        * cols : indices of data points to read (default all)
+        * chunk_size : default is the chunk size the store was written with
+    '''
+    if type(chunk_size) == type(None):
+        chunk_size = store['info']['chunk_size']
+    if type(rows) == type(None):
+        rows = np.arange(store['flux'].shape[0])
+    for start in range(0, len(rows), chunk_size):
+        rows_chunk = rows[start:start+chunk_size]
+        if len(rows_chunk) > 0 and \
+            rows_chunk[-1] - rows_chunk[0] == len(rows_chunk) - 1:
+            flux = np.asarray(store['flux'][rows_chunk[0]:rows_chunk[-1]+1])
+        else: # >> only reads the requested rows
+            flux = store['flux'][rows_chunk]
+        if type(cols) != type(None):
+            flux = flux[:,cols]
+        yield rows_chunk, flux
+
+def nan_mask_store(store, rows=None, cols=None, output_dir='./',
+                   prefix='', tol1=0.05, tol2=0.5, use_tol2=True,
+                   chunk_size=None, col_nan=None, num_nan=None, plot=False):
+    '''Same NaN mask as nan_mask(), but computed chunk by chunk from the light
+    curve store instead of on an in-memory flux array.
+    Parameters:
+        * store : returned by open_lc_store()
+        * rows : indices of light curves to consider (default all)
+        * cols : indices of data points to consider, i.e. with the custom mask
+                 already removed (default all)
+        * tol1, tol2, use_tol2 : see nan_mask()
+        * col_nan, num_nan : whether each of cols has a NaN and number of NaNs
+                             in each of rows, if already counted while writing
+                             the store (skips the first pass)
+        * plot : if True, plots a histogram of the number of data points
+                 masked in each light curve
+    If the store has a packed NaN mask, flux is not read.
+    Returns:
+        * rows : indices of light curves that are kept
+        * cols : indices of data points that are kept
+    '''
+    if type(rows) == type(None):
+        rows = np.arange(store['flux'].shape[0])
+    if type(cols) == type(None):
+        cols = np.arange(store['flux'].shape[1])
+
+    def column_mask(rows):
+        if 'nan_mask' in store.keys(): # >> only read packed NaN mask
+            if type(chunk_size) == type(None):
+                step = store['info']['chunk_size']
+            else:
+                step = chunk_size
+            n = store['flux'].shape[1]
+            keep_cols = np.packbits(np.isin(np.arange(n), cols))
+            packed_col = np.zeros(len(keep_cols), dtype='uint8')
+            num_nan = []
+            for start in range(0, len(rows), step):
+                packed = store['nan_mask'][rows[start:start+step]] & keep_cols
+                packed_col |= np.bitwise_or.reduce(packed, axis=0)
+                num_nan.append(np.sum(POPCOUNT[packed], axis=1,
+                                      dtype='int64'))
+            col_nan = np.unpackbits(packed_col, count=n).astype('bool')[cols]
+            return col_nan, np.concatenate(num_nan + [np.empty(0, 'int64')])
+        
+        col_nan = np.zeros(len(cols), dtype='bool')
+        num_nan = np.empty(len(rows), dtype='int')
+        start = 0
+        for rows_chunk, flux in iterate_lc_store(store, rows, cols,
+                                                 chunk_size=chunk_size):
+            isnan = np.isnan(flux)
+            col_nan |= np.any(isnan, axis=0)
+            num_nan[start:start+len(rows_chunk)] = np.sum(isnan, axis=1)
+            start += len(rows_chunk)
+        return col_nan, num_nan
+    if type(col_nan) == type(None) or type(num_nan) == type(None):
+        col_nan, num_nan = column_mask(rows)
+
+    # >> every NaN in a light curve is in the mask, so the number of data
+    # >> points each light curve loses is the rest of the mask
+    num_masked = np.count_nonzero(col_nan) - num_nan
+    if plot:
+        plt.figure()
+        plt.hist(num_masked, bins=50)
+        plt.ylabel('number of light curves')
+        plt.xlabel('number of data points masked')
+        plt.savefig(output_dir + 'nan_mask.png')
+        plt.close()
+
+    # >> check if only a few light curves contribute to NaN mask
+    worst_inds = np.nonzero( num_nan > tol2*len(cols) )[0]
+    if len(worst_inds)>0 and len(worst_inds)<tol1*len(rows) and use_tol2:
+        with open(output_dir+prefix+'removed_light_curves.txt', 'w') as f:
+            for i in range(len(worst_inds)):
+                f.write('TIC '+ str(store['ticid'][rows[worst_inds[i]]])+'\n')
+
+        print('Removing '+str(len(worst_inds))+' light curves')
+        rows = np.delete(rows, worst_inds)
+
+        # >> and calculate new mask
+        col_nan, num_nan = column_mask(rows)
+
+    return rows, cols[np.nonzero(~col_nan)]
+
+def load_data_from_store(data_dir, sector, cams=[1,2,3,4],
+                         ccds=[[1,2,3,4]]*4, data_type='SPOC',
+                         cadence='2-minute', DEBUG=False, fast=False,
+                         output_dir='./', debug_ind=0,
+                         nan_mask_check=True,
+                         custom_mask=[], store_dir=None, targets=None,
+                         time_window=None, chunk_size=None):
+    '''Drop-in replacement for load_data_from_metafiles() that reads from the
+    sector's light curve store (converting the metafiles the first time).
+    The returned flux is a read-only memory map, so sectors larger than RAM
+    can be loaded. When a NaN mask or a selection is applied, the selected
+    flux is written once into the store (flux_<key>.npy) and re-used by later
+    calls with the same selection.
+
+    If DEBUG, plots light curve debug_ind after the NaN mask (and the
+    histogram of masked data points) in output_dir, like nan_mask().
+
+    Parameters (in addition to load_data_from_metafiles()):
+        * store_dir : default is get_lc_store_dir()
+        * targets : list of TICIDs to load (default all)
+        * time_window : (tmin, tmax), only loads data points in this window
+        * chunk_size : number of light curves read at a time
+
+    Returns:
+        * flux, x, ticid, target_info : same as load_data_from_metafiles(), so
+          target_info is converted back to the legacy string array (see
+          to_legacy_target_info()) for the plotting functions here
+    '''
+    if type(store_dir) == type(None):
+        store_dir = get_lc_store_dir(data_dir, sector, fast=fast)
+    if not os.path.exists(store_dir+'store_info.json'):
+        convert_metafiles_to_store(data_dir, sector, data_type=data_type,
+                                   cadence=cadence, fast=fast,
+                                   store_dir=store_dir)
+    store = open_lc_store(store_dir)
+    x = store['time']
+    if store['info'].get('norm_type', 'none') != 'none':
+        warnings.warn('Light curve store in '+store_dir+' holds normalized '+\
+                      'flux (norm_type='+store['info']['norm_type']+\
+                      '), unlike load_data_from_metafiles()')
+
+    # >> select groups and targets
+    target_info = store['target_info']
+    group_mask = np.zeros(len(target_info), dtype='bool')
+    for i in range(len(cams)):
+        for ccd in ccds[i]:
+            group_mask |= (target_info['cam'] == cams[i]) * \
+                (target_info['ccd'] == ccd)
+    if type(targets) != type(None):
+        group_mask *= np.isin(store['ticid'], targets)
+    rows = np.nonzero(group_mask)[0]
+
+    # >> select data points
+    cols = np.delete(np.arange(len(x)), custom_mask)
+    if len(custom_mask) > 0: print('Applying custom NaN mask')
+    if type(time_window) != type(None):
+        cols = cols[np.nonzero((x[cols] >= time_window[0]) * \
+                               (x[cols] <= time_window[1]))]
+
+    # >> apply nan mask
+    if nan_mask_check:
+        print('Applying nan mask')
+        rows, cols = nan_mask_store(store, rows, cols, output_dir=output_dir,
+                                    chunk_size=chunk_size, plot=DEBUG)
+
+    if len(rows) == store['flux'].shape[0] and len(cols) == len(x):
+        flux = store['flux']
+    else:
+        # >> write selection into the store, unless already there. The key
+        # >> includes the number of rows and the time the store was last
+        # >> written, so re-ingesting or extending the store invalidates it
+        version = '%d_%d'%(store['flux'].shape[0],
+                           os.stat(store_dir+'store_info.json').st_mtime_ns)
+        key = hashlib.md5(rows.astype('int64').tobytes() + \
+                          cols.astype('int64').tobytes() + \
+                          version.encode()).hexdigest()[:12]
+        fname = store_dir + 'flux_' + key + '.npy'
+        if not os.path.exists(fname):
+            print('Writing selected light curves to ' + fname)
+            flux = np.lib.format.open_memmap(fname+'.tmp', mode='w+',
+                                             dtype=store['flux'].dtype,
+                                             shape=(len(rows), len(cols)))
+            start = 0
+            for rows_chunk, flux_chunk in iterate_lc_store(store, rows, cols,
+                                                           chunk_size=chunk_size):
+                flux[start:start+len(rows_chunk)] = flux_chunk
+                start += len(rows_chunk)
+            flux.flush()
+            del flux
+            os.rename(fname+'.tmp', fname)
+        flux = np.load(fname, mmap_mode='r')
+
+    # >> debugging plot (same as nan_mask()), only reads one light curve
+    if DEBUG and len(rows) > 0:
+        fig, ax = plt.subplots()
+        ax.plot(x[cols], flux[min(debug_ind, len(rows)-1)], '.k')
+        ax.set_title('removed orbit gap')
+        fig.tight_layout()
+        fig.savefig(output_dir + 'nanmask_debug.png', bbox_inches='tight')
+        plt.close(fig)
+
+    return flux, x[cols], store['ticid'][rows].astype('float'), \
+        to_legacy_target_info(target_info[rows])
+
+
 def data_access_sector_by_bulk(yourpath, sectorfile, sector,
                                bulk_download_dir, custom_mask=[],
                                apply_nan_mask=False):
@@ -167,8 +167,23 @@ class mergen(object):
 
 
     def spoc_load_lc_from_metafiles(self, DEBUG=False, debug_ind=0,
-                                    nan_mask_check=True, custom_mask=[]):
-    
+                                    nan_mask_check=True, custom_mask=[],
+                                    use_store=False):
+        """ use_store : if True, memory-maps the light curves from the sector's
+        light curve store (converting the metafiles the first time) instead of
+        reading every metafile into memory """
+        if use_store:
+            print("Loading in SPOC light curves from light curve store")
+            # >> datapath is the Sector folder, the store lives inside it
+            data_dir = os.path.dirname(os.path.normpath(self.datapath)) + '/'
+            self.flux, self.time, self.identifiers, self.target_info = \
+                da.load_data_from_store(data_dir, self.sector, cams=self.cams,
+                                        ccds=self.ccds, cadence=self.cadence,
+                                        DEBUG=DEBUG, output_dir=self.savepath,
+                                        debug_ind=debug_ind,
+                                        nan_mask_check=nan_mask_check,
+                                        custom_mask=custom_mask)
+            return
         
         fnames = []
         print("Loading in SPOC light curves from folder")
@@ -278,8 +293,14 @@ class mergen(object):
         return residuals, components
      
 
-    def create_ENF_features(self, version=0, save=True):
-        """ documentation """
+    def create_ENF_features(self, version=0, save=True, n_workers=None,
+                            threads_per_worker=1, catalog=None, query=False):
+        """ documentation
+        n_workers, threads_per_worker : processes and threads per process of
+        the version 1 (TLS) features, see enf.featvec_tls_parallel()
+        catalog, query : TIC stellar radius and mass for the TLS period grids,
+        and whether to query the targets that are not in catalog, see
+        enf.tls_stellar_params() """
         fname_features = self.ENFpath + "features_v"+str(version)+".fits"
         feature_list = []
         if version == 0:
@@ -294,35 +315,43 @@ class mergen(object):
         print("Begining Feature Vector Creation Now")
         #sigma clip each time you calculate - unsure how better to do this??
         sigclip = SigmaClip(sigma=5, maxiters=None, cenfunc='median')
-        for n in range(len(self.flux)):
-            
-            times = self.time
-            ints = self.flux[n]
-            
-            clipped_inds = np.nonzero(np.ma.getmask(sigclip(ints)))
-            ints[clipped_inds] = np.nan
-            delete_index = np.argwhere(np.isnan(ints))
-            times = np.delete(times, delete_index)
-            ints = np.delete(ints, delete_index)
-            
-            try:
-                feature_vector = enf.featvec(times, ints, v=version)
-            except ValueError:
-                print("it did the stupid thing where it freaked out about one light curve and idk why")
-            
-            if version == 1:
-                feature_vector = np.nan_to_num(feature_vector, nan=0)
-                with open(self.ENFpath + 'intermediate_v1_saving.txt', 'a') as f:
-                    f.write('{} {} \n'.format(self.identifiers[n], feature_vector))
-            feature_list.append(feature_vector)
-            
+        def compute(inds):
             if version == 0:
-                if n % 500 == 0: 
-                    print(str(n) + " completed")
-                if self.cadence == "20_s" and n % 20 == 0:
-                    print(str(n) + " completed")
-            elif version == 1:
-                print(str(n))
+                # >> clip all light curves at once and leave the clipped
+                # >> points out of the batched feature vectors
+                flux = self.flux[inds]
+                clipped = np.ma.getmaskarray(sigclip(flux, axis=1))
+                flux[clipped] = np.nan
+                return enf.featvec_batch(self.time, flux, mask=~clipped)
+            # >> TLS features run in parallel and are checkpointed per light
+            # >> curve, so a crashed run resumes where it stopped
+            flux = self.flux[inds]
+            flux[np.ma.getmaskarray(sigclip(flux, axis=1))] = np.nan
+            db_file = self.ENFpath + 'tls_features.db'
+            stellar_params = None
+            if self.datatype == "SPOC": # >> identifiers are TICIDs
+                con = enf.open_tls_db(db_file)
+                stellar_params = enf.tls_stellar_params(self.identifiers[inds],
+                                                        con, catalog=catalog,
+                                                        query=query)
+                con.close()
+            feature_list = enf.featvec_tls_parallel(self.time, flux,
+                                                    self.identifiers[inds],
+                                                    db_file,
+                                                    stellar_params=stellar_params,
+                                                    n_workers=n_workers,
+                                                    threads_per_worker=threads_per_worker)
+            return np.nan_to_num(feature_list, nan=0)
+        
+        # >> only light curves that are new or changed since the last run are
+        # >> computed, the rest are read from the feature cache
+        feature_list = enf.cached_features(self.identifiers, self.time,
+                                           self.flux, compute,
+                                           self.ENFpath + 'feature_cache/',
+                                           version=version,
+                                           params={'datatype': self.datatype,
+                                                   'sigma': 5},
+                                           sector=self.sector)
         
         self.features = np.asarray(feature_list)
         
@@ -330,7 +359,7 @@ class mergen(object):
             hdr = fits.Header()
             hdr["VERSION"] = version
             hdu = fits.PrimaryHDU(feature_list, header=hdr)
-            hdu.writeto(fname_features)
+            hdu.writeto(fname_features, overwrite=True)
         else: 
             print("Not saving feature vectors to fits")
         return   
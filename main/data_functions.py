@@ -10,12 +10,26 @@ Data access
 * load_data_from_metafiles()    : loads LC from ALL metafiles for sector and
                                   applies NaN mask
 * load_group_from_fits()        : loads LC for one group's fits files
+* convert_metafiles_to_store()  : converts a sector's metafiles into a
+                                  memory-mapped light curve store
+* open_lc_store()               : memory-maps a sector's light curve store
+* load_data_from_store()        : drop-in replacement for
+                                  load_data_from_metafiles() using the store
+* combine_sectors_by_time_axis() : concatenates N sectors in time, keeping
+                                   targets with consistent high-pass RMS
+* combine_sectors_by_lc()  : concatenates N sectors along the light curve axis
 * data_access_sector_by_bulk()
 * data_access_by_group_fits()
 * bulk_download_helper()
-* follow_up_on_missed_targets_fits()
+* follow_up_on_missed_targets_fits() : retries targets that failed to download
+* index_bulk_download()    : TICID -> file name index of a bulk download
+* lc_from_bulk_download()  : reads a group's _lc.fits files in parallel
+* bulk_download_to_store() : bounded-memory bulk download -> light curve store
+* ingest_to_store()        : appends new _lc.fits files to a light curve store
 * lc_from_target_list()    : Pulls all light curves from a list of TICs
 * get_lc_file_and_data()        : Pulls a light curve's fits file by TIC
+* download_mast_lcs()  : concurrent, resumable, cached lc.fits downloads
+* mast_lc_urls()       : queries the MAST API for a target's lc.fits URLs
 * tic_list_by_magnitudes        : Gets list of TICs for upper/lower mag. bounds
                         
 Data processing
@@ -23,17 +37,43 @@ Data processing
 * mean_norm() 	    : mean normalization (for TLS)
 * interpolate_all() : sigma clip and interpolate flux array
 * interpolate_lc()  : sigma clip and interpolate one light curve
+* interpolate_batch() : interpolate_lc() for many light curves at once
+* benchmark_interpolate_all() : per light curve vs. batched interpolate_all()
 * nan_mask()        : apply NaN mask to flux array
+* make_target_info()  : structured target_info (TICID, sector, cam, ccd, ...)
+* to_target_info(), to_legacy_target_info() : convert legacy target_info
+* ticid_index(), ticid_lookup() : vectorized joins on TICID
+* update_ticid_index()  : adds appended rows to a TICID index
+* compute_nan_mask() : NaN mask from bit-packed NaN masks (pack_nan_mask())
 
 Engineered features
 * create_save_featvec()     : creates and saves a fits file containing all features
 * featvec()                 : creates a single feature vector for a LC
+* featvec_batch()           : version 0 feature vectors of many LCs at once
+* lc_statistics()           : moments, slope and percentiles of many LCs
+* lombscargle_batch()       : periodograms of many LCs on one time axis
+* benchmark_featvec()       : per LC vs. batched version 0 features
+* cached_features()         : feature vectors from a content-addressed cache,
+                              computing only new or changed LCs
+* featvec_tls_parallel()    : parallel, checkpointed version 1 (TLS) features
+* tls_stellar_params()      : cached stellar radius and mass for TLS
+* cached_psd()              : per sector store of CAE input PSDs
+* gls_batch()               : floating mean periodograms of many LCs at once
 * feature_gen_from_lc_fits()    : creates features for all of a sector
 * get_tess_features : queries Teff, rad, mass, GAIAmag, d 
                       !! query objType from Simbad
 * get_tess_feature_txt : queries TESS features (Teff, rad, etc.) for a sector
 * build_simbad_database : queries bibcode and object type for TESS objects
+* open_xmatch_cache()   : SQLite cache of SIMBAD, Vizier and TIC queries
+* simbad_xmatch(), vizier_query_region() : batched SIMBAD / Vizier queries
+* offline_gcvs_xmatch() : labels a sector from a local GCVS catalogue
+* convert_tic_catalog() : converts the CTL/TIC extract into a columnar store
+* tic_gather()          : catalog columns for an array of TICIDs
 * dbscan_param_search : performs grid search for DBSCAN
+* contingency_matrix(), match_clusters() : optimal cluster -> label matching
+* assign_clusters()     : assigns clusters to labels and scores them
+* load_label_db()       : columnar database of the ground truth labels
+* get_label_codes()     : parent class codes for an array of TICIDs
 
 Depreciated Functions
 * load_group_from_txt()
@@ -52,6 +92,7 @@ rcParams['figure.figsize'] = 10, 10
 rcParams["lines.markersize"] = 2
 # rcParams['lines.color'] = 'k'
 from scipy.signal import argrelextrema
+from scipy.spatial import cKDTree
 from scipy import signal
 
 import plotting_functions as pf
@@ -66,6 +107,11 @@ import fnmatch
 from datetime import datetime
 import os
 import shutil
+import json
+import sqlite3
+import io
+import hashlib
+import warnings
 from scipy.stats import moment, sigmaclip
 
 import astropy
@@ -171,7 +217,11 @@ def representation_learning(flux, x, ticid, target_info,
               'full_feed_forward_highway': False,
               'cvae': False,
               'share_pool_inds': False,
-              'batchnorm_before_act': False} 
+              'batchnorm_before_act': False,
+              'xla': False, # >> performance mode, see ml.set_performance_mode()
+              'mixed_precision': None,
+              'intra_op_threads': None,
+              'inter_op_threads': None} 
         
     print('Preprocessing')
     x_train, x_test, y_train, y_test, ticid_train, ticid_test, target_info_train, \
@@ -278,144 +328,133 @@ def lc_by_camera_ccd(sectorfile, camera, ccd):
     
 def combine_sectors_by_time_axis(sectors, data_dir, cutoff=0.5, custom_mask=[],
                                  order=5, tol=0.6, debug=True, norm_type='standardization',
-                                 output_dir='./', return_median_flux=False):
+                                 output_dir='./', return_median_flux=False,
+                                 chunk_size=1000):
+    '''Concatenates the light curves of targets observed in all sectors along
+    the time axis. Targets are only kept if the RMS of their high-pass
+    filtered light curves is consistent between sectors, i.e. if for every
+    pair of sectors |rms_j - rms_k| < tol*rms_j and < tol*rms_k (or
+    max(rms) - min(rms) < tol*min(rms)).
+    Sectors are read from their light curve stores (see load_data_from_store())
+    chunk_size light curves at a time, and the combined flux is written to
+    output_dir+'Sector<sectors>_combined_flux.npy', so memory does not grow
+    with the number of sectors. The combined flux has the dtype of the stores.
+    Parameters:
+        * sectors : list of any number of sectors
+        * cutoff, order : of the high pass Butterworth filter
+        * tol : RMS tolerance (fraction of RMS)
+        * norm_type : see normalize_chunk()
+        * debug : plots the first 5 and all excluded light curves
+        * return_median_flux : if True, also returns the combined light curves
+                               median normalized in each sector (e.g. for
+                               plotting), written to
+                               'Sector<sectors>_combined_median_flux.npy'
+    Returns:
+        * flux : memory-mapped, shape=(num targets, total num data points)
+        * x : time array
+        * ticid : TICIDs
+        * target_info : structured target_info (see make_target_info()),
+                        shape=(num targets, num sectors), with the sector,
+                        cam and ccd of each target in each sector
+        * flux_median : only if return_median_flux, memory-mapped, same shape
+                        as flux
+    '''
     num_sectors = len(sectors)
-    all_flux = []
-    all_ticid = []
-    all_target_info = []
-    all_x = []
-    all_flux_plot = []
+    b, a = signal.butter(order, cutoff, btype='high', analog=False)
+
     print('Loading data and applying nanmask')
-    for i in range(len(sectors)):
+    all_flux, all_x, all_ticid, all_target_info = [], [], [], []
+    for i in range(num_sectors):
         flux, x, ticid, target_info = \
-            load_data_from_metafiles(data_dir, sectors[i], nan_mask_check=True,
-                                     custom_mask=custom_mask)
-            
-        # all_flux_plot.append(normalize(flux))
-        if norm_type == 'standardization':
-            print('Standardizing fluxes...')
-            flux = standardize(flux)
-    
-        elif norm_type == 'median_normalization':
-            print('Normalizing fluxes (dividing by median)...')
-            flux = normalize(flux)
-            
-        elif norm_type == 'minmax_normalization':
-            print('Normalizing fluxes (changing minimum and range)...')
-            mins = np.min(flux, axis = 1, keepdims=True)
-            flux = flux - mins
-            maxs = np.max(flux, axis=1, keepdims=True)
-            flux = flux / maxs
-            
-        else:
-            print('Light curves are not normalized!')            
-            
-        all_flux.append(flux)
+            load_data_from_store(data_dir, sectors[i], custom_mask=custom_mask,
+                                 output_dir=output_dir)
+        all_flux.append(flux) # >> memory-mapped
+        all_x.append(x)
         all_ticid.append(ticid)
         all_target_info.append(target_info)
-        all_x.append(x)
     
     x = np.concatenate(all_x)
     if np.count_nonzero(np.isnan(x)):
         x = np.interp(np.arange(len(x)), np.arange(len(x))[np.nonzero(~np.isnan(x))],
                       x[np.nonzero(~np.isnan(x))])
-    flux, flux_plot, target_info, ticid, ticid_rejected = [], [], [], [], []
-    
-    # !!
-    all_ticid, comm1, comm2 = np.intersect1d(all_ticid[0], all_ticid[1],
-                                         return_indices=True)
-    all_flux[0] = all_flux[0][comm1]
-    all_flux[1] = all_flux[1][comm2]
-    # all_flux_plot[0] = all_flux_plot[0][comm1]
-    # all_flux_plot[1] = all_flux_plot[1][comm2]
-    all_target_info[0] = all_target_info[0][comm1]
-    all_target_info[1] = all_target_info[1][comm2]
-    
-    for i in range(len(all_ticid)):
-    
-        b, a = signal.butter(order, cutoff, btype='high', analog=False)
-        y1 = signal.filtfilt(b, a, all_flux[0][i])
-        rms1 = np.sqrt(np.mean(y1**2))
-        
-        y2 = signal.filtfilt(b, a, all_flux[1][i])
-        rms2 = np.sqrt(np.mean(y2**2))
-        
-        if debug and i < 5:
-            fig, ax = plt.subplots(2, num_sectors)
-            # ax[0,0].plot(all_x[0], all_flux_plot[0][i], '.k', ms=1)
-            # ax[0,1].plot(all_x[1], all_flux_plot[1][i], '.k', ms=1) 
-            ax[0,0].plot(all_x[0], all_flux[0][i], '.k', ms=1)
-            ax[0,1].plot(all_x[1], all_flux[1][i], '.k', ms=1)               
-            ax[1,0].plot(all_x[0], y1, '.k', ms=1)
-            ax[1,1].plot(all_x[1], y2, '.k', ms=1)
-            fig.savefig(output_dir+'highpass_'+str(cutoff)+'_'+str(i)+'.png')   
-    
-        # >> compare RMS !! assumes combining 2 sectors
-        if np.abs(rms2 - rms1) < tol*rms1 and \
-            np.abs(rms2 - rms1) < tol*rms2:
-            flux.append(np.concatenate([all_flux[0][i], all_flux[1][i]]))
-            # flux_plot.append(np.concatenate([all_flux_plot[0][i],
-            #                                  all_flux_plot[1][i]]))
-            target_info.append([','.join([all_target_info[0][i][0],
-                                         all_target_info[1][i][0]]),
-                               ','.join([all_target_info[0][i][1],
-                                         all_target_info[1][i][1]]),
-                               ','.join([all_target_info[0][i][2],
-                                         all_target_info[1][i][2]]),
-                               all_target_info[0][i][3],
-                               all_target_info[0][i][4]])  
-            ticid.append(all_ticid[i])
-        else:
-                       
-            print('Excluding TIC '+str(all_ticid[i]))
-            if debug:
-                fig, ax = plt.subplots(2, 2)
-                # ax[0,0].plot(all_x[0], all_flux_plot[0][i], '.k', ms=1)
-                # ax[0,1].plot(all_x[1], all_flux_plot[1][i], '.k', ms=1)       
-                ax[0,0].plot(all_x[0], all_flux[0][i], '.k', ms=1)
-                ax[0,1].plot(all_x[1], all_flux[1][i], '.k', ms=1)                   
-                ax[1,0].plot(all_x[0], y1, '.k', ms=1)
-                ax[1,1].plot(all_x[1], y2, '.k', ms=1)
-                fig.savefig(output_dir+'highpass_TIC_'+str(int(all_ticid[i]))+'.png')    
-            ticid_rejected.append(all_ticid[i])
-             
 
-    flux = np.array(flux)
-    flux_plot = np.array(flux_plot)
-    target_info = np.array(target_info)
-    ticid = np.array(ticid)
-    
-    del all_flux
-    del all_x
-    del all_ticid
-    del all_target_info
-            
-    
-    # # >> stitch together !! can only handle 2 sectors
-    # all_ticid1, comm1, comm2 = np.intersect1d(all_ticid[0], all_ticid[1],
-    #                                          return_indices=True)
-        
-    # flux = np.concatenate([all_flux[0][comm1], all_flux[1][comm2]], axis = -1)
+    # >> targets in every sector, and their rows in each sector
+    ticid = all_ticid[0]
+    for i in range(1, num_sectors):
+        ticid = np.intersect1d(ticid, all_ticid[i])
+    rows = [ticid_join(all_ticid[i], ticid) for i in range(num_sectors)]
+    print(str(len(ticid))+' targets in all '+str(num_sectors)+' sectors')
+
+    def read_sector(i, inds, norm_type=norm_type):
+        '''Reads normalized flux of sector i for targets ticid[inds].'''
+        return normalize_chunk(np.asarray(all_flux[i][rows[i][inds]]),
+                               norm_type)
+
+    # -- compare RMS of high-pass filtered light curves ------------------------
+    rms = np.empty((len(ticid), num_sectors))
+    for i in range(num_sectors):
+        print('Filtering Sector '+str(sectors[i]))
+        for start in range(0, len(ticid), chunk_size):
+            inds = np.arange(start, min(start+chunk_size, len(ticid)))
+            y = signal.filtfilt(b, a, read_sector(i, inds), axis=1)
+            rms[inds,i] = np.sqrt(np.mean(y**2, axis=1))
+    rms_min, rms_max = np.min(rms, axis=1), np.max(rms, axis=1)
+    accept = rms_max - rms_min < tol*rms_min
+    ticid_rejected = ticid[~accept]
+    for tic in ticid_rejected:
+        print('Excluding TIC '+str(tic))
+    
+    if debug:
+        for ind in np.concatenate([np.arange(min(5, len(ticid))),
+                                   np.nonzero(~accept)[0]]):
+            fig, ax = plt.subplots(2, num_sectors, squeeze=False)
+            for i in range(num_sectors):
+                flux = read_sector(i, [ind])[0]
+                ax[0,i].plot(all_x[i], flux, '.k', ms=1)
+                ax[1,i].plot(all_x[i], signal.filtfilt(b, a, flux), '.k', ms=1)
+            if accept[ind]:
+                fig.savefig(output_dir+'highpass_'+str(cutoff)+'_'+str(ind)+'.png')
+            else:
+                fig.savefig(output_dir+'highpass_TIC_'+str(int(ticid[ind]))+'.png')
+            plt.close(fig)
+    
+    # -- write combined light curves -------------------------------------------
+    ticid = ticid[accept]
+    rows = [rows[i][accept] for i in range(num_sectors)]
+    def write_combined(fname, norm_type):
+        print('Writing combined light curves to '+fname)
+        flux = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                         shape=(len(ticid), len(x)))
+        col = 0
+        for i in range(num_sectors):
+            for start in range(0, len(ticid), chunk_size):
+                inds = np.arange(start, min(start+chunk_size, len(ticid)))
+                flux[inds, col:col+len(all_x[i])] = read_sector(i, inds,
+                                                                norm_type)
+            col += len(all_x[i])
+        flux.flush()
+        return flux
+    prefix = output_dir+'Sector'+'-'.join([str(s) for s in sectors])
+    dtype = np.result_type(*[f.dtype for f in all_flux])
+    flux = write_combined(prefix+'_combined_flux.npy', norm_type)
+    if return_median_flux:
+        flux_median = write_combined(prefix+'_combined_median_flux.npy',
+                                     'median_normalization')
+
+    # >> one column per sector
+    target_info = np.stack([to_target_info(all_target_info[i][rows[i]],
+                                           ticid=ticid) \
+                            for i in range(num_sectors)], axis=1)
 
-    # target_info = []
-    # for i in range(len(comm1)):
-    #     target_info.append([','.join([all_target_info[0][comm1[i]][0],
-    #                                  all_target_info[1][comm2[i]][0]]),
-    #                        ','.join([all_target_info[0][comm1[i]][1],
-    #                                  all_target_info[1][comm2[i]][1]]),
-    #                        ','.join([all_target_info[0][comm1[i]][2],
-    #                                  all_target_info[1][comm2[i]][2]]),
-    #                        all_target_info[0][comm1[i]][3],
-    #                        all_target_info[0][comm1[i]][4]])
-    # target_info = np.array(target_info)
-    
-    # ticid = all_ticid[0][comm1]
-    
-    # return flux, flux_plot, x, ticid, target_info
+    del all_flux
+    if return_median_flux:
+        return flux, x, ticid, target_info, flux_median
     return flux, x, ticid, target_info
 
 def combine_sectors_by_lc(sectors, data_dir, custom_mask=[],
                           output_dir='./', DEBUG=True):
+    '''Concatenates the light curves of any number of sectors along the light
+    curve axis (truncated to the shortest sector), and applies a NaN mask.'''
     all_flux = []
     all_ticid = []
     all_target_info = []
@@ -435,11 +474,10 @@ def combine_sectors_by_lc(sectors, data_dir, custom_mask=[],
     for i in range(len(sectors)):
         all_flux[i] = all_flux[i][:,:new_length]
         
-    flux = np.concatenate([all_flux[0], all_flux[1]], axis = 0)
+    flux = np.concatenate(all_flux, axis = 0)
     x = all_x[0][:new_length]
-    target_info = np.concatenate([all_target_info[0], all_target_info[1]],
-                                 axis=0)
-    ticid = np.concatenate([all_ticid[0], all_ticid[1]])
+    target_info = np.concatenate(all_target_info, axis=0)
+    ticid = np.concatenate(all_ticid)
   
     flux, x = nan_mask(flux, x, custom_mask=custom_mask, ticid=ticid,
                        target_info=target_info,
@@ -472,9 +510,9 @@ def load_data_from_metafiles(data_dir, sector, cams=[1,2,3,4],
         * flux : array of light curve PDCSAP_FLUX,
                  shape=(num light curves, num data points)
         * x : time array, shape=(num data points)
-        * ticid : list of TICIDs, shape=(num light curves)
-        * target_info : [sector, cam, ccd, data_type, cadence] for each light
-                        curve, shape=(num light curves, 5)
+        * ticid : TICIDs (int64), shape=(num light curves)
+        * target_info : structured target_info (see make_target_info()),
+                        shape=(num light curves)
     '''
     
     # >> get file names for each group
@@ -495,8 +533,8 @@ def load_data_from_metafiles(data_dir, sector, cams=[1,2,3,4],
     # >> pull data from each fits file
     print('Pulling data')
     flux_list = []
-    ticid = np.empty((0, 1))
-    target_info = [] # >> [sector, cam, ccd, data_type, cadence]
+    packed = []
+    target_info = []
     for i in range(len(fnames)):
         print('Loading ' + fnames[i] + '...')
         with fits.open(data_dir + fnames[i], memmap=False) as hdul:
@@ -504,22 +542,26 @@ def load_data_from_metafiles(data_dir, sector, cams=[1,2,3,4],
                 x = hdul[0].data
             flux = hdul[1].data
             ticid_list = hdul[2].data
+        if nan_mask_check: # >> packed NaN mask, saved next to the metafile
+            packed.append(load_packed_nan_mask(data_dir + fnames[i], flux))
     
         flux_list.append(flux)
-        ticid = np.append(ticid, ticid_list)
-        target_info.extend([fname_info[i]] * len(flux))
+        target_info.append(make_target_info(ticid_list, *fname_info[i]))
 
     # >> concatenate flux array         
     flux = np.concatenate(flux_list, axis=0)
+    target_info = np.concatenate(target_info)
+    ticid = target_info['ticid']
         
     # >> apply nan mask
     if nan_mask_check:
         print('Applying nan mask')
         flux, x = nan_mask(flux, x, DEBUG=DEBUG, ticid=ticid,
                            debug_ind=debug_ind, target_info=target_info,
-                           output_dir=output_dir, custom_mask=custom_mask)
+                           output_dir=output_dir, custom_mask=custom_mask,
+                           packed=np.concatenate(packed, axis=0))
 
-    return flux, x, ticid, np.array(target_info)
+    return flux, x, ticid, target_info
     
     
 def load_group_from_fits(path, sector, camera, ccd): 
@@ -538,14 +580,529 @@ def load_group_from_fits(path, sector, camera, ccd):
     f.close()
     
     return time, intensities, targets
-    
 
+# :: Target metadata :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> target_info is a structured array with one row per light curve:
+# >>   ticid (int64), sector, cam, ccd (uint8), and data_type, cadence (uint8
+# >>   codes, i.e. indices into DATA_TYPES and CADENCES)
+# >> e.g. target_info['cam'] gives the camera of every light curve.
+# >> The legacy target_info is a string array of [sector, cam, ccd, data_type,
+# >> cadence] for each light curve, shape=(num light curves, 5), and converts
+# >> both ways with to_target_info() and to_legacy_target_info().
+# >> Light curves combined from several sectors (combine_sectors_by_time_axis())
+# >> have one row per sector, shape=(num light curves, num sectors).
+
+DATA_TYPES = ['SPOC', 'FFI']
+CADENCES = ['2-minute', '20-second', '10-minute', '30-minute']
+TARGET_INFO_DTYPE = np.dtype([('ticid', 'int64'), ('sector', 'uint8'),
+                              ('cam', 'uint8'), ('ccd', 'uint8'),
+                              ('data_type', 'uint8'), ('cadence', 'uint8')])
+
+def make_target_info(ticid, sector, cam, ccd, data_type='SPOC',
+                     cadence='2-minute'):
+    '''Returns structured target_info (see above). sector, cam, ccd,
+    data_type and cadence can be given once for all light curves.'''
+    ticid = np.asarray(ticid).reshape(-1)
+    target_info = np.empty(len(ticid), dtype=TARGET_INFO_DTYPE)
+    target_info['ticid'] = ticid
+    target_info['sector'] = sector
+    target_info['cam'] = cam
+    target_info['ccd'] = ccd
+    target_info['data_type'] = category_codes(data_type, DATA_TYPES)
+    target_info['cadence'] = category_codes(cadence, CADENCES)
+    return target_info
+
+def category_codes(values, categories):
+    '''Returns the index of each value in categories.'''
+    values = np.asarray(values, dtype='str')
+    unique, inverse = np.unique(values, return_inverse=True)
+    unknown = [v for v in unique if v not in categories]
+    if len(unknown) > 0:
+        raise ValueError('Unknown categories: ' + ', '.join(unknown))
+    codes = np.array([categories.index(v) for v in unique], dtype='uint8')
+    return codes[inverse].reshape(values.shape)
+
+def is_structured_target_info(target_info):
+    '''Checks if target_info is structured (see above).'''
+    return type(target_info) == np.ndarray and \
+        target_info.dtype.names == TARGET_INFO_DTYPE.names
+
+def to_target_info(target_info, ticid=None):
+    '''Converts legacy target_info (string array of [sector, cam, ccd,
+    data_type, cadence]) to structured target_info. Structured target_info is
+    returned as it is.
+    Parameters:
+        * target_info : shape=(num light curves, 5)
+        * ticid : TICID of each light curve (set to 0 if not given)
+    '''
+    if is_structured_target_info(target_info):
+        return target_info
+    target_info = np.asarray(target_info, dtype='str').reshape(-1, 5)
+    if type(ticid) == type(None):
+        ticid = np.zeros(len(target_info), dtype='int64')
+    for col in range(3):
+        if not all([v.isdigit() and int(v) < 256 for v in \
+                    np.unique(target_info[:,col])]):
+            # >> e.g. target_info from combine_sectors_by_time_axis() before
+            # >> it was structured
+            raise ValueError('Can not convert ' + str(target_info[0]) + \
+                             ' to structured target_info')
+    return make_target_info(np.asarray(ticid).astype('int64'),
+                            target_info[:,0].astype('int'),
+                            target_info[:,1].astype('int'),
+                            target_info[:,2].astype('int'),
+                            target_info[:,3], target_info[:,4])
+
+def to_legacy_target_info(target_info):
+    '''Converts structured target_info to the legacy string array of [sector,
+    cam, ccd, data_type, cadence]. Legacy target_info is returned as it is.'''
+    if not is_structured_target_info(target_info):
+        return np.asarray(target_info)
+    target_info = target_info.reshape(-1)
+    return np.array([target_info['sector'].astype('str'),
+                     target_info['cam'].astype('str'),
+                     target_info['ccd'].astype('str'),
+                     np.array(DATA_TYPES)[target_info['data_type']],
+                     np.array(CADENCES)[target_info['cadence']]]).T
+
+def target_info_fields(target_info):
+    '''Returns sector, cam, ccd (int), data_type, cadence (str) of one light
+    curve, from either a row of structured target_info or legacy target_info.
+    For light curves combined from several sectors, returns the fields of the
+    first sector.'''
+    if isinstance(target_info, (np.void, np.ndarray)) and \
+        target_info.dtype.names == TARGET_INFO_DTYPE.names:
+        target_info = target_info.reshape(-1)[0]
+        return int(target_info['sector']), int(target_info['cam']), \
+            int(target_info['ccd']), DATA_TYPES[target_info['data_type']], \
+            CADENCES[target_info['cadence']]
+    sector, cam, ccd, data_type, cadence = np.asarray(target_info)[:5]
+    return int(sector), int(cam), int(ccd), str(data_type), str(cadence)
+
+# :: TICID index :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Joins on TICID: build the index of a TICID-keyed table (catalog, features,
+# >> bottleneck, labels) once with ticid_index(), then ticid_lookup() gives
+# >> the row of every TICID in one vectorized search, e.g.
+# >>     index = ticid_index(catalog['ID'])
+# >>     rows = ticid_lookup(index, ticid)
+# >>     catalog_rows = catalog.iloc[rows[rows > -1]]
+
+def ticid_index(ticid):
+    '''Sorted index over the TICID column of a table (given as float or int).
+    Returns:
+        * index : dictionary with sorted TICIDs ('ticid') and their rows
+                  ('rows')
+    '''
+    ticid = np.asarray(ticid).reshape(-1).astype('int64')
+    order = np.argsort(ticid, kind='stable')
+    return {'ticid': ticid[order], 'rows': order}
+
+def ticid_lookup(index, ticid, missing=-1):
+    '''Returns the row of each TICID in the table the index was built from
+    (the first row, if the TICID is repeated), and missing for TICIDs that
+    are not in the table.'''
+    ticid = np.asarray(ticid).astype('int64')
+    if len(index['ticid']) == 0:
+        return np.full(ticid.shape, missing, dtype='int64')
+    pos = np.searchsorted(index['ticid'], ticid)
+    pos = np.minimum(pos, len(index['ticid']) - 1)
+    found = index['ticid'][pos] == ticid
+    return np.where(found, index['rows'][pos], missing)
+
+def update_ticid_index(index, ticid, rows):
+    '''Adds TICIDs in rows of a table (e.g. rows appended to it) to an index
+    returned by ticid_index(), by merging instead of sorting the whole table
+    again. Rows already in the index stay first for repeated TICIDs.'''
+    ticid = np.asarray(ticid).reshape(-1).astype('int64')
+    rows = np.asarray(rows).reshape(-1).astype('int64')
+    order = np.argsort(ticid, kind='stable')
+    pos = np.searchsorted(index['ticid'], ticid[order], side='right')
+    return {'ticid': np.insert(index['ticid'], pos, ticid[order]),
+            'rows': np.insert(index['rows'], pos, rows[order])}
+
+def ticid_join(ticid_table, ticid, missing=-1):
+    '''Same as ticid_lookup(ticid_index(ticid_table), ticid), for one-off
+    joins.'''
+    return ticid_lookup(ticid_index(ticid_table), ticid, missing=missing)
+
+# :: Light curve store :::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> A sector's light curve store is a directory with one .npy file per array,
+# >> so that np.load(..., mmap_mode='r') maps it without reading it into RAM:
+# >>   * time.npy        : shape=(num data points)
+# >>   * flux.npy        : shape=(num light curves, num data points). Stored
+# >>                       row-major, so each light curve is contiguous on disk
+# >>                       and reading a subset of targets only reads those rows
+# >>   * ticid.npy       : int64, shape=(num light curves)
+# >>   * target_info.npy : structured target_info (see make_target_info()),
+# >>                       shape=(num light curves)
+# >>   * nan_mask.npy    : bit-packed NaN mask of flux (see pack_nan_mask()),
+# >>                       so NaN masks are computed without reading flux
+# >>   * ticid_index.npy : rows of the store sorted by TICID (see ticid_index())
+# >>   * store_info.json : shape, dtype, chunk size and row range of each group
+# >>                       (written last, so a half-converted store is ignored)
+# >> Stores written by bulk_download_to_store() also have
+# >>   * cols.npy        : index of each data point in the _lc.fits time axis
+# >>   * ingested_files.txt : _lc.fits files in the store (see ingest_to_store())
+# >> and their store_info.json records the normalization of flux (norm_type,
+# >> 'none' unless asked for)
+
+def write_store_info(store_dir, info):
+    '''Writes store_info.json atomically (temporary file, then renamed), so
+    an interrupted write leaves the previous store_info.json.'''
+    with open(store_dir+'store_info.json.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(store_dir+'store_info.json.tmp', store_dir+'store_info.json')
+
+def get_lc_store_dir(data_dir, sector, fast=False):
+    '''Returns the light curve store directory for a sector.'''
+    if fast:
+        return data_dir + 'Sector{sector}_20s/Sector{sector}_store/'.format(sector=sector)
+    else:
+        return data_dir + 'Sector{sector}/Sector{sector}_store/'.format(sector=sector)
+
+def convert_metafiles_to_store(data_dir, sector, cams=[1,2,3,4],
+                               ccds=[[1,2,3,4]]*4, data_type='SPOC',
+                               cadence='2-minute', fast=False, store_dir=None,
+                               chunk_size=1000):
+    '''Copies the SectorXCamXCCDX_lightcurves.fits metafiles of a sector into
+    a single light curve store (see above). Flux is copied chunk_size rows at a
+    time from memory-mapped fits files, so peak memory is set by chunk_size
+    rather than the size of the sector.
+    Parameters:
+        * data_dir, sector, cams, ccds, data_type, cadence, fast : same as
+          load_data_from_metafiles()
+        * store_dir : output directory, default is get_lc_store_dir()
+        * chunk_size : number of light curves copied at a time
+    Returns:
+        * store_dir
+    '''
+    if type(store_dir) == type(None):
+        store_dir = get_lc_store_dir(data_dir, sector, fast=fast)
+    os.makedirs(store_dir, exist_ok=True)
+
+    # >> get file names for each group
+    fnames = []
+    fname_info = []
+    for i in range(len(cams)):
+        cam = cams[i]
+        for ccd in ccds[i]:
+            if fast:
+                s = 'Sector{sector}_20s/Sector{sector}Cam{cam}CCD{ccd}/' + \
+                    'Sector{sector}Cam{cam}CCD{ccd}_lightcurves.fits'
+            else:
+                s = 'Sector{sector}/Sector{sector}Cam{cam}CCD{ccd}/' + \
+                    'Sector{sector}Cam{cam}CCD{ccd}_lightcurves.fits'
+            fnames.append(s.format(sector=sector, cam=cam, ccd=ccd))
+            fname_info.append([sector, cam, ccd, data_type, cadence])
+
+    # >> read shapes from headers only
+    num_rows = []
+    for i in range(len(fnames)):
+        with fits.open(data_dir + fnames[i], memmap=True) as hdul:
+            if i == 0:
+                x = np.array(hdul[0].data)
+                dtype = hdul[1].data.dtype.newbyteorder('=')
+            if hdul[1].header['NAXIS1'] != len(x):
+                raise ValueError(fnames[i] + ' has a different time axis')
+            num_rows.append(hdul[1].header['NAXIS2'])
+
+    # >> copy flux into store chunk by chunk
+    print('Writing light curve store to ' + store_dir)
+    flux = np.lib.format.open_memmap(store_dir+'flux.npy', mode='w+',
+                                     dtype=dtype,
+                                     shape=(int(np.sum(num_rows)), len(x)))
+    nan_mask = np.lib.format.open_memmap(store_dir+'nan_mask.npy', mode='w+',
+                                         dtype='uint8',
+                                         shape=(len(flux), (len(x)+7)//8))
+    ticid = []
+    target_info = []
+    groups = []
+    row = 0
+    for i in range(len(fnames)):
+        print('Converting ' + fnames[i] + '...')
+        with fits.open(data_dir + fnames[i], memmap=True) as hdul:
+            for start in range(0, num_rows[i], chunk_size):
+                stop = min(start + chunk_size, num_rows[i])
+                flux[row+start:row+stop] = hdul[1].data[start:stop]
+                nan_mask[row+start:row+stop] = \
+                    pack_nan_mask(flux[row+start:row+stop])
+            ticid.append(np.array(hdul[2].data).astype('int64'))
+            target_info.append(make_target_info(ticid[-1], *fname_info[i]))
+        groups.append([int(fname_info[i][1]), int(fname_info[i][2]),
+                       int(row), int(row + num_rows[i])])
+        row += num_rows[i]
+    flux.flush()
+    nan_mask.flush()
+    del flux, nan_mask
+
+    np.save(store_dir+'time.npy', x)
+    np.save(store_dir+'ticid.npy', np.concatenate(ticid))
+    np.save(store_dir+'target_info.npy', np.concatenate(target_info))
+    np.save(store_dir+'ticid_index.npy',
+            ticid_index(np.concatenate(ticid))['rows'])
+
+    store_info = {'sector': sector, 'data_type': data_type,
+                  'cadence': cadence, 'shape': [int(row), len(x)],
+                  'dtype': dtype.str, 'chunk_size': chunk_size,
+                  'groups': groups}
+    write_store_info(store_dir, store_info)
+
+    return store_dir
+
+def open_lc_store(store_dir, mode='r'):
+    '''Memory-maps a light curve store. Slicing store['flux'] only reads the
+    requested rows (and columns) from disk.
+    Parameters:
+        * store_dir : directory written by convert_metafiles_to_store()
+        * mode : mmap_mode passed to np.load ('r', 'r+' or 'c')
+    Only the rows counted in store_info.json are returned: rows appended by
+    an interrupted ingest_to_store() are ignored, and the TICID index is
+    rebuilt if it does not match them.
+    Returns:
+        * store : dictionary with keys 'time', 'flux', 'ticid', 'target_info'
+                  'index' (see ticid_index()) and 'info' (contents of
+                  store_info.json), and 'nan_mask' if the store has one
+    '''
+    if not os.path.exists(store_dir+'store_info.json'):
+        raise OSError('No light curve store in ' + store_dir)
+    store = {}
+    with open(store_dir+'store_info.json', 'r') as f:
+        store['info'] = json.load(f)
+    num_rows = store['info']['shape'][0]
+    store['dir'] = store_dir
+    store['time'] = np.load(store_dir+'time.npy')
+    store['flux'] = np.load(store_dir+'flux.npy', mmap_mode=mode)[:num_rows]
+    store['ticid'] = np.load(store_dir+'ticid.npy')[:num_rows]
+    # >> stores written before structured target_info have string arrays
+    store['target_info'] = \
+        to_target_info(np.load(store_dir+'target_info.npy')[:num_rows],
+                       store['ticid'])
+    if os.path.exists(store_dir+'nan_mask.npy'):
+        store['nan_mask'] = np.load(store_dir+'nan_mask.npy',
+                                    mmap_mode=mode)[:num_rows]
+    rows = None
+    if os.path.exists(store_dir+'ticid_index.npy'):
+        rows = np.load(store_dir+'ticid_index.npy')
+    if type(rows) != type(None) and len(rows) == num_rows:
+        store['index'] = {'ticid': store['ticid'][rows], 'rows': rows}
+    else:
+        store['index'] = ticid_index(store['ticid'])
+    return store
+
+def iterate_lc_store(store, rows=None, cols=None, chunk_size=None):
+    '''Yields (row indices, flux) for chunk_size light curves at a time.
+    Parameters:
+        * store : returned by open_lc_store()
+        * rows : indices of light curves to read (default all)
+        * cols : indices of data points to read (default all)
+        * chunk_size : default is the chunk size the store was written with
+    '''
+    if type(chunk_size) == type(None):
+        chunk_size = store['info']['chunk_size']
+    if type(rows) == type(None):
+        rows = np.arange(store['flux'].shape[0])
+    for start in range(0, len(rows), chunk_size):
+        rows_chunk = rows[start:start+chunk_size]
+        if len(rows_chunk) > 0 and \
+            rows_chunk[-1] - rows_chunk[0] == len(rows_chunk) - 1:
+            flux = np.asarray(store['flux'][rows_chunk[0]:rows_chunk[-1]+1])
+        else: # >> only reads the requested rows
+            flux = store['flux'][rows_chunk]
+        if type(cols) != type(None):
+            flux = flux[:,cols]
+        yield rows_chunk, flux
+
+def nan_mask_store(store, rows=None, cols=None, output_dir='./',
+                   prefix='', tol1=0.05, tol2=0.5, use_tol2=True,
+                   chunk_size=None, col_nan=None, num_nan=None, plot=False):
+    '''Same NaN mask as nan_mask(), but computed chunk by chunk from the light
+    curve store instead of on an in-memory flux array.
+    Parameters:
+        * store : returned by open_lc_store()
+        * rows : indices of light curves to consider (default all)
+        * cols : indices of data points to consider, i.e. with the custom mask
+                 already removed (default all)
+        * tol1, tol2, use_tol2 : see nan_mask()
+        * col_nan, num_nan : whether each of cols has a NaN and number of NaNs
+                             in each of rows, if already counted while writing
+                             the store (skips the first pass)
+        * plot : if True, plots a histogram of the number of data points
+                 masked in each light curve
+    If the store has a packed NaN mask, flux is not read.
+    Returns:
+        * rows : indices of light curves that are kept
+        * cols : indices of data points that are kept
+    '''
+    if type(rows) == type(None):
+        rows = np.arange(store['flux'].shape[0])
+    if type(cols) == type(None):
+        cols = np.arange(store['flux'].shape[1])
+
+    def column_mask(rows):
+        if 'nan_mask' in store.keys(): # >> only read packed NaN mask
+            if type(chunk_size) == type(None):
+                step = store['info']['chunk_size']
+            else:
+                step = chunk_size
+            n = store['flux'].shape[1]
+            keep_cols = np.packbits(np.isin(np.arange(n), cols))
+            packed_col = np.zeros(len(keep_cols), dtype='uint8')
+            num_nan = []
+            for start in range(0, len(rows), step):
+                packed = store['nan_mask'][rows[start:start+step]] & keep_cols
+                packed_col |= np.bitwise_or.reduce(packed, axis=0)
+                num_nan.append(np.sum(POPCOUNT[packed], axis=1,
+                                      dtype='int64'))
+            col_nan = np.unpackbits(packed_col, count=n).astype('bool')[cols]
+            return col_nan, np.concatenate(num_nan + [np.empty(0, 'int64')])
+        
+        col_nan = np.zeros(len(cols), dtype='bool')
+        num_nan = np.empty(len(rows), dtype='int')
+        start = 0
+        for rows_chunk, flux in iterate_lc_store(store, rows, cols,
+                                                 chunk_size=chunk_size):
+            isnan = np.isnan(flux)
+            col_nan |= np.any(isnan, axis=0)
+            num_nan[start:start+len(rows_chunk)] = np.sum(isnan, axis=1)
+            start += len(rows_chunk)
+        return col_nan, num_nan
+    if type(col_nan) == type(None) or type(num_nan) == type(None):
+        col_nan, num_nan = column_mask(rows)
+
+    # >> every NaN in a light curve is in the mask, so the number of data
+    # >> points each light curve loses is the rest of the mask
+    num_masked = np.count_nonzero(col_nan) - num_nan
+    if plot:
+        plt.figure()
+        plt.hist(num_masked, bins=50)
+        plt.ylabel('number of light curves')
+        plt.xlabel('number of data points masked')
+        plt.savefig(output_dir + 'nan_mask.png')
+        plt.close()
+
+    # >> check if only a few light curves contribute to NaN mask
+    worst_inds = np.nonzero( num_nan > tol2*len(cols) )[0]
+    if len(worst_inds)>0 and len(worst_inds)<tol1*len(rows) and use_tol2:
+        with open(output_dir+prefix+'removed_light_curves.txt', 'w') as f:
+            for i in range(len(worst_inds)):
+                f.write('TIC '+ str(store['ticid'][rows[worst_inds[i]]])+'\n')
+
+        print('Removing '+str(len(worst_inds))+' light curves')
+        rows = np.delete(rows, worst_inds)
+
+        # >> and calculate new mask
+        col_nan, num_nan = column_mask(rows)
+
+    return rows, cols[np.nonzero(~col_nan)]
+
+def load_data_from_store(data_dir, sector, cams=[1,2,3,4],
+                         ccds=[[1,2,3,4]]*4, data_type='SPOC',
+                         cadence='2-minute', DEBUG=False, fast=False,
+                         output_dir='./', debug_ind=0,
+                         nan_mask_check=True,
+                         custom_mask=[], store_dir=None, targets=None,
+                         time_window=None, chunk_size=None):
+    '''Drop-in replacement for load_data_from_metafiles() that reads from the
+    sector's light curve store (converting the metafiles the first time).
+    The returned flux is a read-only memory map, so sectors larger than RAM
+    can be loaded. When a NaN mask or a selection is applied, the selected
+    flux is written once into the store (flux_<key>.npy) and re-used by later
+    calls with the same selection.
+
+    If DEBUG, plots light curve debug_ind after the NaN mask (and the
+    histogram of masked data points) in output_dir, like nan_mask().
+
+    Parameters (in addition to load_data_from_metafiles()):
+        * store_dir : default is get_lc_store_dir()
+        * targets : list of TICIDs to load (default all)
+        * time_window : (tmin, tmax), only loads data points in this window
+        * chunk_size : number of light curves read at a time
+
+    Returns:
+        * flux, x, ticid, target_info : same as load_data_from_metafiles()
+    '''
+    if type(store_dir) == type(None):
+        store_dir = get_lc_store_dir(data_dir, sector, fast=fast)
+    if not os.path.exists(store_dir+'store_info.json'):
+        convert_metafiles_to_store(data_dir, sector, data_type=data_type,
+                                   cadence=cadence, fast=fast,
+                                   store_dir=store_dir)
+    store = open_lc_store(store_dir)
+    x = store['time']
+    if store['info'].get('norm_type', 'none') != 'none':
+        warnings.warn('Light curve store in '+store_dir+' holds normalized '+\
+                      'flux (norm_type='+store['info']['norm_type']+\
+                      '), unlike load_data_from_metafiles()')
+
+    # >> select groups and targets
+    target_info = store['target_info']
+    group_mask = np.zeros(len(target_info), dtype='bool')
+    for i in range(len(cams)):
+        for ccd in ccds[i]:
+            group_mask |= (target_info['cam'] == cams[i]) * \
+                (target_info['ccd'] == ccd)
+    if type(targets) != type(None):
+        group_mask *= np.isin(store['ticid'], targets)
+    rows = np.nonzero(group_mask)[0]
+
+    # >> select data points
+    cols = np.delete(np.arange(len(x)), custom_mask)
+    if len(custom_mask) > 0: print('Applying custom NaN mask')
+    if type(time_window) != type(None):
+        cols = cols[np.nonzero((x[cols] >= time_window[0]) * \
+                               (x[cols] <= time_window[1]))]
+
+    # >> apply nan mask
+    if nan_mask_check:
+        print('Applying nan mask')
+        rows, cols = nan_mask_store(store, rows, cols, output_dir=output_dir,
+                                    chunk_size=chunk_size, plot=DEBUG)
+
+    if len(rows) == store['flux'].shape[0] and len(cols) == len(x):
+        flux = store['flux']
+    else:
+        # >> write selection into the store, unless already there. The key
+        # >> includes the number of rows and the time the store was last
+        # >> written, so re-ingesting or extending the store invalidates it
+        version = '%d_%d'%(store['flux'].shape[0],
+                           os.stat(store_dir+'store_info.json').st_mtime_ns)
+        key = hashlib.md5(rows.astype('int64').tobytes() + \
+                          cols.astype('int64').tobytes() + \
+                          version.encode()).hexdigest()[:12]
+        fname = store_dir + 'flux_' + key + '.npy'
+        if not os.path.exists(fname):
+            print('Writing selected light curves to ' + fname)
+            flux = np.lib.format.open_memmap(fname+'.tmp', mode='w+',
+                                             dtype=store['flux'].dtype,
+                                             shape=(len(rows), len(cols)))
+            start = 0
+            for rows_chunk, flux_chunk in iterate_lc_store(store, rows, cols,
+                                                           chunk_size=chunk_size):
+                flux[start:start+len(rows_chunk)] = flux_chunk
+                start += len(rows_chunk)
+            flux.flush()
+            del flux
+            os.rename(fname+'.tmp', fname)
+        flux = np.load(fname, mmap_mode='r')
+
+    # >> debugging plot (same as nan_mask()), only reads one light curve
+    if DEBUG and len(rows) > 0:
+        fig, ax = plt.subplots()
+        ax.plot(x[cols], flux[min(debug_ind, len(rows)-1)], '.k')
+        ax.set_title('removed orbit gap')
+        fig.tight_layout()
+        fig.savefig(output_dir + 'nanmask_debug.png', bbox_inches='tight')
+        plt.close(fig)
+
+    return flux, x[cols], store['ticid'][rows], target_info[rows]
 
 
 def data_access_sector_by_bulk(data_dir, sector,
                                bulk_download_dir, custom_mask=[],
                                apply_nan_mask=False, query_tess_feats=False,
-                               query_gcvs=True, query_simbad=True, make_fits=True):
+                               query_gcvs=True, query_simbad=True, make_fits=True,
+                               n_workers=None, make_store=False,
+                               gcvs_file=None):
     '''Get interpolated flux array for each group, if you already have all the
     _lc.fits files downloaded in bulk_download_dir.
     Parameters:
@@ -558,6 +1115,14 @@ def data_access_sector_by_bulk(data_dir, sector,
           can be downloaded from 
           http://archive.stsci.edu/tess/bulk_downloads.html
           Also see bulk_download_helper()
+        * n_workers : number of processes reading _lc.fits files
+        * make_store : if True, writes a nan masked light curve store (raw
+                       flux) with bulk_download_to_store() instead of the
+                       per-group fits files (make_fits is ignored). If the
+                       store exists, only _lc.fits files that are not in it
+                       yet are added (see ingest_to_store())
+        * gcvs_file : local GCVS catalogue (see read_gcvs_dump()). If given,
+                      GCVS labels are cross-matched offline
     e.g. df.data_access_sector_by_bulk('../../',
                                        '../../all_targets_S020_v1.txt', 20,
                                        '../../tessdata_sector_20/')
@@ -567,14 +1132,21 @@ def data_access_sector_by_bulk(data_dir, sector,
     sectorpath=data_dir+'Sector'+str(sector)+'/'
     sectorfile = sectorpath+'all_targets_S%03d'%sector+'_v1.txt'
     
-    if make_fits:
+    if make_store:
+        ingest_to_store(data_dir, sector, bulk_download_dir,
+                        custom_mask=custom_mask, n_workers=n_workers)
+    elif make_fits:
+        # >> list bulk_download_dir once for all 16 groups
+        fits_index = index_bulk_download(bulk_download_dir)
         for cam in [1,2,3,4]:
             for ccd in [1,2,3,4]:
                 data_access_by_group_fits(sectorpath, sectorfile, sector, cam,
                                           ccd, bulk_download=True,
                                           bulk_download_dir=bulk_download_dir,
                                           custom_mask=custom_mask,
-                                          apply_nan_mask=apply_nan_mask)
+                                          apply_nan_mask=apply_nan_mask,
+                                          fits_index=fits_index,
+                                          n_workers=n_workers)
             
     # >> get a list of TICIDs from sectorfile
     ticid_list = np.loadtxt(sectorfile)[:,0] # >> take first column only
@@ -586,7 +1158,10 @@ def data_access_sector_by_bulk(data_dir, sector,
 
     database_dir = data_dir+'databases/'
 
-    if query_gcvs:
+    if query_gcvs and type(gcvs_file) != type(None):
+        offline_gcvs_xmatch(data_dir, sector, gcvs_file,
+                            out=database_dir+'Sector'+str(sector)+'_GCVS.txt')
+    elif query_gcvs:
         # >> query GCVS
         query_vizier(ticid_list=ticid_list, data_dir=data_dir, sector=sector,
                      out=database_dir+'Sector'+str(sector)+'_GCVS.txt', query_mast=False)
@@ -638,7 +1213,8 @@ def bulk_download_helper(yourpath, shell_script):
 #data process an entire group of TICs
 def data_access_by_group_fits(yourpath, sectorfile, sector, camera, ccd,
                               bulk_download=False, bulk_download_dir='./',
-                              custom_mask=[], apply_nan_mask=False):
+                              custom_mask=[], apply_nan_mask=False,
+                              fits_index=None, n_workers=None):
     """you will need:
         your path into the main folder you're working in - must end with /
         the file for your sector from TESS (full path)
@@ -646,10 +1222,10 @@ def data_access_by_group_fits(yourpath, sectorfile, sector, camera, ccd,
         camera number you want (as int/float)
         ccd number you want (as int/float)
         this ONLY returns the target list and folderpath for the group
+        fits_index and n_workers are passed to lc_from_bulk_download()
         
         Saves a .fits file with primaryHDU=f[0]=time array,
-        f[1]=raw intensity array, f[2] = interpolated intensity array (not normalized!)
-        , f[3]=TICIDs
+        f[1]=interpolated intensity array (not normalized!), f[2]=TICIDs
         """
     # produce the folder to save everything into and set up file names
     folder_name = "Sector" + str(sector) + "Cam" + str(camera) + "CCD" + str(ccd)
@@ -678,7 +1254,9 @@ def data_access_by_group_fits(yourpath, sectorfile, sector, camera, ccd,
                                       fname_time_intensities, fname_targets,
                                       fname_notes, path, fname_flagged,
                                       custom_mask=custom_mask,
-                                      apply_nan_mask=apply_nan_mask)
+                                      apply_nan_mask=apply_nan_mask,
+                                      fits_index=fits_index,
+                                      n_workers=n_workers)
         else: # >> download each light curve
             # !! TODO: add flag option to lc_from_target_list()
             confirmation = lc_from_target_list(yourpath, target_list,
@@ -693,90 +1271,78 @@ def data_access_by_group_fits(yourpath, sectorfile, sector, camera, ccd,
         print("There was an OS Error trying to create the folder. Check to see if data is already saved there")
         targets = "empty"
         
-def follow_up_on_missed_targets_fits(yourpath, sector, camera, ccd):
-    """ function to follow up on rejected TIC ids"""
+def follow_up_on_missed_targets_fits(yourpath, sector, camera, ccd,
+                                     cache_dir=None, **kwargs):
+    """ function to follow up on rejected TIC ids
+    Retries every target listed in the group notes with download_mast_lcs()
+    (kwargs are passed to it), and saves the TICIDs that still have no data
+    to _targets_still_no_data.txt.
+    returns: TICIDs still without data, path"""
     folder_name = "Sector" + str(sector) + "Cam" + str(camera) + "CCD" + str(ccd)
     path = yourpath + folder_name
-    fname_time_intensities = path + "/" + folder_name + "_lightcurves.fits"
-    fname_targets = path + "/" + folder_name + "_targets.txt"
     fname_notes = path + "/" + folder_name + "_group_notes.txt"
     fname_notes_followed_up = path + "/" + folder_name + "_targets_still_no_data.txt"
+    if type(cache_dir) == type(None):
+        cache_dir = yourpath + 'lc_cache/'
     
+    retry_targets = np.loadtxt(fname_notes, skiprows=1, ndmin=1)
+    fnames, failed = download_mast_lcs(retry_targets, cache_dir,
+                                       retry_failed=True, **kwargs)
+    print("after following up, found data for ", len(fnames), " targets")
     
-    retry_targets = np.loadtxt(fname_notes, skiprows=1)
-    retry_targets = np.column_stack((retry_targets, retry_targets)) #loak this is a crude way to get around some indexing issues and we're working with it
-    
-    with open(fname_notes_followed_up, 'a') as file_object:
+    with open(fname_notes_followed_up, 'w') as file_object:
         file_object.write("Data could not be found for the following TICs after two attempts")
+        for target in failed:
+            file_object.write("\n" + str(int(target)))
     
-    
-    for n in range(len(retry_targets)):
-        target = retry_targets[n][0] #get that target number
-        time1, i1 = get_lc_file_and_data(yourpath, target)
-        if type(i1) == np.ndarray: #IF THE DATA IS FORMATTED LKE DATA
-            fits.append(fname_time_intensities, i1, header=hdr)
-            with open(fname_targets, 'a') as file_object:
-                file_object.write("\n")
-                file_object.write(str(int(target)))
-        else: #IF THE DATA IS NOT DATA
-            print("File failed to return targets")
-            with open(fname_notes_followed_up, 'a') as file_object:
-                file_object.write("\n")
-                file_object.write(str(int(target)))
-    
-    
-    targets = np.loadtxt(fname_targets, skiprows=1)
-    print("after following up, found data for ", len(targets), " targets")
-    
-    return targets, path
+    return failed, path
 
     
 def lc_from_target_list(yourpath, targetList, fname_time_intensities_raw,
                              fname_targets, fname_notes, path='./',
-                             custom_mask=[], apply_nan_mask=False):
+                             custom_mask=[], apply_nan_mask=False,
+                             cache_dir=None, **kwargs):
     """ runs getting the files and data for all targets on the list
     then appends the time & intensity arrays and the TIC number into text files
     that can later be accessed
+    Light curves are downloaded concurrently into cache_dir (default
+    yourpath+'lc_cache/') with download_mast_lcs(), which is given kwargs, so
+    re-running after an interruption only downloads the missing targets.
     modified [lcg 07092020]
     """
+    if type(cache_dir) == type(None):
+        cache_dir = yourpath + 'lc_cache/'
+    fnames, failed = download_mast_lcs(np.asarray(targetList)[:,0], cache_dir,
+                                       **kwargs)
+    
+    if len(failed) > 0:
+        with open(fname_notes, 'a') as file_object:
+            for target in failed:
+                file_object.write("\n")
+                file_object.write(str(int(target)))
+    
+    if len(fnames) == 0:
+        print('No light curves were downloaded, see ' + fname_notes)
+        return "lc_from_target_list: no light curves downloaded"
+    
     intensity = []
     ticids = []
-    for n in range(len(targetList)): #for each item on the list
-        
-        if n == 0: #for the first target only do you need to get the time index
-            target = targetList[n][0] #get that target number
-            time1, i1, tic = get_lc_file_and_data(yourpath, target) #grab that data
-            
-            if type(i1) == np.ndarray: #if the data IS data
-                intensity.append(i1)
-                ticids.append(tic)
-            else: #if the data is NOT a data
-                print("First target failed, no time index was saved")
-                with open(fname_notes, 'a') as file_object:
-                    file_object.write("\n")
-                    file_object.write(str(int(target)))
-        else: #only saving the light curve into the fits file because it's all you need
-            target = targetList[n][0] #get that target number
-            time1, i1, tic = get_lc_file_and_data(yourpath, target)
-            if type(i1) == np.ndarray:
-                intensity.append(i1)    
-                ticids.append(tic)
-            else: #IF THE DATA IS NOT DATA
-                print("File failed to return targets")
-                with open(fname_notes, 'a') as file_object:
-                    file_object.write("\n")
-                    file_object.write(str(int(target)))
-        
-        #if n %10 == 0: #every 50, print how many have been done
-        print(str(n), "completed")
+    for n, target in enumerate(fnames.keys()):
+        time1, i1, tic = read_lc_fits(fnames[target][0])
+        intensity.append(i1)
+        ticids.append(tic)
+        if n == 0: # >> only need the time index of the first target
+            time = time1
             
     intensity = np.array(intensity)
     ticids = np.array(ticids)
+    with open(fname_targets, 'a') as f:
+        f.write(''.join(['\n' + str(int(tic)) for tic in ticids]))
     
     # >> interpolate and nan mask
     print('Interpolating and applying nan mask')
     intensity_interp, time, ticids, flagged, ticid_flagged = \
-        interpolate_all(intensity, time1, ticids, custom_mask=custom_mask,
+        interpolate_all(intensity, time, ticids, custom_mask=custom_mask,
                         apply_nan_mask=apply_nan_mask)
     
     print('Saving to fits file')
@@ -787,92 +1353,306 @@ def lc_from_target_list(yourpath, targetList, fname_time_intensities_raw,
     fits.append(fname_time_intensities_raw, intensity_interp)
     fits.append(fname_time_intensities_raw, ticids)
     
-    # >> actually i'm going to save the raw intensities just in case
-    fits.append(fname_time_intensities_raw, intensity)
-    
-    # with open(fname_time_intensities_raw, 'rb+') as f:
-    #     # >> don't want to save 2x data we need to, so only save interpolated
-    #     # fits.append(fname_time_intensities_raw, intensity)
-    #     fits.append(fname_time_intensities_raw, i_interp)
-    #     fits.append(fname_time_intensities_raw, ticids)
-    
     confirmation = "lc_from_target_list has finished running"
     return confirmation
 
-def get_lc_file_and_data(yourpath, target):
+def get_lc_file_and_data(yourpath, target, cache_dir=None, **kwargs):
     """ goes in, grabs the data for the target, gets the time index, intensity,and TIC
     if connection error w/ MAST, skips it.
     Also masks any flagged data points according to the QUALITY column.
     parameters: 
         * yourpath, where you want the files saved to. must end in /
         * targets, target list of all TICs 
+        * cache_dir : download cache (default yourpath+'lc_cache/'), files
+          already in the cache are not downloaded again
+        * kwargs are passed to download_mast_lcs()
     modified [lcg 07082020] - fixed handling no results, fixed deleting download folder"""
-    fitspath = yourpath + 'mastDownload/TESS/' # >> download directory
+    if type(cache_dir) == type(None):
+        cache_dir = yourpath + 'lc_cache/'
     targ = "TIC " + str(int(target))
     print(targ)
-    try:
-        #find and download data products for your target objectname='TIC '+str(int(target)),
-        obs_table = Observations.query_criteria(obs_collection='TESS',
-                                        dataproduct_type='timeseries',
-                                        target_name=str(int(target)),
-                                        objectname=targ)
-        data_products_by_obs = Observations.get_product_list(obs_table[0:8])
-            
-        filter_products = Observations.filter_products(data_products_by_obs,
-                                                       description = 'Light curves')
-        if len(filter_products) != 0:
-            manifest = Observations.download_products(filter_products, download_dir= yourpath, extension='fits')
-        else: 
-            print("Query yielded no matching data produts for ", targ)
-            time1 = 0
-            i1 = 0
-            ticid = 0
-            
-        #get all the paths to lc.fits files
-        filepaths = []
-        for root, dirs, files in os.walk(fitspath):
-            for name in files:
-                #print(name)
-                if name.endswith(("lc.fits")):
-                    filepaths.append(root + "/" + name)
-        #print(len(filepaths))
-        #print(filepaths)
-        
-        if len(filepaths) == 0: #if no lc.fits were downloaded, move on
-            print("No lc.fits files available for TIC ", targ)
-            time1 = 0
-            i1 = 0
-            ticid = 0
-        else: #if there are lc.fits files, open them and get the goods
-                #get the goods and then close it
-            f = fits.open(filepaths[0], memmap=False)
-            time1 = f[1].data['TIME']
-            i1 = f[1].data['PDCSAP_FLUX']
-            ticid = f[1].header["TICID"]
-            quality = f[1].data['QUALITY']
-            f.close()
-            
-            # >> mask out any nonzero points
-            flagged_inds = np.nonzero(quality)
-            i1[flagged_inds] = np.nan # >> will be interpolated later
-                  
-        #then delete all downloads in the folder, no matter what type
-        if os.path.isdir(yourpath + "mastDownload") == True:
-            shutil.rmtree(yourpath + "mastDownload")
-            print("Download folder deleted.")
-            
-        #corrects for connnection errors
-    except (ConnectionError, OSError, TimeoutError, RemoteServiceError):
-        print(targ, " could not be accessed due to an error.")
-        i1 = 0
-        time1 = 0
-        ticid = 0
+    fnames, failed = download_mast_lcs([target], cache_dir, retry_failed=True,
+                                       **kwargs)
+    if len(failed) > 0:
+        print(targ, " could not be accessed.")
+        return 0, 0, 0
     
+    time1, i1, ticid = read_lc_fits(fnames[int(target)][0])
     return time1, i1, ticid
 
+# :: Concurrent MAST downloads :::::::::::::::::::::::::::::::::::::::::::::::::
+# >> download_mast_lcs() keeps, in cache_dir:
+# >>   * objects/ : downloaded lc.fits files, named by the sha256 of their
+# >>                contents, so each file is only stored once
+# >>   * manifest.txt : one tab-separated line per attempt: ticid, status
+# >>                    ('done', 'none' or 'failed'), urls, sha256s (urls and
+# >>                    sha256s comma-separated). The last line for a TICID wins
+# >> Lines are appended as each target finishes, so an interrupted run
+# >> resumes where it stopped.
+
+MAST_URL = 'https://mast.stsci.edu'
+
+def with_retries(func, max_retries=5, backoff=2., name=''):
+    '''Returns func(), retrying with exponential backoff (backoff**attempt s)
+    on connection errors and server errors. A 4xx reply is not retried.'''
+    import urllib.error
+    import time
+    
+    for attempt in range(max_retries):
+        try:
+            return func()
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == max_retries - 1:
+                raise
+        except (urllib.error.URLError, ConnectionError, TimeoutError, OSError):
+            if attempt == max_retries - 1:
+                raise
+        print('Retrying '+name+' in '+str(backoff**attempt)+' s')
+        time.sleep(backoff**attempt)
+
+def mast_invoke(service, params, mast_url=MAST_URL, timeout=60.,
+                max_retries=5, backoff=2.):
+    '''Sends one request to the MAST portal API (mast_url/api/v0/invoke, the
+    interface astroquery.mast uses) and returns the rows of the reply.'''
+    import urllib.parse
+    import urllib.request
+    import time
+    
+    request = {'service': service, 'params': params, 'format': 'json',
+               'pagesize': 100000, 'page': 1}
+    data = urllib.parse.urlencode({'request': json.dumps(request)}).encode()
+    def post():
+        with urllib.request.urlopen(mast_url + '/api/v0/invoke', data=data,
+                                    timeout=timeout) as response:
+            return json.loads(response.read().decode())
+    
+    for attempt in range(max_retries):
+        reply = with_retries(post, max_retries=max_retries, backoff=backoff,
+                             name=service)
+        if reply.get('status') != 'EXECUTING': # >> long queries are re-sent
+            break
+        time.sleep(backoff**attempt)
+    if reply.get('status') != 'COMPLETE':
+        raise RemoteServiceError(service + ': ' + str(reply.get('msg')))
+    return reply['data']
+
+def mast_lc_urls(ticid, mast_url=MAST_URL, timeout=60., max_retries=5,
+                 backoff=2.):
+    '''Queries MAST (at mast_url) for the light curve products of one target.
+    Returns a list of download URLs (empty if MAST has no light curves).'''
+    kwargs = dict(mast_url=mast_url, timeout=timeout, max_retries=max_retries,
+                  backoff=backoff)
+    filters = [{'paramName': 'obs_collection', 'values': ['TESS']},
+               {'paramName': 'dataproduct_type', 'values': ['timeseries']},
+               {'paramName': 'target_name', 'values': [str(int(ticid))]}]
+    obs_table = mast_invoke('Mast.Caom.Filtered',
+                            {'columns': 'obsid', 'filters': filters}, **kwargs)
+    if len(obs_table) == 0:
+        return []
+    products = mast_invoke('Mast.Caom.Products',
+                           {'obsid': ','.join([str(row['obsid']) \
+                                               for row in obs_table])},
+                           **kwargs)
+    return [mast_url + '/api/v0.1/Download/file?uri=' + row['dataURI'] \
+            for row in products if row['description'] == 'Light curves' \
+            and row['dataURI'].endswith('lc.fits')]
+
+def curl_script_lc_urls(shell_script):
+    '''Reads the download URL of every target from a bulk download shell script
+    (tesscurl_sector_*_lc.sh from
+    http://archive.stsci.edu/tess/bulk_downloads.html), which can be passed
+    to download_mast_lcs() instead of querying MAST target by target.
+    Returns:
+        * urls : dictionary, urls[ticid] = [url]
+    '''
+    urls = {}
+    with open(shell_script, 'r') as f:
+        for line in f.readlines():
+            line = line.split()
+            if len(line) < 7 or line[0] != 'curl':
+                continue
+            ticid = int(line[5].split('-')[2])
+            urls.setdefault(ticid, []).append(line[6])
+    return urls
+
+def read_download_manifest(cache_dir):
+    '''Returns dictionary manifest[ticid] = [status, [urls], [sha256s]] from
+    the last attempt for each TICID in cache_dir/manifest.txt.'''
+    manifest = {}
+    if not os.path.exists(cache_dir + 'manifest.txt'):
+        return manifest
+    with open(cache_dir + 'manifest.txt', 'r') as f:
+        for line in f.readlines():
+            line = line[:-1].split('\t')
+            if len(line) != 4: # >> partially written line
+                continue
+            ticid, status, urls, shas = line
+            manifest[int(ticid)] = [status, urls.split(',') if urls else [],
+                                    shas.split(',') if shas else []]
+    return manifest
+
+def fetch_url(url, fname, max_retries=5, backoff=2., timeout=60.):
+    '''Downloads url into fname, retrying with exponential backoff on
+    connection errors and server errors (a 4xx reply is not retried).
+    Returns the sha256 of the downloaded file.'''
+    import urllib.request
+    
+    def fetch():
+        sha = hashlib.sha256()
+        with urllib.request.urlopen(url, timeout=timeout) as response, \
+            open(fname, 'wb') as f:
+            while True:
+                block = response.read(1 << 20)
+                if not block:
+                    break
+                sha.update(block)
+                f.write(block)
+        return sha.hexdigest()
+    return with_retries(fetch, max_retries=max_retries, backoff=backoff,
+                        name=url)
+
+def download_mast_lcs(ticid_list, cache_dir, urls=None, n_workers=8,
+                      max_retries=5, backoff=2., timeout=60., 
+                      retry_failed=False, mast_url=MAST_URL, lc_urls=None):
+    '''Downloads the lc.fits files of many targets with a bounded pool of
+    concurrent requests, into a content-addressed cache with a persistent
+    manifest (see above). Targets already done in the manifest are not
+    downloaded again.
+    Parameters:
+        * ticid_list : list of TICIDs
+        * cache_dir : directory of the cache and manifest (ending with '/')
+        * urls : dictionary urls[ticid] = [download urls], e.g. from
+                 curl_script_lc_urls(). Targets not in urls are looked up with
+                 lc_urls
+        * n_workers : maximum number of concurrent requests
+        * max_retries, backoff, timeout : see fetch_url()
+        * retry_failed : if True, also retries targets that failed before
+        * mast_url : MAST server for both the product queries and the
+                     downloads (see mast_lc_urls()), e.g. a local stand-in
+                     for testing
+        * lc_urls : function lc_urls(ticid) returning the download URLs of a
+                    target, default is mast_lc_urls() at mast_url
+    Returns:
+        * fnames : dictionary fnames[ticid] = [paths to cached lc.fits files],
+                   in the order of ticid_list
+        * failed : list of TICIDs without light curves
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    
+    if type(lc_urls) == type(None):
+        def lc_urls(ticid):
+            return mast_lc_urls(ticid, mast_url=mast_url, timeout=timeout,
+                                max_retries=max_retries, backoff=backoff)
+    os.makedirs(cache_dir + 'objects/', exist_ok=True)
+    manifest = read_download_manifest(cache_dir)
+    lock = threading.Lock()
+    
+    def object_path(sha):
+        return cache_dir + 'objects/' + sha + '.fits'
+
+    def record(ticid, status, target_urls=[], shas=[]):
+        with lock:
+            with open(cache_dir + 'manifest.txt', 'a') as f:
+                f.write('{}\t{}\t{}\t{}\n'.format(ticid, status,
+                                                  ','.join(target_urls),
+                                                  ','.join(shas)))
+
+    def download(ticid):
+        try:
+            if type(urls) != type(None) and ticid in urls:
+                target_urls = urls[ticid]
+            else:
+                target_urls = lc_urls(ticid)
+            if len(target_urls) == 0:
+                print('No light curves for TIC '+str(ticid))
+                record(ticid, 'none')
+                return ticid, 'none', []
+            shas = []
+            for url in target_urls:
+                tmp = cache_dir + 'objects/.' + str(ticid) + '-' + \
+                    str(threading.get_ident()) + '.tmp'
+                sha = fetch_url(url, tmp, max_retries=max_retries,
+                                backoff=backoff, timeout=timeout)
+                os.replace(tmp, object_path(sha))
+                shas.append(sha)
+            record(ticid, 'done', target_urls, shas)
+            return ticid, 'done', shas
+        except Exception as e:
+            print('TIC '+str(ticid)+' could not be accessed: '+str(e))
+            record(ticid, 'failed')
+            return ticid, 'failed', []
+
+    ticid_list = [int(ticid) for ticid in ticid_list]
+    todo = []
+    for ticid in ticid_list:
+        if ticid in manifest:
+            status, _, shas = manifest[ticid]
+            if status == 'done' and \
+                all([os.path.exists(object_path(sha)) for sha in shas]):
+                continue
+            if status in ['none', 'failed'] and not retry_failed:
+                continue
+        todo.append(ticid)
+    print(str(len(ticid_list)-len(todo))+' targets already in manifest, '+\
+          str(len(todo))+' to download')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for n, (ticid, status, shas) in enumerate(executor.map(download, todo)):
+            manifest[ticid] = [status, [], shas]
+            if n % 100 == 0:
+                print(str(n) + '/' + str(len(todo)) + ' completed')
+
+    fnames = {}
+    failed = []
+    for ticid in ticid_list:
+        status, _, shas = manifest[ticid]
+        if status == 'done':
+            fnames[ticid] = [object_path(sha) for sha in shas]
+        else:
+            failed.append(ticid)
+    return fnames, failed
+
+def index_bulk_download(fits_path):
+    '''Builds a TICID -> file name index of a bulk download directory with a
+    single directory listing. Bulk download files are named e.g.
+    tess2019306063752-s0018-0000000005613228-0162-s_lc.fits, where the third
+    field is the TICID.
+    Parameters:
+        * fits_path : directory containing all light curve fits files
+                      (ending with '/')
+    Returns:
+        * fits_index : dictionary, fits_index[ticid] = file name
+    '''
+    fits_index = {}
+    for fname in os.listdir(fits_path):
+        if not fname.endswith('_lc.fits'):
+            continue
+        fields = fname.split('-')
+        if len(fields) < 3 or not fields[2].isdigit():
+            print('Skipping '+fname+' (can not read TICID from file name)')
+            continue
+        fits_index[int(fields[2])] = fname
+    return fits_index
+
+def read_lc_fits(fname):
+    '''Reads TIME, PDCSAP_FLUX and the TICID header of one _lc.fits file,
+    and sets data points flagged in QUALITY to NaN.
+    Returns:
+        * time, flux, ticid
+    '''
+    with fits.open(fname, memmap=False) as hdul:
+        time = np.array(hdul[1].data['TIME'])
+        i = np.array(hdul[1].data['PDCSAP_FLUX'])
+        quality = hdul[1].data['QUALITY']
+        ticid = hdul[1].header['TICID']
+    i[np.nonzero(quality)] = np.nan
+    return time, i, ticid
+
 def lc_from_bulk_download(fits_path, target_list, fname_out, fname_targets,
                           fname_notes, path, fname_flagged,
-                          custom_mask=[], apply_nan_mask=False):
+                          custom_mask=[], apply_nan_mask=False,
+                          fits_index=None, n_workers=None, chunksize=16):
     '''This function opens each _lc.fits file in fits_path, masks flagged data
     points from QUALITY and saves interpolated PDCSAP_FLUX, TIME and TICID to
     fits file fname_out.
@@ -885,68 +1665,46 @@ def lc_from_bulk_download(fits_path, target_list, fname_out, fname_targets,
         * fname_notes : saves the ticid of any target it fails on
         * path : directory to save nan mask plots in
         * fname_flagged : name of fits file to save flagged light curves
+        * fits_index : returned by index_bulk_download(), built from fits_path
+                       if not given (pass it in when ingesting many groups)
+        * n_workers : number of processes reading fits files (default is the
+                      number of CPUs)
+        * chunksize : number of files handed to a process at a time
     Returns:
-        * confirmation : boolean, returns False if failure
+        * time, intensity_interp, ticid_interp, flagged, ticid_flagged
     '''
-    import fnmatch
-    import gc
-    
-    # >> get list of all light curve fits files
-    fnames_all = os.listdir(fits_path)
-    fnames = fnmatch.filter(fnames_all, '*fits*')
+    from multiprocessing import Pool
     
     # >> find all light curves in a group
-    fnames_group = []
-    target_list = target_list[:,0]
-    for target in target_list:
-        try:
-            fname = list(filter(lambda x: str(int(target)) in x, fnames))[0]
-            fnames_group.append(fname)
-        except:
+    if type(fits_index) == type(None):
+        fits_index = index_bulk_download(fits_path)
+    fnames = []
+    missing = []
+    for target in target_list[:,0]:
+        if int(target) in fits_index:
+            fnames.append(fits_path + fits_index[int(target)])
+        else:
             print('Missing ' + str(int(target)))
-            with open(fname_notes, 'a') as f:
-                f.write(str(int(target)) + '\n')
-        
-    fnames = fnames_group
-    count = 0
-    
+            missing.append(str(int(target)))
+    if len(missing) > 0:
+        with open(fname_notes, 'a') as f:
+            f.write('\n'.join(missing) + '\n')
+
+    # >> read light curves in parallel (imap keeps the order of fnames)
+    print('Reading '+str(len(fnames))+' light curves...')
     ticid_list = []
     intensity = []
-    for n in range(len(fnames)):
-        
-        file = fnames[n]
-        print(count)
-        
-        # >> open file
-        with fits.open(fits_path + file, memmap=False) as hdul:
-            hdu_data = hdul[1].data
-            
-            # >> get time array (only for the first light curve)
-            if n == 0: 
-                time = hdu_data['TIME']
-                
-            # >> get flux array
-            i = hdu_data['PDCSAP_FLUX']
+    with Pool(processes=n_workers) as pool:
+        for n, (t, i, ticid) in enumerate(pool.imap(read_lc_fits, fnames,
+                                                    chunksize=chunksize)):
+            if n == 0: # >> get time array (only for the first light curve)
+                time = t
             intensity.append(i)
-            
-            # >> get quality mask
-            quality = hdu_data['QUALITY']
-            flagged_inds = np.nonzero(quality)
-            i[flagged_inds] = np.nan
-            
-            # >> get ticid
-            ticid = hdul[1].header['TICID']
             ticid_list.append(ticid)
-            with open(fname_targets, 'a') as f:
-                f.write(str(int(ticid)) + '\n')
-            
-            # >> clear memory
-            del hdu_data
-            del hdul[1].data
-            del hdul[0].data
-            gc.collect()
-            
-        count += 1
+            if n % 1000 == 0:
+                print(str(n) + '/' + str(len(fnames)))
+    with open(fname_targets, 'a') as f:
+        f.write(''.join([str(int(ticid)) + '\n' for ticid in ticid_list]))
     
     # >> interpolate and NaN mask
     print('Interpolating...')
@@ -958,27 +1716,415 @@ def lc_from_bulk_download(fits_path, target_list, fname_out, fname_targets,
     
     # >> save time array, intensity array and ticids to fits file
     print('Saving to fits file...')
-    
-    hdr = fits.Header()
-    hdu = fits.PrimaryHDU(time, header=hdr)
-    hdu.writeto(fname_out)
-    fits.append(fname_out, intensity_interp)
-    fits.append(fname_out, ticid_interp)
-    # >> actually i'm going to save the raw intensities just in case
-    fits.append(fname_out, intensity)
+    del intensity
+    hdul = fits.HDUList([fits.PrimaryHDU(time, header=fits.Header()),
+                         fits.ImageHDU(intensity_interp),
+                         fits.ImageHDU(ticid_interp)])
+    hdul.writeto(fname_out)
     
     # >> save flagged
     if np.shape(flagged)[0] != 0:
-        hdr = fits.Header()
-        hdu = fits.PrimaryHDU(flagged, header=hdr)
-        hdu.writeto(fname_flagged)
-        fits.append(fname_flagged, ticid_flagged)
+        hdul = fits.HDUList([fits.PrimaryHDU(flagged, header=fits.Header()),
+                             fits.ImageHDU(ticid_flagged)])
+        hdul.writeto(fname_flagged)
     
     print("lc_from_bulk_download has finished running")
     return time, intensity_interp, ticid_interp, flagged, ticid_flagged
 
 
 
+# :: Streaming preprocessing :::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> bulk_download_to_store() goes from a bulk download directory straight to a
+# >> light curve store (see above), chunk_size light curves at a time:
+# >>   1st pass : read _lc.fits (QUALITY mask), sigma clip + interpolate, write
+# >>              to flux_interp.npy and count NaNs of each data point
+# >>   2nd pass : apply the global NaN mask, normalize and write flux.npy
+# >> so peak memory is set by chunk_size rather than the size of the sector.
+
+def stream_lc_fits(fnames, chunk_size=1000, n_workers=None, chunksize=16):
+    '''Reads _lc.fits files in parallel (see read_lc_fits()), and yields
+    (time, flux, ticid) for chunk_size light curves at a time, in the order of
+    fnames. time is the time array of the first light curve of the chunk.'''
+    from multiprocessing import Pool
+    
+    with Pool(processes=n_workers) as pool:
+        time = None
+        flux, ticid = [], []
+        for t, i, tic in pool.imap(read_lc_fits, fnames, chunksize=chunksize):
+            if type(time) == type(None):
+                time = t
+            flux.append(i)
+            ticid.append(tic)
+            if len(flux) == chunk_size:
+                yield time, np.array(flux), np.array(ticid)
+                time = None
+                flux, ticid = [], []
+        if len(flux) > 0:
+            yield time, np.array(flux), np.array(ticid)
+
+def normalize_chunk(flux, norm_type='standardization'):
+    '''Normalizes each light curve (row) of flux, so it can be applied to one
+    chunk at a time. norm_type is standardization, median_normalization,
+    minmax_normalization or none.'''
+    if norm_type == 'standardization':
+        return standardize(flux)
+    elif norm_type == 'median_normalization':
+        return normalize(flux)
+    elif norm_type == 'minmax_normalization':
+        flux = flux - np.nanmin(flux, axis=1, keepdims=True)
+        return flux / np.nanmax(flux, axis=1, keepdims=True)
+    else:
+        return flux
+
+def bulk_download_to_store(data_dir, sector, bulk_download_dir, cams=[1,2,3,4],
+                           ccds=[[1,2,3,4]]*4, data_type='SPOC',
+                           cadence='2-minute', fast=False, store_dir=None,
+                           custom_mask=[], apply_nan_mask=True,
+                           norm_type='none', chunk_size=1000,
+                           n_workers=None, fits_index=None, tol1=0.05,
+                           tol2=0.5, use_tol2=True, dtype='float32'):
+    '''Bounded-memory alternative to data_access_sector_by_bulk() followed by
+    load_data_from_metafiles(): preprocesses every _lc.fits file of a sector
+    in bulk_download_dir and writes the result into a light curve store,
+    which can be read with load_data_from_store(). No raw intensities are
+    kept.
+    Parameters:
+        * data_dir : contains SectorX/all_targets_S0XX_v1.txt
+        * sector, cams, ccds, data_type, cadence, fast : same as
+          load_data_from_metafiles()
+        * bulk_download_dir : directory containing all the _lc.fits files
+        * store_dir : default is get_lc_store_dir()
+        * custom_mask : list of indices to remove from all light curves
+        * apply_nan_mask : if True, removes data points with a NaN in any
+                           light curve (see nan_mask()), otherwise keeps them
+        * norm_type : see normalize_chunk(). Recorded in store_info.json.
+                      The default ('none') stores raw flux, like
+                      convert_metafiles_to_store(), which is what
+                      load_data_from_store() callers expect
+        * chunk_size : number of light curves in memory at a time
+        * n_workers : number of processes reading _lc.fits files
+        * fits_index : returned by index_bulk_download()
+        * tol1, tol2, use_tol2 : see nan_mask()
+    Returns:
+        * store_dir
+    '''
+    if type(store_dir) == type(None):
+        store_dir = get_lc_store_dir(data_dir, sector, fast=fast)
+    os.makedirs(store_dir, exist_ok=True)
+    if type(fits_index) == type(None):
+        fits_index = index_bulk_download(bulk_download_dir)
+    sectorpath = data_dir + 'Sector' + str(sector) + ('_20s/' if fast else '/')
+    sectorfile = sectorpath + 'all_targets_S%03d'%sector + '_v1.txt'
+
+    # >> find all light curves in the sector
+    fnames = []
+    fname_info = [] # >> [cam, ccd] of each file
+    for i in range(len(cams)):
+        for ccd in ccds[i]:
+            target_list = lc_by_camera_ccd(sectorfile, cams[i], ccd)
+            for target in target_list[:,0]:
+                if int(target) in fits_index:
+                    fnames.append(bulk_download_dir + fits_index[int(target)])
+                    fname_info.append([cams[i], ccd])
+                else:
+                    print('Missing ' + str(int(target)))
+    fname_info = np.array(fname_info, dtype='int').reshape(-1, 2)
+
+    # -- 1st pass: interpolate and count NaNs ----------------------------------
+    print('Interpolating '+str(len(fnames))+' light curves...')
+    flux_interp = None
+    rows = [] # >> index into fnames of each row of flux_interp
+    ticid = []
+    ticid_flagged = []
+    start = 0
+    for time_chunk, flux, ticid_chunk in stream_lc_fits(fnames, chunk_size,
+                                                        n_workers=n_workers):
+        if type(flux_interp) == type(None):
+            time = time_chunk
+            cols = np.delete(np.arange(len(time)), custom_mask)
+            flux_interp = np.lib.format.open_memmap(store_dir+'flux_interp.npy',
+                                                    mode='w+', dtype=dtype,
+                                                    shape=(len(fnames),
+                                                           len(time)))
+            col_nan = np.zeros(len(cols), dtype='bool')
+            num_nan = []
+        flux, _, ticid_kept, flagged, ticid_flag = \
+            interpolate_all(flux, time, ticid_chunk, batched=True)
+        kept = np.nonzero(~np.isin(ticid_chunk, ticid_flag))[0]
+        row = len(rows)
+        flux_interp[row:row+len(kept)] = flux
+        rows.extend(start + kept)
+        ticid.extend(ticid_kept)
+        ticid_flagged.extend(ticid_flag)
+        isnan = np.isnan(flux[:,cols])
+        col_nan |= np.any(isnan, axis=0)
+        num_nan.extend(np.sum(isnan, axis=1))
+        start += len(ticid_chunk)
+        print(str(start) + '/' + str(len(fnames)))
+    flux_interp.flush()
+    interp = {'flux': flux_interp, 'ticid': np.array(ticid, dtype='int64'),
+              'info': {'chunk_size': chunk_size}}
+    rows = np.array(rows)
+    np.save(store_dir+'ticid_flagged.npy', np.array(ticid_flagged,
+                                                    dtype='int64'))
+
+    # >> global NaN mask (from the counts of the 1st pass)
+    keep = np.arange(len(rows))
+    if apply_nan_mask:
+        print('Applying nan mask')
+        keep, cols = nan_mask_store(interp, keep, cols, output_dir=store_dir,
+                                    tol1=tol1, tol2=tol2, use_tol2=use_tol2,
+                                    chunk_size=chunk_size, col_nan=col_nan,
+                                    num_nan=np.array(num_nan), plot=True)
+
+    # -- 2nd pass: normalize and write store -----------------------------------
+    print('Writing light curve store to ' + store_dir)
+    flux = np.lib.format.open_memmap(store_dir+'flux.npy', mode='w+',
+                                     dtype=dtype, shape=(len(keep), len(cols)))
+    nan_mask = np.lib.format.open_memmap(store_dir+'nan_mask.npy', mode='w+',
+                                         dtype='uint8',
+                                         shape=(len(keep), (len(cols)+7)//8))
+    start = 0
+    for rows_chunk, flux_chunk in iterate_lc_store(interp, keep, cols):
+        flux_chunk = normalize_chunk(flux_chunk, norm_type)
+        flux[start:start+len(rows_chunk)] = flux_chunk
+        nan_mask[start:start+len(rows_chunk)] = pack_nan_mask(flux_chunk)
+        start += len(rows_chunk)
+    flux.flush()
+    nan_mask.flush()
+    del flux, nan_mask, flux_interp, interp
+    os.remove(store_dir+'flux_interp.npy')
+
+    ticid = np.array(ticid, dtype='int64')[keep]
+    target_info = make_target_info(ticid, sector, fname_info[rows[keep],0],
+                                   fname_info[rows[keep],1], data_type,
+                                   cadence)
+    np.save(store_dir+'time.npy', time[cols])
+    np.save(store_dir+'cols.npy', cols)
+    np.save(store_dir+'ticid.npy', ticid)
+    np.save(store_dir+'target_info.npy', target_info)
+    np.save(store_dir+'ticid_index.npy', ticid_index(ticid)['rows'])
+
+    groups = []
+    for i in range(len(cams)):
+        for ccd in ccds[i]:
+            inds = np.nonzero((target_info['cam'] == cams[i]) * \
+                              (target_info['ccd'] == ccd))[0]
+            if len(inds) > 0:
+                groups.append([int(cams[i]), int(ccd), int(inds[0]),
+                               int(inds[-1]+1)])
+    store_info = {'sector': sector, 'data_type': data_type,
+                  'cadence': cadence, 'shape': [int(len(keep)), len(cols)],
+                  'dtype': np.dtype(dtype).str, 'chunk_size': chunk_size,
+                  'groups': groups, 'norm_type': norm_type}
+    write_store_info(store_dir, store_info)
+    write_ingest_record(store_dir, fnames)
+    
+    print("bulk_download_to_store has finished running")
+    return store_dir
+
+# :: Incremental ingest ::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> ingest_to_store() adds the _lc.fits files of a bulk download directory
+# >> that are not yet in a sector's light curve store (e.g. late-arriving
+# >> targets), or builds the store of a new sector with
+# >> bulk_download_to_store(). The store records the files it has ingested
+# >> (ingested_files.txt), so re-running ingest_to_store() on the same
+# >> directory only lists the directory. New light curves are interpolated,
+# >> put on the time axis of the store (cols.npy) and normalized like the rest
+# >> of the store, then appended in place to flux.npy, nan_mask.npy, ticid.npy,
+# >> target_info.npy and ticid_index.npy. Their NaNs are in their packed NaN
+# >> masks, so load_data_from_store() masks them like any other NaN.
+
+def read_ingest_record(store_dir):
+    '''Returns the set of file names already ingested into a store.'''
+    fname = store_dir + 'ingested_files.txt'
+    if not os.path.exists(fname):
+        return set()
+    with open(fname, 'r') as f:
+        return set(f.read().split())
+
+def write_ingest_record(store_dir, fnames):
+    '''Adds file names to the record of files ingested into a store.'''
+    with open(store_dir + 'ingested_files.txt', 'a') as f:
+        f.write(''.join([os.path.basename(fname) + '\n' for fname in fnames]))
+
+def append_npy(fname, arr, num_rows=None):
+    '''Writes arr after the first num_rows rows of the .npy file fname (default
+    after all of its rows) and updates the shape in its header, without
+    reading the rows already in the file. Rows after num_rows, e.g. left by an
+    interrupted append, are overwritten.'''
+    with open(fname, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+        if fortran_order or arr.shape[1:] != tuple(shape[1:]):
+            raise ValueError('Can not append array of shape '+str(arr.shape)+\
+                             ' to '+fname)
+        if type(num_rows) == type(None):
+            num_rows = shape[0]
+        shape = (num_rows + len(arr),) + tuple(shape[1:])
+        header = io.BytesIO()
+        d = {'shape': shape, 'fortran_order': False,
+             'descr': np.lib.format.dtype_to_descr(dtype)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, d)
+        else:
+            np.lib.format.write_array_header_2_0(header, d)
+        if len(header.getvalue()) == offset:
+            row_size = int(np.prod(shape[1:], dtype='int64')) * dtype.itemsize
+            f.seek(offset + num_rows*row_size)
+            f.write(arr.tobytes())
+            f.truncate()
+            f.seek(0) # >> header last, so it never describes missing rows
+            f.write(header.getvalue())
+            return
+
+    # >> header grew (older numpy doesn't pad it), so rewrite the file
+    old = np.load(fname, mmap_mode='r')
+    new = np.lib.format.open_memmap(fname+'.tmp', mode='w+', dtype=dtype,
+                                    shape=shape)
+    for start in range(0, num_rows, 1000):
+        new[start:min(start+1000, num_rows)] = old[start:min(start+1000,
+                                                             num_rows)]
+    new[num_rows:] = arr
+    new.flush()
+    del old, new
+    os.replace(fname+'.tmp', fname)
+
+def ingest_to_store(data_dir, sector, bulk_download_dir, cams=[1,2,3,4],
+                    ccds=[[1,2,3,4]]*4, data_type='SPOC', cadence='2-minute',
+                    fast=False, store_dir=None, chunk_size=1000,
+                    n_workers=None, **kwargs):
+    '''Incremental version of bulk_download_to_store(): appends the light
+    curves of _lc.fits files in bulk_download_dir that were not ingested yet
+    to the sector's light curve store, or builds the store if the sector
+    does not have one. Stores converted from metafiles can be appended to as
+    well: their targets are recognized by TICID.
+    Parameters:
+        * data_dir, sector, bulk_download_dir, cams, ccds, data_type,
+          cadence, fast, store_dir, chunk_size, n_workers : see
+          bulk_download_to_store()
+        * kwargs : passed to bulk_download_to_store() if the store is built
+    Returns:
+        * store_dir
+        * ticid : TICIDs added to the store
+    '''
+    if type(store_dir) == type(None):
+        store_dir = get_lc_store_dir(data_dir, sector, fast=fast)
+    fits_index = index_bulk_download(bulk_download_dir)
+    if not os.path.exists(store_dir+'store_info.json'):
+        print('Building light curve store for Sector '+str(sector))
+        bulk_download_to_store(data_dir, sector, bulk_download_dir, cams=cams,
+                               ccds=ccds, data_type=data_type,
+                               cadence=cadence, fast=fast, store_dir=store_dir,
+                               chunk_size=chunk_size, n_workers=n_workers,
+                               fits_index=fits_index, **kwargs)
+        return store_dir, np.load(store_dir+'ticid.npy')
+
+    # >> only a directory scan if there is nothing new
+    ingested = read_ingest_record(store_dir)
+    ticid = np.array([tic for tic in fits_index \
+                      if fits_index[tic] not in ingested], dtype='int64')
+    if len(ticid) == 0:
+        print('Sector '+str(sector)+' light curve store is up to date')
+        return store_dir, ticid
+
+    store = open_lc_store(store_dir)
+    info = store['info']
+    num_rows = info['shape'][0]
+    if os.path.exists(store_dir+'cols.npy'):
+        cols = np.load(store_dir+'cols.npy')
+    else: # >> converted from metafiles, which keep every data point
+        cols = np.arange(info['shape'][1])
+    norm_type = info.get('norm_type', 'none')
+    dtype = np.dtype(info['dtype'])
+
+    # >> targets already in the store only need to be recorded
+    in_store = ticid_lookup(store['index'], ticid) > -1
+    done = [fits_index[tic] for tic in ticid[in_store]]
+    ticid = ticid[~in_store]
+
+    # >> get camera and ccd of new targets from sectorfile
+    sectorpath = data_dir + 'Sector' + str(sector) + ('_20s/' if fast else '/')
+    sectorfile = sectorpath + 'all_targets_S%03d'%sector + '_v1.txt'
+    target_list = np.loadtxt(sectorfile, ndmin=2)
+    rows = ticid_join(target_list[:,0], ticid)
+    in_groups = np.zeros(len(ticid), dtype='bool')
+    for i in range(len(cams)):
+        for ccd in ccds[i]:
+            in_groups |= (rows > -1) * (target_list[rows,1] == cams[i]) * \
+                (target_list[rows,2] == ccd)
+    for tic in ticid[rows == -1]:
+        print('TIC '+str(tic)+' is not in '+sectorfile)
+    ticid, rows = ticid[in_groups], rows[in_groups]
+    cam = target_list[rows,1].astype('int')
+    ccd = target_list[rows,2].astype('int')
+    order = np.lexsort((ticid, ccd, cam)) # >> keep groups contiguous
+    ticid, cam, ccd = ticid[order], cam[order], ccd[order]
+    fnames = [bulk_download_dir + fits_index[tic] for tic in ticid]
+
+    # >> append light curves chunk by chunk
+    print('Ingesting '+str(len(fnames))+' light curves into '+store_dir)
+    new_ticid, new_cam, new_ccd = [], [], []
+    ticid_flagged = []
+    row = num_rows
+    start = 0
+    for time, flux, ticid_chunk in stream_lc_fits(fnames, chunk_size,
+                                                  n_workers=n_workers):
+        if np.shape(flux)[1] <= cols[-1]:
+            raise ValueError('Light curves in '+bulk_download_dir+\
+                             ' are shorter than the time axis of '+store_dir)
+        flux, _, ticid_kept, flagged, ticid_flag = \
+            interpolate_all(flux, time, ticid_chunk, batched=True)
+        kept = start + np.nonzero(~np.isin(ticid_chunk, ticid_flag))[0]
+        flux = normalize_chunk(flux[:,cols], norm_type).astype(dtype)
+        append_npy(store_dir+'flux.npy', flux, row)
+        append_npy(store_dir+'nan_mask.npy', pack_nan_mask(flux), row)
+        new_ticid.extend(ticid_kept)
+        new_cam.extend(cam[kept])
+        new_ccd.extend(ccd[kept])
+        ticid_flagged.extend(ticid_flag)
+        row += len(flux)
+        start += len(ticid_chunk)
+        print(str(start) + '/' + str(len(fnames)))
+    new_ticid = np.array(new_ticid, dtype='int64')
+    new_cam, new_ccd = np.array(new_cam), np.array(new_ccd)
+
+    # >> update TICIDs, target_info and TICID index
+    target_info = make_target_info(new_ticid, info['sector'], new_cam, new_ccd,
+                                   info['data_type'], info['cadence'])
+    np.save(store_dir+'ticid.npy',
+            np.concatenate([store['ticid'][:num_rows], new_ticid]))
+    np.save(store_dir+'target_info.npy',
+            np.concatenate([store['target_info'][:num_rows], target_info]))
+    index = update_ticid_index(store['index'], new_ticid,
+                               np.arange(num_rows, row))
+    np.save(store_dir+'ticid_index.npy', index['rows'])
+    if len(ticid_flagged) > 0: # >> unique, in case an ingest is redone
+        if os.path.exists(store_dir+'ticid_flagged.npy'):
+            ticid_flagged = np.concatenate([np.load(store_dir+'ticid_flagged.npy'),
+                                            ticid_flagged])
+        np.save(store_dir+'ticid_flagged.npy',
+                np.unique(np.array(ticid_flagged, dtype='int64')))
+
+    # >> store_info.json and then the record, so an interrupted ingest is
+    # >> redone. Until store_info.json is written, open_lc_store() ignores the
+    # >> rows appended above (and rebuilds the TICID index without them)
+    for c, d in np.unique(np.array([new_cam, new_ccd]).T.reshape(-1, 2),
+                          axis=0):
+        inds = num_rows + np.nonzero((new_cam == c) * (new_ccd == d))[0]
+        info['groups'].append([int(c), int(d), int(inds[0]), int(inds[-1]+1)])
+    info['shape'][0] = int(row)
+    write_store_info(store_dir, info)
+    write_ingest_record(store_dir, done + fnames)
+    
+    print('Added '+str(len(new_ticid))+' light curves to '+store_dir)
+    return store_dir, new_ticid
+
 def tic_list_by_magnitudes(path, lowermag, uppermag, n, filelabel):
     """ Creates a fits file of the first n TICs that fall between the given
     magnitude ranges. 
@@ -1043,27 +2189,55 @@ def standardize(x, ax=1):
 #interpolate and sigma clip
 def interpolate_all(flux, time, ticid, flux_err=False, interp_tol=20./(24*60),
                     num_sigma=10, k=3, DEBUG_INTERP=False, output_dir='./',
-                    apply_nan_mask=False, DEBUG_MASK=False, custom_mask=[]):
-    '''Interpolates each light curves in flux array.'''
-    
-    flux_interp = []
-    ticid_interp = []
-    flagged = []
-    ticid_flagged = []
-    for i in range(len(flux)):
-        i_interp, flag = interpolate_lc(flux[i], time, flux_err=flux_err,
-                                        interp_tol=interp_tol,
-                                        num_sigma=num_sigma, k=k,
-                                        DEBUG_INTERP=DEBUG_INTERP,
-                                        output_dir=output_dir,
-                                        prefix=str(i)+'-')
-        if not flag:
-            flux_interp.append(i_interp)
-            ticid_interp.append(ticid[i])
+                    apply_nan_mask=False, DEBUG_MASK=False, custom_mask=[],
+                    batched=False, batch_size=1000, n_workers=1):
+    '''Interpolates each light curves in flux array.
+    If batched, light curves are interpolated batch_size at a time with
+    interpolate_batch() (same results as interpolate_lc()), split between
+    n_workers processes. See benchmark_interpolate_all().'''
+    
+    if batched and not DEBUG_INTERP:
+        from multiprocessing import Pool
+        from functools import partial
+        
+        batches = [flux[i:i+batch_size] for i in range(0, len(flux),
+                                                       batch_size)]
+        func = partial(interpolate_batch, time=time, interp_tol=interp_tol,
+                       num_sigma=num_sigma, k=k)
+        if n_workers == 1:
+            results = list(map(func, batches))
         else:
-            flagged.append(i_interp)
-            ticid_flagged.append(ticid[i])
-            print('Spline interpolation failed!')
+            with Pool(processes=n_workers) as pool:
+                results = pool.map(func, batches)
+        flux_all = np.concatenate([res[0] for res in results])
+        flags = np.concatenate([res[1] for res in results])
+        ticid = np.asarray(ticid)
+        if np.count_nonzero(flags) > 0:
+            print('Spline interpolation failed for '+\
+                  str(np.count_nonzero(flags))+' light curves!')
+        flux_interp = list(flux_all[~flags])
+        ticid_interp = list(ticid[~flags])
+        flagged = list(flux_all[flags])
+        ticid_flagged = list(ticid[flags])
+    else:
+        flux_interp = []
+        ticid_interp = []
+        flagged = []
+        ticid_flagged = []
+        for i in range(len(flux)):
+            i_interp, flag = interpolate_lc(flux[i], time, flux_err=flux_err,
+                                            interp_tol=interp_tol,
+                                            num_sigma=num_sigma, k=k,
+                                            DEBUG_INTERP=DEBUG_INTERP,
+                                            output_dir=output_dir,
+                                            prefix=str(i)+'-')
+            if not flag:
+                flux_interp.append(i_interp)
+                ticid_interp.append(ticid[i])
+            else:
+                flagged.append(i_interp)
+                ticid_flagged.append(ticid[i])
+                print('Spline interpolation failed!')
     
     if apply_nan_mask:
         flux_interp, time = nan_mask(flux_interp, time, DEBUG=DEBUG_MASK,
@@ -1073,6 +2247,180 @@ def interpolate_all(flux, time, ticid, flux_err=False, interp_tol=20./(24*60),
     return np.array(flux_interp), time, np.array(ticid_interp), \
             np.array(flagged), np.array(ticid_flagged)
 
+def interpolate_batch(flux, time, interp_tol=20./(24*60), num_sigma=10, k=3,
+                      search_range=200, med_tol=2, spline_window=100):
+    '''Same as interpolate_lc() for many light curves sharing one time array.
+    Sigma clipping, NaN gap and orbit gap detection and linear interpolation
+    are done on the whole (num light curves, num data points) array, and
+    splines are only fit to spline_window non-NaN data points on either side
+    of each gap longer than interp_tol (which gives the same values as a
+    spline through the whole light curve, to floating point precision).
+    Light curves with no gap besides the orbit gap and the NaN windows at the
+    beginning and end are only sigma clipped, and not flagged.
+    Parameters:
+        * flux : shape=(num light curves, num data points), not modified
+        * time : shape=(num data points)
+        * interp_tol, num_sigma, k, search_range, med_tol : see
+          interpolate_lc()
+        * spline_window : number of data points on either side of a gap used
+                          to fit the spline
+    Returns:
+        * flux_interp : shape=(num light curves, num data points)
+        * flags : shape=(num light curves), same as flag from interpolate_lc()
+    '''
+    from scipy import interpolate
+    
+    flux = np.array(flux)
+    num_lc, n = flux.shape
+    dt = np.nanmin( np.diff(time) )
+    
+    # -- sigma clip (same as astropy's SigmaClip, one row per light curve) ----
+    valid = ~np.isnan(flux)
+    clip = ~valid
+    active = np.arange(num_lc)
+    lower = np.empty((num_lc, 1), dtype=flux.dtype)
+    upper = np.empty((num_lc, 1), dtype=flux.dtype)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        while len(active) > 0:
+            data = np.where(clip[active], np.nan, flux[active])
+            cen = np.nanmedian(data, axis=1, keepdims=True)
+            std = np.nanstd(data, axis=1, keepdims=True)
+            lower[active] = cen - std * num_sigma
+            upper[active] = cen + std * num_sigma
+            new_clip = clip[active] | (data < lower[active]) | \
+                (data > upper[active])
+            changed = np.any(new_clip != clip[active], axis=1)
+            clip[active] = new_clip
+            active = active[changed]
+        # >> mask is set by the final bounds
+        clip = ~valid | (flux < lower) | (flux > upper)
+    flux[clip] = np.nan
+    
+    # -- locate nan gaps ------------------------------------------------------
+    isnan = np.isnan(flux)
+    pad = np.zeros((num_lc, 1), dtype='int8')
+    edges = np.diff(np.concatenate([pad, isnan.astype('int8'), pad], axis=1),
+                    axis=1)
+    row, start = np.nonzero(edges == 1)
+    end = np.nonzero(edges == -1)[1]
+    length = end - start
+    
+    # >> remove nan windows at the beginning and end
+    keep = (start != 0) * (end != n)
+    row, start, end, length = row[keep], start[keep], end[keep], length[keep]
+    
+    # >> remove orbit gap (the first longest gap of each light curve)
+    order = np.lexsort((start, -length, row))
+    first = np.ones(len(order), dtype='bool')
+    first[1:] = row[order][1:] != row[order][:-1]
+    keep = np.ones(len(row), dtype='bool')
+    keep[order[first]] = False
+    row, start, end, length = row[keep], start[keep], end[keep], length[keep]
+    
+    # >> light curves without any other gaps have nothing to interpolate
+    fallback = np.ones(num_lc, dtype='bool')
+    fallback[row] = False
+    gaps = ~fallback[row]
+    row, start, end, length = row[gaps], start[gaps], end[gaps], length[gaps]
+    
+    # -- interpolate nan gaps -------------------------------------------------
+    valid = ~isnan * ~np.isnan(time)
+    flux_interp = np.copy(flux)
+    inds = np.arange(n)
+    prev_valid = np.maximum.accumulate(np.where(valid, inds, -1), axis=1)
+    next_valid = np.minimum.accumulate(np.where(valid, inds, n)[:,::-1],
+                                       axis=1)[:,::-1]
+    
+    # >> spline interpolate long gaps, unless the spline looks wrong
+    linear = length * dt < interp_tol
+    for a in np.nonzero(length * dt > interp_tol)[0]:
+        i = flux[row[a]]
+        num_inds = np.nonzero(valid[row[a]])[0]
+        left = max(np.searchsorted(num_inds, start[a]) - spline_window, 0)
+        right = np.searchsorted(num_inds, end[a]) + spline_window
+        num_inds = num_inds[left:right]
+        ius = interpolate.InterpolatedUnivariateSpline(num_inds, i[num_inds],
+                                                       k=k)
+        spline_interp = ius(inds[start[a]:end[a]])
+        
+        # >> compare std, median of interpolate region to local std, median
+        std_local = np.mean([np.nanstd(i[start[a]-search_range : start[a]]),
+                             np.nanstd(i[end[a] : end[a]+search_range])])
+        med_local = np.mean([np.nanmedian(i[start[a]-search_range : start[a]]),
+                             np.nanmedian(i[end[a] : end[a]+search_range])])
+        if np.std(spline_interp) > std_local or \
+            np.median(spline_interp) > med_tol*med_local or\
+                np.median(spline_interp) < med_local/med_tol:
+            linear[a] = True
+        else:
+            flux_interp[row[a], start[a]:end[a]] = spline_interp
+    
+    # >> linear interpolate between the non-NaN data points around each gap
+    # >> (same arithmetic as np.interp)
+    gap_row = np.repeat(row[linear], length[linear])
+    gap_x = np.concatenate([inds[s:e] for s, e in zip(start[linear],
+                                                      end[linear])] + \
+                           [np.empty(0, dtype='int')])
+    x0 = prev_valid[gap_row, np.repeat(start[linear], length[linear]) - 1]
+    x1 = next_valid[gap_row, np.repeat(end[linear], length[linear])]
+    x0 = np.where(x0 < 0, x1, x0)
+    x1 = np.where(x1 >= n, x0, x1)
+    y0 = flux[gap_row, x0].astype('float64')
+    y1 = flux[gap_row, x1].astype('float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (y1 - y0) / (x1 - x0)
+        y = np.where(x0 == x1, y0, slope * (gap_x - x0) + y0)
+    flux_interp[gap_row, gap_x] = y
+    
+    # >> interpolate_lc() falls back to linear interpolation (and resets flag)
+    # >> when the spline is rejected, so light curves are not flagged
+    flags = np.zeros(num_lc, dtype='bool')
+    
+    return flux_interp, flags
+
+def benchmark_interpolate_all(num_lc=200, n=18000, batch_size=100,
+                              n_workers=4, seed=0):
+    '''Times interpolate_all() per light curve and batched on synthetic light
+    curves (orbit gap, short and long NaN gaps, outliers), and checks that
+    both give the same results.
+    Returns:
+        * dictionary of run times (in seconds)
+    '''
+    import time as timer
+    
+    rng = np.random.default_rng(seed)
+    time = np.arange(n) * 2. / (24*60)
+    flux = (1000. + 10*np.sin(time[None,:] * rng.uniform(1, 5, (num_lc, 1))) +\
+            rng.normal(0, 1, (num_lc, n))).astype('float32')
+    flux[:, n//2 : n//2 + n//20] = np.nan # >> orbit gap
+    flux[:, :10] = np.nan
+    for i in range(num_lc):
+        for s in rng.integers(100, n-100, 20): # >> short gaps
+            flux[i, s:s+rng.integers(1, 10)] = np.nan
+        for s in rng.integers(200, n-200, 2): # >> long gaps
+            flux[i, s:s+rng.integers(20, 60)] = np.nan
+        flux[i, rng.integers(0, n, 3)] = 1e6 # >> outliers
+    ticid = np.arange(num_lc)
+    
+    runtimes = {}
+    start = timer.time()
+    res_loop = interpolate_all(np.copy(flux), time, ticid)
+    runtimes['per light curve'] = timer.time() - start
+    for workers in [1, n_workers]:
+        start = timer.time()
+        res_batch = interpolate_all(np.copy(flux), time, ticid, batched=True,
+                                    batch_size=batch_size, n_workers=workers)
+        runtimes['batched, '+str(workers)+' workers'] = timer.time() - start
+    
+    same = np.allclose(res_loop[0], res_batch[0], rtol=1e-6, equal_nan=True) \
+        and np.array_equal(res_loop[2], res_batch[2]) and \
+        np.array_equal(res_loop[4], res_batch[4])
+    for key in runtimes.keys():
+        print(key + ': ' + str(round(runtimes[key], 3)) + ' s')
+    print('Same results: ' + str(same))
+    return runtimes
+
 def interpolate_lc(i, time, flux_err=False, interp_tol=20./(24*60),
                    num_sigma=10, k=3, search_range=200, med_tol=2,
                    DEBUG_INTERP=False, orbig_gap_len=0.5,
@@ -1226,10 +2574,73 @@ def interpolate_lc(i, time, flux_err=False, interp_tol=20./(24*60),
         
     return i_interp, flag
     
+# >> number of bits set in each uint8
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype='uint8')
+
+def pack_nan_mask(flux):
+    '''Bit-packed NaN mask (8 data points per byte) of each light curve.
+    Returns:
+        * packed : uint8, shape=(num light curves, ceil(num data points / 8))
+    '''
+    return np.packbits(np.isnan(flux), axis=1)
+
+def load_packed_nan_mask(fname, flux=None):
+    '''Loads the packed NaN mask saved next to a metafile (fname[:-5] +
+    '_nan_mask.npy'), or computes it from flux and saves it if it is missing
+    or older than the metafile.'''
+    fname_mask = fname[:-5] + '_nan_mask.npy'
+    if os.path.exists(fname_mask) and \
+        os.path.getmtime(fname_mask) >= os.path.getmtime(fname):
+        return np.load(fname_mask)
+    if type(flux) == type(None):
+        with fits.open(fname, memmap=True) as hdul:
+            flux = hdul[1].data
+    packed = pack_nan_mask(flux)
+    np.save(fname_mask, packed)
+    return packed
+
+def compute_nan_mask(packed, num_points, custom_mask=[], tol1=0.05, tol2=0.5,
+                     use_tol2=True):
+    '''NaN mask of nan_mask() from bit-packed NaN masks (see pack_nan_mask()),
+    without unpacking them.
+    Parameters:
+        * packed : shape=(num light curves, ceil(num_points / 8))
+        * num_points : number of data points
+        * custom_mask, tol1, tol2, use_tol2 : see nan_mask()
+    Returns:
+        * rows : indices of light curves that are kept
+        * mask : bool, shape=(num_points), True for data points to remove
+                 (including custom_mask)
+        * num_nan : number of NaNs in each light curve (outside custom_mask)
+        * num_masked : number of non-NaN data points each light curve loses
+        * worst_inds : indices of light curves that are removed
+    '''
+    keep_cols = np.ones(num_points, dtype='bool')
+    keep_cols[custom_mask] = False
+    packed = packed & np.packbits(keep_cols)
+    
+    num_nan = np.sum(POPCOUNT[packed], axis=1, dtype='int64')
+    col_nan = np.bitwise_or.reduce(packed, axis=0)
+    # >> every NaN in a light curve is in the mask, so the number of data
+    # >> points each light curve loses is the rest of the mask
+    num_masked = np.sum(POPCOUNT[col_nan], dtype='int64') - num_nan
+
+    # >> check if only a few light curves contribute to NaN mask
+    rows = np.arange(len(packed))
+    worst_inds = np.nonzero( num_nan > tol2*np.count_nonzero(keep_cols) )[0]
+    if len(worst_inds)>0 and len(worst_inds)<tol1*len(packed) and use_tol2:
+        rows = np.delete(rows, worst_inds)
+        col_nan = np.bitwise_or.reduce(packed[rows], axis=0)
+    else:
+        worst_inds = np.empty(0, dtype='int')
+
+    mask = np.unpackbits(col_nan, count=num_points).astype('bool') | ~keep_cols
+    return rows, mask, num_nan, num_masked, worst_inds
+
 def nan_mask(flux, time, flux_err=False, DEBUG=False, debug_ind=1042,
              ticid=False, target_info=False,
              output_dir='./', prefix='', tol1=0.05, tol2=0.5,
-             custom_mask=[], use_tol2=True):
+             custom_mask=[], use_tol2=True, packed=None, plot=False):
     '''Apply nan mask to flux and time array.
     Returns masked, homogenous flux and time array.
     If there are only a few (less than tol1 light curves) light curves that
@@ -1246,32 +2657,34 @@ def nan_mask(flux, time, flux_err=False, DEBUG=False, debug_ind=1042,
           light curves
         * tol2 : given as fraction of num data points
         * custom_mask : list of indicies to remove from all light curves
+        * packed : bit-packed NaN mask of flux (see pack_nan_mask()), computed
+                   if not given
+        * plot : if True, plots a histogram of the number of data points
+                 masked in each light curve (always plotted if DEBUG)
     '''
-    # >> apply custom NaN mask
+    flux = np.asarray(flux)
     if len(custom_mask) > 0: print('Applying custom NaN mask')
-    time = np.delete(time, custom_mask)
-    flux = np.delete(flux, custom_mask, 1)
-
-    mask = np.nonzero(np.prod(~np.isnan(flux), axis = 0) == False)
-    # >> plot histogram of number of data points thrown out
-    num_nan = np.sum( np.isnan(flux), axis=1 )
-
-    def count_masked(x):
-        '''Counts number of masked data points for one light curve.'''
-        return np.count_nonzero( ~np.isin(mask, np.nonzero(x)) )
-    num_masked = np.apply_along_axis(count_masked, axis=1, arr=np.isnan(flux))
+    if type(packed) == type(None):
+        packed = pack_nan_mask(flux)
+    rows, mask, num_nan, num_masked, worst_inds = \
+        compute_nan_mask(packed, flux.shape[1], custom_mask=custom_mask,
+                         tol1=tol1, tol2=tol2, use_tol2=use_tol2)
     
-    plt.figure()
-    plt.hist(num_masked, bins=50)
-    plt.ylabel('number of light curves')
-    plt.xlabel('number of data points masked')
-    plt.savefig(output_dir + 'nan_mask.png')
-    plt.close()
+    # >> plot histogram of number of data points thrown out
+    if plot or DEBUG:
+        plt.figure()
+        plt.hist(num_masked, bins=50)
+        plt.ylabel('number of light curves')
+        plt.xlabel('number of data points masked')
+        plt.savefig(output_dir + 'nan_mask.png')
+        plt.close()
     
     # >> debugging plots
     if DEBUG:
+        time_plot = np.delete(time, custom_mask)
+        flux_plot = np.delete(flux, custom_mask, 1)
         fig, ax = plt.subplots()
-        ax.plot(time, flux[debug_ind], '.k')
+        ax.plot(time_plot, flux_plot[debug_ind], '.k')
         ax.set_title('removed orbit gap')
         fig.tight_layout()
         fig.savefig(output_dir + prefix + 'nanmask_debug.png',
@@ -1287,10 +2700,9 @@ def nan_mask(flux, time, flux_err=False, DEBUG=False, debug_ind=1042,
                     ind = sorted_inds[i]
                 else:
                     ind = sorted_inds[-i-1]
-                ax[i].plot(time, flux[ind], '.k')
+                ax[i].plot(time_plot, flux_plot[ind], '.k')
                 pf.ticid_label(ax[i], ticid[ind], target_info[ind], title=True)
-                num_nans = np.count_nonzero(np.isnan(flux[ind]))
-                ax[i].text(0.98, 0.98, 'Num NaNs: '+str(num_nans)+\
+                ax[i].text(0.98, 0.98, 'Num NaNs: '+str(num_nan[ind])+\
                            '\nNum masked: '+str(num_masked[ind]),
                            transform=ax[i].transAxes,
                            horizontalalignment='right',
@@ -1304,31 +2716,23 @@ def nan_mask(flux, time, flux_err=False, DEBUG=False, debug_ind=1042,
                 fig.savefig(output_dir + prefix + 'nanmask_low.png',
                             bbox_inches='tight')
        
-    # >> check if only a few light curves contribute to NaN mask
-    num_nan = np.array(num_nan)
-    worst_inds = np.nonzero( num_nan > tol2*flux.shape[1] )[0]
-
-    if len(worst_inds)>0 and len(worst_inds)<tol1*len(flux) and use_tol2:
+    if len(worst_inds) > 0:
         with open(output_dir+prefix+'removed_light_curves.txt', 'w') as f:
             for i in range(len(worst_inds)):
                 f.write('TIC '+ str(ticid[worst_inds[i]])+'\n')
 
         print('Removing '+str(len(worst_inds))+' light curves')
-        flux = np.delete(flux, worst_inds, 0)        
-
-        # >> and calculate new mask
-        mask = np.nonzero(np.prod(~np.isnan(flux), axis = 0) == False)    
+        flux = flux[rows]
         
     # >> apply NaN mask
-    time = np.delete(time, mask)
-    flux = np.delete(flux, mask, 1)
+    time = np.asarray(time)[~mask]
+    flux = flux[:,~mask]
     
     # # >> will need to truncate if using multiple sectors
     # new_length = np.min([np.shape(i)[1] for i in flux])
     
     if type(flux_err) != bool:
-        flux_err = np.delete(flux_err, mask, 1)
-        flux_err = np.delete(flux_err, custom_mask, 1)
+        flux_err = np.asarray(flux_err)[rows][:,~mask]
         return flux, time, flux_err
     else:
         return flux, time
@@ -1385,7 +2789,8 @@ def targetwise_data_access_by(yourpath, target_list, startindex, increment, file
 
 
 
-def targetwise_lc(yourpath, target_list, fname_time_intensities,fname_notes):
+def targetwise_lc(yourpath, target_list, fname_time_intensities,fname_notes,
+                  cache_dir=None, **kwargs):
     """ runs getting the files and data for all targets on the list
     then appends the time & intensity arrays and the TIC number into text files
     that can later be accessed
@@ -1395,53 +2800,36 @@ def targetwise_lc(yourpath, target_list, fname_time_intensities,fname_notes):
         * fname_time_intensities = direct path to the file to save into
         * fname_notes = direct path to file to save TICIDS of targets that 
             return no data into
+        * cache_dir = download cache (default yourpath+'lc_cache/')
+        * kwargs are passed to download_mast_lcs()
     returns: list of ticids as an array
-    requires: get_lc_file_and_data(), interpolate_lc()
+    requires: download_mast_lcs(), read_lc_fits(), interpolate_lc()
     modified [lcg 07112020]
     """
+    if type(cache_dir) == type(None):
+        cache_dir = yourpath + 'lc_cache/'
+    fnames, failed = download_mast_lcs(target_list, cache_dir, **kwargs)
+    
+    if len(failed) > 0:
+        with open(fname_notes, 'a') as file_object:
+            for target in failed:
+                file_object.write("\n")
+                file_object.write(str(int(target)))
 
     ticids = []
-    for n in range(len(target_list)): #for each item on the list
-        
-        if n == 0: #for the first target only do you need to get the time index
-            target = target_list[0] #get that target number
-            time1, i1, tic = get_lc_file_and_data(yourpath, target) #grab that data
-            
-            if type(i1) == np.ndarray: #if the data IS data
-                i_interp, flag = interpolate_lc(i1, time1, flux_err=False, interp_tol=20./(24*60),
-                                   num_sigma=10, DEBUG_INTERP=False,
-                                   output_dir=yourpath, prefix='')
-                TI = [time1, i1]
-                TI_array = np.asarray(TI)
-                hdr = fits.Header() # >> make the header
-                hdu = fits.PrimaryHDU(TI_array, header=hdr)
-                hdu.writeto(fname_time_intensities)
-                ticids.append(tic)
-                
-            else: #if the data is NOT a data
-                print("First target failed, no time index was saved")
-                with open(fname_notes, 'a') as file_object:
-                    file_object.write("\n")
-                    file_object.write(str(int(target)))
-        else: 
-            target = target_list[n] #get that target number
-            time1, i1, tic = get_lc_file_and_data(yourpath, target) #grab that data
-            
-            if type(i1) == np.ndarray: #if the data IS data
-                i_interp, flag = interpolate_lc(i1, time1, flux_err=False, interp_tol=20./(24*60),
-                                   num_sigma=10, DEBUG_INTERP=False,
-                                   output_dir=yourpath, prefix='')
-                TI = [time1, i1]
-                TI_array = np.asarray(TI)
-                fits.append(fname_time_intensities, TI_array)
-                ticids.append(tic)
-                
-            else: #if the data is NOT a data
-                print("Target failed to return a light curve")
-                with open(fname_notes, 'a') as file_object:
-                    file_object.write("\n")
-                    file_object.write(str(int(target)))
-        print(n, " completed")
+    for n, target in enumerate(fnames.keys()):
+        time1, i1, tic = read_lc_fits(fnames[target][0])
+        i_interp, flag = interpolate_lc(i1, time1, flux_err=False, interp_tol=20./(24*60),
+                           num_sigma=10, DEBUG_INTERP=False,
+                           output_dir=yourpath, prefix='')
+        TI_array = np.asarray([time1, i1])
+        if n == 0: #for the first target only do you need to write the header
+            hdr = fits.Header() # >> make the header
+            hdu = fits.PrimaryHDU(TI_array, header=hdr)
+            hdu.writeto(fname_time_intensities)
+        else:
+            fits.append(fname_time_intensities, TI_array)
+        ticids.append(tic)
     fits.append(fname_time_intensities, np.asarray(ticids))
         
     print("lc_from_target_list has finished running")
@@ -1451,7 +2839,108 @@ def targetwise_lc(yourpath, target_list, fname_time_intensities,fname_notes):
     
 
 
-def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel, version=0, save=True):
+# :: Batched periodograms ::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Lomb-Scargle periodograms of many light curves on the same time axis. The
+# >> trig tables cos(w t) and sin(w t) depend only on the time axis and the
+# >> frequency grid, so lombscargle_tables() computes them once, and
+# >> lombscargle_batch() turns a block of light curves into periodograms with
+# >> two matrix products. The phase offset tau of every frequency follows from
+# >> the sums of cos(2 w t) and sin(2 w t), so masked points (e.g. NaNs or
+# >> sigma-clipped points) only need those sums per light curve. Same results
+# >> as signal.lombscargle(t[mask], y[mask], freqs) for each light curve.
+# >> Large grids (e.g. 5000 frequencies of an 18000 point sector take 1.44 GB)
+# >> are built with chunk_size: only the sums are kept, and lombscargle_batch()
+# >> recomputes cos(w t) and sin(w t) chunk_size frequencies at a time.
+
+def lombscargle_tables(t, freqs, chunk_size=None):
+    '''Trig tables for lombscargle_batch(), for time axis t and angular
+    frequencies freqs. The tables take 16*len(freqs)*len(t) bytes, unless
+    chunk_size is given, in which case they are computed chunk_size
+    frequencies at a time (16*chunk_size*len(t) bytes) whenever they are
+    needed.'''
+    t = np.asarray(t, dtype='float64')
+    freqs = np.asarray(freqs, dtype='float64')
+    tables = {'freqs': freqs, 't': t, 'chunk_size': chunk_size,
+              'cos2': np.empty(len(freqs)), 'sin2': np.empty(len(freqs))}
+    step = len(freqs) if type(chunk_size) == type(None) else chunk_size
+    for i in range(0, len(freqs), max(step, 1)):
+        c, s = trig_chunk(tables, i, i+step)
+        # >> sums of cos(2wt) and sin(2wt) over all points
+        tables['cos2'][i:i+step] = np.sum(c**2 - s**2, axis=1)
+        tables['sin2'][i:i+step] = 2*np.sum(c*s, axis=1)
+        if type(chunk_size) == type(None):
+            tables['cos'], tables['sin'] = c, s
+    return tables
+
+def trig_chunk(tables, start, end):
+    '''cos(w t) and sin(w t) of frequencies start to end of tables (see
+    lombscargle_tables()), shape (end - start, len(t)).'''
+    if 'cos' in tables:
+        return tables['cos'][start:end], tables['sin'][start:end]
+    wt = np.outer(tables['freqs'][start:end], tables['t'])
+    return np.cos(wt), np.sin(wt)
+
+def lombscargle_batch(y, tables, mask=None, normalize=True, freq_chunk=500):
+    '''Lomb-Scargle periodograms of a block of light curves.
+    Parameters:
+        * y : light curves, shape (num_lc, len(t))
+        * tables : from lombscargle_tables(t, freqs)
+        * mask : boolean array shaped like y, False for points to leave out
+                 (default: use every point)
+        * normalize : same as in signal.lombscargle()
+        * freq_chunk : number of frequencies at a time for the sums over
+                       masked points (tables built with a chunk_size use
+                       their chunk_size instead)
+    Returns:
+        * pg : periodograms, shape (num_lc, len(freqs))
+    '''
+    y = np.asarray(y, dtype='float64').reshape(-1, len(tables['t']))
+    num_freqs = len(tables['freqs'])
+    if type(tables['chunk_size']) != type(None):
+        freq_chunk = tables['chunk_size']
+    elif type(mask) == type(None):
+        freq_chunk = num_freqs # >> one matrix product with the full tables
+    if type(mask) == type(None):
+        num_points = np.full((len(y), 1), y.shape[1], dtype='float64')
+        cos2, sin2 = tables['cos2'][None,:], tables['sin2'][None,:]
+    else:
+        mask = np.asarray(mask, dtype='bool').reshape(y.shape)
+        y = np.where(mask, y, 0.)
+        weights = mask.astype('float64')
+        num_points = np.sum(weights, axis=1, keepdims=True)
+        cos2 = np.empty((len(y), num_freqs))
+        sin2 = np.empty((len(y), num_freqs))
+    
+    yc = np.empty((len(y), num_freqs))
+    ys = np.empty((len(y), num_freqs))
+    for i in range(0, num_freqs, max(freq_chunk, 1)):
+        c, s = trig_chunk(tables, i, i+freq_chunk)
+        if type(mask) != type(None):
+            cos2[:,i:i+freq_chunk] = weights @ (c**2 - s**2).T
+            sin2[:,i:i+freq_chunk] = 2 * (weights @ (c*s).T)
+        yc[:,i:i+freq_chunk] = y @ c.T
+        ys[:,i:i+freq_chunk] = y @ s.T
+    
+    # >> rotate by the phase offset tau, tan(2 w tau) = sin2 / cos2
+    wtau = 0.5 * np.arctan2(sin2, cos2)
+    c, s = np.cos(wtau), np.sin(wtau)
+    yc, ys = c*yc + s*ys, c*ys - s*yc
+    r = np.hypot(cos2, sin2)
+    eps = np.finfo('float64').epsneg * num_points
+    cc = np.maximum((num_points + r) / 2, eps) # >> sum of cos^2(w(t-tau))
+    ss = np.maximum((num_points - r) / 2, eps) # >> sum of sin^2(w(t-tau))
+    
+    pg = yc**2 / cc + ys**2 / ss
+    if normalize:
+        pg /= np.sum(y**2, axis=1, keepdims=True)
+    else:
+        pg *= 0.5
+    return pg
+
+
+def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel, version=0, save=True,
+                                        ticid=None, n_workers=None, threads_per_worker=1,
+                                        tic_store_dir=None, query=False):
     """Produces the feature vectors for each light curve and saves them all
     into a single fits file. requires all light curves on the same time axis
     parameters:
@@ -1462,8 +2951,14 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
         * version = what version of feature vector to calculate for all. 
             default is 0
         * save = whether or not to save into a fits file
+        * ticid = TICIDs of the light curves, for the TLS period grids (version 1)
+        * n_workers, threads_per_worker = see featvec_tls_parallel() (version 1)
+        * tic_store_dir = TIC catalog store with the stellar radius and mass
+            of ticid (see convert_tic_catalog()), for the TLS period grids
+        * query = whether to query catalog_info() for the targets that are not
+            in the TIC store (see tls_stellar_params())
     returns: list of feature vectors + fits file containing all feature vectors
-    requires: featvec()
+    requires: featvec_batch() (version 0), featvec_tls_parallel() (version 1)
     modified: [lcg 08212020]"""
     
 
@@ -1478,11 +2973,27 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
         intensities = mean_norm(intensities)
 
     print("Begining Feature Vector Creation Now")
-    for n in range(len(intensities)):
-        feature_vector = featvec(times, intensities[n], v=version)
-        feature_list.append(feature_vector)
-        
-        if n % 25 == 0: print(str(n) + " completed")
+    if version == 0:
+        feature_list = featvec_batch(times, intensities)
+    else:
+        # >> checkpointed, so a rerun picks up where it stopped
+        db_file = yourpath + "/" + filelabel + "_tls.db"
+        stellar_params = None
+        if type(ticid) != type(None):
+            catalog = None
+            if type(tic_store_dir) != type(None):
+                catalog = tic_gather(open_tic_store(tic_store_dir), ticid,
+                                     ['rad', 'mass'])
+            con = open_tls_db(db_file)
+            stellar_params = tls_stellar_params(ticid, con, catalog=catalog,
+                                                query=query)
+            con.close()
+        else:
+            ticid = np.arange(len(intensities))
+        feature_list = featvec_tls_parallel(times, intensities, ticid, db_file,
+                                            stellar_params=stellar_params,
+                                            n_workers=n_workers,
+                                            threads_per_worker=threads_per_worker)
     
     feature_list = np.asarray(feature_list)
     
@@ -1496,7 +3007,8 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
     
     return feature_list
 
-def featvec(x_axis, sampledata, ticid=None, v=0): 
+def featvec(x_axis, sampledata, ticid=None, v=0, stellar_params=None,
+            use_threads=None, show_progress_bar=True): 
     """calculates the feature vector of a single light curve
         version 0: features 0-15
         version 1: features 0-19
@@ -1538,6 +3050,9 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
 
 	*** version 1 note: you may wish to go into the transitleastsquares's main.py file and
 	comment out all 'print' statements in order to save space while running this over lots of light curves
+	*** version 1 parameters: stellar_params = (radius, mass) of the star, to pick
+	the smallest period grid without querying catalog_info() for ticid (see
+	tls_stellar_params()); use_threads and show_progress_bar are passed to TLS
         modified [lcg 07202020]"""
     #empty feature vector
     featvec = []
@@ -1611,34 +3126,22 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
     
     #tls 
     elif v == 1: 
-        from transitleastsquares import transitleastsquares, period_grid, catalog_info
+        from transitleastsquares import transitleastsquares
         model = transitleastsquares(x_axis, sampledata)
         
-        if type(ticid) != type(None):
-            dt = np.max(x_axis) - np.min(x_axis)            
-            ab, mass, mass_min, mass_max, radius, radius_min, radius_max = catalog_info(TIC_ID=int(ticid))
-            # >> find smallest period grid
-            rm_set = []
-            grid_lengths = [period_grid(1, 1, dt).shape[0]]
-            rm_set.append([1,1])
-            
-            if not np.isnan(radius):                
-                grid_lengths.append(period_grid(radius, 1, dt).shape[0])
-                rm_set.append([radius, 1])
-                
-            if not np.isnan(mass):
-                grid_lengths.append(period_grid(1, mass, dt).shape[0])
-                rm_set.append([1, mass])
-                
-            
-            ind = np.argmin(grid_lengths)
-            R_star, M_star = rm_set[ind]
-            
+        # >> find smallest period grid
+        if type(stellar_params) == type(None) and type(ticid) != type(None):
+            stellar_params = tls_catalog_params(ticid)
+        if type(stellar_params) != type(None):
+            R_star, M_star = tls_grid_params(x_axis, *stellar_params)
         else:
             R_star, M_star = 1,1
         
-        results = model.power(show_progress_bar=True, R_star=R_star,
-                              M_star=M_star)
+        kwargs = {}
+        if type(use_threads) != type(None):
+            kwargs['use_threads'] = use_threads
+        results = model.power(show_progress_bar=show_progress_bar,
+                              R_star=R_star, M_star=M_star, **kwargs)
         featvec.append(results.period)
         featvec.append(results.duration)
         featvec.append((1 - results.depth))
@@ -1646,6 +3149,181 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
     
     return featvec 
 
+def lc_statistics(x_axis, flux, mask=None, percentiles=[5, 50, 95],
+                  batch_size=1000):
+    """Moments, slope and percentiles of many light curves on the same time
+    axis, batch_size light curves at a time. NaNs (and points where mask is
+    False) are left out.
+    parameters:
+        * x_axis = time axis
+        * flux = array of light curves, shape (num_lc, len(x_axis))
+        * mask = boolean array shaped like flux, False for points to leave out
+        * percentiles = percentiles to compute (as np.percentile())
+    returns: dictionary of arrays with one value per light curve:
+        'num_points', 'mean', 'variance', 'skewness' and 'kurtosis' (2nd, 3rd
+        and 4th central moments, as in featvec()), 'slope' (as in
+        stats.linregress()) and 'percentiles' (shape (num_lc,
+        len(percentiles)))"""
+    x_axis = np.asarray(x_axis, dtype='float64')
+    lc_stats = {}
+    for key in ['num_points', 'mean', 'variance', 'skewness', 'kurtosis',
+                'slope']:
+        lc_stats[key] = np.empty(len(flux))
+    lc_stats['percentiles'] = np.empty((len(flux), len(percentiles)))
+    
+    for i in range(0, len(flux), batch_size):
+        y = np.asarray(flux[i:i+batch_size], dtype='float64')
+        valid = np.isfinite(y)
+        if type(mask) != type(None):
+            valid = valid * np.asarray(mask[i:i+batch_size], dtype='bool')
+        num_points = np.sum(valid, axis=1)
+        
+        #moments
+        mean = np.sum(np.where(valid, y, 0.), axis=1) / num_points
+        dev = np.where(valid, y - mean[:,None], 0.)
+        dev_k = dev**2
+        for key in ['variance', 'skewness', 'kurtosis']:
+            lc_stats[key][i:i+batch_size] = np.sum(dev_k, axis=1) / num_points
+            dev_k *= dev
+        lc_stats['num_points'][i:i+batch_size] = num_points
+        lc_stats['mean'][i:i+batch_size] = mean
+        
+        #slope
+        x_mean = valid @ x_axis / num_points
+        x_dev = np.where(valid, x_axis[None,:] - x_mean[:,None], 0.)
+        lc_stats['slope'][i:i+batch_size] = np.sum(x_dev * dev, axis=1) / \
+            np.sum(x_dev**2, axis=1)
+        
+        # >> percentiles, interpolating linearly between the sorted points
+        # >> (NaNs are sorted to the end)
+        if len(percentiles) > 0:
+            y = np.sort(np.where(valid, y, np.nan), axis=1)
+            pos = np.asarray(percentiles)[None,:] / 100 * (num_points[:,None]-1)
+            lower = np.clip(np.floor(pos).astype('int'), 0, y.shape[1]-1)
+            upper = np.minimum(lower+1, np.maximum(num_points[:,None]-1, 0))
+            frac = pos - lower
+            lower = np.take_along_axis(y, lower, axis=1)
+            upper = np.take_along_axis(y, upper, axis=1)
+            lc_stats['percentiles'][i:i+batch_size] = \
+                lower + (upper - lower) * frac
+    
+    return lc_stats
+
+def featvec_tables(x_axis, chunk_size=500):
+    '''Lomb-Scargle tables (see lombscargle_tables()) of the two frequency
+    grids of featvec(v=0), for time axis x_axis. The 5000 frequency grid is
+    computed chunk_size frequencies at a time (all at once if chunk_size is
+    None).'''
+    return {'pg': lombscargle_tables(x_axis, np.linspace(0.6, 62.8, 5000),
+                                     chunk_size=chunk_size),
+            'pg2': lombscargle_tables(x_axis, np.linspace(62.8, 6283.2, 20))}
+
+def featvec_batch(x_axis, flux, mask=None, batch_size=500, tables=None):
+    """Version 0 feature vectors (see featvec()) of many light curves on the
+    same time axis, batch_size light curves at a time.
+    parameters:
+        * x_axis = time axis
+        * flux = array of light curves, shape (num_lc, len(x_axis))
+        * mask = boolean array shaped like flux, False for points to leave out
+            (e.g. sigma-clipped points). NaNs are always left out
+        * tables = featvec_tables(x_axis), to reuse the trig tables between
+            calls with the same time axis (or to change their chunk_size)
+    returns: array of feature vectors, shape (num_lc, 16). Features that
+        featvec() cannot compute (no relative maximum in a periodogram) are NaN
+    requires: featvec_tables(), lombscargle_batch(), lc_statistics()"""
+    x_axis = np.asarray(x_axis, dtype='float64')
+    if type(tables) == type(None):
+        tables = featvec_tables(x_axis)
+    periods = np.linspace(0.1, 10, 5000)
+    bands = [(457, 5000), (121, 457), (0, 121)] # >> 0.1-1, 1-3, 3-10 days
+    
+    features = np.empty((len(flux), 16))
+    for i in range(0, len(flux), batch_size):
+        y = np.asarray(flux[i:i+batch_size], dtype='float64')
+        m = np.isfinite(y)
+        if type(mask) != type(None):
+            m = m * np.asarray(mask[i:i+batch_size], dtype='bool')
+        lc_stats = lc_statistics(x_axis, y, mask=m, percentiles=[],
+                                 batch_size=len(y))
+        if np.all(m):
+            m = None
+        
+        #moments
+        moments = np.array([lc_stats['variance'], lc_stats['skewness'],
+                            lc_stats['kurtosis']]).T
+        features[i:i+batch_size, 0] = lc_stats['mean']
+        features[i:i+batch_size, 1:4] = moments
+        features[i:i+batch_size, 4:7] = np.log(np.abs(moments))
+        
+        #periods
+        for key, col in [('pg', 7), ('pg2', 15)]:
+            pg = lombscargle_batch(y, tables[key], mask=m)
+            # >> relative maxima, as argrelextrema(pg, np.greater)
+            peaks = (pg[:,1:-1] > pg[:,:-2]) * (pg[:,1:-1] > pg[:,2:])
+            peak_pg = np.where(peaks, pg[:,1:-1], -np.inf)
+            ind = np.argmax(peak_pg, axis=1)
+            max_power = np.where(np.any(peaks, axis=1),
+                                 peak_pg[np.arange(len(pg)), ind], np.nan)
+            period_max_power = np.where(np.any(peaks, axis=1),
+                                        2*np.pi / tables[key]['freqs'][ind+1],
+                                        np.nan)
+            if key == 'pg':
+                features[i:i+batch_size, 7] = max_power
+                features[i:i+batch_size, 8] = np.log(np.abs(max_power))
+                features[i:i+batch_size, 9] = period_max_power
+                
+                #integrates the whole 0.1-10 day range
+                for j, (start, end) in enumerate(bands):
+                    features[i:i+batch_size, 12+j] = \
+                        np.sum((pg[:,start+1:end] + pg[:,start:end-1]) * \
+                               np.diff(periods[start:end]), axis=1) / 2
+            else:
+                features[i:i+batch_size, 15] = period_max_power
+        
+        features[i:i+batch_size, 10] = lc_stats['slope']
+        features[i:i+batch_size, 11] = np.log(np.abs(lc_stats['slope']))
+        
+        print(str(min(i+batch_size, len(flux))) + " completed")
+    
+    return features
+
+def benchmark_featvec(num_lc=20000, n=18000, num_check=20, batch_size=500,
+                      seed=0):
+    '''Times featvec(v=0) per light curve and featvec_batch() on num_lc
+    synthetic light curves of n points (about a 2-minute sector), and checks
+    that both give the same features. featvec() is only run on num_check
+    light curves, and its run time extrapolated to num_lc.
+    Returns:
+        * dictionary of run times (in seconds)
+    '''
+    import time as timer
+    
+    rng = np.random.default_rng(seed)
+    time = np.arange(n) * 2. / (24*60)
+    time = np.delete(time, np.arange(n//2, n//2 + n//20)) # >> orbit gap
+    flux = np.empty((num_lc, len(time)), dtype='float32')
+    for i in range(0, num_lc, 1000):
+        num = len(flux[i:i+1000])
+        flux[i:i+1000] = 1. + 0.01*rng.uniform(0, 1, (num,1)) * \
+            np.sin(time[None,:] * rng.uniform(0.7, 60, (num,1))) + \
+            rng.normal(0, 1e-3, (num, len(time)))
+    
+    runtimes = {}
+    start = timer.time()
+    res_loop = np.array([featvec(time, flux[i].astype('float64')) \
+                         for i in range(num_check)])
+    runtimes['per light curve'] = (timer.time() - start) * num_lc / num_check
+    start = timer.time()
+    res_batch = featvec_batch(time, flux, batch_size=batch_size)
+    runtimes['batched'] = timer.time() - start
+    
+    same = np.allclose(res_loop, res_batch[:num_check], rtol=1e-6,
+                       equal_nan=True)
+    for key in runtimes.keys():
+        print(key + ': ' + str(round(runtimes[key], 3)) + ' s')
+    print('Same results: ' + str(same))
+    return runtimes
+
 def feature_gen_from_lc_fits(path, sector, feature_version=0):
     """Given a path to a folder containing ALL the light curve metafiles 
     for a sector, produces the feature vector metafile for each group and then
@@ -1687,7 +3365,8 @@ def feature_gen_from_lc_fits(path, sector, feature_version=0):
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
             print("Starting feature vectors for camera ", camera, "ccd ", ccd, "at ", dt_string)
             
-            create_save_featvec(folderpath, t2, i3, file_label, version=0, save=True)
+            create_save_featvec_homogenous_time(folderpath, t2, i3, file_label,
+                                                version=0, save=True)
     
     ticids_all = ticids_all[1:]
     feats_all = np.zeros((2,16))
@@ -1699,7 +3378,8 @@ def feature_gen_from_lc_fits(path, sector, feature_version=0):
             ccd = int(m)
             file_label = "Sector" + str(sector) + "Cam" + str(camera) + "CCD" + str(ccd)
             folderpath = path + "/" + file_label + "/"
-            f = fits.open(folderpath + file_label + "_features.fits", memmap=False)
+            f = fits.open(folderpath + "/" + file_label + "_features_v0.fits",
+                          memmap=False)
             feats = f[0].data
             feats_all = np.concatenate((feats_all, feats))
             f.close()
@@ -1723,12 +3403,11 @@ def calculate_variability_statistics(data_dir):
         flux, x, ticid, target_info = \
             load_data_from_metafiles(data_dir, sector, nan_mask_check=False)
 
-        variability = []
-        for i in range(len(flux)):
-            norm = flux[i] / np.nanmedian(flux[i])
-            norm = np.delete(norm, np.nonzero(np.isnan(norm)))
-            var = np.percentile(norm, 95) - np.percentile(norm, 5)
-            variability.append(var)
+        # >> 95th - 5th percentile of the median normalized light curves,
+        # >> flux / median (its percentiles swap if the median is negative)
+        p5, median, p95 = lc_statistics(x, flux)['percentiles'].T
+        norm = np.array([p5 / median, p95 / median])
+        variability = np.max(norm, axis=0) - np.min(norm, axis=0)
         np.savetxt(data_dir+'Sector'+str(sector)+'/Sector'+\
                    str(sector)+'variability_statistics.txt',
                    [ticid, variability])
@@ -1736,92 +3415,1054 @@ def calculate_variability_statistics(data_dir):
 
 
 
-def get_tess_features(ticid):
-    '''Query catalog data https://arxiv.org/pdf/1905.10694.pdf'''
+# :: Feature cache :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Feature vectors are cached by content. Every light curve gets a 64-bit key
+# >> hashed from its identifier (e.g. TICID), sector, time axis and
+# >> preprocessed flux, so a changed light curve gets a new key. The cache of a
+# >> feature version and its parameters is the directory
+# >> cache_dir+'v<version>_<hash of parameters>/', with keys.npy,
+# >> features.npy and feature_cache_info.json (version, parameters and number
+# >> of rows), which is written last so that it never describes missing rows.
+
+def feature_cache_subdir(cache_dir, version=0, params={}):
+    '''Directory of the cache of feature version version, computed with
+    params (dictionary of everything else the features depend on).'''
+    params = json.dumps(params, sort_keys=True, default=str)
+    params_hash = hashlib.blake2b(params.encode(), digest_size=8).hexdigest()
+    return cache_dir + 'v' + str(version) + '_' + params_hash + '/'
+
+def lc_keys(identifiers, time, flux, sector=None):
+    '''64-bit cache keys of light curves.
+    Parameters:
+        * identifiers : identifier of each light curve (TICID, Gaia ID, name),
+                        or None
+        * time : time axis of all light curves, or one time axis per light
+                 curve
+        * flux : light curves, as passed to the feature functions
+        * sector : sector number, or None
+    '''
+    identifiers = np.full(len(flux), '') if type(identifiers) == type(None) \
+        else np.asarray(identifiers)
+    if identifiers.dtype.kind in 'fiu': # >> 1234.0 and 1234 are the same
+        identifiers = identifiers.astype('int64')
+    shared_time = np.ndim(time[0]) == 0
+    if shared_time:
+        time_hash = hashlib.blake2b(np.ascontiguousarray(time, dtype='float64'),
+                                    digest_size=8).digest()
+    keys = np.empty(len(flux), dtype='uint64')
+    for i in range(len(flux)):
+        h = hashlib.blake2b(digest_size=8)
+        h.update((str(identifiers[i]) + '|' + str(sector) + '|').encode())
+        if shared_time:
+            h.update(time_hash)
+        else:
+            h.update(np.ascontiguousarray(time[i], dtype='float64'))
+        h.update(np.ascontiguousarray(flux[i], dtype='float64'))
+        keys[i] = np.frombuffer(h.digest(), dtype='uint64')[0]
+    return keys
+
+def open_feature_cache(subdir):
+    '''Returns the keys, feature vectors (memory-mapped) and info of the
+    feature cache in subdir (see feature_cache_subdir()), or None if it is
+    empty.'''
+    if not os.path.exists(subdir+'feature_cache_info.json'):
+        return None
+    with open(subdir+'feature_cache_info.json', 'r') as f:
+        info = json.load(f)
+    num_rows = info['num_rows']
+    keys = np.load(subdir+'keys.npy')[:num_rows]
+    features = np.load(subdir+'features.npy', mmap_mode='r')[:num_rows]
+    return keys, features, info
+
+def append_feature_cache(subdir, keys, features, version=0, params={}):
+    '''Adds feature vectors (with cache keys keys) to the feature cache in
+    subdir.'''
+    os.makedirs(subdir, exist_ok=True)
+    cache = open_feature_cache(subdir)
+    if type(cache) == type(None):
+        np.save(subdir+'keys.npy', np.asarray(keys, dtype='uint64'))
+        np.save(subdir+'features.npy', np.asarray(features, dtype='float64'))
+        num_rows = len(keys)
+    else:
+        num_rows = cache[2]['num_rows']
+        append_npy(subdir+'keys.npy', keys, num_rows=num_rows)
+        append_npy(subdir+'features.npy', features, num_rows=num_rows)
+        num_rows += len(keys)
+    info = {'version': version, 'params': params, 'num_rows': num_rows}
+    with open(subdir+'feature_cache_info.json', 'w') as f:
+        json.dump(info, f, default=str)
+
+def cached_features(identifiers, time, flux, compute, cache_dir, version=0,
+                    params={}, sector=None):
+    '''Feature vectors of light curves, looked up in the feature cache
+    (cache_dir, see above). Only light curves that are not in the cache are
+    computed, and their feature vectors are added to it.
+    Parameters:
+        * identifiers, time, flux, sector : see lc_keys()
+        * compute : function, compute(inds) returns the feature vectors of the
+                    light curves flux[inds]
+        * version, params : feature version and the parameters the features
+                            depend on (see feature_cache_subdir())
+    Returns:
+        * features : array of feature vectors, shape (len(flux),
+                     num_features)
+    '''
+    subdir = feature_cache_subdir(cache_dir, version, params)
+    keys = lc_keys(identifiers, time, flux, sector=sector)
+    cache = open_feature_cache(subdir)
+    rows = np.full(len(keys), -1)
+    if type(cache) != type(None) and len(cache[0]) > 0:
+        order = np.argsort(cache[0])
+        pos = np.minimum(np.searchsorted(cache[0], keys, sorter=order),
+                         len(order) - 1)
+        rows = np.where(cache[0][order[pos]] == keys, order[pos], -1)
+    
+    # >> compute every new light curve once
+    new = np.nonzero(rows == -1)[0]
+    new_keys, first, inverse = np.unique(keys[new], return_index=True,
+                                         return_inverse=True)
+    print(str(len(new_keys)) + ' of ' + str(len(keys)) + \
+          ' feature vectors not in ' + subdir)
+    if len(new_keys) > 0:
+        new_features = np.asarray(compute(new[first]), dtype='float64')
+        new_features = new_features.reshape(len(new_keys), -1)
+        append_feature_cache(subdir, new_keys, new_features, version, params)
+        cache = open_feature_cache(subdir)
+        rows[new] = cache[2]['num_rows'] - len(new_keys) + inverse.reshape(-1)
+    
+    return np.asarray(cache[1][rows])
+
+# :: Parallel TLS features :::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Version 1 (TLS) features take minutes per light curve, so
+# >> featvec_tls_parallel() runs featvec(v=1) on a pool of processes and
+# >> checkpoints every light curve in an SQLite database as soon as it is done.
+# >> A crashed or interrupted run started again with the same database skips
+# >> the light curves it already has (they are keyed by lc_keys(), so a changed
+# >> light curve is computed again). The database also caches the stellar
+# >> radius and mass of each TICID, which choose the TLS period grid (see
+# >> tls_grid_params()). They are taken from the TIC catalog if it is given;
+# >> targets that are not in it get the solar grid, unless query=True, which
+# >> queries catalog_info() once per target. Network errors fall back to the
+# >> solar grid as well (and are not cached, so they are queried again).
+# >> Each worker gets threads_per_worker threads (TLS use_threads, numba and
+# >> BLAS), so n_workers * threads_per_worker should be the number of cores.
+
+TLS_FEATURE_COLUMNS = ['period', 'duration', 'depth', 'power']
+
+def open_tls_db(db_file):
+    '''Opens (or creates) a TLS feature database. Returns an sqlite3
+    connection.'''
+    con = sqlite3.connect(db_file)
+    con.execute('CREATE TABLE IF NOT EXISTS stellar_params (ticid INTEGER '+\
+                'PRIMARY KEY, radius REAL, mass REAL)')
+    con.execute('CREATE TABLE IF NOT EXISTS tls_features (key TEXT PRIMARY '+\
+                'KEY, identifier TEXT, '+' REAL, '.join(TLS_FEATURE_COLUMNS)+\
+                ' REAL, time REAL)')
+    return con
+
+def tls_catalog_params(ticid, network_fallback=True):
+    '''Queries the stellar radius and mass of a TICID with catalog_info(). Both
+    are NaN (the solar grid, see tls_grid_params()) if the TICID is not in the
+    TIC, or if the query fails with a network error and network_fallback
+    (otherwise the error is raised).'''
+    from transitleastsquares import catalog_info
+    try:
+        ab, mass, mass_min, mass_max, radius, radius_min, radius_max = \
+            catalog_info(TIC_ID=int(ticid))
+    except IndexError:
+        return np.nan, np.nan
+    except NETWORK_ERRORS as e:
+        if not network_fallback:
+            raise
+        print('catalog_info() failed for TIC '+str(int(ticid))+' ('+str(e)+\
+              '), using solar values')
+        return np.nan, np.nan
+    params = [radius, mass]
+    for i in range(2):
+        if np.ma.is_masked(params[i]) or type(params[i]) == type(None):
+            params[i] = np.nan
+    return float(params[0]), float(params[1])
+
+def tls_stellar_params(ticid, con, catalog=None, query=False):
+    '''Stellar radius and mass of each TICID, from the TLS feature database.
+    TICIDs that are not in it are taken from catalog, or queried with
+    catalog_info() (if query), and added to the database.
+    Parameters:
+        * ticid : array of TICIDs
+        * con : returned by open_tls_db()
+        * catalog : dictionary with 'ID', 'rad' and 'mass' arrays, e.g.
+                    returned by tic_gather(store, ticid, ['rad', 'mass'])
+        * query : whether to query TICIDs that are neither in the database
+                  nor in catalog, one at a time (otherwise they are NaN)
+    Returns:
+        * params : array shape=(len(ticid), 2), radius and mass (NaN if
+                   unknown)
+    '''
+    ticid = np.asarray(ticid).astype('float').astype('int64')
+    params = np.full((len(ticid), 2), np.nan)
+    
+    # >> look up database
+    known = {}
+    unique = [int(t) for t in np.unique(ticid)]
+    for start in range(0, len(unique), 500):
+        chunk = unique[start:start+500]
+        query_str = 'SELECT ticid, radius, mass FROM stellar_params WHERE '+\
+            'ticid IN ('+','.join(['?']*len(chunk))+')'
+        for t, radius, mass in con.execute(query_str, chunk):
+            known[t] = (radius, mass)
+    
+    # >> add new TICIDs from catalog, then from catalog_info()
+    new = {}
+    if type(catalog) != type(None):
+        for t, radius, mass in zip(catalog['ID'], catalog['rad'],
+                                   catalog['mass']):
+            if int(t) > -1 and int(t) not in known:
+                new[int(t)] = (radius, mass)
+    con.executemany('INSERT OR REPLACE INTO stellar_params VALUES (?,?,?)',
+                    [(t, float(radius), float(mass)) \
+                     for t, (radius, mass) in new.items()])
+    con.commit()
+    known.update(new)
+    missing = [t for t in unique if t not in known]
+    if query and len(missing) > 0:
+        print('Querying stellar parameters of '+str(len(missing))+' targets')
+        for n, t in enumerate(missing):
+            try:
+                new[t] = tls_catalog_params(t, network_fallback=False)
+            except NETWORK_ERRORS as e:
+                print('Stopped querying stellar parameters ('+str(e)+\
+                      '), using solar values for the remaining targets')
+                break
+            con.execute('INSERT OR REPLACE INTO stellar_params VALUES '+\
+                        '(?,?,?)', (t, float(new[t][0]), float(new[t][1])))
+            con.commit() # >> so an interrupted run keeps its queries
+            if n % 100 == 0: print(str(n) + " completed")
+    known.update(new)
+    
+    for i in range(len(ticid)):
+        if int(ticid[i]) in known:
+            params[i] = known[int(ticid[i])]
+    return params
+
+def tls_grid_params(x_axis, radius, mass):
+    '''Returns the R_star, M_star (solar units) of the smallest TLS period
+    grid, out of the solar values and the star's radius or mass (NaN if
+    unknown).'''
+    from transitleastsquares import period_grid
+    dt = np.max(x_axis) - np.min(x_axis)
+    rm_set = [[1, 1]]
+    grid_lengths = [period_grid(1, 1, dt).shape[0]]
+    
+    if not np.isnan(radius):
+        grid_lengths.append(period_grid(radius, 1, dt).shape[0])
+        rm_set.append([radius, 1])
+    
+    if not np.isnan(mass):
+        grid_lengths.append(period_grid(1, mass, dt).shape[0])
+        rm_set.append([1, mass])
+    
+    return rm_set[np.argmin(grid_lengths)]
+
+def limit_threads(num_threads):
+    '''Worker initializer: limits the threads of numba and of the BLAS /
+    OpenMP libraries to num_threads. The libraries are loaded (numpy is
+    imported) before the initializer runs, so their thread pools are resized
+    with threadpoolctl; the environment variables only reach libraries that
+    are loaded later.'''
+    from threadpoolctl import threadpool_limits
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+    threadpool_limits(limits=num_threads)
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+def tls_featvec_worker(key, x_axis, flux, stellar_params, num_threads):
+    '''Version 1 feature vector of one light curve (NaNs are left out), run
+    by featvec_tls_parallel(). Light curves TLS fails on (with any error) get
+    NaNs.'''
+    flux = np.asarray(flux, dtype='float64')
+    valid = ~np.isnan(flux)
+    try:
+        features = featvec(x_axis[valid], flux[valid], v=1,
+                           stellar_params=stellar_params,
+                           use_threads=num_threads, show_progress_bar=False)
+    except Exception as e:
+        print('TLS failed on '+key+': '+type(e).__name__+': '+str(e))
+        features = [np.nan]*len(TLS_FEATURE_COLUMNS)
+    return key, features
+
+def featvec_tls_parallel(x_axis, flux, identifiers, db_file, stellar_params=None,
+                         n_workers=None, threads_per_worker=1,
+                         max_pending=None):
+    '''Version 1 (TLS) feature vectors of many light curves, computed in
+    parallel and checkpointed in db_file (see above).
+    Parameters:
+        * x_axis : time axis of all light curves, or one time axis per light
+                   curve
+        * flux : light curves (NaNs, e.g. sigma clipped points, are left out)
+        * identifiers : identifier (e.g. TICID) of each light curve, or None
+                        (the database then records row indices)
+        * db_file : TLS feature database (see open_tls_db())
+        * stellar_params : radius and mass of each light curve, returned by
+                           tls_stellar_params() (default solar)
+        * n_workers : number of processes (default is the number of CPUs
+                      divided by threads_per_worker)
+        * threads_per_worker : threads each process may use
+        * max_pending : number of light curves submitted to the workers at a
+                        time (default 2*n_workers), so that flux is not
+                        copied to the workers all at once
+    Light curves TLS fails on are recorded with NaN features.
+    Returns:
+        * features : array shape=(len(flux), 4), see TLS_FEATURE_COLUMNS
+    '''
+    import time
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    
+    if type(n_workers) == type(None):
+        n_workers = max(1, os.cpu_count() // threads_per_worker)
+    if type(max_pending) == type(None):
+        max_pending = 2*n_workers
+    if type(stellar_params) == type(None):
+        stellar_params = np.full((len(flux), 2), np.nan)
+    shared_time = np.ndim(x_axis[0]) == 0
+    keys = ['%016x'%key for key in lc_keys(identifiers, x_axis, flux)]
+    
+    # >> read checkpoint
+    con = open_tls_db(db_file)
+    done = {}
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start+500]
+        query = 'SELECT key, '+', '.join(TLS_FEATURE_COLUMNS)+\
+            ' FROM tls_features WHERE key IN ('+','.join(['?']*len(chunk))+')'
+        for row in con.execute(query, chunk):
+            done[row[0]] = row[1:]
+    todo = {}
+    for i, key in enumerate(keys):
+        if key not in done and key not in todo:
+            todo[key] = i
+    print(str(len(todo))+' of '+str(len(keys))+' light curves not in '+db_file)
+    
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=limit_threads,
+                                 initargs=(threads_per_worker,)) as executor:
+            # >> at most max_pending light curves in flight; flux is
+            # >> converted to float64 by the workers
+            queue = iter(todo.items())
+            pending = set()
+            n = 0
+            while True:
+                for key, i in queue:
+                    pending.add(executor.submit(
+                        tls_featvec_worker, key,
+                        np.asarray(x_axis if shared_time else x_axis[i]),
+                        np.asarray(flux[i]), stellar_params[i],
+                        threads_per_worker))
+                    if len(pending) >= max_pending:
+                        break
+                if len(pending) == 0:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, features = future.result()
+                    identifier = todo[key] if type(identifiers) == type(None) \
+                        else identifiers[todo[key]]
+                    con.execute('INSERT OR REPLACE INTO tls_features VALUES '+\
+                                '(?,?,?,?,?,?,?)',
+                                (key, str(identifier),
+                                 *[float(x) for x in features], time.time()))
+                    con.commit()
+                    done[key] = features
+                    if n % 25 == 0: print(str(n) + " completed")
+                    n += 1
+    con.close()
+    
+    return np.array([done[key] for key in keys], dtype='float64')
+
+# :: PSD store :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Power spectra for the CAE (input_psd=True in ml.autoencoder_preprocessing)
+# >> are computed once per sector and kept in a store, a directory
+# >> get_psd_store_dir() per frequency grid, normalization and method with
+# >>   * freq.npy            : frequency grid (1/days)
+# >>   * ticid.npy           : TICID of each row
+# >>   * key.npy             : lc_keys() of each row (TICID, sector, time and
+# >>                           flux)
+# >>   * psd.npy             : shape=(num rows, len(freq))
+# >>   * psd_store_info.json : grid, normalization, method and number of rows
+# >>                           (written last)
+# >> cached_psd() gathers the rows of any set of light curves (a train/test
+# >> split, an iteration, a segment) and only computes light curves not in the
+# >> store yet. Rows are looked up by key, so a light curve whose time axis or
+# >> flux changed (e.g. after a different detrending) gets a new row instead
+# >> of the PSD of its old version.
+# >> method='batch' computes the generalized (floating mean) Lomb-Scargle
+# >> periodogram of blocks of light curves with matrix products over the
+# >> trig tables of lombscargle_tables(), method='astropy' calls
+# >> LombScargle(time, flux).power(freq) (its 'fast' method) per light curve.
+
+def psd_frequency_grid(time, n_pgram=1000):
+    '''n_pgram evenly spaced frequencies spanning LombScargle's automatic
+    frequency grid of time.'''
+    from astropy.timeseries import LombScargle
+    f = LombScargle(time, np.ones(len(time))).autofrequency()
+    return np.linspace(np.min(f), np.max(f), n_pgram)
+
+def gls_tables(time, freq):
+    '''Trig tables for gls_batch(), for time axis time and frequencies freq (not
+    angular). Light curves must not have NaNs.'''
+    t = np.asarray(time, dtype='float64')
+    tables = lombscargle_tables(t - np.mean(t), 2*np.pi*np.asarray(freq))
+    tables['C'] = np.mean(tables['cos'], axis=1)
+    tables['S'] = np.mean(tables['sin'], axis=1)
+    tables['CC'] = np.mean(tables['cos']**2, axis=1) - tables['C']**2
+    tables['SS'] = np.mean(tables['sin']**2, axis=1) - tables['S']**2
+    tables['CS'] = np.mean(tables['cos']*tables['sin'], axis=1) - \
+        tables['C']*tables['S']
+    return tables
+
+def gls_batch(y, tables, normalization='standard'):
+    '''Generalized Lomb-Scargle periodograms (Zechmeister & Kurster 2009) of
+    light curves y (shape=(num light curves, num points)), the same as
+    LombScargle(time, y[i]).power(freq, normalization=normalization,
+    method='slow') for normalization 'standard' or 'psd'.'''
+    y = np.asarray(y, dtype='float64')
+    y = y - np.mean(y, axis=1, keepdims=True)
+    n = y.shape[1]
+    YY = np.sum(y**2, axis=1, keepdims=True)
+    YC = np.matmul(y, tables['cos'].T) / n
+    YS = np.matmul(y, tables['sin'].T) / n
+    CC, SS, CS = tables['CC'], tables['SS'], tables['CS']
+    pgram = (SS*YC**2 + CC*YS**2 - 2*CS*YC*YS) / (CC*SS - CS**2) * n
+    if normalization == 'standard':
+        return pgram / YY
+    elif normalization == 'psd':
+        return 0.5 * pgram
+    raise ValueError('Unknown normalization '+str(normalization))
+
+# >> trig tables of the worker processes of compute_psd()
+PSD_TABLES = {}
+
+def init_psd_worker(time, freq, normalization, method):
+    '''Worker initializer of compute_psd(), computes the trig tables once per
+    process.'''
+    PSD_TABLES['time'] = time
+    PSD_TABLES['freq'] = freq
+    PSD_TABLES['normalization'] = normalization
+    PSD_TABLES['method'] = method
+    if method == 'batch':
+        PSD_TABLES['tables'] = gls_tables(time, freq)
+
+def psd_block(flux):
+    '''Periodograms of a block of light curves, on the frequency grid set by
+    init_psd_worker().'''
+    if PSD_TABLES['method'] == 'batch':
+        return gls_batch(flux, PSD_TABLES['tables'],
+                         normalization=PSD_TABLES['normalization'])
+    from astropy.timeseries import LombScargle
+    return np.array([LombScargle(PSD_TABLES['time'], y).power(
+        PSD_TABLES['freq'], normalization=PSD_TABLES['normalization']) \
+                     for y in flux])
+
+def compute_psd(time, flux, freq, normalization='standard', method='batch',
+                block_size=1000, n_workers=1, inds=None):
+    '''Periodograms of light curves on the same time axis (of flux[inds], if
+    inds is given), block_size light curves at a time, on n_workers
+    processes. Yields (start, psd) for each block, in order. See PSD store
+    above for method.'''
+    from multiprocessing import Pool
+    
+    if type(inds) == type(None):
+        inds = np.arange(len(flux))
+    starts = range(0, len(inds), block_size)
+    blocks = (flux[inds[start:start+block_size]] for start in starts)
+    if n_workers == 1:
+        init_psd_worker(time, freq, normalization, method)
+        for start, block in zip(starts, blocks):
+            yield start, psd_block(block)
+        PSD_TABLES.clear()
+    else:
+        with Pool(processes=n_workers, initializer=init_psd_worker,
+                  initargs=(time, freq, normalization, method)) as pool:
+            for start, psd in zip(starts, pool.imap(psd_block, blocks)):
+                yield start, psd
+
+def get_psd_store_dir(data_dir, sector, freq, normalization='standard',
+                      method='batch'):
+    '''Returns the PSD store directory of a sector, frequency grid,
+    normalization and method.'''
+    h = hashlib.blake2b(digest_size=8)
+    h.update(np.ascontiguousarray(freq, dtype='float64'))
+    h.update((normalization + '|' + method).encode())
+    return data_dir + 'psd_store/Sector' + str(sector) + '/' + \
+        h.hexdigest() + '/'
+
+def open_psd_store(store_dir):
+    '''Memory-maps a PSD store. Returns a dictionary with 'info', 'freq',
+    'ticid', 'key', 'psd' and 'index' (see ticid_index(), over the keys), or
+    None if the store is empty or has no keys (stores written before rows were
+    keyed are rebuilt).'''
+    if not os.path.exists(store_dir + 'psd_store_info.json') or \
+        not os.path.exists(store_dir + 'key.npy'):
+        return None
+    with open(store_dir + 'psd_store_info.json', 'r') as f:
+        info = json.load(f)
+    num_rows = info['num_rows']
+    store = {'info': info, 'freq': np.load(store_dir + 'freq.npy'),
+             'ticid': np.load(store_dir + 'ticid.npy')[:num_rows],
+             'key': np.load(store_dir + 'key.npy')[:num_rows],
+             'psd': np.load(store_dir + 'psd.npy', mmap_mode='r')[:num_rows]}
+    # >> the uint64 keys are indexed as int64, which keeps them distinct
+    store['index'] = ticid_index(store['key'].view('int64'))
+    return store
+
+def cached_psd(data_dir, sector, ticid, time, flux, freq,
+               normalization='standard', method='batch', block_size=1000,
+               n_workers=1):
+    '''Periodograms of light curves, gathered from the sector's PSD store
+    (see above). Light curves that are not in the store (new TICIDs, or
+    changed time axis or flux) are computed with compute_psd() and appended
+    to it block by block, so an interrupted run keeps the finished blocks.
+    Parameters:
+        * ticid : TICID of each light curve
+        * time, flux : time axis and light curves (without NaNs)
+        * freq : frequency grid, e.g. psd_frequency_grid(time)
+        * normalization, method, block_size, n_workers : see compute_psd()
+    Returns:
+        * psd : array shape=(len(flux), len(freq))
+    '''
+    store_dir = get_psd_store_dir(data_dir, sector, freq, normalization,
+                                  method)
+    store = open_psd_store(store_dir)
+    ticid = np.asarray(ticid).astype('int64')
+    keys = lc_keys(ticid, time, flux, sector=sector).view('int64')
+    rows = np.full(len(ticid), -1) if type(store) == type(None) else \
+        ticid_lookup(store['index'], keys)
+    
+    # >> compute every new light curve once, in the order they are given
+    new_keys, new = np.unique(keys[rows == -1], return_index=True)
+    order = np.argsort(new)
+    new_keys, new = new_keys[order], np.nonzero(rows == -1)[0][new[order]]
+    print(str(len(new))+' of '+str(len(ticid))+' PSDs not in '+store_dir)
+    if len(new) > 0:
+        os.makedirs(store_dir, exist_ok=True)
+        num_rows = 0 if type(store) == type(None) else \
+            store['info']['num_rows']
+        for start, psd in compute_psd(time, flux, freq,
+                                      normalization=normalization,
+                                      method=method, block_size=block_size,
+                                      n_workers=n_workers, inds=new):
+            block = new[start:start+len(psd)]
+            block_keys = new_keys[start:start+len(psd)].view('uint64')
+            if num_rows == 0:
+                np.save(store_dir + 'freq.npy', freq)
+                np.save(store_dir + 'ticid.npy', ticid[block])
+                np.save(store_dir + 'key.npy', block_keys)
+                np.save(store_dir + 'psd.npy', psd)
+            else:
+                append_npy(store_dir + 'ticid.npy', ticid[block],
+                           num_rows=num_rows)
+                append_npy(store_dir + 'key.npy', block_keys,
+                           num_rows=num_rows)
+                append_npy(store_dir + 'psd.npy', psd, num_rows=num_rows)
+            num_rows += len(psd)
+            info = {'sector': sector, 'n_pgram': len(freq),
+                    'fmin': float(np.min(freq)), 'fmax': float(np.max(freq)),
+                    'normalization': normalization, 'method': method,
+                    'num_rows': num_rows}
+            with open(store_dir + 'psd_store_info.json', 'w') as f:
+                json.dump(info, f)
+            print(str(num_rows) + ' PSDs in store')
+        store = open_psd_store(store_dir)
+        rows = ticid_lookup(store['index'], keys)
+    
+    # >> read rows in disk order
+    order = np.argsort(rows)
+    psd = np.empty((len(ticid), len(freq)))
+    psd[order] = store['psd'][rows[order]]
+    return psd
+
+# :: Cross-match cache :::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> SIMBAD, Vizier and TIC lookups are cached in an SQLite database, keyed by
+# >> (service, catalog, key), where key is an identifier (e.g. 'TIC 1234') or a
+# >> sky cell (see sky_cell_key()). Negative results (nothing found) are cached
+# >> as well, so re-running the queries of a sector makes no network calls.
+# >> Each entry has the time it was queried (in seconds since the epoch), and
+# >> entries older than max_age are queried again.
+
+# >> errors worth retrying: connection errors and timeouts (requests and urllib
+# >> errors are OSErrors) and errors reported by the service
+NETWORK_ERRORS = (OSError, RemoteServiceError)
+
+def with_network_retries(func, max_retries=5, backoff=2., name=''):
+    '''Returns func(), retrying after backoff**attempt seconds when it raises
+    one of NETWORK_ERRORS. The error of the last attempt is raised.'''
+    import time
+    for attempt in range(max_retries):
+        try:
+            return func()
+        except NETWORK_ERRORS as e:
+            print(e)
+            if attempt == max_retries - 1:
+                raise
+        print('Retrying '+name+' in '+str(backoff**attempt)+' s')
+        time.sleep(backoff**attempt)
+
+def open_xmatch_cache(cache_file):
+    '''Opens (or creates) a cross-match cache. Returns an sqlite3 connection.'''
+    con = sqlite3.connect(cache_file)
+    con.execute('CREATE TABLE IF NOT EXISTS xmatch (service TEXT, '+\
+                'catalog TEXT, key TEXT, found INTEGER, result TEXT, '+\
+                'time REAL, PRIMARY KEY (service, catalog, key))')
+    return con
+
+def xmatch_cache_get(con, service, catalog, keys, max_age=None):
+    '''Returns a dictionary with the cached result of each of keys that is in
+    the cache (None for negative results).'''
+    import time
+    cached = {}
+    keys = list(keys)
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start+500]
+        query = 'SELECT key, found, result, time FROM xmatch WHERE '+\
+            'service=? AND catalog=? AND key IN ('+\
+            ','.join(['?']*len(chunk))+')'
+        for key, found, result, t in con.execute(query,
+                                                 [service, catalog] + chunk):
+            if type(max_age) != type(None) and time.time() - t > max_age:
+                continue
+            cached[key] = json.loads(result) if found else None
+    return cached
+
+def xmatch_cache_put(con, service, catalog, results):
+    '''Adds results (dictionary key -> result, or None if nothing was found)
+    to the cache. Results are stored as JSON.'''
+    import time
+    now = time.time()
+    con.executemany('INSERT OR REPLACE INTO xmatch VALUES (?,?,?,?,?,?)',
+                    [(service, catalog, key, int(type(res) != type(None)),
+                      json.dumps(res, default=str), now) \
+                     for key, res in results.items()])
+    con.commit()
+
+def cached_query(con, service, catalog, key, query, max_age=None):
+    '''Returns the cached result for key, or calls query() (which returns the
+    result, or None if nothing was found) and caches its result. Exceptions
+    raised by query() (e.g. connection errors) are not cached.'''
+    cached = xmatch_cache_get(con, service, catalog, [key], max_age=max_age)
+    if key in cached:
+        return cached[key]
+    res = query()
+    xmatch_cache_put(con, service, catalog, {key: res})
+    return res
+
+def sky_cell_key(ra, dec, radius):
+    '''Cache key of a cone search (ra, dec, radius in degrees).'''
+    return '{:.6f},{:.6f},{:g}'.format(float(ra), float(dec), float(radius))
+
+def table_row_to_dict(row):
+    '''Converts a row of an astropy table to a dictionary that can be cached
+    (masked values become None).'''
+    d = {}
+    for col in row.colnames:
+        value = row[col]
+        if np.ma.is_masked(value):
+            value = None
+        elif isinstance(value, bytes):
+            value = value.decode('utf-8')
+        elif isinstance(value, np.generic):
+            value = value.item()
+        d[col] = value
+    return d
+
+def query_tic(ticid, con, max_age=None):
+    '''Returns the TIC catalog entry (as a dictionary) of a TICID, from the
+    cross-match cache if it was queried less than max_age seconds ago.'''
+    target = 'TIC '+str(int(ticid))
+    def query():
+        catalog_data = Catalogs.query_object(target, radius=0.02,
+                                             catalog='TIC')
+        return table_row_to_dict(catalog_data[0])
+    return cached_query(con, 'mast', 'TIC', target, query, max_age=max_age)
+
+# >> TIC catalog columns with identifiers SIMBAD knows, and their prefixes
+# >> (UCAC is not in SIMBAD yet)
+SIMBAD_ALIASES = [('TYC', 'TYC'), ('HIP', 'HIP'), ('TWOMASS', '2MASS'),
+                  ('SDSS', 'SDSS'), ('ALLWISE', 'ALLWISE'), ('GAIA', 'Gaia'),
+                  ('APASS', 'APASS'), ('KIC', 'KIC')]
+
+def catalog_id(value):
+    '''Returns an identifier from a TIC catalog column as a string, or None if
+    it is missing (masked, NaN or empty).'''
+    if np.ma.is_masked(value) or type(value) == type(None):
+        return None
+    if isinstance(value, str) and len(value.strip()) == 0:
+        return None
+    if isinstance(value, float):
+        if np.isnan(value):
+            return None
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+# :: Batched cross-match :::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Instead of one request per target (and per alias), targets are sent to
+# >> SIMBAD and Vizier chunk_size at a time: identifiers through
+# >> Simbad.query_objects(), coordinates as an uploaded table through
+# >> Vizier.query_region(). The replies are matched back to the targets by
+# >> their index in the chunk (SCRIPT_NUMBER_ID or user_specified_id for
+# >> SIMBAD, _q for Vizier). The service is a parameter, so any object with
+# >> the same query_objects() / query_region() (e.g. a local stand-in) can be
+# >> used. Results share the cross-match cache with the per-target queries.
+# >> Every request is retried on network errors (see with_network_retries());
+# >> a chunk that still fails is left out of the results and the cache, and
+# >> its targets are reported in failed, so that a later run queries them.
+
+def simbad_query_objects(identifiers, simbad=None, con=None, chunk_size=500,
+                         max_age=None, max_retries=5, backoff=2.):
+    '''Looks up identifiers in SIMBAD with one query_objects() request per
+    chunk_size identifiers.
+    Parameters:
+        * identifiers : list of identifiers, e.g. ['TIC 1234', 'HIP 77']
+        * simbad : default is Simbad() with the otypes votable field
+        * con : cross-match cache (see open_xmatch_cache()), only identifiers
+                that are not in it are queried
+        * max_retries, backoff : see with_network_retries()
+    Returns:
+        * results : dictionary, identifier -> {'otypes', 'main_id'}, or None
+                    if SIMBAD does not know the identifier (identifiers whose
+                    request failed are not in it)
+    '''
+    if type(simbad) == type(None):
+        simbad = Simbad()
+        simbad.add_votable_fields('otypes')
+    identifiers = list(dict.fromkeys(identifiers)) # >> unique, keeps order
+    results = {}
+    if type(con) != type(None):
+        results.update(xmatch_cache_get(con, 'simbad', 'otypes', identifiers,
+                                        max_age=max_age))
+    todo = [identifier for identifier in identifiers \
+            if identifier not in results]
+    
+    for start in range(0, len(todo), chunk_size):
+        chunk = todo[start:start+chunk_size]
+        print('Querying SIMBAD for '+str(start+len(chunk))+'/'+\
+              str(len(todo))+' identifiers')
+        try:
+            res = with_network_retries(lambda: simbad.query_objects(chunk),
+                                       max_retries=max_retries,
+                                       backoff=backoff, name='SIMBAD')
+        except NETWORK_ERRORS:
+            print('Skipping '+str(len(chunk))+' identifiers after '+\
+                  str(max_retries)+' attempts')
+            continue
+        found = dict.fromkeys(chunk)
+        if type(res) != type(None):
+            for row in res:
+                # >> astroquery versions differ in the case of column names
+                row = {key.lower(): value for key, value in \
+                       table_row_to_dict(row).items()}
+                if 'user_specified_id' in row:
+                    identifier = row['user_specified_id']
+                else:
+                    identifier = chunk[int(row['script_number_id']) - 1]
+                if identifier in found and \
+                    type(found[identifier]) == type(None) and row['main_id']:
+                    found[identifier] = {'otypes': row['otypes'] or '',
+                                         'main_id': row['main_id']}
+        results.update(found)
+        if type(con) != type(None):
+            xmatch_cache_put(con, 'simbad', 'otypes', found)
+    return results
+
+def simbad_xmatch(identifiers, simbad=None, con=None, chunk_size=500,
+                  max_age=None, max_retries=5, backoff=2., failed=None):
+    '''Cross-matches targets with SIMBAD, trying the identifiers of each
+    target in order until one is found: the first round looks up the first
+    identifier of every target, the next round the second identifier of
+    targets that were not found, etc.
+    Parameters:
+        * identifiers : list with the identifiers of each target, e.g.
+                        [['TIC 1234', 'HIP 77'], ['TIC 5678']]
+        * simbad, con, chunk_size, max_age, max_retries, backoff : see
+          simbad_query_objects()
+        * failed : list, the indices of targets whose requests failed are
+                   appended to it (their results are None)
+    Returns:
+        * results : list with {'otypes', 'main_id'} or None for each target
+    '''
+    results = [None]*len(identifiers)
+    todo = range(len(identifiers))
+    failed_set = set()
+    for k in range(max([len(ids) for ids in identifiers] + [0])):
+        todo = [n for n in todo if type(results[n]) == type(None) and \
+                k < len(identifiers[n]) and n not in failed_set]
+        res = simbad_query_objects([identifiers[n][k] for n in todo],
+                                   simbad=simbad, con=con,
+                                   chunk_size=chunk_size, max_age=max_age,
+                                   max_retries=max_retries, backoff=backoff)
+        for n in todo:
+            if identifiers[n][k] in res:
+                results[n] = res[identifiers[n][k]]
+            else:
+                failed_set.add(n)
+    if type(failed) != type(None):
+        failed.extend(sorted(failed_set))
+    return results
+
+def vizier_query_region(ra, dec, radius=0.003, catalog='gcvs', vizier=None,
+                        con=None, chunk_size=500, max_age=None, max_retries=5,
+                        backoff=2., failed=None):
+    '''Cone searches of radius (deg) around every (ra, dec), with one
+    query_region() request per chunk_size targets.
+    Parameters:
+        * ra, dec : coordinates of each target (deg)
+        * vizier : default is Vizier(columns=['VarType', 'VarName', '+_r'])
+                   without a row limit
+        * con : cross-match cache (see open_xmatch_cache())
+        * max_retries, backoff : see with_network_retries()
+        * failed : list, the indices of targets whose request failed are
+                   appended to it (their results are None)
+    Returns:
+        * results : list with {'VarType', 'VarName'} of the closest match,
+                    or None, for each target
+    '''
+    if type(vizier) == type(None):
+        vizier = Vizier(columns=['VarType', 'VarName', '+_r'], row_limit=-1)
+    keys = [sky_cell_key(ra[i], dec[i], radius) for i in range(len(ra))]
+    results = {}
+    if type(con) != type(None):
+        results.update(xmatch_cache_get(con, 'vizier', catalog, keys,
+                                        max_age=max_age))
+    todo = [] # >> one cone search per sky cell
+    for i in range(len(keys)):
+        if keys[i] not in results:
+            results[keys[i]] = None
+            todo.append(i)
+    failed_keys = set()
+    
+    for start in range(0, len(todo), chunk_size):
+        inds = todo[start:start+chunk_size]
+        print('Querying Vizier for '+str(start+len(inds))+'/'+\
+              str(len(todo))+' targets')
+        coords = coord.SkyCoord(ra=np.array(ra)[inds], dec=np.array(dec)[inds],
+                                unit=(u.deg, u.deg), frame='icrs')
+        try:
+            res = with_network_retries(
+                lambda: vizier.query_region(coords, radius=radius*u.deg,
+                                            catalog=catalog),
+                max_retries=max_retries, backoff=backoff, name='Vizier')
+        except NETWORK_ERRORS:
+            print('Skipping '+str(len(inds))+' targets after '+\
+                  str(max_retries)+' attempts')
+            failed_keys.update([keys[i] for i in inds])
+            continue
+        found = dict.fromkeys([keys[i] for i in inds])
+        if len(res) > 0:
+            for row in res[0]: # >> sorted by distance, so closest first
+                if '_q' in res[0].colnames:
+                    key = keys[inds[int(row['_q']) - 1]]
+                else: # >> only given for more than one target
+                    key = keys[inds[0]]
+                if type(found[key]) == type(None):
+                    found[key] = {'VarType': str(row['VarType']),
+                                  'VarName': str(row['VarName'])}
+        results.update(found)
+        if type(con) != type(None):
+            xmatch_cache_put(con, 'vizier', catalog, found)
+    if type(failed) != type(None):
+        failed.extend([i for i in range(len(keys)) if keys[i] in failed_keys])
+    return [results[key] for key in keys]
+
+# :: Offline cross-match :::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> GCVS is small enough (~60k stars) to keep on disk, so sectors can be
+# >> labelled without Vizier: the catalogue is put into a KD-tree of unit
+# >> vectors on the sphere, and all targets of a sector are matched to their
+# >> closest catalogue entry in one query. The cone search radius of
+# >> query_vizier() (radius, in deg) becomes the chord length 2 sin(radius/2).
+
+def radec_to_unit_vectors(ra, dec):
+    '''Unit vectors (shape=(N, 3)) of coordinates ra, dec (deg).'''
+    ra, dec = np.radians(np.asarray(ra, dtype='float')), \
+        np.radians(np.asarray(dec, dtype='float'))
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                     np.sin(dec)], axis=-1)
+
+def sky_xmatch(ra, dec, cat_ra, cat_dec, radius=0.003, tree=None):
+    '''Returns the index of the closest catalogue entry (cat_ra, cat_dec)
+    within radius (deg) of each target (ra, dec), or -1 if there is none.
+    tree is a cKDTree of radec_to_unit_vectors(cat_ra, cat_dec), if already
+    built.'''
+    if type(tree) == type(None):
+        tree = cKDTree(radec_to_unit_vectors(cat_ra, cat_dec))
+    xyz = radec_to_unit_vectors(ra, dec)
+    ind = np.full(len(xyz), -1, dtype='int64')
+    valid = np.all(np.isfinite(xyz), axis=1)
+    dist, match = tree.query(xyz[valid], k=1,
+                             distance_upper_bound=2*np.sin(np.radians(radius)/2))
+    ind[np.nonzero(valid)[0][np.isfinite(dist)]] = match[np.isfinite(dist)]
+    return ind
+
+def download_gcvs_dump(out='./gcvs.csv', catalog='B/gcvs/gcvs_cat'):
+    '''Saves VarName, VarType and J2000 coordinates (deg) of every star in
+    GCVS from Vizier to a CSV file that read_gcvs_dump() can read.'''
+    v = Vizier(columns=['VarName', 'VarType', '_RAJ2000', '_DEJ2000'],
+               row_limit=-1)
+    cat = v.get_catalogs(catalog)[0]
+    with open(out, 'w') as f:
+        f.write('ra,dec,VarType,VarName\n')
+        for row in cat:
+            f.write('{},{},{},{}\n'.format(row['_RAJ2000'], row['_DEJ2000'],
+                                           str(row['VarType']).replace(',', ''),
+                                           str(row['VarName']).replace(',', '')))
+
+def read_gcvs_dump(fname):
+    '''Reads a local GCVS catalogue, either a CSV file written by
+    download_gcvs_dump() or the gcvs5.txt file from
+    http://www.sai.msu.su/gcvs/gcvs/ (fixed-width fields separated by '|',
+    with J2000 coordinates as hhmmss.ss+ddmmss.s). Entries without
+    coordinates are skipped.
+    Returns:
+        * gcvs : dictionary with arrays 'ra', 'dec' (deg), 'VarType' and
+                 'VarName'
+    '''
+    ra, dec, otype, main_id = [], [], [], []
+    with open(fname, 'r') as f:
+        lines = f.readlines()
+    if lines[0].startswith('ra,dec'):
+        for line in lines[1:]:
+            line = line.rstrip('\n').split(',')
+            if len(line[0]) > 0 and len(line[1]) > 0:
+                ra.append(float(line[0]))
+                dec.append(float(line[1]))
+                otype.append(line[2])
+                main_id.append(line[3])
+    else:
+        for line in lines:
+            line = line.split('|')
+            if len(line) < 4:
+                continue
+            coords = line[2].strip()
+            if len(coords) < 15 or not coords[:6].isdigit():
+                continue
+            sign = coords.index('+') if '+' in coords else coords.index('-')
+            r, d = coords[:sign], coords[sign+1:]
+            ra.append(15*(float(r[:2]) + float(r[2:4])/60 + float(r[4:])/3600))
+            dec.append((-1 if coords[sign] == '-' else 1) * \
+                       (float(d[:2]) + float(d[2:4])/60 + float(d[4:])/3600))
+            otype.append(line[3].strip())
+            # >> the last column of the name field is the remark flag ('*')
+            main_id.append(' '.join(line[1][:-1].split()))
+    return {'ra': np.array(ra), 'dec': np.array(dec),
+            'VarType': np.array(otype), 'VarName': np.array(main_id)}
+
+def offline_gcvs_xmatch(data_dir, sector, gcvs_file, out=None, radius=0.003,
+                        gcvs=None):
+    '''Offline replacement for query_vizier(): matches every target of the
+    sector in the TIC catalog store (see convert_tic_catalog()) to the
+    closest GCVS star within radius (deg) with sky_xmatch().
+    Parameters:
+        * gcvs_file : local GCVS catalogue (see read_gcvs_dump())
+        * out : default data_dir+'databases/SectorX_GCVS.txt', in the format of
+                query_vizier() (ticid,VarType,VarName), which is read by
+                get_gcvs_classifications() and assign_real_labels()
+        * gcvs : returned by read_gcvs_dump(), if already read
+    Returns:
+        * ticid, otypes, main_id : of targets with a GCVS match
+    '''
+    if type(out) == type(None):
+        out = data_dir+'databases/Sector'+str(sector)+'_GCVS.txt'
+    if type(gcvs) == type(None):
+        gcvs = read_gcvs_dump(gcvs_file)
+    sectorfile = data_dir+'Sector'+str(sector)+'/all_targets_S%03d'%sector+\
+        '_v1.txt'
+    ticid = np.loadtxt(sectorfile, ndmin=2)[:,0].astype('int64')
+    catalog_data = tic_gather(open_tic_store(get_tic_store_dir(data_dir)),
+                              ticid, ['ra', 'dec'])
+    ind = sky_xmatch(catalog_data['ra'], catalog_data['dec'], gcvs['ra'],
+                     gcvs['dec'], radius=radius)
+    otype = np.where(ind > -1, gcvs['VarType'][ind], '')
+    main_id = np.where(ind > -1, gcvs['VarName'][ind], '')
+    print(str(np.count_nonzero(ind > -1))+'/'+str(len(ticid))+\
+          ' targets in GCVS')
+    if len(os.path.dirname(out)) > 0:
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        f.write(''.join(['{},{},{}\n'.format(ticid[i], otype[i], main_id[i]) \
+                         for i in range(len(ticid))]))
+    matched = np.nonzero(ind > -1)[0]
+    return ticid[matched], otype[matched], main_id[matched]
+
+def get_tess_features(ticid, cache_file='./xmatch_cache.sqlite'):
+    '''Query catalog data https://arxiv.org/pdf/1905.10694.pdf
+    Results are cached in cache_file (see open_xmatch_cache()).'''
     
-
     target = 'TIC '+str(int(ticid))
-    catalog_data = Catalogs.query_object(target, radius=0.02, catalog='TIC')
-    Teff = catalog_data[0]["Teff"]
-
-    rad = catalog_data[0]["rad"]
-    mass = catalog_data[0]["mass"]
-    GAIAmag = catalog_data[0]["GAIAmag"]
-    d = catalog_data[0]["d"]
-    # Bmag = catalog_data[0]["Bmag"]
-    # Vmag = catalog_data[0]["Vmag"]
-    objType = catalog_data[0]["objType"]
-    Tmag = catalog_data[0]["Tmag"]
-    # lum = catalog_data[0]["lum"]
+    con = open_xmatch_cache(cache_file)
+    catalog_data = query_tic(ticid, con)
+    con.close()
+    Teff = catalog_data["Teff"]
+
+    rad = catalog_data["rad"]
+    mass = catalog_data["mass"]
+    GAIAmag = catalog_data["GAIAmag"]
+    d = catalog_data["d"]
+    # Bmag = catalog_data["Bmag"]
+    # Vmag = catalog_data["Vmag"]
+    objType = catalog_data["objType"]
+    Tmag = catalog_data["Tmag"]
+    # lum = catalog_data["lum"]
 
     return target, Teff, rad, mass, GAIAmag, d, objType, Tmag
 
-def get_tess_feature_all(data_dir='./data/'):
-    columns = np.loadtxt(data_dir+'exo_CTL_08.01xTIC_v8.1_header.csv',
-                         dtype='str', delimiter=',')
-    columns = np.char.replace(columns, '[', '') # >> clean up
-    columns = np.char.split(columns, ']')
-    columns = [x[0] for x in columns]
-    columns.remove('objID')
+def get_tess_feature_all(data_dir='./data/', cache_file=None, sectors=[26],
+                         write_csv=True):
+    '''Makes sure the TIC catalog store (see convert_tic_catalog()) has every
+    target of sectors. Targets missing from it are queried from MAST (cached
+    in cache_file, default data_dir+'xmatch_cache.sqlite') and appended to the
+    store. If write_csv, also writes the catalog entries of the sector's
+    targets to SectorXtic_cat_all.csv.'''
+    if type(cache_file) == type(None):
+        cache_file = data_dir + 'xmatch_cache.sqlite'
+    con = open_xmatch_cache(cache_file)
+    store_dir = get_tic_store_dir(data_dir)
+    store = open_tic_store(store_dir)
+    columns = store['info']['columns']
 
-    sectors =  [26] # np.arange(8,27)
     for sector in sectors:
         print('Sector '+str(sector))
         output_dir = data_dir + 'Sector'+str(sector)+'/'
         fname = output_dir+'all_targets_S%03d'%sector+'_v1.txt'
-        ticid = np.loadtxt(fname)[:,0] # >> take first column
-
-        fname = output_dir+'Sector'+str(sector)+'tic_cat.csv'
-        data = pd.read_csv(fname) # !! need to first do get_TIC_catalog_sector
-        data_ticid = data['ID'].to_numpy()
-        with open(fname, 'r') as f:
-            lines=f.readlines()[1:]
-
-        # >> make new file
-        fname = output_dir+'Sector'+str(sector)+'tic_cat_all.csv'
-        if os.path.exists(fname):
-            prog = pd.read_csv(fname, index_col=False)
-            prog.to_csv(output_dir+'Sector'+str(sector)+'backup.csv',
-                        index=False)
-            ticid_prog = prog['ID'].to_numpy()
-
-        with open(fname, 'w') as f:
-            f.write(','.join(columns)+'\n')
-
-        for i in range(len(ticid)):
-            if i % 100 == 0:
-                print(str(i) + '/' + str(len(ticid)))
-
-
-            if ticid[i] not in ticid_prog:
-                if ticid[i] in data_ticid:
-                    ind = np.nonzero(data_ticid == ticid[i])[0][0]
-                    with open(fname, 'a') as f:
-                        f.write(','.join(lines[ind].split(',')[:124])+'\n')
-                else:
-                    target = 'TIC ' + str(int(ticid[i]))
-                    print('Querying '+target)
-                    catalog_data = \
-                        Catalogs.query_object(target, radius=0.02, catalog='TIC')
-                    line = []
-                    for col in columns:
-                        line.append(catalog_data[0][col])
-                    line = np.array(line) # >> clean up
-                    line[np.nonzero(line == 'nan')] = ''
-                    with open(fname, 'a') as f:
-                        f.write(','.join(line) +'\n')
-            else:
-                print('Already completed '+str(ticid[i]))
-                ind = np.nonzero(ticid_prog == ticid[i])[0][0]
-                with open(fname, 'a') as f:
-                    f.write(','.join(prog.loc[ind].to_numpy().astype('str'))+'\n')
-                
-
-    
-
-def get_tess_feature_txt(ticid_list, out='./tess_features_sectorX.txt'):
+        ticid = np.loadtxt(fname, ndmin=2)[:,0].astype('int64') # >> take first column
+
+        # >> query targets that are not in the catalog store
+        missing = ticid[ticid_lookup(store['index'], ticid) == -1]
+        print(str(len(missing))+'/'+str(len(ticid))+' targets to query')
+        data = {col: [] for col in columns}
+        for i in range(len(missing)):
+            print('Querying TIC '+str(missing[i]))
+            catalog_data = query_tic(missing[i], con)
+            for col in columns:
+                data[col].append(catalog_data.get(col, None))
+            data['ID'][-1] = missing[i]
+        if len(missing) > 0:
+            append_tic_store(store_dir, data)
+            store = open_tic_store(store_dir)
+
+        if write_csv:
+            data = tic_gather(store, ticid, [col for col in columns \
+                                             if col != 'objID'])
+            lines = np.array([data[col].astype('str') for col in data]).T
+            lines[lines == 'nan'] = ''
+            with open(output_dir+'Sector'+str(sector)+'tic_cat_all.csv',
+                      'w') as f:
+                f.write(','.join(data.keys())+'\n')
+                f.write(''.join([','.join(line)+'\n' for line in lines]))
+    con.close()
+
+    
+def get_tess_feature_txt(ticid_list, out='./tess_features_sectorX.txt',
+                         cache_file='./xmatch_cache.sqlite'):
     '''Queries 'TESS features' (i.e. Teff, rad, mass, GAIAmag, d) for each
-    TICID and saves to text file.
+    TICID and saves to text file. Queries are cached in cache_file.
     
     Can get ticid_list with:
     with open('all_targets_S019_v1.txt', 'r') as f:
@@ -1836,7 +4477,7 @@ def get_tess_feature_txt(ticid_list, out='./tess_features_sectorX.txt'):
     for i in range(len(ticid_list)):
         print(i)
         try:
-            features = get_tess_features(ticid_list[i])
+            features = get_tess_features(ticid_list[i], cache_file=cache_file)
             # TESS_features.append(features)
             with open(out, 'a') as f:
                 f.write(' '.join(map(str, features)) + '\n')
@@ -1880,90 +4521,254 @@ def download_TIC_catalog(output_dir='./'):
     fname = 'tic_column_description.txt'
     os.system('curl -# -o '+output_dir+fname+' '+url+fname)
     
-def get_TIC_catalog_sector(data_dir='data/'):
-    '''Will read TICv8 CSV files and return a pandas dataframe as another csv.'''
-    # import glob
-
-    # >> get column descriptions
-    # columns = np.loadtxt(data_dir+'tic_column_description.txt',
-    #                      dtype='str')[:,0] # >> take first column
-    # columns = np.char.replace(columns, '[', '') # >> clean up
-    # columns = np.char.replace(columns, ']', '')
+# :: TIC catalog store :::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> The CTL x TIC v8 extract (exo_CTL_08.01xTIC_v8.1.csv) is converted once
+# >> into a columnar store, a directory (get_tic_store_dir()) with
+# >>   * <column>.npy         : one typed array per catalog column, all rows in
+# >>                            the same order, so columns are memory-mapped
+# >>                            and only the gathered rows are read
+# >>   * ticid_index.npy      : rows sorted by TICID (see ticid_index())
+# >>   * tic_store_info.json  : columns, their dtypes and the number of rows
+# >>                            (written last)
+# >> ID is int64, identifiers in TIC_STRING_COLUMNS and other columns that are
+# >> not numbers are fixed width strings ('' if missing), and the rest are
+# >> float64 (NaN if missing). A column that looks numeric in the first chunk
+# >> but has other values later is promoted to strings, so no value is lost.
+# >> tic_gather() returns columns for an array of TICIDs with one vectorized
+# >> lookup.
+
+# >> identifiers are kept as strings (SDSS and Gaia IDs do not fit in float64)
+TIC_STRING_COLUMNS = ['HIP', 'TYC', 'UCAC', 'TWOMASS', 'SDSS', 'ALLWISE',
+                      'GAIA', 'APASS', 'KIC']
+
+def get_tic_store_dir(data_dir):
+    '''Returns the TIC catalog store directory.'''
+    return data_dir + 'tic_store/'
+
+def tic_catalog_columns(data_dir):
+    '''Column names of exo_CTL_08.01xTIC_v8.1.csv, from its header file.'''
     columns = np.loadtxt(data_dir+'exo_CTL_08.01xTIC_v8.1_header.csv',
                          dtype='str', delimiter=',')
     columns = np.char.replace(columns, '[', '') # >> clean up
     columns = np.char.split(columns, ']')
-    columns = [x[0] for x in columns]
-
-    # >> get TICIDs for each sector
-    ticid = []
-    sectors = np.arange(1,27)
-    for sector in sectors:
-        fname = 'Sector'+str(sector)+'/all_targets_S%03d'%sector+'_v1.txt'
-        ticid_sector = np.loadtxt(data_dir+fname)[:,0] # >> take first column
-        ticid.append(ticid_sector)
-
-    # # >> initialize sector_df
-    # sector_df = {}
-    # for i in range(len(sectors)):
-    #     sector_df[i] = []
-
-    # for fname in fnames:
-        # print('Loading ' + fname + ' ...')
-        # for chunk in pd.read_csv(fname, header=None, chunksize=50000,
-        #                          low_memory=False):
-
-        #     for i in range(len(sectors)):
-        #         # >> find data only for our desired TICIDs
-        #         _, _, inds = np.intersect1d(ticid[i], chunk[0],
-        #                                     return_indices=True)
-
-        #         if len(inds) > 0:
-        #             sector_df[i].append(chunk.iloc[inds])
-        #             if len(sector_df[i]) > 1:
-        #                 sector_df[i] = [pd.concat(sector_df[i])]
-        #             sector_df[i][0].to_csv(data_dir+'Sector'+str(i+1)+'/Sector'+\
-        #                                    str(i+1)+'tic_cat.csv')
-
-    sector_df = {}
-
-    # # >> find all TICv8 csv files
-    # fnames = glob.glob(data_dir+'tic_dec*')
-    fname = data_dir + 'exo_CTL_08.01xTIC_v8.1.csv'
+    return [x[0] for x in columns]
+
+def tic_column_to_array(values, dtype):
+    '''Converts catalog values (strings read from the CSV file, or numbers,
+    strings and None from MAST) to a column of the TIC catalog store. dtype is
+    'int64', 'float64' or 'str'. Raises ValueError if a value is not a
+    number.'''
+    if np.asarray(values).dtype.kind != 'U':
+        values = [catalog_id(v) for v in values]
+        values = ['' if type(v) == type(None) else v for v in values]
+    values = np.char.strip(np.asarray(values, dtype='str'))
+    if dtype == 'str': # >> as narrow as possible
+        return values.astype('U'+str(max([1] + list(np.char.str_len(values)))))
+    missing = (values == '') | (values == 'nan')
+    column = np.full(len(values), -1 if dtype == 'int64' else np.nan,
+                     dtype=dtype)
+    column[~missing] = values[~missing].astype('float64')
+    return column
+
+def convert_tic_catalog(data_dir, fname=None, store_dir=None,
+                        sectors=np.arange(1,27), chunk_size=100000):
+    '''Converts exo_CTL_08.01xTIC_v8.1.csv into the TIC catalog store (see
+    above), chunk_size rows at a time.
+    Parameters:
+        * data_dir : contains the catalog, its header file, and
+                     SectorX/all_targets_S0XX_v1.txt for each of sectors
+        * fname : default is data_dir+'exo_CTL_08.01xTIC_v8.1.csv'
+        * store_dir : default is get_tic_store_dir()
+        * sectors : only keeps targets of these sectors (None keeps every row)
+    Returns:
+        * store_dir
+    '''
+    if type(fname) == type(None):
+        fname = data_dir + 'exo_CTL_08.01xTIC_v8.1.csv'
+    if type(store_dir) == type(None):
+        store_dir = get_tic_store_dir(data_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    columns = tic_catalog_columns(data_dir)
+
+    # >> TICIDs of all sectors
+    ticid = None
+    if type(sectors) != type(None):
+        ticid = []
+        for sector in sectors:
+            sectorfile = data_dir+'Sector'+str(sector)+'/all_targets_S%03d'%sector+\
+                '_v1.txt'
+            ticid.append(np.loadtxt(sectorfile, ndmin=2)[:,0].astype('int64'))
+        ticid = ticid_index(np.unique(np.concatenate(ticid)))
 
+    # >> write each chunk of each column to a temporary file
     print('Loading ' + fname + ' ...')
-    cat = pd.read_csv(fname, header=None, low_memory=False)
-
-    for i in range(len(sectors)):
-        # >> find data only for our desired TICIDs
-        _, _, inds = np.intersect1d(ticid[i], cat[0], return_indices=True)
-
-        sector_df[i] = cat.iloc[inds]
-        sector_df[i].columns = columns
-
-        sector_df[i].to_csv(data_dir+'Sector'+str(i+1)+'/Sector'+\
-                            str(i+1)+'tic_cat.csv', index=False)
-
+    dtypes = None
+    num_chunks, num_rows = 0, 0
+    for chunk in pd.read_csv(fname, header=None, chunksize=chunk_size,
+                             dtype=str, keep_default_na=False):
+        chunk = chunk.to_numpy().astype('str')
+        if type(dtypes) == type(None): # >> column types from the first chunk
+            dtypes = []
+            for j in range(len(columns)):
+                if columns[j] == 'ID':
+                    dtypes.append('int64')
+                elif columns[j] in TIC_STRING_COLUMNS:
+                    dtypes.append('str')
+                else:
+                    try:
+                        tic_column_to_array(chunk[:,j], 'float64')
+                        dtypes.append('float64')
+                    except ValueError:
+                        dtypes.append('str')
+        if type(ticid) != type(None):
+            keep = ticid_lookup(ticid, chunk[:,0].astype('int64')) > -1
+            chunk = chunk[keep]
+        for j in range(len(columns)):
+            try:
+                column = tic_column_to_array(chunk[:,j], dtypes[j])
+            except ValueError: # >> not a number after all
+                if columns[j] == 'ID':
+                    raise
+                print('Column '+columns[j]+' has values that are not '+\
+                      'numbers, storing it as strings')
+                dtypes[j] = 'str'
+                column = tic_column_to_array(chunk[:,j], 'str')
+            np.save(store_dir+columns[j]+'.%d.npy'%num_chunks, column)
+        num_chunks += 1
+        num_rows += len(chunk)
+        print(str(num_rows)+' rows')
+
+    def load_chunk(f, dtype):
+        data = np.load(f)
+        if dtype == 'str' and data.dtype.kind == 'f': # >> promoted column
+            data = np.where(np.isnan(data), '', data.astype('str'))
+        return data
+
+    # >> concatenate chunks of each column
+    info = {'columns': columns, 'dtypes': [], 'num_rows': num_rows,
+            'source': os.path.basename(fname)}
+    for j in range(len(columns)):
+        chunks = [store_dir+columns[j]+'.%d.npy'%i for i in range(num_chunks)]
+        if dtypes[j] == 'str': # >> width of the widest chunk
+            dtype = np.dtype('U'+str(max([1] + \
+                [load_chunk(f, 'str').dtype.itemsize//4 for f in chunks])))
+        else:
+            dtype = np.dtype(dtypes[j])
+        column = np.lib.format.open_memmap(store_dir+columns[j]+'.npy',
+                                           mode='w+', dtype=dtype,
+                                           shape=(num_rows,))
+        row = 0
+        for f in chunks:
+            data = load_chunk(f, dtypes[j])
+            column[row:row+len(data)] = data
+            row += len(data)
+            os.remove(f)
+        column.flush()
+        del column
+        info['dtypes'].append(dtype.str)
+
+    np.save(store_dir+'ticid_index.npy',
+            ticid_index(np.load(store_dir+'ID.npy'))['rows'])
+    with open(store_dir+'tic_store_info.json', 'w') as f:
+        json.dump(info, f)
+    return store_dir
+
+def open_tic_store(store_dir):
+    '''Memory-maps the TIC catalog store.
+    Returns:
+        * store : dictionary with 'info' (contents of tic_store_info.json),
+                  'index' (see ticid_index()) and 'columns' (dictionary,
+                  column name -> memory-mapped column)
+    '''
+    if not os.path.exists(store_dir+'tic_store_info.json'):
+        raise OSError('No TIC catalog store in ' + store_dir + \
+                      ' (see convert_tic_catalog())')
+    store = {'dir': store_dir, 'columns': {}}
+    with open(store_dir+'tic_store_info.json', 'r') as f:
+        store['info'] = json.load(f)
+    for col in store['info']['columns']:
+        store['columns'][col] = np.load(store_dir+col+'.npy', mmap_mode='r')
+    rows = np.load(store_dir+'ticid_index.npy')
+    store['index'] = {'ticid': np.asarray(store['columns']['ID'])[rows],
+                      'rows': rows}
+    return store
+
+def tic_gather(store, ticid, columns=None):
+    '''Returns the catalog columns of each TICID, in the order of ticid.
+    Parameters:
+        * store : returned by open_tic_store()
+        * ticid : array of TICIDs (float or int)
+        * columns : list of columns (default all)
+    Returns:
+        * data : dictionary, column -> array with one value per TICID. TICIDs
+                 that are not in the catalog have NaN, '' and ID -1
+    '''
+    if type(columns) == type(None):
+        columns = store['info']['columns']
+    rows = ticid_lookup(store['index'], ticid)
+    found = np.nonzero(rows > -1)[0]
+    data = {}
+    for col in list(dict.fromkeys(['ID'] + list(columns))):
+        column = store['columns'][col]
+        if column.dtype.kind == 'U':
+            data[col] = np.full(len(rows), '', dtype=column.dtype)
+        else:
+            data[col] = np.full(len(rows), -1 if column.dtype.kind == 'i' \
+                                else np.nan, dtype=column.dtype)
+        # >> read rows in disk order
+        order = np.argsort(rows[found])
+        data[col][found[order]] = column[rows[found][order]]
+    return data
+
+def append_tic_store(store_dir, data):
+    '''Appends rows to the TIC catalog store, e.g. targets queried from MAST.
+    data is a dictionary, column -> list of values (strings, numbers or None)
+    with the same length for every column, and must have 'ID'. Columns not
+    in data are missing for the new rows.'''
+    store = open_tic_store(store_dir)
+    info = store['info']
+    num_rows = len(data['ID'])
+    for j in range(len(info['columns'])):
+        col = info['columns'][j]
+        dtype = np.dtype(info['dtypes'][j])
+        values = data.get(col, [None]*num_rows)
+        if dtype.kind == 'U':
+            column = tic_column_to_array(values, 'str')
+            if column.dtype.itemsize > dtype.itemsize: # >> widen the column
+                np.save(store_dir+col+'.npy',
+                        np.concatenate([np.asarray(store['columns'][col]),
+                                        column]))
+                info['dtypes'][j] = np.load(store_dir+col+'.npy',
+                                            mmap_mode='r').dtype.str
+                continue
+        else:
+            column = tic_column_to_array(values, dtype.name)
+        append_npy(store_dir+col+'.npy', column, info['num_rows'])
+    index = update_ticid_index(store['index'], data['ID'],
+                               np.arange(info['num_rows'],
+                                         info['num_rows']+num_rows))
+    np.save(store_dir+'ticid_index.npy', index['rows'])
+    info['num_rows'] += num_rows
+    with open(store_dir+'tic_store_info.json', 'w') as f:
+        json.dump(info, f)
 
-    # # >> put column descriptions in each .csv file
-    # for i in range(len(sectors)):
-    #     sector_df[i][0].columns = columns
-    #     sector_df[i][0].to_csv(data_dir+'Sector'+str(i+1)+'/Sector'+\
-    #                            str(i+1)+'tic_cat.csv')
+def get_TIC_catalog_sector(data_dir='data/'):
+    '''Converts exo_CTL_08.01xTIC_v8.1.csv into the TIC catalog store, keeping
+    the targets of Sectors 1-26 (see convert_tic_catalog()). Use tic_gather()
+    to get the catalog entries of a sector's targets.'''
+    return convert_tic_catalog(data_dir, sectors=np.arange(1,27))
 
 
 def get_TIC_check_success(data_dir):
+    store = open_tic_store(get_tic_store_dir(data_dir))
     for sector in range(1,27):
         print('Sector '+str(sector))
         fname = data_dir+'Sector'+str(sector)+'/all_targets_S%03d'%sector+\
                 '_v1.txt'
         ticid = np.loadtxt(fname)[:,0]
-        fname = data_dir+'Sector'+str(sector)+'/Sector'+str(sector)+\
-                'tic_cat_all.csv'
-        df = pd.read_csv(fname, index_col=False)
-        inter = np.intersect1d(ticid, df['ID'])
-        print('Number of targets in tic_cat_all: '+str(len(inter)))
-        print('Right order? '+str(ticid==df['ID']))
+        found = ticid_lookup(store['index'], ticid) > -1
+        print('Number of targets in TIC catalog store: '+\
+              str(np.count_nonzero(found)))
 
         fname = data_dir+'Sector'+str(sector)+'/Sector'+str(sector)+\
                 'tic_cat_v2.csv'
@@ -2061,13 +4866,21 @@ def build_simbad_database(out='./simbad_database.txt'):
 
                
 def get_simbad_classifications(ticid_list,
-                               simbad_database_txt='./simbad_database.txt'):
+                               simbad_database_txt='./simbad_database.txt',
+                               label_db=None):
     '''Query Simbad classification and bibcode from .txt file (output from
-    build_simbad_database).
+    build_simbad_database), or from the label database if label_db is given
+    (see load_label_db(..., simbad_database_txt=...)).
     Returns a list where simbad_info[i] = [ticid, main_id, obj type, bibcode]
     Object type follows format in:
     http://vizier.u-strasbg.fr/cgi-bin/OType?$1
     '''
+    if type(label_db) != type(None):
+        rows = label_db_rows(label_db, ticid_list, 'simbad_database')
+        cols = label_db['columns']
+        return [[int(cols['ticid'][i]), cols['main_id'][i], cols['otype'][i],
+                 cols['bibcode'][i]] for i in rows]
+    
     ticid_simbad = []
     main_id_list = []
     otype_list = []
@@ -2096,126 +4909,157 @@ def query_associated_catalogs(ticid):
 
 def query_simbad_classifications(ticid_list, out_f='./SectorX_simbdad.txt',
                                  data_dir='data/', query_mast=False, 
-                                 sector=1):
+                                 sector=1, cache_file=None, max_age=None,
+                                 max_retries=5, backoff=2., batched=False,
+                                 chunk_size=500, simbad=None):
     '''Call like this:
     query_simbad_classifications([453370125.0, 356473029])
+    Each target is looked up in SIMBAD by its TICID, then by the identifiers
+    in SIMBAD_ALIASES. Every query is cached in cache_file (default
+    data_dir+'xmatch_cache.sqlite', see open_xmatch_cache()), including
+    identifiers SIMBAD does not know, so targets that were queried before
+    make no network calls. Cached entries older than max_age seconds are
+    queried again. Queries that fail with a connection error are retried
+    after backoff**attempt seconds, and targets that fail max_retries times
+    are skipped. Targets without a TIC entry are skipped without retrying.
+    If batched, targets are looked up chunk_size at a time with
+    simbad_xmatch() (simbad can be any object with the query_objects() of
+    Simbad, default is Simbad()).
     '''
     import time
     
     customSimbad = Simbad()
     customSimbad.add_votable_fields('otypes')
     # customSimbad.add_votable_fields('biblio')
+    if type(cache_file) == type(None):
+        cache_file = data_dir + 'xmatch_cache.sqlite'
+    con = open_xmatch_cache(cache_file)
+    try:
+        def query_simbad(target):
+            def query():
+                res = customSimbad.query_object(target)
+                if type(res) == type(None):
+                    return None
+                res = table_row_to_dict(res[0])
+                return {'otypes': res['OTYPES'], 'main_id': res['MAIN_ID']}
+            return cached_query(con, 'simbad', 'otypes', target, query,
+                                max_age=max_age)
+    
+        ticid_simbad = []
+        otypes_simbad = []
+        main_id_simbad = []
+        bibcode_simbad = []
     
-    ticid_simbad = []
-    otypes_simbad = []
-    main_id_simbad = []
-    bibcode_simbad = []
-    
-    with open(out_f, 'a') as f:
-        f.write('')    
-    
-    with open(out_f, 'r') as f:
-        lines = f.readlines()
-        ticid_already_classified = []
-        for line in lines:
-            ticid_already_classified.append(float(line.split(',')[0]))
+        with open(out_f, 'a') as f:
+            f.write('')    
     
-    if not query_mast:
-        catalog_data_all=pd.read_csv(data_dir+'Sector'+str(sector)+'/Sector'+str(sector)+\
-                                 'tic_cat_all.csv', index_col=False)
-
-    print(str(len(ticid_list))+' targets')
-    print(str(len(ticid_already_classified))+' targets completed')
-    ticid_list = np.setdiff1d(ticid_list, ticid_already_classified)
-    print(str(len(ticid_list))+' targets to query')
-
-    res=None
-
-    for tic in ticid_list:
-        
-        res = None
-        
-        while res is None:
-            try:
-                if tic in ticid_already_classified:
-                    print('Skipping TIC')
-                    
+        with open(out_f, 'r') as f:
+            lines = f.readlines()
+            ticid_already_classified = []
+            for line in lines:
+                ticid_already_classified.append(float(line.split(',')[0]))
+    
+        print(str(len(ticid_list))+' targets')
+        print(str(len(ticid_already_classified))+' targets completed')
+        ticid_list = np.setdiff1d(ticid_list, ticid_already_classified)
+        print(str(len(ticid_list))+' targets to query')
+        ticid_already_classified = set(ticid_already_classified)
+
+        if not query_mast:
+            # >> identifiers of each target from the TIC catalog store
+            catalog_data_all = tic_gather(open_tic_store(get_tic_store_dir(data_dir)),
+                                          ticid_list,
+                                          [col for col, _ in SIMBAD_ALIASES])
+
+        if batched:
+            # >> identifiers of each target, in the order they are tried
+            ticid_simbad, identifiers = [], []
+            for n, tic in enumerate(ticid_list):
+                if query_mast:
+                    try:
+                        catalog_data = with_network_retries(
+                            lambda: query_tic(tic, con, max_age=max_age),
+                            max_retries=max_retries, backoff=backoff,
+                            name='MAST')
+                    except IndexError as e: # >> no TIC entry, don't retry
+                        print(e)
+                        continue
+                    except NETWORK_ERRORS:
+                        print('Skipping TIC '+str(int(tic))+' after '+\
+                              str(max_retries)+' attempts')
+                        continue
+                elif catalog_data_all['ID'][n] == -1:
+                    print('TIC '+str(int(tic))+' is not in the TIC catalog store')
+                    continue
                 else:
+                    catalog_data = {col: catalog_data_all[col][n] \
+                                    for col in catalog_data_all}
+                ticid_simbad.append(tic)
+                identifiers.append(['TIC ' + str(int(tic))])
+                for col, prefix in SIMBAD_ALIASES:
+                    identifier = catalog_id(catalog_data[col])
+                    if type(identifier) != type(None):
+                        identifiers[-1].append(prefix + ' ' + identifier)
+            if type(simbad) == type(None):
+                simbad = customSimbad
+            failed = []
+            res = simbad_xmatch(identifiers, simbad=simbad, con=con,
+                                chunk_size=chunk_size, max_age=max_age,
+                                max_retries=max_retries, backoff=backoff,
+                                failed=failed)
+            # >> targets whose requests failed are left out, so they are
+            # >> queried again next time
+            keep = [n for n in range(len(res)) if n not in set(failed)]
+            ticid_simbad = [ticid_simbad[n] for n in keep]
+            res = [res[n] for n in keep]
+            otypes_simbad = [r['otypes'] if r else 'none' for r in res]
+            main_id_simbad = [r['main_id'] if r else 'none' for r in res]
+            with open(out_f, 'a') as f:
+                for n in range(len(res)):
+                    if res[n]:
+                        f.write('{},{},{}\n'.format(ticid_simbad[n],
+                                                    otypes_simbad[n],
+                                                    main_id_simbad[n]))
+                    else:
+                        f.write('{},{},{}\n'.format(ticid_simbad[n], '', ''))
+            return ticid_simbad, otypes_simbad, main_id_simbad
+
+        for n, tic in enumerate(ticid_list):
+            if tic in ticid_already_classified:
+                print('Skipping TIC')
+                continue
+            if not query_mast and catalog_data_all['ID'][n] == -1:
+                # >> not found, so retrying would not help
+                print('TIC '+str(int(tic))+' is not in the TIC catalog store')
+                continue
+        
+            for attempt in range(max_retries):
+                try:
                     print('get coords for TIC' + str(int(tic)))
 
                     target = 'TIC ' + str(int(tic))                    
                     if query_mast:
                         # >> get coordinates
-                        catalog_data = Catalogs.query_object(target, radius=0.02,
-                                                             catalog='TIC')[0]
+                        catalog_data = query_tic(tic, con, max_age=max_age)
 
                     else:
-                        ind = np.nonzero(catalog_data_all['ID'].to_numpy() == tic)[0][0]
-                        catalog_data=catalog_data_all.iloc[ind]
-                    # time.sleep(6)
-            
-                    
+                        catalog_data = {col: catalog_data_all[col][n] \
+                                        for col in catalog_data_all}
+        
+                
                     # -- get object type from Simbad --------------------------------------
-                    
+                
                     # >> first just try querying the TICID
-                    res = customSimbad.query_object(target)
-                    # time.sleep(6)
-                    
+                    res = query_simbad(target)
+                
                     # >> if no luck with that, try checking other IDs
-                    if type(res) == type(None):
-                        if type(catalog_data['TYC']) != np.ma.core.MaskedConstant:
-                            target_new = 'TYC ' + str(catalog_data['TYC'])
-                            res = customSimbad.query_object(target_new)
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['HIP']) != np.ma.core.MaskedConstant:
-                            target_new = 'HIP ' + str(catalog_data['HIP'])
-                            res = customSimbad.query_object(target_new)
-                            # time.sleep(6)
-            
-                    # # >> UCAC not added to Simbad yet
-                    # if type(res) == type(None):
-                    #     if type(catalog_data['UCAC']) != np.ma.core.MaskedConstant:
-                    #         target_new = 'UCAC ' + str(catalog_data['UCAC'])
-                    #         res = customSimbad.query_object(target_new)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['TWOMASS']) != np.ma.core.MaskedConstant:
-                            target_new = '2MASS ' + str(catalog_data['TWOMASS'])
-                            res = customSimbad.query_object(target_new)     
-                            # time.sleep(6)
-            
-                    if type(res) == type(None):
-                        if type(catalog_data['SDSS']) != np.ma.core.MaskedConstant:
-                            target_new = 'SDSS ' + str(catalog_data['SDSS'])
-                            res = customSimbad.query_object(target_new) 
-                            # time.sleep(6)
-            
-                    if type(res) == type(None):
-                        if type(catalog_data['ALLWISE']) != np.ma.core.MaskedConstant:
-                            target_new = 'ALLWISE ' + str(catalog_data['ALLWISE'])
-                            res = customSimbad.query_object(target_new)
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['GAIA']) != np.ma.core.MaskedConstant:
-                            target_new = 'Gaia ' + str(catalog_data['GAIA'])
-                            res = customSimbad.query_object(target_new)      
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['APASS']) != np.ma.core.MaskedConstant:
-                            target_new = 'APASS ' + str(catalog_data['APASS'])
-                            res = customSimbad.query_object(target_new)        
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['KIC']) != np.ma.core.MaskedConstant:
-                            target_new = 'KIC ' + str(catalog_data['KIC'])
-                            res = customSimbad.query_object(target_new)    
-                            # time.sleep(6)
-                    
+                    for col, prefix in SIMBAD_ALIASES:
+                        if type(res) != type(None):
+                            break
+                        identifier = catalog_id(catalog_data[col])
+                        if type(identifier) != type(None):
+                            res = query_simbad(prefix + ' ' + identifier)
+                
                     # # >> if still nothing, query with coordinates
                     # if type(res) == type(None):
                     #     ra = catalog_data['ra']
@@ -2223,36 +5067,55 @@ def query_simbad_classifications(ticid_list, out_f='./SectorX_simbdad.txt',
                     #     coords = coord.SkyCoord(ra, dec, unit=(u.deg, u.deg))
                     #     res = customSimbad.query_region(coords, radius='0d0m2s')         
                     #     time.sleep(6)
-                    
+                
                     if type(res) == type(None):
                         print('failed :(')
-                        res=0
                         with open(out_f, 'a') as f:
                             f.write('{},{},{}\n'.format(tic, '', ''))              
                         ticid_simbad.append(tic)
                         otypes_simbad.append('none')
                         main_id_simbad.append('none')                
                     else:
-                        otypes = res['OTYPES'][0].decode('utf-8')
-                        main_id = res['MAIN_ID'].data[0].decode('utf-8')
+                        otypes = res['otypes']
+                        main_id = res['main_id']
                         ticid_simbad.append(tic)
                         otypes_simbad.append(otypes)
                         main_id_simbad.append(main_id)
-                        
+                    
                         with open(out_f, 'a') as f:
                             f.write('{},{},{}\n'.format(tic, otypes, main_id))
-                            
-                    # time.sleep(6)
-            except:
-                pass
-                print('connection failed! Trying again now')
+                    break
+            
+                except IndexError as e: # >> MAST has no TIC entry, don't retry
+                    print(e)
+                    break
+                except NETWORK_ERRORS as e:
+                    print(e)
+                    if attempt < max_retries - 1:
+                        print('connection failed! Trying again in '+\
+                              str(backoff**attempt)+' s')
+                        time.sleep(backoff**attempt)
+            else:
+                print('Skipping TIC '+str(int(tic))+' after '+str(max_retries)+\
+                      ' attempts')
             
-    return ticid_simbad, otypes_simbad, main_id_simbad
+        return ticid_simbad, otypes_simbad, main_id_simbad
+    finally:
+        con.close()
         
 def query_vizier(ticid_list=None, out='./SectorX_GCVS.txt', catalog='gcvs',
                  data_dir = '/Users/studentadmin/Dropbox/TESS_UROP/data/',
-                 sector=20, query_mast=False):
-    '''http://www.sai.msu.su/gcvs/gcvs/vartype.htm'''
+                 sector=20, query_mast=False, cache_file=None, max_age=None,
+                 batched=False, chunk_size=500, vizier=None, max_retries=5,
+                 backoff=2.):
+    '''http://www.sai.msu.su/gcvs/gcvs/vartype.htm
+    Cone searches (and TIC queries if query_mast) are cached in cache_file
+    (default data_dir+'xmatch_cache.sqlite', see open_xmatch_cache()).
+    If batched, the coordinates of chunk_size targets are sent in one request
+    with vizier_query_region() (vizier can be any object with the
+    query_region() of Vizier). Batched requests that fail with a connection
+    error are retried after backoff**attempt seconds, and targets that fail
+    max_retries times, or have no TIC entry, are skipped.'''
     
     # Vizier.ROW_LIMIT=-1
     # catalog_list=Vizier.find_catalogs('B/gcvs')
@@ -2281,60 +5144,124 @@ def query_vizier(ticid_list=None, out='./SectorX_GCVS.txt', catalog='gcvs',
             ticid_already_classified.append(float(line.split(',')[0]))
             
 
-    if not query_mast:
-        catalog_data = pd.read_csv(data_dir+'Sector'+str(sector)+'/Sector'+\
-                                   str(sector)+'tic_cat_all.csv',
-                                   index_col=False)
-    
     print(str(len(ticid_list))+' targets')
     print(str(len(ticid_already_classified))+' targets completed')
     ticid_list = np.setdiff1d(ticid_list, ticid_already_classified)
     print(str(len(ticid_list))+' targets to query')
 
-    for tic in ticid_list:
-        try:
-            print('Running '+str(tic))
+    if type(cache_file) == type(None):
+        cache_file = data_dir + 'xmatch_cache.sqlite'
+    con = open_xmatch_cache(cache_file)
+    try:
+        if not query_mast:
+            # >> coordinates of each target from the TIC catalog store
+            catalog_data = tic_gather(open_tic_store(get_tic_store_dir(data_dir)),
+                                      ticid_list, ['ra', 'dec'])
+            found = catalog_data['ID'] > -1
+
+        if batched:
             if query_mast:
-                target = 'TIC ' + str(int(tic))
-                print('Query Catalogs')
-                catalog_data = Catalogs.query_object(target, radius=0.02,
-                                                     catalog='TIC')[0]
-                ra = catalog_data['ra']
-                dec = catalog_data['dec']            
+                ticid_found, ra, dec = [], [], []
+                for tic in ticid_list:
+                    try:
+                        catalog_data = with_network_retries(
+                            lambda: query_tic(tic, con, max_age=max_age),
+                            max_retries=max_retries, backoff=backoff,
+                            name='MAST')
+                    except IndexError as e: # >> no TIC entry, don't retry
+                        print(e)
+                        continue
+                    except NETWORK_ERRORS:
+                        print('Skipping TIC '+str(int(tic))+' after '+\
+                              str(max_retries)+' attempts')
+                        continue
+                    ticid_found.append(tic)
+                    ra.append(catalog_data['ra'])
+                    dec.append(catalog_data['dec'])
+                ticid_list = np.array(ticid_found)
             else:
-                ind = np.nonzero(catalog_data['ID'].to_numpy()==tic)[0][0]
-                ra = catalog_data.iloc[ind]['ra']
-                dec = catalog_data.iloc[ind]['dec']
-            # coords = coord.SkyCoord(ra, dec, unit=(u.deg, u.deg)) 
-            # ra = coords.ra.deg
-            # dec = coords
-            v = Vizier(columns=['VarType', 'VarName'])
-            print('Query Vizier')
-            res = v.query_region(coord.SkyCoord(ra=ra, dec=dec,
-                                                     unit=(u.deg, u.deg),
-                                                     frame='icrs'),
-                                      radius=0.003*u.deg, catalog=catalog)
-            if len(res) > 0:
-                otype = res[0]['VarType'][0]
-                main_id = res[0]['VarName'][0]
-                ticid_viz.append(tic)
-                otypes_viz.append(otype)
-                main_id_viz.append(main_id)
-                # with open(out, 'a') as f:
-                #     f.write('{},{},{}\n'.format(tic, otype, main_id))              
-            else:
-                otype = ''
-                main_id = ''
-
+                for tic in ticid_list[~found]:
+                    print('TIC '+str(int(tic))+' is not in the TIC catalog store')
+                ticid_list = ticid_list[found]
+                ra = catalog_data['ra'][found]
+                dec = catalog_data['dec'][found]
+            failed = []
+            res = vizier_query_region(ra, dec, radius=0.003, catalog=catalog,
+                                      vizier=vizier, con=con,
+                                      chunk_size=chunk_size, max_age=max_age,
+                                      max_retries=max_retries, backoff=backoff,
+                                      failed=failed)
+            failed = set(failed)
             with open(out, 'a') as f:
-                f.write('{},{},{}\n'.format(tic, otype, main_id))    
+                for n in range(len(res)):
+                    if n in failed: # >> queried again next time
+                        continue
+                    if res[n]:
+                        ticid_viz.append(ticid_list[n])
+                        otypes_viz.append(res[n]['VarType'])
+                        main_id_viz.append(res[n]['VarName'])
+                        f.write('{},{},{}\n'.format(ticid_list[n],
+                                                    res[n]['VarType'],
+                                                    res[n]['VarName']))
+                    else:
+                        f.write('{},{},{}\n'.format(ticid_list[n], '', ''))
+            print('Completed!')
+            return ticid_viz, otypes_viz, main_id_viz
 
-            del res
-        except:
-            print('Connection failed! Trying again now')
+        for n, tic in enumerate(ticid_list):
+            try:
+                print('Running '+str(tic))
+                if query_mast:
+                    print('Query Catalogs')
+                    catalog_data = query_tic(tic, con, max_age=max_age)
+                    ra = catalog_data['ra']
+                    dec = catalog_data['dec']            
+                else:
+                    if not found[n]:
+                        raise IndexError('TIC '+str(int(tic))+\
+                                         ' is not in the TIC catalog store')
+                    ra = catalog_data['ra'][n]
+                    dec = catalog_data['dec'][n]
+                # coords = coord.SkyCoord(ra, dec, unit=(u.deg, u.deg)) 
+                # ra = coords.ra.deg
+                # dec = coords
+                def query():
+                    v = Vizier(columns=['VarType', 'VarName'])
+                    print('Query Vizier')
+                    res = v.query_region(coord.SkyCoord(ra=ra, dec=dec,
+                                                        unit=(u.deg, u.deg),
+                                                        frame='icrs'),
+                                         radius=0.003*u.deg, catalog=catalog)
+                    if len(res) > 0:
+                        return {'VarType': str(res[0]['VarType'][0]),
+                                'VarName': str(res[0]['VarName'][0])}
+                    return None
+                res = cached_query(con, 'vizier', catalog,
+                                   sky_cell_key(ra, dec, 0.003), query,
+                                   max_age=max_age)
+                if type(res) != type(None):
+                    otype = res['VarType']
+                    main_id = res['VarName']
+                    ticid_viz.append(tic)
+                    otypes_viz.append(otype)
+                    main_id_viz.append(main_id)
+                    # with open(out, 'a') as f:
+                    #     f.write('{},{},{}\n'.format(tic, otype, main_id))              
+                else:
+                    otype = ''
+                    main_id = ''
+
+                with open(out, 'a') as f:
+                    f.write('{},{},{}\n'.format(tic, otype, main_id))    
+
+                del res
+            except:
+                print('Connection failed! Trying again now')
                 
-    print('Completed!')
-    return ticid_viz, otypes_viz, main_id_viz
+        print('Completed!')
+        return ticid_viz, otypes_viz, main_id_viz
+    finally:
+        con.close()
 
 # def query_vizier_v2(data_dir='./data/', sector=1, catalog='gcvs'):
 #     df = get_TIC_catalog_sector(data_dir, sector)
@@ -2360,9 +5287,16 @@ def query_vizier(ticid_list=None, out='./SectorX_GCVS.txt', catalog='gcvs',
 #             dec = df['dec'][i]
             
 
+OTYPE_DICTS = {} # >> gcvs_labels.txt -> [modification time, dictionary]
+
 def get_otype_dict(data_dir='/Users/studentadmin/Dropbox/TESS_UROP/data/',
                    uncertainty_flags=[':', '?', '*']):
-    '''Return a dictionary of descriptions'''
+    '''Return a dictionary of descriptions (read once per change of
+    gcvs_labels.txt)'''
+    fname = data_dir + 'gcvs_labels.txt'
+    mtime = os.path.getmtime(fname)
+    if fname in OTYPE_DICTS and OTYPE_DICTS[fname][0] == mtime:
+        return dict(OTYPE_DICTS[fname][1])
     # d = {'a2': 'Variable Star of alpha2 CVn type',
     #      'ACYG': 'Variables of the Alpha Cygni type',
     #      'IR': 'Infra-Red source',
@@ -2438,76 +5372,25 @@ def get_otype_dict(data_dir='/Users/studentadmin/Dropbox/TESS_UROP/data/',
         
         d[otype] = description
         
+    OTYPE_DICTS[fname] = [mtime, dict(d)]
     return d
 
 
 
-def get_parents_only(class_info, parent_dict=None,
+def get_parents_only(class_info, parent_dict=None, parents=None,
                      remove_classes=[], remove_flags=[]):
     '''Finds all the objects with same parent and combines them into the same
-    class
+    class (see merge_parent_otypes())
     '''
-    classes = []
-    new_class_info = []
-
-    if type(parent_dict) == type(None):
-        parent_dict = pf.make_parent_dict()
-
-    parents = list(parent_dict.keys())
-
-    # >> turn into array
-    subclasses = []
-    for parent in parents:
-        subclasses.extend(parent_dict[parent])
-
-    for i in range(len(class_info)):
-        otype_list = class_info[i][1]
-
-        # >> remove any flags
-        for flag in remove_flags:
-            otype_list = otype_list.replace(flag, '|')
-        otype_list = otype_list.split('|')
-
-        new_otype_list=[]
-        for otype in otype_list:
-            if not otype in remove_classes:
-                if otype in subclasses:
-                    # >> find parent
-                    for parent in parents:
-                        if otype in parent_dict[parent]:
-                            new_otype = parent
-
-                    new_otype_list.append(new_otype)
-                else:
-                    new_otype_list.append(otype)
-
-        # >> remove repeats
-        new_otype_list = np.unique(new_otype_list)
-
-        # >> don't want e.g. E|EA or E|EW (redundant)
-        if 'E' in new_otype_list:
-            if len(np.intersect1d(new_otype_list, ['EA', 'EP', 'EW', 'EB']))>0:
-                new_otype_list = np.delete(new_otype_list, np.nonzero(new_otype_list=='E'))
-
-        if 'L' in new_otype_list and len(new_otype_list) > 1:
-            new_otype_list = np.delete(new_otype_list,
-                                       np.nonzero(new_otype_list=='L'))
-
-        if '' in new_otype_list:
-            new_otype_list = np.delete(new_otype_list,
-                                       np.nonzero(new_otype_list==''))
-
-        # if '|'.join(new_otype_list) == '|AR|EA|EB|RS|SB':
-        #     pdb.set_trace()
-
-        new_class_info.append([class_info[i][0], '|'.join(new_otype_list),
-                               class_info[i][2]])
+    class_info = np.asarray(class_info)
+    parent_map = make_parent_map(parent_dict, parents)
+    otype = merge_parent_otypes(class_info[:,1], parent_map, remove_classes,
+                                remove_flags)
+    new_class_info = np.array([class_info[:,0].astype('str'), otype,
+                               class_info[:,2].astype('str')]).T
 
     # >> get rid of empty classes
-    new_class_info = np.array(new_class_info)
-    new_class_info = np.delete(new_class_info, np.nonzero(new_class_info[:,1]==''), 0)
-            
-    
+    new_class_info = np.delete(new_class_info, np.nonzero(otype==''), 0)
     return new_class_info
 
 # def merge_classes(labels, remove_classes=[], remove_flags=[' ']):
@@ -2666,19 +5549,350 @@ def quick_simbad(ticidasstring):
 
 
 
+# :: Label database ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Ground truth labels from every source in one columnar store,
+# >> database_dir+'label_db/', with one .npy file per column:
+# >>     ticid   : TICID (int64)
+# >>     source  : 'gcvs' (SectorX_GCVS.txt), 'simbad' (other .txt files in
+# >>               database_dir, e.g. SectorX_simbad.txt), 'simbad_database'
+# >>               (build_simbad_database()) or 'ensemble' (*ticid_to_label.txt)
+# >>     otype   : raw object type, with the labels of all files of the source
+# >>               joined by '|'
+# >>     main_id : SIMBAD main_id (GCVS name for 'gcvs')
+# >>     bibcode : only for 'simbad_database'
+# >>     label   : parent class code, i.e. row of classes.npy with the object
+# >>               type cleaned and merged into parent classes the way
+# >>               assign_real_labels() does it, or -1 if there is none left
+# >> There is one row per source and TICID. label_db_info.json has the
+# >> parent-class mapping (make_parent_map()) and the size and modification
+# >> time of every text file, so load_label_db() only rebuilds the database
+# >> when the text files change. Cleaning and merging work on the distinct
+# >> object types, which are far fewer than the objects.
+
+LABEL_DB_COLUMNS = ['ticid', 'source', 'otype', 'main_id', 'bibcode', 'label']
+GCVS_REMOVE_CLASSES = ['D','DM','DS','DW','K','KE','KW','SD', 'GS', 'PN', 'RS',
+                       'WD', 'WR', 'CST','GAL']
+SIMBAD_REMOVE_CLASSES = ['V', 'VAR', '**', '*i', '*iC', '*iA','*iN', 'Em']
+
+def get_label_db_dir(database_dir='./databases/'):
+    '''Returns the label database directory.'''
+    return database_dir + 'label_db/'
+
+def make_parent_map(parent_dict=None, parents=None):
+    '''Maps each subclass to its parent class, e.g. {'RRAB': 'RR', ...}, from
+    pf.make_parent_dict() (or parent_dict), for the parent classes in parents
+    (default all).'''
+    if type(parent_dict) == type(None):
+        parent_dict = pf.make_parent_dict()
+    if type(parents) == type(None):
+        parents = list(parent_dict.keys())
+    parent_map = {}
+    for parent in parents:
+        for otype in parent_dict[parent]:
+            parent_map[otype] = parent
+    return parent_map
+
+def clean_gcvs_otypes(otype, remove_flags=True,
+                      remove_classes=GCVS_REMOVE_CLASSES):
+    '''Removes spaces, uncertainty flags (':', if remove_flags) and
+    remove_classes from GCVS object types, and splits '+' and '/' into '|'.
+    Returns an array of cleaned object types, one per element of otype.'''
+    unique, inverse = np.unique(np.asarray(otype).astype('str'),
+                                return_inverse=True)
+    cleaned = np.char.replace(unique, ' ', '') # >> remove spaces
+    cleaned = np.char.replace(cleaned, '+', '|')
+    cleaned = np.char.replace(cleaned, '/', '|')
+    if remove_flags:
+        cleaned = np.char.replace(cleaned, ':', '')
+    cleaned = ['|'.join(np.setdiff1d(c.split('|'), remove_classes)) \
+               for c in cleaned]
+    return np.array(cleaned + [''])[inverse.reshape(-1)]
+
+def clean_simbad_otypes(otype, useless_classes=['*', 'IR', 'UV', 'X', 'PM',
+                                                '?', ':'],
+                        uncertainty_flags=['*', ':', '?']):
+    '''Removes candidate indicators (uncertainty_flags at the end of a class),
+    useless_classes and repeats from SIMBAD object types, and sorts them.
+    Returns an array of cleaned object types, one per element of otype.'''
+    unique, inverse = np.unique(np.asarray(otype).astype('str'),
+                                return_inverse=True)
+    cleaned = []
+    for otype_list in unique:
+        otype_list = otype_list.split('|')
+        for i in range(len(otype_list)):
+            if otype_list[i] != '**' and len(otype_list[i])>0:
+                if otype_list[i][-1] in uncertainty_flags:
+                    otype_list[i] = otype_list[i][:-1]
+        otype_list = np.setdiff1d(otype_list, useless_classes + [''])
+        cleaned.append('|'.join(otype_list))
+    return np.array(cleaned + [''])[inverse.reshape(-1)]
+
+def merge_parent_otypes(otype, parent_map=None, remove_classes=[],
+                        remove_flags=[]):
+    '''Replaces subclasses with their parent class (parent_map, see
+    make_parent_map()) in object types, after splitting remove_flags into
+    '|' and removing remove_classes. Drops 'E' next to EA, EP, EW or EB,
+    and 'L' next to any other class.
+    Returns an array of merged object types, one per element of otype.'''
+    if type(parent_map) == type(None):
+        parent_map = make_parent_map()
+    unique, inverse = np.unique(np.asarray(otype).astype('str'),
+                                return_inverse=True)
+    merged = []
+    for otype_list in unique:
+        for flag in remove_flags:
+            otype_list = otype_list.replace(flag, '|')
+        new_otype_list = [parent_map.get(o, o) for o in otype_list.split('|') \
+                          if not o in remove_classes]
+        new_otype_list = np.setdiff1d(new_otype_list, [''])
+
+        # >> don't want e.g. E|EA or E|EW (redundant)
+        if 'E' in new_otype_list:
+            if len(np.intersect1d(new_otype_list, ['EA', 'EP', 'EW', 'EB']))>0:
+                new_otype_list = np.setdiff1d(new_otype_list, ['E'])
+        if 'L' in new_otype_list and len(new_otype_list) > 1:
+            new_otype_list = np.setdiff1d(new_otype_list, ['L'])
+        merged.append('|'.join(new_otype_list))
+    return np.array(merged + [''])[inverse.reshape(-1)]
+
+def narrow_str(values):
+    '''String array with the smallest width that fits values.'''
+    values = np.asarray(values).astype('str')
+    return values.astype('U'+str(max([1] + list(np.char.str_len(values)))))
+
+def join_by_key(key, otype):
+    '''Joins the non-empty object types of rows with the same key with '|'.
+    Returns:
+        * first : first row of each key
+        * inverse : key of each row (index into first)
+        * joined : joined object types of each key
+    '''
+    unique, first, inverse, counts = np.unique(key, return_index=True,
+                                               return_inverse=True,
+                                               return_counts=True)
+    inverse = inverse.reshape(-1)
+    joined = otype[first].astype('object')
+    groups = np.split(otype[np.argsort(inverse, kind='stable')],
+                      np.cumsum(counts)[:-1])
+    for i in np.nonzero(counts > 1)[0]:
+        joined[i] = '|'.join(groups[i][groups[i] != ''])
+    return first, inverse, np.array(list(joined) + [''])[:-1]
+
+def label_db_source_files(database_dir, simbad_database_txt=None,
+                          ticid_to_label_txt=[]):
+    '''Text files read into the label database, as a dictionary with file
+    names as keys and [source, size, modification time] as values.'''
+    files = {}
+    for fname in sorted(fm.filter(os.listdir(database_dir), '*.txt')):
+        source = 'gcvs' if fname.endswith('_GCVS.txt') else 'simbad'
+        files[database_dir+fname] = [source]
+    if type(simbad_database_txt) != type(None):
+        files[simbad_database_txt] = ['simbad_database']
+    for fname in ticid_to_label_txt:
+        files[fname] = ['ensemble']
+    for fname in files:
+        stat = os.stat(fname)
+        files[fname] += [stat.st_size, stat.st_mtime]
+    return files
+
+def read_label_txt(fname, source):
+    '''Reads a label text file into arrays ticid, otype, main_id, bibcode.'''
+    ncols = {'gcvs': 3, 'simbad': 3, 'simbad_database': 4, 'ensemble': 2}
+    data = np.loadtxt(fname, delimiter=',', dtype='str', ndmin=2,
+                      comments=None)
+    if len(data) == 0:
+        data = np.empty((0, ncols[source]), dtype='str')
+    if source == 'simbad_database':
+        ticid, main_id, otype, bibcode = data.T
+    else:
+        ticid, otype = data[:,0], data[:,1]
+        main_id = data[:,2] if source != 'ensemble' else np.full(len(data), '')
+        bibcode = np.full(len(data), '')
+    ticid = ticid.astype('float').astype('int64')
+    return ticid, otype, main_id, bibcode
+
+def build_label_db(database_dir='./databases/', db_dir=None,
+                   simbad_database_txt=None, ticid_to_label_txt=[],
+                   parent_dict=None):
+    '''Reads the label text files of database_dir (and simbad_database_txt and
+    the ticid_to_label_txt files, if given) into the label database (see
+    above). Returns db_dir.'''
+    if type(db_dir) == type(None):
+        db_dir = get_label_db_dir(database_dir)
+    os.makedirs(db_dir, exist_ok=True)
+    files = label_db_source_files(database_dir, simbad_database_txt,
+                                  ticid_to_label_txt)
+    
+    # >> read every file once
+    cols = {'ticid': [], 'source': [], 'otype': [], 'main_id': [],
+            'bibcode': []}
+    for fname in files:
+        source = files[fname][0]
+        print('Reading '+fname)
+        ticid, otype, main_id, bibcode = read_label_txt(fname, source)
+        for col, values in zip(['ticid', 'otype', 'main_id', 'bibcode'],
+                               [ticid, otype, main_id, bibcode]):
+            cols[col].append(values)
+        cols['source'].append(np.full(len(ticid), source))
+    for col in cols:
+        cols[col] = np.concatenate(cols[col]) if len(cols[col]) > 0 else \
+            np.empty(0, dtype='int64' if col == 'ticid' else 'str')
+    
+    # >> one row per source and TICID, with the object types joined
+    order = np.lexsort((cols['ticid'], cols['source']))
+    for col in cols:
+        cols[col] = cols[col][order]
+    key = np.char.add(cols['source'], np.char.mod('|%d', cols['ticid']))
+    first, inverse, otype = join_by_key(key, cols['otype'])
+    for col in ['main_id', 'bibcode']: # >> first non-empty value
+        values = cols[col]
+        rows = np.nonzero(values != '')[0]
+        non_empty = np.full(len(first), -1)
+        non_empty[inverse[rows[::-1]]] = rows[::-1]
+        cols[col] = np.where(non_empty > -1, values[np.maximum(non_empty, 0)],
+                             '')
+    for col in ['ticid', 'source']:
+        cols[col] = cols[col][first]
+    cols['otype'] = otype
+    
+    # >> clean and merge object types into parent classes
+    parent_map = make_parent_map(parent_dict)
+    label = np.full(len(first), '', dtype='object')
+    inds = np.nonzero(cols['source'] == 'gcvs')
+    label[inds] = merge_parent_otypes(clean_gcvs_otypes(cols['otype'][inds]),
+                                      parent_map)
+    inds = np.nonzero(np.isin(cols['source'], ['simbad', 'simbad_database']))
+    label[inds] = merge_parent_otypes(clean_simbad_otypes(cols['otype'][inds]),
+                                      parent_map, SIMBAD_REMOVE_CLASSES,
+                                      ['+', '/', ':'])
+    inds = np.nonzero(cols['source'] == 'ensemble')
+    label[inds] = clean_simbad_otypes(cols['otype'][inds], ['NONE'], [])
+    label = label.astype('str')
+    classes = np.unique(label[label != ''])
+    cols['label'] = np.full(len(label), -1, dtype='int32')
+    cols['label'][label != ''] = np.searchsorted(classes, label[label != ''])
+    
+    # >> write columns, then the info file
+    for col in LABEL_DB_COLUMNS:
+        values = cols[col] if col in ['ticid', 'label'] else \
+            narrow_str(cols[col])
+        np.save(db_dir+col+'.npy', values)
+    np.save(db_dir+'classes.npy', narrow_str(classes))
+    info = {'columns': LABEL_DB_COLUMNS, 'num_rows': int(len(first)),
+            'parent_map': parent_map, 'files': files}
+    with open(db_dir+'label_db_info.json', 'w') as f:
+        json.dump(info, f)
+    print('Saved '+str(len(first))+' labels to '+db_dir)
+    return db_dir
+
+def open_label_db(db_dir):
+    '''Loads the label database.
+    Returns:
+        * db : dictionary with 'info' (contents of label_db_info.json),
+               'classes' (class of each label code), 'columns' (dictionary,
+               column name -> array) and 'index' (dictionary, source ->
+               index of its rows, see ticid_index())
+    '''
+    if not os.path.exists(db_dir+'label_db_info.json'):
+        raise OSError('No label database in ' + db_dir + \
+                      ' (see build_label_db())')
+    db = {'dir': db_dir, 'columns': {}, 'index': {}}
+    with open(db_dir+'label_db_info.json', 'r') as f:
+        db['info'] = json.load(f)
+    for col in db['info']['columns']:
+        db['columns'][col] = np.load(db_dir+col+'.npy')
+    db['classes'] = np.load(db_dir+'classes.npy')
+    for source in np.unique(db['columns']['source']):
+        rows = np.nonzero(db['columns']['source'] == source)[0]
+        index = ticid_index(db['columns']['ticid'][rows])
+        index['rows'] = rows[index['rows']]
+        db['index'][source] = index
+    return db
+
+def load_label_db(database_dir='./databases/', db_dir=None,
+                  simbad_database_txt=None, ticid_to_label_txt=[],
+                  rebuild=False):
+    '''Opens the label database, building it first if it is missing or if
+    any of its text files were changed, added or removed since.'''
+    if type(db_dir) == type(None):
+        db_dir = get_label_db_dir(database_dir)
+    if not rebuild and os.path.exists(db_dir+'label_db_info.json'):
+        with open(db_dir+'label_db_info.json', 'r') as f:
+            files = json.load(f)['files']
+        rebuild = files != label_db_source_files(database_dir,
+                                                 simbad_database_txt,
+                                                 ticid_to_label_txt)
+    else:
+        rebuild = True
+    if rebuild:
+        build_label_db(database_dir, db_dir, simbad_database_txt,
+                       ticid_to_label_txt)
+    return open_label_db(db_dir)
+
+def label_db_rows(db, ticid=None, source='gcvs'):
+    '''Rows of the label database for source ('gcvs', 'simbad', ... or a
+    list of sources), for TICIDs in ticid (default all).'''
+    sources = [source] if type(source) == type('') else source
+    rows = np.concatenate([db['index'][s]['rows'] for s in sources \
+                           if s in db['index']] + [np.empty(0, 'int64')])
+    if type(ticid) != type(None):
+        ticid = np.asarray(ticid).astype('float').astype('int64')
+        rows = rows[np.isin(db['columns']['ticid'][rows], ticid)]
+    return np.sort(rows)
+
+def get_label_codes(db, ticid, source='gcvs', missing=-1):
+    '''Parent class codes of an array of TICIDs, with missing for TICIDs
+    without a label. The class of code i is db['classes'][i].'''
+    rows = ticid_lookup(db['index'][source], ticid)
+    codes = np.full(len(rows), missing, dtype='int32')
+    found = np.nonzero(rows > -1)
+    codes[found] = db['columns']['label'][rows[found]]
+    codes[codes == -1] = missing
+    return codes
+
+def label_db_class_info(db, ticid=None, source='gcvs'):
+    '''class_info array ([ticid, parent class, main_id] for each labelled
+    object, see get_parents_only()) from the label database.'''
+    rows = label_db_rows(db, ticid, source)
+    rows = rows[db['columns']['label'][rows] > -1]
+    return np.array([db['columns']['ticid'][rows].astype('str'),
+                     db['classes'][db['columns']['label'][rows]],
+                     db['columns']['main_id'][rows]]).T.reshape(-1, 3)
+
+
+
 def get_true_classifications(ticid_list,
                              database_dir='./databases/',
                              single_file=False,
                              useless_classes = ['*', 'IR', 'UV', 'X', 'PM',
                                                 '?', ':'],
-                             uncertainty_flags = ['*', ':', '?']):
+                             uncertainty_flags = ['*', ':', '?'],
+                             label_db=None):
     '''Query classifications and bibcode from *_database.txt file.
     Returns a list where class_info[i] = [ticid, obj type, bibcode]
     Object type follows format in:
     http://vizier.u-strasbg.fr/cgi-bin/OType?$1
+    Unless single_file, the text files are read from the label database
+    (label_db, default load_label_db(database_dir)).
     '''
-    ticid_classified = []
+    if not single_file:
+        if type(label_db) == type(None):
+            label_db = load_label_db(database_dir)
+        rows = label_db_rows(label_db, ticid_list, ['gcvs', 'simbad'])
+        otype = clean_simbad_otypes(label_db['columns']['otype'][rows],
+                                    useless_classes, uncertainty_flags)
+        rows, otype = rows[otype != ''], otype[otype != '']
+        
+        # >> merge the classes of objects in several files
+        ticid = label_db['columns']['ticid'][rows]
+        first, inverse, otype = join_by_key(ticid, otype)
+        otype = clean_simbad_otypes(otype, [], [])
+        return np.array([ticid[first].astype('str'), otype,
+                         label_db['columns']['main_id'][rows][first]]).T
+    
+    ticid_classified = {} # >> ticid_classified[ticid] = row in class_info
     class_info = []
+    ticid_list = set(np.asarray(ticid_list).astype('float'))
     
     # >> find all text files in directory
     if single_file:
@@ -2716,13 +5930,13 @@ def get_true_classifications(ticid_list,
                 ticid = float(ticid)
                 if ticid in ticid_list and len(otype) > 0:
                     if ticid in ticid_classified:
-                        ind = np.nonzero(np.array(ticid_classified) == ticid)[0][0]
+                        ind = ticid_classified[ticid]
                         new_class_info = class_info[ind][1] + '|' + otype
                         new_class_info = new_class_info.split('|')
                         new_class_info = '|'.join(np.unique(new_class_info))
                         class_info[ind][1] = new_class_info
                     else:
-                        ticid_classified.append(ticid)
+                        ticid_classified[ticid] = len(class_info)
                         class_info.append([int(ticid), otype, bibcode])
                     
     # >> check for any repeats
@@ -2732,37 +5946,18 @@ def get_true_classifications(ticid_list,
 
 def get_gcvs_classifications(database_dir='./databases/',
                              remove_flags=True,
-                             remove_classes=['D','DM','DS','DW','K','KE','KW','SD',
-                                             'GS', 'PN', 'RS', 'WD', 'WR',
-                                             'CST','GAL']):
-    ''' D, DM, DS, DW, K, KE, KW, SD ... are subsets of eclipsing binaries'''
-    ticid = []
-    labels = []
-    
-    fnames = fm.filter(os.listdir(database_dir), '*_GCVS.txt')
-    
-    for fname in fnames:
-        data = np.loadtxt(database_dir+fname, delimiter=',', dtype='str')
-        ticid_sector, otype = data[:,0], data[:,1]
-        inds = np.nonzero(otype != '')
-        ticid_sector, otype = ticid_sector[inds], otype[inds]
-        otype = np.char.replace(otype, ' ', '') # >> remove spaces
-        otype = np.char.replace(otype, '+', '|')
-        otype = np.char.replace(otype, '/', '|')        
-        if remove_flags:
-            otype = np.char.replace(otype, ':', '')
-
-        for i in range(len(otype)):
-            label_list = otype[i].split('|')
-            label_list = np.setdiff1d(label_list, remove_classes)
-            label_list = np.unique(label_list) # >> remove repeats
-            otype[i] = '|'.join(label_list)
-
-        ticid.extend(ticid_sector)
-        labels.extend(otype)
-                    
-    # >> check for any repeats
-    return np.array(ticid), np.array(labels)
+                             remove_classes=GCVS_REMOVE_CLASSES,
+                             label_db=None):
+    ''' D, DM, DS, DW, K, KE, KW, SD ... are subsets of eclipsing binaries
+    Reads the *_GCVS.txt files from the label database (label_db, default
+    load_label_db(database_dir)).'''
+    if type(label_db) == type(None):
+        label_db = load_label_db(database_dir)
+    rows = label_db_rows(label_db, source='gcvs')
+    rows = rows[label_db['columns']['otype'][rows] != '']
+    labels = clean_gcvs_otypes(label_db['columns']['otype'][rows],
+                               remove_flags, remove_classes)
+    return label_db['columns']['ticid'][rows].astype('str'), labels
 
 
 
@@ -3328,80 +6523,193 @@ def lof_param_scan(ticid_feat, features,n_neighbors=list(range(10,40,10)),
                             f.write('\n')
     
 
+# :: Cluster-to-label matching ::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Scores a clustering against catalog labels: contingency_matrix() counts
+# >> (true label, cluster) pairs with a single bincount, and match_clusters()
+# >> solves the cluster -> label assignment on it, either one-to-one with the
+# >> Hungarian algorithm or many-to-one (several clusters merged into one
+# >> label) by giving each cluster the label it overlaps with most.
+
+def contingency_matrix(y_true, y_pred, label_true=None, label_pred=None):
+    '''Counts of objects with true label label_true[i] in cluster
+    label_pred[j].
+    Parameters:
+        * y_true : true label of each object
+        * y_pred : cluster of each object
+        * label_true, label_pred : row and column labels (default: the unique
+          values of y_true and y_pred). Objects with labels not in them are
+          not counted.
+    Returns:
+        * cm : contingency matrix, shape (len(label_true), len(label_pred))
+        * label_true, label_pred
+    '''
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    if type(label_true) == type(None):
+        label_true, y_true = np.unique(y_true, return_inverse=True)
+    else:
+        label_true = np.asarray(label_true)
+        y_true = label_codes(label_true, y_true)
+    if type(label_pred) == type(None):
+        label_pred, y_pred = np.unique(y_pred, return_inverse=True)
+    else:
+        label_pred = np.asarray(label_pred)
+        y_pred = label_codes(label_pred, y_pred)
+        
+    n_true, n_pred = len(label_true), len(label_pred)
+    inds = np.nonzero((y_true > -1) * (y_pred > -1))
+    cm = np.bincount(y_true[inds]*n_pred + y_pred[inds],
+                     minlength=n_true*n_pred).reshape(n_true, n_pred)
+    return cm, label_true, label_pred
+
+def label_codes(labels, y):
+    '''Position of each element of y in labels, or -1 if it is not in
+    labels.'''
+    order = np.argsort(labels, kind='stable')
+    if len(labels) == 0:
+        return np.full(np.shape(y), -1, dtype='int64')
+    pos = np.minimum(np.searchsorted(labels[order], y), len(labels) - 1)
+    return np.where(labels[order][pos] == y, order[pos], -1)
+
+def match_clusters(cm, method='hungarian'):
+    '''Assigns clusters (columns of cm) to true labels (rows of cm).
+    Parameters:
+        * cm : contingency matrix from contingency_matrix()
+        * method : 'hungarian' for the one-to-one assignment maximizing the
+          number of matched objects, or 'greedy' to give every cluster the
+          label it overlaps with most (several clusters can share a label)
+    Returns:
+        * row_ind, col_ind : cluster col_ind[i] is assigned to label
+          row_ind[i]
+    '''
+    from scipy.optimize import linear_sum_assignment
+    cm = np.asarray(cm)
+    if method == 'hungarian':
+        row_ind, col_ind = linear_sum_assignment(-1*cm)
+    elif method == 'greedy':
+        col_ind = np.nonzero(np.sum(cm, axis=0) > 0)[0]
+        row_ind = np.argmax(cm[:,col_ind], axis=0)
+    else:
+        raise ValueError('Unknown method '+str(method)+\
+                         ', expected hungarian or greedy')
+    return row_ind, col_ind
+
+def match_accuracy(cm, row_ind, col_ind):
+    '''Fraction of objects in cm whose cluster is assigned to their label.'''
+    total = np.sum(cm)
+    if total == 0:
+        return 0.
+    return np.sum(cm[row_ind, col_ind]) / total
+
+def diagonal_confusion_matrix(cm, label_true, label_pred):
+    '''Pads cm with empty rows or columns (labelled 'X') to make it square
+    and reorders the columns by the Hungarian assignment, so that matched
+    (label, cluster) pairs are on the diagonal.
+    Returns:
+        * cm, label_true, label_pred
+    '''
+    n = max(cm.shape)
+    label_true = np.append(np.asarray(label_true).astype('str'),
+                           ['X']*(n-cm.shape[0]))
+    label_pred = np.append(np.asarray(label_pred).astype('str'),
+                           ['X']*(n-cm.shape[1]))
+    cm = np.pad(cm, ((0, n-cm.shape[0]), (0, n-cm.shape[1])))
+    row_ind, col_ind = match_clusters(cm)
+    return cm[:,col_ind], label_true, label_pred[col_ind]
+
+def assign_clusters(y_true, y_pred, method='hungarian'):
+    '''Matches clusters y_pred to true labels y_true.
+    Returns:
+        * assignments : array of [label_pred, label_true] pairs
+        * accuracy : fraction of objects whose cluster is assigned to their
+          label
+        * cm, label_true, label_pred : contingency matrix and its labels
+    '''
+    cm, label_true, label_pred = contingency_matrix(y_true, y_pred)
+    row_ind, col_ind = match_clusters(cm, method=method)
+    assignments = np.array([label_pred[col_ind].astype('str'),
+                            label_true[row_ind].astype('str')]).T
+    accuracy = match_accuracy(cm, row_ind, col_ind)
+    return assignments, accuracy, cm, label_true, label_pred
+
 def make_confusion_matrix(ticid_pred, ticid_true, y_true_labels, y_pred,
                           debug=False, output_dir='./'):
-    from sklearn.metrics import confusion_matrix
-    from scipy.optimize import linear_sum_assignment   
-    import seaborn as sn
-    
+    '''Confusion matrix of clusters y_pred (for ticid_pred) against labels
+    y_true_labels (for ticid_true), with columns reordered so that the
+    optimal one-to-one assignment is on the diagonal.
+    Returns:
+        * cm, accuracy
+    '''
     # >> find intersection
     intersection, comm1, comm2 = np.intersect1d(ticid_pred, ticid_true,
                                                 return_indices=True)
-    ticid_pred = ticid_pred[comm1]
-    y_pred = y_pred[comm1]
-    ticid_true = ticid_true[comm2]
-    y_tru_labels = y_true_labels[comm2]           
-        
-    columns = np.unique(y_pred).astype('str')
-
-    y_true = []
-    for i in range(len(ticid_true)):
-        class_num = np.nonzero(y_true_labels == y_true_labels[i])[0][0]
-        y_true.append(class_num)
-    y_true = np.array(y_true).astype('int')    
-    
-    cm = confusion_matrix(y_true, y_pred)
-    while len(columns) < len(cm):
-        columns = np.append(columns, 'X')       
-    while len(y_true_labels) < len(cm):
-        y_true_labels = np.append(y_true_labels, 'X')     
-        
-    row_ind, col_ind = linear_sum_assignment(-1*cm)
-    cm = cm[:,col_ind]       
-    accuracy = np.sum(np.diag(cm)) / np.sum(cm)
+    y_pred = np.asarray(y_pred)[comm1]
+    y_true = np.asarray(y_true_labels)[comm2]
+    
+    cm, label_true, label_pred = contingency_matrix(y_true, y_pred)
+    cm, label_true, label_pred = diagonal_confusion_matrix(cm, label_true,
+                                                           label_pred)
+    accuracy = match_accuracy(cm, np.arange(len(cm)), np.arange(len(cm)))
     return cm, accuracy
   
        
 def optimize_confusion_matrix(ticid_pred, y_pred, database_dir='./',
-                              num_classes=[10,15], num_iter=10):
-    from itertools import permutations
-    import random
-    class_info = get_true_classifications(ticid_pred,
-                                          database_dir=database_dir,
-                                          single_file=False)  
-    ticid_true = class_info[:,0].astype('int')
-    classes = []
-    for i in range(len(class_info)):
-        for label in class_info[i][1].split('|'):
-            if label not in classes:
-                classes.append(label)
-                
+                              num_classes=[10,15], class_info=None,
+                              method='hungarian'):
+    '''Scores clusters y_pred against the catalog classifications of
+    ticid_pred, for objects with one of the num_classes[i] most common
+    classes. Objects can have several classes (e.g. 'EA|RS'), and count as
+    correct if their cluster is assigned to any of them.
+    Returns:
+        * accuracy : accuracy for each entry of num_classes
+        * assignments : list of [label_pred, label_true] arrays, for each
+          entry of num_classes
+    '''
+    if type(class_info) == type(None):
+        class_info = get_true_classifications(ticid_pred,
+                                              database_dir=database_dir,
+                                              single_file=False)  
+    ticid_true = class_info[:,0].astype('float').astype('int')
+    
+    # >> one (object, class) pair per class of each classified object
+    rows = ticid_join(ticid_pred, ticid_true)
+    otypes = [otype.split('|') for otype in class_info[:,1]]
+    num_otypes = np.array([len(otype) for otype in otypes])
+    pair_pred = np.repeat(rows, num_otypes)
+    pair_true = np.concatenate(otypes) if len(otypes) > 0 else np.array([])
+    inds = np.nonzero(pair_pred > -1)
+    pair_pred, pair_true = pair_pred[inds], pair_true[inds]
+    pair_y_pred = np.asarray(y_pred)[pair_pred]
+    
+    classes, counts = np.unique(pair_true, return_counts=True)
+    classes = classes[np.argsort(-counts, kind='stable')]
+        
     accuracy = []
+    assignments = []
     for n in num_classes:
-        combinations = list(permutations(classes))
-        print('Number of combinations: ' + str(len(combinations)))
-        for i in range(num_iter):
-            labels = random.choice(combinations)
-            
-            
-            ticid_new = []
-            y_true = []
-            for i in range(len(ticid_true)):
-                for j in range(len(labels)):
-                    if labels[j] in class_info[i][1] and \
-                        ticid_true[i] not in ticid_new:
-                        y_true.append(labels[j])
-                        ticid_new.append(ticid_true[i])
-                        
-            y_true = np.array(y_true)
-            ticid_true_new = np.array(ticid_new)  
-            
-            cm, acc = make_confusion_matrix(ticid_pred, ticid_true_new,
-                                            labels, y_pred)
-            print(labels)
-            print('accuracy: ' + str(acc))
-            accuracy.append(acc)
-    
+        # >> pairs of objects in the n most common classes
+        inds = np.nonzero(np.isin(pair_true, classes[:n]))
+        cm, label_true, label_pred = \
+            contingency_matrix(pair_true[inds], pair_y_pred[inds])
+        row_ind, col_ind = match_clusters(cm, method=method)
+        
+        # >> an object is correct if any of its classes is assigned to its
+        # >> cluster
+        assigned = np.zeros(cm.shape, dtype='bool')
+        assigned[row_ind, col_ind] = True
+        codes_true = label_codes(label_true, pair_true[inds])
+        codes_pred = label_codes(label_pred, pair_y_pred[inds])
+        correct = np.zeros(len(y_pred), dtype='bool')
+        correct[pair_pred[inds][assigned[codes_true, codes_pred]]] = True
+        num_objects = len(np.unique(pair_pred[inds]))
+        acc = np.count_nonzero(correct) / max(num_objects, 1)
+        
+        assignments.append(np.array([label_pred[col_ind].astype('str'),
+                                     label_true[row_ind]]).T)
+        print('Number of classes: ' + str(n))
+        print('accuracy: ' + str(acc))
+        accuracy.append(acc)
+        
+    return accuracy, assignments
             
             
                 
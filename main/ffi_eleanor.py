@@ -468,19 +468,28 @@ class FFI_lc(object):
                 self.intensities[n] = df.mean_norm(self.intensities[n], axis=0)
     
         print("Begining Feature Vector Creation Now")
-        for n in range(len(self.intensities)):
-            feature_vector = df.featvec(self.times[n], self.intensities[n], v=self.version)
-            feature_list.append(feature_vector)
-            
-            if n % 25 == 0: print(str(n) + " completed")
+        def compute(inds):
+            feature_list = []
+            for n in inds:
+                feature_vector = df.featvec(self.times[n], self.intensities[n], v=self.version)
+                feature_list.append(feature_vector)
+                
+                if len(feature_list) % 25 == 0:
+                    print(str(len(feature_list)) + " completed")
+            return feature_list
         
-        feature_list = np.asarray(feature_list)
+        # >> only light curves that are new or changed since the last run are
+        # >> computed, the rest are read from the feature cache
+        cache_dir = os.path.dirname(fname_features) + '/feature_cache/'
+        feature_list = df.cached_features(self.gaia_ids, self.times,
+                                          self.intensities, compute, cache_dir,
+                                          version=self.version)
         
         if self.savetrue:
             hdr = fits.Header()
             hdr["VERSION"] = self.version
             hdu = fits.PrimaryHDU(feature_list, header=hdr)
-            hdu.writeto(fname_features)
+            hdu.writeto(fname_features, overwrite=True)
             fits.append(fname_features, self.gaia_ids)
         else: 
             print("Not saving feature vectors to fits")
@@ -463,26 +463,44 @@ class hyperleda_ffi(object):
         print("Begining Feature Vector Creation Now")
         #sigma clip each time you calculate - unsure how better to do this??
         sigclip = SigmaClip(sigma=5, maxiters=None, cenfunc='median')
-        for n in range(len(self.cleanedflux)):
-            
-            times = self.timeaxis
-            ints = self.cleanedflux[n]
-            
-            clipped_inds = np.nonzero(np.ma.getmask(sigclip(ints)))
-            ints[clipped_inds] = np.nan
-            delete_index = np.argwhere(np.isnan(ints))
-            times = np.delete(times, delete_index)
-            ints = np.delete(ints, delete_index)
-            
-            try:
-                feature_vector = df.featvec(times, ints, v=version)
-            except ValueError:
-                print("it did the stupid thing where it freaked out about one light curve and idk why")
-            if version == 1:
+        def compute(inds):
+            if version == 0:
+                # >> clip all light curves at once and leave the clipped
+                # >> points out of the batched feature vectors
+                flux = self.cleanedflux[inds]
+                clipped = np.ma.getmaskarray(sigclip(flux, axis=1))
+                flux[clipped] = np.nan
+                return df.featvec_batch(self.timeaxis, flux, mask=~clipped)
+            feature_list = []
+            for n in inds:
+                
+                times = self.timeaxis
+                ints = np.copy(self.cleanedflux[n])
+                
+                clipped_inds = np.nonzero(np.ma.getmask(sigclip(ints)))
+                ints[clipped_inds] = np.nan
+                delete_index = np.argwhere(np.isnan(ints))
+                times = np.delete(times, delete_index)
+                ints = np.delete(ints, delete_index)
+                
+                try:
+                    feature_vector = df.featvec(times, ints, v=version)
+                except ValueError:
+                    print("it did the stupid thing where it freaked out about one light curve and idk why")
                 feature_vector = np.nan_to_num(feature_vector, nan=0)
-            feature_list.append(feature_vector)
-            
-            if n % 500 == 0: print(str(n) + " completed")
+                feature_list.append(feature_vector)
+                
+                if len(feature_list) % 500 == 0:
+                    print(str(len(feature_list)) + " completed")
+            return feature_list
+        
+        # >> only light curves that are new or changed since the last run are
+        # >> computed, the rest are read from the feature cache
+        feature_list = df.cached_features(self.identifiers, self.timeaxis,
+                                          self.cleanedflux, compute,
+                                          self.enffolder + 'feature_cache/',
+                                          version=version,
+                                          params={'sigma': 5})
         
         self.features = np.asarray(feature_list)
         
@@ -490,7 +508,7 @@ class hyperleda_ffi(object):
             hdr = fits.Header()
             hdr["VERSION"] = version
             hdu = fits.PrimaryHDU(feature_list, header=hdr)
-            hdu.writeto(fname_features)
+            hdu.writeto(fname_features, overwrite=True)
         else: 
             print("Not saving feature vectors to fits")
         
@@ -756,12 +774,18 @@ class hyperleda_ffi(object):
                   'full_feed_forward_highway': False,
                   'cvae': False,
                   'share_pool_inds': False,
-                  'batchnorm_before_act': False} 
+                  'batchnorm_before_act': False,
+                  'xla': False, # >> performance mode, see ml.set_performance_mode()
+                  'mixed_precision': None,
+                  'intra_op_threads': None,
+                  'inter_op_threads': None} 
             
         print('Preprocessing')
         x_train, x_test, y_train, y_test, ticid_train, ticid_test, target_info_train, \
             target_info_test, rms_train, rms_test, x = \
-            ml.autoencoder_preprocessing(self.cleanedflux, self.CAE_index, self.timeaxis, target_info, p,
+            ml.autoencoder_preprocessing(self.cleanedflux, self.timeaxis, p,
+                                         ticid=self.CAE_index,
+                                         target_info=target_info,
                                          validation_targets=validation_targets,
                                          norm_type=norm_type,
                                          input_rms=input_rms, input_psd=input_psd,
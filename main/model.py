@@ -16,6 +16,8 @@ from astropy.io import fits
 from astropy.timeseries import LombScargle
 import random
 import time
+import weakref
+import json
 from sklearn.cluster import KMeans    
 import fnmatch as fm
 import pandas as pd
@@ -100,25 +102,30 @@ def merge_sector_diag(data_dir, sectors=list(range(1, 29)), output_dir='./',
     
 
 def autoencoder_preprocessing(flux, time, p, ticid=None, target_info=None,
-                              sector=1, mock_data=False,
+                              sector=None, mock_data=False,
                               validation_targets=[219107776],
                               DAE=False, features=False,
                               norm_type='standardization', input_rms=True,
                               input_psd = True, load_psd=False, n_pgram=1000,
-                              train_test_ratio=0.9, data_dir='./',
+                              train_test_ratio=0.9, data_dir=None,
                               split=False, output_dir='./', prefix='',
                               use_tess_features=True,
                               use_tls_features=True,
                               use_rms=True, flux_plot=None,
-                              concat_ext_feats=False):
+                              concat_ext_feats=False,
+                              psd_normalization='standard',
+                              psd_method='batch', psd_workers=1):
     '''Preprocesses output from df.load_data_from_metafiles
     Shuffles array.
     Parameters:
         * flux : array of light curves, shape=(num light curves, num points)
         * ticid : list of TICIDs, shape=(num light curves)
         * p : parameter dictionary
-        * target_info : [sector, cam, ccd, data_type, cadence] for each light
-                        curve, shape=(num light curves, 5)
+        * target_info : structured target_info (see df.make_target_info()),
+                        or legacy [sector, cam, ccd, data_type, cadence] for
+                        each light curve
+        * sector, data_dir : sector number and data directory of the light
+                             curves, required by concat_ext_feats
         * validation_targets : list of TICIDs to move from the training set to
                                testing set [deprecated]
         * DAE : preprocessing for deep autoencoder. if True, the following is
@@ -129,6 +136,11 @@ def autoencoder_preprocessing(flux, time, p, ticid=None, target_info=None,
           * norm_type : either standardization, median_normalization,
                         minmax_normalization, none
           * input_rms : calculate RMS before normalizing
+          * input_psd : also input PSDs, from the sector's PSD store in
+                        data_dir (see df.cached_psd()), or computed without
+                        the store if sector or data_dir is not given
+          * psd_normalization, psd_method, psd_workers : normalization,
+                        method and n_workers of df.cached_psd()
     '''
     
     # -- shuffle array ---------------------------------------------------------
@@ -185,19 +197,24 @@ def autoencoder_preprocessing(flux, time, p, ticid=None, target_info=None,
         # -- calculate PSDs ----------------------------------------------------
         if input_psd:
             # >> get frequency array
-            f, tmp = LombScargle(time, flux[0]).autopower()
-            f = np.linspace(np.min(f), np.max(f), n_pgram)
+            f = df.psd_frequency_grid(time, n_pgram)
                             
             if not load_psd:
                 print('Calculating PSD..')
-                
-                psd = []
-                for i in range(len(flux)):
-                    print(str(i) + '/' + str(len(flux)))
-                    # f, tmp = LombScargle(time, flux[i]).autopower()
-                    tmp = LombScargle(time, flux[i]).power(f)
-                    psd.append(tmp)
-                psd = np.array(psd)
+                if type(sector) == type(None) or type(data_dir) == type(None):
+                    # >> no store to keep them in
+                    psd = np.concatenate([block for _, block in \
+                        df.compute_psd(time, flux, f,
+                                       normalization=psd_normalization,
+                                       method=psd_method,
+                                       n_workers=psd_workers)])
+                else:
+                    # >> computed once per sector (new light curves only)
+                    # >> and gathered for this split from the PSD store
+                    psd = df.cached_psd(data_dir, sector, ticid, time, flux,
+                                        f, normalization=psd_normalization,
+                                        method=psd_method,
+                                        n_workers=psd_workers)
                 
                 # >> truncate
                 if not p['fully_conv']:
@@ -299,6 +316,8 @@ def autoencoder_preprocessing(flux, time, p, ticid=None, target_info=None,
         # -- get other external features ---------------------------------------
 
         if concat_ext_feats:
+            if type(sector) == type(None) or type(data_dir) == type(None):
+                raise ValueError('concat_ext_feats needs sector and data_dir')
             external_features_train, flux_train, ticid_train, target_info_train = \
                 bottleneck_preprocessing(sector, x_train, ticid_train,
                                          target_info_train, rms_train,
@@ -343,8 +362,9 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
         * sector : given as int TOOD: list of sector numbers
         * flux : array of light curves, shape=(num light curves, num data points)
         * ticid : list of TICIDs (given as int) for sector
-        * target_info : list of [sector, cam, ccd, data_type cadence] for each
-                        light curve
+        * target_info : structured target_info (see df.make_target_info()),
+                        or legacy [sector, cam, ccd, data_type, cadence] for
+                        each light curve
         * output_dir : output directory, containing CAE and DAE dirs
         * data_dir : directory containing _lightcurves.fits and _features*.fits
         * learned_features, engineered_features, tess_features : feature
@@ -365,11 +385,11 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
             engineered_feature_vector = hdul[0].data
             engineered_feature_ticid = hdul[1].data
         # >> re-arrange so that engineered_feature_ticid[i] = ticid[i]
-        tmp = []
-        for i in range(len(ticid)):
-            ind = np.nonzero(engineered_feature_ticid == ticid[i])
-            tmp.append(engineered_feature_vector[ind])
-        engineered_feature_vector = np.array(tmp).reshape((len(ticid), 16))
+        inds = df.ticid_join(engineered_feature_ticid, ticid)
+        if np.any(inds == -1):
+            raise ValueError('No engineered features for TIC ' + \
+                             str(int(ticid[np.nonzero(inds == -1)[0][0]])))
+        engineered_feature_vector = engineered_feature_vector[inds]
         features.append(engineered_feature_vector)
             
     if use_learned_features:
@@ -431,11 +451,11 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
         
         
     if use_tess_features:
-        tess_features = pd.read_csv(data_dir+'Sector'+str(sector)+\
-                                  '/Sector'+str(sector)+'tic_cat_all.csv')
-        ticid_tess = tess_features['ID'].to_numpy()
         columns = ['Teff', 'rad', 'mass', 'GAIAmag', 'd']
-        tess_features = tess_features[columns].to_numpy()
+        tess_features = df.tic_gather(df.open_tic_store(df.get_tic_store_dir(data_dir)),
+                                      ticid, columns)
+        ticid_tess = tess_features['ID']
+        tess_features = np.array([tess_features[col] for col in columns]).T
         
         # tess_features = np.loadtxt(data_dir + 'Sector'+str(sector)+\
         #                            '/tess_features_sector'+str(sector)+'.txt',
@@ -653,6 +673,63 @@ def vae_gan(x_train, y_train, x_test, y_test, params,
     E.save_weights('encoder.h5')
     print('end')    
 
+# :: Performance mode ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Opt-in training options, set in the parameter dictionary p (all off by
+# >> default):
+# >>   * 'xla' : True to compile the model with XLA (jit)
+# >>   * 'mixed_precision' : 'bfloat16', 'float16' or 'auto' (bfloat16 on CPUs
+# >>     with bfloat16 instructions, float16 on GPUs). Layers compute in the
+# >>     16 bit type and keep float32 weights, the output is float32, and
+# >>     float16 losses are scaled (LossScaleOptimizer)
+# >>   * 'intra_op_threads', 'inter_op_threads' : TensorFlow thread pools (must
+# >>     be set before TensorFlow runs anything, i.e. in the first model of a
+# >>     session)
+# >> conv_autoencoder() writes the time of every epoch (TimeHistory) with the
+# >> mode to epoch_times.txt, to compare against the baseline.
+
+def cpu_supports_bfloat16():
+    '''Whether the CPU has bfloat16 instructions (AVX512_BF16 or AMX).'''
+    if not os.path.exists('/proc/cpuinfo'):
+        return False
+    with open('/proc/cpuinfo', 'r') as f:
+        flags = f.read()
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def set_performance_mode(p):
+    '''Sets the thread pools and mixed precision policy of p (see Performance
+    mode above), before the model is built. Returns the name of the policy
+    used ('float32' if mixed precision is off or not supported).'''
+    intra, inter = p.get('intra_op_threads'), p.get('inter_op_threads')
+    try:
+        if type(intra) != type(None):
+            tf.config.threading.set_intra_op_parallelism_threads(intra)
+        if type(inter) != type(None):
+            tf.config.threading.set_inter_op_parallelism_threads(inter)
+    except RuntimeError:
+        print('!! TensorFlow is already running, thread pools not changed')
+    
+    dtype = p.get('mixed_precision')
+    gpu = len(tf.config.list_physical_devices('GPU')) > 0
+    if dtype == 'auto':
+        dtype = 'float16' if gpu else 'bfloat16'
+    if dtype == 'bfloat16' and not gpu and not cpu_supports_bfloat16():
+        print('!! CPU has no bfloat16 instructions, training in float32')
+        dtype = None
+    elif dtype == 'float16' and not gpu:
+        print('!! float16 is only fast on GPUs, training in float32')
+        dtype = None
+    policy = 'float32' if type(dtype) == type(None) else 'mixed_' + dtype
+    # >> also resets the policy of an earlier model
+    keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+def performance_mode_name(p):
+    '''Short description of the performance mode, for reports.'''
+    return 'policy=' + keras.mixed_precision.global_policy().name + \
+        ', xla=' + str(bool(p.get('xla'))) + \
+        ', intra_op_threads=' + str(p.get('intra_op_threads')) + \
+        ', inter_op_threads=' + str(p.get('inter_op_threads'))
+
 class TimeHistory(keras.callbacks.Callback):
     '''https://stackoverflow.com/questions/43178668/record-the-computation-time-
     for-each-epoch-in-keras-during-model-fit'''
@@ -665,6 +742,96 @@ class TimeHistory(keras.callbacks.Callback):
     def on_epoch_end(self, batch, logs={}):
         self.times.append(time.time() - self.epoch_time_start)
 
+# :: Streaming input pipeline ::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Instead of shuffling, normalizing, truncating and splitting copies of the
+# >> whole flux array (autoencoder_preprocessing(), split_data()), the CAE can
+# >> be trained from a tf.data pipeline that reads batches of rows from the
+# >> memory-mapped flux of one or more light curve stores, e.g.
+# >>     flux, x, ticid, target_info = df.load_data_from_store(data_dir, sector)
+# >>     train_rows, test_rows = split_rows(len(flux))
+# >>     x_train = flux_dataset(flux, train_rows, p)
+# >>     x_test = flux_dataset(flux, test_rows, p, shuffle=False)
+# >>     model, history = conv_autoencoder(x_train, None, x_test, None, p)
+# >> Rows are normalized (df.normalize_chunk()) and truncated to a length the
+# >> pooling layers divide evenly while the next batches are prefetched, so
+# >> memory is set by batch_size and the prefetch buffer, not the data set.
+
+def truncated_length(num_points, p):
+    '''Largest length <= num_points that the encoder's pooling layers and
+    strides reduce without remainder (what split_data() truncates to).'''
+    # >> dim reduced each iteration
+    reduction_factor = np.max(p['pool_size'])* np.max(p['strides'])**np.max(p['num_consecutive'] )
+    
+    num_iter = np.max(p['num_conv_layers'])/2
+    tot_reduction_factor = reduction_factor**num_iter
+    if p['fully_conv']:
+        # >> 1 more conv layer
+        tot_reduction_factor = tot_reduction_factor * np.max(p['strides'])
+    return int(num_points / tot_reduction_factor)*int(tot_reduction_factor)
+
+def split_rows(num_rows, train_test_ratio=0.9, seed=4):
+    '''Rows of the training and testing sets, shuffled the same way as
+    autoencoder_preprocessing() shuffles light curves.'''
+    inds = np.arange(num_rows)
+    random.Random(seed).shuffle(inds)
+    split_ind = int(train_test_ratio*num_rows)
+    return inds[:split_ind], inds[split_ind:]
+
+def read_flux_rows(flux, rows, norm_type='standardization', length=None):
+    '''Reads rows of flux (an array, or a list of arrays with the same number
+    of columns, e.g. the memory maps of several sectors, whose rows are
+    numbered one after the other), normalizes each row and truncates it to
+    length. Returns a float32 array.'''
+    if type(flux) != list:
+        flux = [flux]
+    offsets = np.cumsum([0] + [len(f) for f in flux])
+    rows = np.asarray(rows)
+    x = np.empty((len(rows), flux[0].shape[1]), dtype='float32')
+    part = np.searchsorted(offsets, rows, side='right') - 1
+    for i in np.unique(part):
+        inds = np.nonzero(part == i)[0]
+        inds = inds[np.argsort(rows[inds])] # >> read in disk order
+        x[inds] = flux[i][rows[inds] - offsets[i]]
+    x = df.normalize_chunk(x, norm_type=norm_type)
+    return np.ascontiguousarray(x[:, :length], dtype='float32')
+
+def flux_dataset(flux, rows, p, norm_type='standardization', length=None,
+                 shuffle=True, seed=4, num_parallel_calls=tf.data.AUTOTUNE,
+                 prefetch=tf.data.AUTOTUNE):
+    '''tf.data pipeline of batches (x, x) of rows of flux, to train the CAE
+    with conv_autoencoder() (see Streaming input pipeline above).
+    Parameters:
+        * flux : array or list of arrays, see read_flux_rows()
+        * rows : rows in the data set, e.g. from split_rows()
+        * p : parameter dictionary ('batch_size', and the pooling parameters
+              for the default length)
+        * norm_type : see df.normalize_chunk()
+        * length : number of data points kept (default truncated_length())
+        * shuffle : shuffle rows every epoch (use False to keep the order of
+                    rows, e.g. for the testing set or get_bottleneck())
+        * num_parallel_calls : number of batches read in parallel
+        * prefetch : number of batches prefetched
+    '''
+    num_points = flux[0].shape[1] if type(flux) == list else flux.shape[1]
+    if type(length) == type(None):
+        length = truncated_length(num_points, p)
+    
+    def load(batch_rows):
+        x = tf.numpy_function(lambda r: read_flux_rows(flux, r, norm_type,
+                                                       length),
+                              [batch_rows], tf.float32)
+        x = tf.ensure_shape(x, [None, length])
+        return x, x
+    
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(rows,
+                                                            dtype='int64'))
+    if shuffle: # >> only the row numbers are shuffled
+        dataset = dataset.shuffle(len(rows), seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.batch(p['batch_size'])
+    dataset = dataset.map(load, num_parallel_calls=num_parallel_calls)
+    return dataset.prefetch(prefetch)
+
 def conv_autoencoder(x_train, y_train, x_test, y_test, params, 
                      val=True, split=False, input_features=False,
                      features=None, input_psd=False, save_model_epoch=False,
@@ -678,6 +845,19 @@ def conv_autoencoder(x_train, y_train, x_test, y_test, params,
     # -- making swish activation function -------------------------------------
     # get_custom_objects().update({'swish': Activation(swish)})
     
+    # -- streamed input (see flux_dataset()) ----------------------------------
+    streamed = isinstance(x_train, tf.data.Dataset)
+    if streamed:
+        if predict or save_bottleneck:
+            raise ValueError('Get predictions and bottleneck of streamed '+\
+                             'data with flux_dataset(..., shuffle=False)')
+        train_data, val_data = x_train, x_test
+        # >> the model is built from the input shape only
+        x_train = np.empty((0,) + tuple(train_data.element_spec[0].shape[1:]))
+    
+    # -- performance mode (mixed precision, threads) --------------------------
+    policy = set_performance_mode(params)
+    
     # -- encoding -------------------------------------------------------------
     params['concat_ext_feats']=concat_ext_feats
     if split:
@@ -704,6 +884,12 @@ def conv_autoencoder(x_train, y_train, x_test, y_test, params,
     else:
         decoded = decoder(x_train, encoded.output, params)
         
+    if policy != 'float32': # >> outputs (and the loss) in float32
+        if type(decoded) == list:
+            decoded = [Activation('linear', dtype='float32')(x) \
+                       for x in decoded]
+        else:
+            decoded = Activation('linear', dtype='float32')(decoded)
         
     model = Model(encoded.input, decoded)
     # model = decoder(x_train, encoded, params)
@@ -744,7 +930,11 @@ def conv_autoencoder(x_train, y_train, x_test, y_test, params,
             callbacks.append(checkpoint)
             callbacks.append(tensorboard_callback)
         
-        if val:
+        if streamed:
+            history = model.fit(train_data, epochs=params['epochs'],
+                                validation_data=val_data if val else None,
+                                callbacks=callbacks)
+        elif val:
             history = model.fit(x_train, x_train, epochs=params['epochs'],
                                 batch_size=params['batch_size'], shuffle=True,
                                 validation_data=(x_test, x_test),
@@ -753,10 +943,18 @@ def conv_autoencoder(x_train, y_train, x_test, y_test, params,
             history = model.fit(x_train, x_train, epochs=params['epochs'],
                         batch_size=params['batch_size'], shuffle=True,
                                 callbacks=callbacks)
+        if not val:
             time = time_callback.times
             print('Training time: ' + str(time))
             with open(output_dir+prefix+'training_time.txt', 'w') as f:
                 f.write(str(time[0]))
+        
+        # >> epoch times of the performance mode, to compare against float32
+        with open(output_dir+prefix+'epoch_times.txt', 'a') as f:
+            f.write(performance_mode_name(params) + ': ' + \
+                    ' '.join(['%.3f'%t for t in time_callback.times]) + '\n')
+        print('Epoch times (' + performance_mode_name(params) + '): ' + \
+              str(time_callback.times))
             
         if save_model:
             model.save(output_dir + prefix + 'model.hdf5')      
@@ -774,7 +972,8 @@ def conv_autoencoder(x_train, y_train, x_test, y_test, params,
         print('Getting bottlneck...')
         bottleneck_train = \
             get_bottleneck(model, x_train, params, save=True, ticid=ticid_train,
-                           out=output_dir+prefix+'bottleneck_train.fits')
+                           out=output_dir+prefix+'bottleneck_train.fits',
+                           stats_out=output_dir+prefix+'bottleneck_stats.npz')
         if len(x_test) > 0:
             bottleneck = get_bottleneck(model, x_test, params, save=True,
                                         ticid=ticid_test,
@@ -1409,7 +1608,7 @@ def post_process(x, x_train, x_test, ticid_train, ticid_test, target_info_train,
                                             metric=metric).fit(features)
                 labels = clusterer.labels_
                 np.savetxt(output_dir+prefix+'hdbscan_labels.txt',
-                           np.array([ticid_feat, labels]))
+                           np.array([ticid_feat, labels]), fmt='%d')
                 
         # -- GMM ---------------------------------------------------------------
         if run_gmm:
@@ -1421,7 +1620,7 @@ def post_process(x, x_train, x_test, ticid_train, ticid_test, target_info_train,
                 gmm = GaussianMixture(n_components=n_components)
                 labels = gmm.fit_predict(features)
                 np.savetxt(output_dir+prefix+'gmm_labels.txt',
-                           np.array([ticid_feat, labels]))
+                           np.array([ticid_feat, labels]), fmt='%d')
 
         
         pf.classification_plots(features, x, flux_feat, ticid_feat, info_feat,
@@ -1888,15 +2087,23 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
         #                         output_dir=output_dir+'Sector'+str(sectors[0]))
 
 def iterative_cae_clustering(ensemble_dir, data_dir, sectors=[], num_iter=2,
-                             n_clusters=[100,100,100], first_iter_only=False):
-    '''Do clustering'''
+                             n_clusters=[100,100,100], first_iter_only=False,
+                             use_store=False):
+    '''Do clustering
+    use_store : if True, reads light curves from the memory-mapped light curve
+                store (see df.load_data_from_store) instead of the metafiles'''
     for sector in sectors:
         print('Sector '+ str(sector))
         output_dir=ensemble_dir+'Ensemble-Sector_'+str(sector)+'/'
 
-        flux, time, ticid, target_info = \
-            df.load_data_from_metafiles(data_dir, sector,
+        if use_store:
+            flux, time, ticid, target_info = \
+                df.load_data_from_store(data_dir, sector,
                                         output_dir=output_dir)
+        else:
+            flux, time, ticid, target_info = \
+                df.load_data_from_metafiles(data_dir, sector,
+                                            output_dir=output_dir)
         flux = df.normalize(flux)
 
         iterations = [0,2] # list(range(num_iter))
@@ -1953,7 +2160,7 @@ def iterative_cae_clustering(ensemble_dir, data_dir, sectors=[], num_iter=2,
                 gmm = GaussianMixture(n_components=n_clusters[i])
                 y_pred = gmm.fit_predict(features)
                 np.savetxt(out_file,
-                           np.array([ticid, y_pred]))
+                           np.array([ticid, y_pred]), fmt='%d')
 
             assignments = pf.assign_real_labels(ticid, y_pred, data_dir=data_dir,
                                         output_dir=output_dir, prefix=prefix)
@@ -2118,7 +2325,14 @@ def compile_model(model, params):
         # opt = optimizers.adadelta(lr = params['lr'])
         opt = optimizers.Adadelta(lr = params['lr'])
         
-    model.compile(optimizer=opt, loss=params['losses'])
+    if keras.mixed_precision.global_policy().name == 'mixed_float16':
+        # >> scale the loss so float16 gradients don't underflow
+        opt = keras.mixed_precision.LossScaleOptimizer(opt)
+        
+    if params.get('xla'): # >> see Performance mode
+        model.compile(optimizer=opt, loss=params['losses'], jit_compile=True)
+    else:
+        model.compile(optimizer=opt, loss=params['losses'])
 
 def sampling(args):
     """
@@ -3127,17 +3341,7 @@ def split_data(flux, x, ticid, target_info, time, p,
                resize_arr=False, truncate=True):
 
     if truncate:
-        # >> dim reduced each iteration
-        reduction_factor = np.max(p['pool_size'])* np.max(p['strides'])**np.max(p['num_consecutive'] )
-        # reduction_factor = np.max(p['pool_size'])* np.max(p['strides'])
-        
-        num_iter = np.max(p['num_conv_layers'])/2
-        tot_reduction_factor = reduction_factor**num_iter
-        if p['fully_conv']:
-            # >> 1 more conv layer
-            tot_reduction_factor = tot_reduction_factor * np.max(p['strides'])
-        new_length = int(x.shape[1] / tot_reduction_factor)*\
-                     int(tot_reduction_factor)
+        new_length = truncated_length(x.shape[1], p)
         x = np.delete(x,np.arange(new_length,x.shape[1]),1)
         time_plot = time
         time = time[:new_length]         
@@ -3193,9 +3397,8 @@ def split_data(flux, x, ticid, target_info, time, p,
 def get_activations(model, x_test, input_rms = False, rms_test = False,
                     ind=None):
     '''Returns intermediate activations.'''
-    from keras.models import Model
-    layer_outputs = [layer.output for layer in model.layers][1:]
-    activation_model = Model(inputs=model.input, outputs=layer_outputs)
+    activation_model = sub_model(model, 'activations', lambda: \
+                                 [layer.output for layer in model.layers][1:])
     if input_rms:
         activations = activation_model.predict([x_test, rms_test])
     else:
@@ -3205,27 +3408,51 @@ def get_activations(model, x_test, input_rms = False, rms_test = False,
             activations = activation_model.predict(x_test[ind].reshape(1,-1))
     return activations
 
-def get_bottleneck(model, x_test, p, DAE=True, save=False, ticid=None,
-                   out=None):
+# >> sub-models of trained models (encoder, activations), built once per model
+SUB_MODELS = weakref.WeakKeyDictionary()
+
+def sub_model(model, key, outputs):
+    '''Returns the sub-model key of model, with the same input and outputs
+    outputs() (a function returning layer outputs), building it the first
+    time.'''
+    if model not in SUB_MODELS:
+        SUB_MODELS[model] = {}
+    if key not in SUB_MODELS[model]:
+        SUB_MODELS[model][key] = Model(inputs=model.input, outputs=outputs())
+    return SUB_MODELS[model][key]
+
+def bottleneck_layer_index(model, p, DAE=True):
+    '''Index of the bottleneck layer of model.'''
     if p['fully_conv']:
         inds = np.nonzero(['conv1d' in x.name for x in model.layers])[0]
-        bottleneck_ind = inds[-1]        
+        return inds[-1]
+    
+    inds = np.nonzero(['dense' in x.name for x in model.layers])[0]
+    
+    # >> bottleneck layer is the first Dense layer
+    if DAE:
+        return inds[int(len(inds)/2)-1]
     else:
-        inds = np.nonzero(['dense' in x.name for x in model.layers])[0]
-        
-        # >> bottleneck layer is the first Dense layer
-        if DAE:
-            bottleneck_ind = inds[int(len(inds)/2)-1]
-        else:
-            bottleneck_ind = inds[0]
-                        
-    activation_model = Model(inputs=model.input,
-                             outputs=model.layers[bottleneck_ind].output)
-    bottleneck = activation_model.predict(x_test)    
+        return inds[0]
+
+def encoder_model(model, p, DAE=True):
+    '''Encoder sub-model of model (input to bottleneck), cached.'''
+    bottleneck_ind = bottleneck_layer_index(model, p, DAE=DAE)
+    return sub_model(model, ('encoder', bottleneck_ind),
+                     lambda: model.layers[bottleneck_ind].output)
+
+def get_bottleneck(model, x_test, p, DAE=True, save=False, ticid=None,
+                   out=None, stats_out=None):
+    '''Standardized bottleneck of x_test. stats_out : file to save the
+    bottleneck statistics in (see save_bottleneck_stats()), for the training
+    set.'''
+    bottleneck = encoder_model(model, p, DAE=DAE).predict(x_test)
     
     if p['fully_conv']:
         bottleneck = np.squeeze(bottleneck, axis=-1)
     
+    if type(stats_out) != type(None):
+        save_bottleneck_stats(stats_out, bottleneck)
     bottleneck = df.standardize(bottleneck, ax=0)
     
     if save:
@@ -3236,6 +3463,220 @@ def get_bottleneck(model, x_test, p, DAE=True, save=False, ticid=None,
     
     return bottleneck
 
+# :: Embedding API :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> CAEEmbedder scores new light curves (e.g. a new sector) against a trained
+# >> CAE without iterative_cae(run=False): it loads model.hdf5 once, keeps the
+# >> encoder sub-model, and embeds or reconstructs batches of light curves,
+# >> from arrays or streamed from a light curve store, e.g.
+# >>     cae = CAEEmbedder(output_dir+'model.hdf5', p,
+# >>                       output_dir+'bottleneck_stats.npz')
+# >>     store = df.open_lc_store(df.get_lc_store_dir(data_dir, sector))
+# >>     bottleneck = cae.embed_store(store['flux'])
+# >> Bottlenecks are standardized with the mean and standard deviation of the
+# >> training bottleneck, saved by get_bottleneck(stats_out=...) (see
+# >> conv_autoencoder(save_bottleneck=True)), so they are comparable with the
+# >> training bottleneck.
+
+def save_bottleneck_stats(fname, bottleneck):
+    '''Saves the mean and standard deviation of each bottleneck feature.'''
+    stds = np.nanstd(bottleneck, axis=0)
+    stds[np.nonzero(stds == 0.)] = 1e-8 # >> same as df.standardize()
+    np.savez(fname, mean=np.nanmean(bottleneck, axis=0), std=stds)
+
+def load_bottleneck_stats(fname):
+    '''Returns the mean and standard deviation saved by
+    save_bottleneck_stats().'''
+    with np.load(fname) as stats:
+        return stats['mean'], stats['std']
+
+class CAEEmbedder:
+    '''Trained CAE, loaded once (see Embedding API above).
+    Parameters:
+        * model_file : model saved by conv_autoencoder(save_model=True)
+        * p : parameter dictionary the model was trained with
+        * stats_file : bottleneck statistics saved by get_bottleneck(), to
+                       standardize bottlenecks like the training bottleneck
+                       (if None, embed(standardize=True) standardizes each
+                       call with its own statistics, like get_bottleneck())
+        * norm_type : normalization of the training light curves (see
+                      df.normalize_chunk())
+        * batch_size : number of light curves per prediction batch
+        * DAE : see get_bottleneck()
+    '''
+    def __init__(self, model_file, p, stats_file=None,
+                 norm_type='standardization', batch_size=None, DAE=True):
+        self.p = p
+        self.norm_type = norm_type
+        self.batch_size = p['batch_size'] if type(batch_size) == type(None) \
+            else batch_size
+        self.model = keras.models.load_model(model_file, compile=False,
+                                             custom_objects={'tf': tf})
+        self.encoder = encoder_model(self.model, p, DAE=DAE)
+        self.input_dim = self.model.input_shape[1]
+        self.stats = None
+        if type(stats_file) != type(None):
+            self.stats = load_bottleneck_stats(stats_file)
+    
+    def preprocess(self, flux):
+        '''Normalizes light curves and truncates them to the input length.'''
+        return read_flux_rows(flux, np.arange(len(flux)), self.norm_type,
+                              self.input_dim)
+    
+    def standardize(self, bottleneck):
+        if type(self.stats) == type(None):
+            return df.standardize(bottleneck, ax=0)
+        return (bottleneck - self.stats[0]) / self.stats[1]
+    
+    def embed(self, flux_batch, preprocess=True, standardize=True):
+        '''Bottleneck of light curves (shape=(num light curves, num points)).
+        If preprocess is False, flux_batch is already normalized and
+        truncated.'''
+        x = self.preprocess(flux_batch) if preprocess else flux_batch
+        bottleneck = self.encoder.predict(x, batch_size=self.batch_size)
+        if self.p['fully_conv']:
+            bottleneck = np.squeeze(bottleneck, axis=-1)
+        if standardize:
+            bottleneck = self.standardize(bottleneck)
+        return bottleneck
+    
+    def reconstruct(self, flux_batch, preprocess=True):
+        '''Reconstructions of light curves (see embed()).'''
+        x = self.preprocess(flux_batch) if preprocess else flux_batch
+        return self.model.predict(x, batch_size=self.batch_size)
+    
+    def embed_store(self, flux, rows=None, standardize=True):
+        '''Bottleneck of rows of flux (e.g. the memory-mapped flux of a light
+        curve store, or a list of them, see read_flux_rows()), streamed with
+        flux_dataset() so only a few batches are in memory.'''
+        if type(rows) == type(None):
+            rows = np.arange(sum([len(f) for f in flux]) if type(flux) == list \
+                             else len(flux))
+        dataset = flux_dataset(flux, rows, {'batch_size': self.batch_size},
+                               norm_type=self.norm_type,
+                               length=self.input_dim, shuffle=False)
+        bottleneck = self.encoder.predict(dataset)
+        if self.p['fully_conv']:
+            bottleneck = np.squeeze(bottleneck, axis=-1)
+        if standardize:
+            bottleneck = self.standardize(bottleneck)
+        return bottleneck
+
+def export_encoder_npz(model, p, fname, DAE=True, stats_file=None,
+                       norm_type='standardization'):
+    '''Writes the encoder of a trained CAE (input to bottleneck, see
+    get_bottleneck()) to fname (.npz), for the NumPy-only runtime
+    numpy_encoder.py. Supports the layers encoder() builds: Conv1D,
+    BatchNormalization, Activation, MaxPooling1D, Dropout, Flatten and Dense.
+    Raises a ValueError for any layer or setting numpy_encoder.py can not
+    reproduce (e.g. causal padding, dilation, an unknown activation).
+    Parameters:
+        * stats_file : bottleneck statistics of the training set (see
+                       save_bottleneck_stats()), to export with the weights
+        * norm_type : normalization of the training light curves
+    '''
+    import numpy_encoder as ne
+    arrays = {}
+    layers = []
+    encoder = encoder_model(model, p, DAE=DAE)
+    if len(encoder.input_shape) != 2:
+        raise ValueError('Can only export encoders of 1D light curves')
+    for layer in encoder.layers:
+        config = layer.get_config()
+        name = layer.__class__.__name__
+        if config.get('data_format', 'channels_last') != 'channels_last':
+            raise ValueError('Can not export '+layer.name+' with '+\
+                             config['data_format'])
+        if name in ['InputLayer', 'Dropout']:
+            continue
+        if name == 'Reshape':
+            if layer.input_shape != encoder.input_shape or \
+               tuple(config['target_shape']) != (encoder.input_shape[1], 1):
+                raise ValueError('Can not export '+layer.name+', only '+\
+                                 '(num points,) -> (num points, 1)')
+            continue # >> implied by the runtime
+        if name == 'Conv1D':
+            if config['dilation_rate'][0] != 1 or config.get('groups', 1) != 1:
+                raise ValueError('Can not export dilated or grouped '+\
+                                 'convolution '+layer.name)
+            if config['padding'] not in ne.PADDINGS:
+                raise ValueError('Can not export '+layer.name+' with '+\
+                                 config['padding']+' padding')
+            spec = {'type': 'conv1d', 'strides': config['strides'][0],
+                    'padding': config['padding']}
+            weights = {'kernel': layer.kernel}
+        elif name == 'Dense':
+            spec = {'type': 'dense'}
+            weights = {'kernel': layer.kernel}
+        elif name == 'BatchNormalization':
+            if config['axis'] not in [-1, [-1], len(layer.input_shape)-1,
+                                      [len(layer.input_shape)-1]] or \
+               config.get('renorm'):
+                raise ValueError('Can only export batch normalization '+\
+                                 'over the last axis ('+layer.name+')')
+            spec = {'type': 'batch_norm', 'epsilon': config['epsilon']}
+            weights = {'moving_mean': layer.moving_mean,
+                       'moving_variance': layer.moving_variance}
+            if config['scale']:
+                weights['gamma'] = layer.gamma
+            if config['center']:
+                weights['beta'] = layer.beta
+        elif name == 'MaxPooling1D':
+            if config['padding'] not in ne.PADDINGS:
+                raise ValueError('Can not export '+layer.name+' with '+\
+                                 config['padding']+' padding')
+            spec = {'type': 'max_pool1d', 'pool_size': config['pool_size'][0],
+                    'strides': config['strides'][0],
+                    'padding': config['padding']}
+            weights = {}
+        elif name == 'Flatten':
+            spec = {'type': 'flatten'}
+            weights = {}
+        elif name == 'Activation':
+            spec = {'type': 'activation'}
+            weights = {}
+        else:
+            raise ValueError('Can not export layer '+layer.name+' ('+name+')')
+        if config.get('use_bias'):
+            weights['bias'] = layer.bias
+        if 'activation' in config:
+            if type(config['activation']) != str or \
+               config['activation'] not in ne.ACTIVATIONS:
+                raise ValueError('Can not export '+layer.name+' with '+\
+                                 'activation '+str(config['activation']))
+            spec['activation'] = config['activation']
+        spec['weight_names'] = list(weights.keys())
+        for key, weight in weights.items():
+            arrays['layer%d_%s'%(len(layers), key)] = \
+                np.asarray(weight.numpy(), dtype='float32')
+        layers.append(spec)
+    
+    config = {'layers': layers, 'input_dim': int(model.input_shape[1]),
+              'fully_conv': bool(p['fully_conv']), 'norm_type': norm_type}
+    arrays['config'] = np.array(json.dumps(config))
+    if type(stats_file) != type(None):
+        arrays['bottleneck_mean'], arrays['bottleneck_std'] = \
+            load_bottleneck_stats(stats_file)
+    np.savez(fname, **arrays)
+
+def benchmark_numpy_encoder(model, p, x, fname='encoder.npz'):
+    '''Exports the encoder of model to fname, and compares the NumPy-only
+    bottleneck of x (normalized, truncated light curves) with Keras. Returns
+    the largest absolute difference.'''
+    import numpy_encoder as ne
+    export_encoder_npz(model, p, fname)
+    start = time.time()
+    encoder = ne.load_encoder(fname)
+    bottleneck = ne.encode(encoder, x)
+    print('NumPy runtime (load + encode): ' + str(time.time() - start) + ' s')
+    start = time.time()
+    reference = encoder_model(model, p).predict(x)
+    if p['fully_conv']:
+        reference = np.squeeze(reference, axis=-1)
+    print('Keras predict: ' + str(time.time() - start) + ' s')
+    diff = np.max(np.abs(bottleneck - reference))
+    print('Max. difference: ' + str(diff))
+    return diff
+
 # :: mock data ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 
 def gaussian(x, a, b, c):
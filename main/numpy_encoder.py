@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy-only inference for trained CAE encoders, for scoring jobs that should
+not import TensorFlow. The encoder of a trained conv_autoencoder() is exported
+once with ml.export_encoder_npz() (which needs TensorFlow), then
+    encoder = load_encoder('encoder.npz')
+    bottleneck = embed(encoder, flux)
+gives the same bottleneck as ml.get_bottleneck() (up to float32 rounding).
+This module only imports numpy and json.
+
+Runtime
+* load_encoder()    : reads an encoder exported by ml.export_encoder_npz()
+* encode()          : forward pass of batches of normalized light curves
+* embed()           : normalize, truncate, encode and standardize light curves
+* normalize_rows()  : same as df.normalize_chunk()
+
+Layers
+* conv1d()          : Conv1D ('same' or 'valid' padding, any stride)
+* max_pool1d()      : MaxPooling1D ('same' or 'valid' padding)
+* batch_norm()      : BatchNormalization (inference)
+* ACTIVATIONS       : activations the encoder builder supports
+"""
+
+import json
+import numpy as np
+
+# :: Layers ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# >> Arrays are (num light curves, num data points, num channels), like the
+# >> Keras layers. Padding follows TensorFlow: 'same' pads
+# >> max((out - 1)*strides + size - length, 0) points, the smaller half first.
+# >> Other paddings (e.g. 'causal') raise a ValueError.
+
+PADDINGS = ['same', 'valid']
+
+def elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+def selu(x):
+    return 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * \
+                                         np.expm1(np.minimum(x, 0)))
+
+def sigmoid(x):
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'relu': lambda x: np.maximum(x, 0),
+               'elu': elu,
+               'selu': selu,
+               'sigmoid': sigmoid,
+               'tanh': np.tanh,
+               'softplus': lambda x: np.logaddexp(x, 0),
+               'swish': lambda x: x * sigmoid(x)}
+
+def same_padding(length, size, strides):
+    '''Points padded before and after an axis of length for 'same' padding.'''
+    out = -(-length // strides)
+    pad = max((out - 1) * strides + size - length, 0)
+    return pad // 2, pad - pad // 2
+
+def conv1d(x, kernel, bias, strides=1, padding='same'):
+    '''Conv1D. kernel has shape (size, channels in, channels out). Computed as
+    one matrix product per kernel tap (im2col one column block at a time), so
+    memory stays at the size of the output.'''
+    if padding not in PADDINGS:
+        raise ValueError('Unsupported Conv1D padding '+str(padding))
+    size = kernel.shape[0]
+    if padding == 'same':
+        x = np.pad(x, ((0, 0), same_padding(x.shape[1], size, strides),
+                       (0, 0)))
+    out_len = (x.shape[1] - size) // strides + 1
+    y = np.matmul(x[:, :(out_len - 1)*strides + 1:strides], kernel[0])
+    for j in range(1, size):
+        y += np.matmul(x[:, j:j + (out_len - 1)*strides + 1:strides],
+                       kernel[j])
+    if type(bias) != type(None):
+        y += bias
+    return y
+
+def max_pool1d(x, pool_size=2, strides=None, padding='valid'):
+    '''MaxPooling1D (strides default to pool_size).'''
+    if padding not in PADDINGS:
+        raise ValueError('Unsupported MaxPooling1D padding '+str(padding))
+    if type(strides) == type(None):
+        strides = pool_size
+    if padding == 'same':
+        x = np.pad(x, ((0, 0), same_padding(x.shape[1], pool_size, strides),
+                       (0, 0)), constant_values=-np.inf)
+    out_len = (x.shape[1] - pool_size) // strides + 1
+    y = x[:, :(out_len - 1)*strides + 1:strides]
+    for j in range(1, pool_size):
+        y = np.maximum(y, x[:, j:j + (out_len - 1)*strides + 1:strides])
+    return y
+
+def batch_norm(x, weights, epsilon=1e-3):
+    '''BatchNormalization with the moving mean and variance. weights has
+    'moving_mean', 'moving_variance', and 'gamma' and 'beta' if the layer
+    scales and centers.'''
+    scale = 1 / np.sqrt(weights['moving_variance'] + epsilon)
+    if 'gamma' in weights:
+        scale = scale * weights['gamma']
+    y = (x - weights['moving_mean']) * scale
+    if 'beta' in weights:
+        y += weights['beta']
+    return y
+
+# :: Runtime :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def load_encoder(fname):
+    '''Reads an encoder exported by ml.export_encoder_npz().
+    Returns:
+        * encoder : dictionary with 'layers' (list of layer configs, each
+                    with its 'weights'), 'input_dim', 'fully_conv',
+                    'norm_type', and 'mean' and 'std' of the training
+                    bottleneck (None if they were not exported)
+    '''
+    with np.load(fname, allow_pickle=False) as f:
+        arrays = {key: f[key] for key in f.files}
+    encoder = json.loads(str(arrays.pop('config')))
+    for i, layer in enumerate(encoder['layers']):
+        layer['weights'] = {name: arrays['layer%d_%s'%(i, name)] \
+                            for name in layer['weight_names']}
+    encoder['mean'] = arrays.get('bottleneck_mean')
+    encoder['std'] = arrays.get('bottleneck_std')
+    return encoder
+
+def forward(encoder, x):
+    '''Bottleneck of one batch of normalized, truncated light curves.'''
+    x = np.asarray(x, dtype='float32')[:, :, None]
+    for layer in encoder['layers']:
+        w = layer['weights']
+        if layer['type'] == 'conv1d':
+            x = conv1d(x, w['kernel'], w.get('bias'), layer['strides'],
+                       layer['padding'])
+        elif layer['type'] == 'dense':
+            x = np.matmul(x, w['kernel'])
+            if 'bias' in w:
+                x += w['bias']
+        elif layer['type'] == 'batch_norm':
+            x = batch_norm(x, w, layer['epsilon'])
+        elif layer['type'] == 'max_pool1d':
+            x = max_pool1d(x, layer['pool_size'], layer['strides'],
+                           layer['padding'])
+        elif layer['type'] == 'flatten':
+            x = x.reshape(len(x), -1)
+        elif layer['type'] != 'activation':
+            raise ValueError('Unsupported layer type '+layer['type'])
+        if 'activation' in layer:
+            if type(layer['activation']) != str or \
+               layer['activation'] not in ACTIVATIONS:
+                raise ValueError('Unsupported activation '+\
+                                 str(layer['activation']))
+            x = ACTIVATIONS[layer['activation']](x)
+    return x
+
+def encode(encoder, x, batch_size=256):
+    '''Bottleneck (not standardized) of normalized, truncated light curves x,
+    batch_size light curves at a time.'''
+    if len(x) == 0: # >> for the output shape
+        return encode(encoder, np.zeros((1, encoder['input_dim'])))[:0]
+    bottleneck = np.concatenate([forward(encoder, x[i:i+batch_size]) \
+                                 for i in range(0, len(x), batch_size)])
+    if encoder['fully_conv']:
+        bottleneck = np.squeeze(bottleneck, axis=-1)
+    return bottleneck
+
+def normalize_rows(flux, norm_type='standardization'):
+    '''Normalizes each light curve (row) of flux, like df.normalize_chunk().'''
+    if norm_type == 'standardization':
+        flux = flux - np.nanmean(flux, axis=1, keepdims=True)
+        stdevs = np.nanstd(flux, axis=1, keepdims=True)
+        stdevs[np.nonzero(stdevs == 0.)] = 1e-8
+        return flux / stdevs
+    elif norm_type == 'median_normalization':
+        return flux / np.nanmedian(flux, axis=1, keepdims=True)
+    elif norm_type == 'minmax_normalization':
+        flux = flux - np.nanmin(flux, axis=1, keepdims=True)
+        return flux / np.nanmax(flux, axis=1, keepdims=True)
+    else:
+        return flux
+
+def embed(encoder, flux, preprocess=True, standardize=True, batch_size=256):
+    '''Bottleneck of light curves flux, as ml.get_bottleneck() (or
+    ml.CAEEmbedder.embed()) gives it.
+    Parameters:
+        * encoder : returned by load_encoder()
+        * flux : light curves, shape=(num light curves, num points)
+        * preprocess : normalize (encoder['norm_type']) and truncate flux to
+                       the input length
+        * standardize : standardize each bottleneck feature with the training
+                        statistics (or with those of flux, like
+                        ml.get_bottleneck(), if they were not exported)
+        * batch_size : number of light curves per forward pass
+    '''
+    x = flux
+    if preprocess:
+        x = normalize_rows(np.asarray(flux, dtype='float64'),
+                           encoder['norm_type'])[:, :encoder['input_dim']]
+    bottleneck = encode(encoder, x, batch_size=batch_size)
+    if standardize:
+        if type(encoder['mean']) == type(None):
+            bottleneck = normalize_rows(bottleneck.T).T
+        else:
+            bottleneck = (bottleneck - encoder['mean']) / encoder['std']
+    return bottleneck
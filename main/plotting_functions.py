@@ -132,8 +132,8 @@ def sector_nan_mask_diag(custom_masks=[[]]*26,
         flux, time, ticid, target_info = \
             df.load_data_from_metafiles('/nfs/blender/data/tdaylan/data/',
                                         sector, nan_mask_check=False)
-        cams = target_info[:,1].astype('int')
-        ccds = target_info [:,2].astype('int')
+        cams = target_info['cam']
+        ccds = target_info['ccd']
         masked_time = np.delete(time, custom_mask)
         for cam in [1,2,3,4]:
             for ccd in [1,2,3,4]:
@@ -2577,7 +2577,8 @@ def ticid_label(ax, ticid, target_info, title=False, color='black',
                 fontsize='xx-small'):
     '''Query catalog data and add text to axis.
     Parameters:
-        * target_info : [sector, camera, ccd, data_type, cadence]
+        * target_info : [sector, camera, ccd, data_type, cadence], or a row of
+                        structured target_info (see df.make_target_info())
     TODO: use Simbad classifications and other cross-checking database
     classifications'''
     try:
@@ -2592,9 +2593,8 @@ def ticid_label(ax, ticid, target_info, title=False, color='black',
         else: Teff = '%.4d'%Teff
         
         # >> query sector, camera, ccd
-        sector, cam, ccd = target_info[:3]
-        data_type = target_info[3]
-        cadence = target_info[4]
+        sector, cam, ccd, data_type, cadence = \
+            df.target_info_fields(target_info)
         # obj_name = 'TIC ' + str(int(ticid))
         # obj_table = Tesscut.get_sectors(obj_name)
         # ind = np.nonzero(obj_table['sector']==sector)
@@ -3012,11 +3012,9 @@ def assign_real_labels(ticid_pred, y_pred, database_dir='./databases/',
     
     # -- get 'ground truth' classifications -----------------------------------
     if gcvs_only:
-        ticid_true, label_true = df.get_gcvs_classifications(database_dir)
-        class_info = np.concatenate([np.expand_dims(ticid_true,1),
-                                     np.repeat(np.expand_dims(label_true, 1),
-                                               2, 1)], 1)
-        class_info =  df.get_parents_only(class_info)
+        # >> GCVS labels merged into parent classes, from the label database
+        label_db = df.load_label_db(database_dir)
+        class_info = df.label_db_class_info(label_db, source='gcvs')
 
     else:
         class_info = get_classifications(ticid_pred, database_dir, class_info,
@@ -3033,28 +3031,13 @@ def assign_real_labels(ticid_pred, y_pred, database_dir='./databases/',
     y_pred = y_pred[comm1]
     ticid_true = ticid_true[comm2]
     class_info_new = class_info[comm2]       
-    label_true = np.unique(class_info_new[:,1])    
-    
-    # >> create number labels for true labels so we can make confusion matrix
-    y_true = []
-    for i in range(len(ticid_true)):
-        class_num = np.nonzero(label_true == class_info_new[i][1])[0][0]
-        y_true.append(class_num)
-    y_true = np.array(y_true).astype('int')
-    
-    # >> create a confusion matrix
-    cm = confusion_matrix(y_true, y_pred)
-    
-    # >> make the matrix square so that we can apply linear_sum_assignment
-    while len(label_pred) < len(cm):
-        label_pred = np.append(label_pred, 'X')     
-    while len(label_true) < len(cm):
-        label_true = np.append(label_true, 'X')
-        
-    # >> make confusion matrix diagonal by re-ordering columns
-    row_ind, col_ind = linear_sum_assignment(-1*cm)
-    cm = cm[:,col_ind]
-    label_pred = label_pred[col_ind]
+    
+    # >> contingency matrix of true labels and clusters, with the optimal
+    # >> one-to-one assignment on the diagonal
+    cm, label_true, label_pred = \
+        df.contingency_matrix(class_info_new[:,1], y_pred)
+    cm, label_true, label_pred = \
+        df.diagonal_confusion_matrix(cm, label_true, label_pred)
     
     # -- make assignment dictionary --------------------------------------------
 
@@ -4176,29 +4159,25 @@ def plot_cross_identifications(time, intensity, targets, target_info, features,
 def plot_class_dists(assignments, ticid, y_pred, y_true, data_dir, sectors, 
                      label_list=[], output_dir='./'):
     
-    data = []
     var_data = []
     var_tic = []
     for sector in sectors:
-        print('Loading TICv8 catalog data: Sector '+str(sector))
-        sector_data = pd.read_csv(data_dir+'Sector'+str(sector)+\
-                                  '/Sector'+str(sector)+'tic_cat_all.csv')
-        data.append(sector_data)
-
         tic, var = np.loadtxt(data_dir+'Sector'+str(sector)+\
                               '/Sector'+str(sector)+'variability_statistics.txt')
         var_tic.append(tic)
         var_data.append(var)
-    data = pd.concat(data)
     var_data = np.concatenate(var_data, axis=0)
     var_tic = np.concatenate(var_tic)
 
-    _, _, inds = np.intersect1d(ticid, data['ID'],
-                                return_indices=True)
-    data = data.iloc[inds]
+    # >> TICv8 catalog data of each target
+    print('Loading TICv8 catalog data')
+    data = df.tic_gather(df.open_tic_store(df.get_tic_store_dir(data_dir)),
+                         ticid, ['Teff', 'rad', 'mass', 'GAIAmag', 'd'])
+    data = pd.DataFrame(data)
 
-    _, _, inds = np.intersect1d(ticid.astype('float'), var_tic, return_indices=True)
-    var_data = var_data[inds]
+    # >> variability statistics of each target (NaN if missing)
+    rows = df.ticid_join(var_tic, ticid)
+    var_data = np.where(rows > -1, var_data[rows], np.nan)
 
     # sector_dists(data, var_data, ticid,
     #              output_dir, prefix='all-')
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures for the tests of the main/ modules. The modules import each
+other by module name (import data_functions as df), so main/ is put on the
+path here. Light curves are synthetic and written to pytest's tmp_path.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+def synthetic_flux(num_lc, n, seed=0, nan_frac=0.):
+    '''Sinusoids with noise around a positive median, shape=(num_lc, n).'''
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 27, n)
+    period = rng.uniform(0.5, 5, size=(num_lc, 1))
+    flux = 1000 + 20*np.sin(2*np.pi*t/period) + rng.normal(size=(num_lc, n))
+    if nan_frac > 0:
+        flux[rng.random(flux.shape) < nan_frac] = np.nan
+    return t, flux
+
+def write_metafiles(data_dir, sector, groups, num_lc=6, n=200, seed=0):
+    '''Writes SectorXCamXCCDX_lightcurves.fits metafiles (time, flux and
+    TICIDs, as data_access_by_group_fits() writes them) for each (cam, ccd)
+    in groups. Returns {(cam, ccd): (ticid, flux)}.'''
+    from astropy.io import fits
+    out = {}
+    for k, (cam, ccd) in enumerate(groups):
+        t, flux = synthetic_flux(num_lc, n, seed=seed+k)
+        ticid = 1000*cam + 100*ccd + np.arange(num_lc)
+        group_dir = data_dir + 'Sector{s}/Sector{s}Cam{c}CCD{d}/'.format(
+            s=sector, c=cam, d=ccd)
+        os.makedirs(group_dir, exist_ok=True)
+        hdul = fits.HDUList([fits.PrimaryHDU(t), fits.ImageHDU(flux),
+                             fits.ImageHDU(ticid.astype('float'))])
+        hdul.writeto(group_dir + 'Sector{s}Cam{c}CCD{d}_lightcurves.fits'.format(
+            s=sector, c=cam, d=ccd), overwrite=True)
+        out[(cam, ccd)] = (ticid, flux)
+    return out
+
+def lc_fits_bytes(ticid, n=200, sector=5):
+    '''Contents of a synthetic _lc.fits file (TIME, PDCSAP_FLUX, QUALITY and
+    the TICID header), as MAST serves them, with an orbit gap and two short
+    gaps.'''
+    import io
+    from astropy.io import fits
+    t, flux = synthetic_flux(1, n, seed=int(ticid))
+    flux[0, n//2-10:n//2+10] = np.nan # >> orbit gap
+    flux[0, 3*n//4:3*n//4+3] = np.nan
+    quality = np.zeros(n, dtype='int32')
+    quality[n//4] = 1
+    cols = [fits.Column(name='TIME', format='D', array=t + 100*sector),
+            fits.Column(name='PDCSAP_FLUX', format='E', array=flux[0]),
+            fits.Column(name='QUALITY', format='J', array=quality)]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    hdu.header['TICID'] = int(ticid)
+    f = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(f)
+    return f.getvalue()
+
+def write_bulk_download(data_dir, bulk_dir, sector, targets, n=200):
+    '''Writes a bulk download directory of _lc.fits files and the sector's
+    all_targets_S0XX_v1.txt for targets, a list of (ticid, cam, ccd).
+    Targets already in the sector file are kept in it.'''
+    os.makedirs(bulk_dir, exist_ok=True)
+    sectorpath = data_dir + 'Sector' + str(sector) + '/'
+    os.makedirs(sectorpath, exist_ok=True)
+    sectorfile = sectorpath + 'all_targets_S%03d'%sector + '_v1.txt'
+    rows = []
+    if os.path.exists(sectorfile):
+        rows = [list(row) for row in np.loadtxt(sectorfile, ndmin=2)]
+    for ticid, cam, ccd in targets:
+        fname = 'tess2019000000000-s%04d-%016d-0000-s_lc.fits'%(sector, ticid)
+        with open(bulk_dir + fname, 'wb') as f:
+            f.write(lc_fits_bytes(ticid, n, sector))
+        rows.append([ticid, cam, ccd])
+    np.savetxt(sectorfile, np.array(rows), fmt='%d')
+
+@pytest.fixture(scope='session')
+def df():
+    return pytest.importorskip('data_functions')
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return str(tmp_path) + '/'
+
+@pytest.fixture(scope='session')
+def ml():
+    return pytest.importorskip('model')
+
+def cae_params(**kwargs):
+    '''Parameters of a small CAE (two conv layers and a dense bottleneck in
+    the encoder) for 1D light curves.'''
+    p = {'kernel_size': 3, 'latent_dim': 4, 'strides': 1, 'epochs': 1,
+         'dropout': 0., 'num_filters': [4, 4], 'num_conv_layers': 4,
+         'num_consecutive': [1, 1], 'batch_size': 8, 'activation': 'elu',
+         'last_activation': 'linear', 'optimizer': 'adadelta',
+         'losses': 'mean_squared_error', 'lr': 0.01,
+         'initializer': 'glorot_uniform', 'kernel_regularizer': None,
+         'bias_regularizer': None, 'activity_regularizer': None,
+         'batch_norm': True, 'fully_conv': False, 'pool_size': 2,
+         'cvae': False, 'units': [4], 'concat_ext_feats': False}
+    p.update(kwargs)
+    return p
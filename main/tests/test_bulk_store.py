@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming preprocessing (bulk_download_to_store()) and incremental ingest
+(ingest_to_store()) into the light curve store.
+"""
+
+import numpy as np
+import pytest
+
+from conftest import write_bulk_download
+
+TARGETS = [(101, 1, 1), (102, 1, 1), (103, 1, 2), (104, 1, 2), (105, 1, 1)]
+KWARGS = dict(cams=[1], ccds=[[1,2]], chunk_size=2, n_workers=1)
+
+def raw_flux(df, bulk_dir, ticid):
+    '''Interpolated _lc.fits flux of each of ticid, like the 1st pass.'''
+    fits_index = df.index_bulk_download(bulk_dir)
+    lcs = [df.read_lc_fits(bulk_dir + fits_index[tic]) for tic in ticid]
+    flux, time, ticid_kept, _, _ = \
+        df.interpolate_all(np.array([lc[1] for lc in lcs]), lcs[0][0],
+                           np.array(ticid), batched=True)
+    return flux, time, ticid_kept
+
+def test_bulk_store_holds_raw_flux(df, data_dir):
+    bulk_dir = data_dir + 'bulk/'
+    write_bulk_download(data_dir, bulk_dir, 5, TARGETS)
+    store_dir = df.bulk_download_to_store(data_dir, 5, bulk_dir,
+                                          apply_nan_mask=False, **KWARGS)
+    store = df.open_lc_store(store_dir)
+    assert store['info']['norm_type'] == 'none'
+    flux, time, ticid, _ = \
+        df.load_data_from_store(data_dir, 5, cams=[1], ccds=[[1,2]],
+                                nan_mask_check=False, output_dir=data_dir)
+    expected = raw_flux(df, bulk_dir, ticid)[0]
+    np.testing.assert_allclose(flux, expected, rtol=1e-6)
+    assert np.nanmedian(flux) > 900 # >> not standardized
+    assert sorted(ticid) == [t[0] for t in TARGETS]
+
+def test_normalized_store_warns(df, data_dir):
+    bulk_dir = data_dir + 'bulk/'
+    write_bulk_download(data_dir, bulk_dir, 5, TARGETS)
+    df.bulk_download_to_store(data_dir, 5, bulk_dir, apply_nan_mask=False,
+                              norm_type='standardization', **KWARGS)
+    with pytest.warns(UserWarning, match='normalized'):
+        df.load_data_from_store(data_dir, 5, cams=[1], ccds=[[1,2]],
+                                nan_mask_check=False, output_dir=data_dir)
+
+def store_flux_by_ticid(df, store_dir):
+    store = df.open_lc_store(store_dir)
+    return {int(tic): np.array(store['flux'][row]) \
+            for row, tic in enumerate(store['ticid'])}
+
+def test_ingest_appends_and_is_idempotent(df, data_dir):
+    bulk_dir = data_dir + 'bulk/'
+    write_bulk_download(data_dir, bulk_dir, 5, TARGETS[:3])
+    store_dir, added = df.ingest_to_store(data_dir, 5, bulk_dir,
+                                          apply_nan_mask=False, **KWARGS)
+    assert sorted(added) == [101, 102, 103]
+
+    write_bulk_download(data_dir, bulk_dir, 5, TARGETS[3:])
+    _, added = df.ingest_to_store(data_dir, 5, bulk_dir, **KWARGS)
+    assert sorted(added) == [104, 105]
+    _, added = df.ingest_to_store(data_dir, 5, bulk_dir, **KWARGS)
+    assert len(added) == 0
+
+    flux = store_flux_by_ticid(df, store_dir)
+    assert sorted(flux.keys()) == [t[0] for t in TARGETS]
+    expected = raw_flux(df, bulk_dir, [104, 105])[0]
+    np.testing.assert_allclose(flux[104], expected[0], rtol=1e-6)
+    np.testing.assert_allclose(flux[105], expected[1], rtol=1e-6)
+
+def test_interrupted_ingest(df, data_dir, monkeypatch):
+    bulk_dir = data_dir + 'bulk/'
+    write_bulk_download(data_dir, bulk_dir, 5, TARGETS[:3])
+    store_dir, _ = df.ingest_to_store(data_dir, 5, bulk_dir,
+                                      apply_nan_mask=False, **KWARGS)
+    before = store_flux_by_ticid(df, store_dir)
+
+    # >> interrupted after flux, ticid.npy and ticid_index.npy were written,
+    # >> before store_info.json
+    write_bulk_download(data_dir, bulk_dir, 5, TARGETS[3:])
+    def interrupt(store_dir, info):
+        raise KeyboardInterrupt
+    with monkeypatch.context() as m:
+        m.setattr(df, 'write_store_info', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            df.ingest_to_store(data_dir, 5, bulk_dir, **KWARGS)
+    assert len(np.load(store_dir + 'ticid.npy')) == 5
+
+    # >> the half-written rows are invisible...
+    store = df.open_lc_store(store_dir)
+    assert store['flux'].shape[0] == 3 and len(store['index']['rows']) == 3
+    assert df.ticid_lookup(store['index'], np.array([104, 105]))[0] == -1
+    flux, _, ticid, _ = df.load_data_from_store(data_dir, 5, cams=[1],
+                                                ccds=[[1,2]],
+                                                nan_mask_check=False,
+                                                output_dir=data_dir)
+    assert sorted(ticid) == [101, 102, 103]
+
+    # >> ...and re-running the ingest adds them without losing any data
+    _, added = df.ingest_to_store(data_dir, 5, bulk_dir, **KWARGS)
+    assert sorted(added) == [104, 105]
+    after = store_flux_by_ticid(df, store_dir)
+    assert sorted(after.keys()) == [t[0] for t in TARGETS]
+    for tic in before:
+        np.testing.assert_array_equal(after[tic], before[tic])
+    expected = raw_flux(df, bulk_dir, [104, 105])[0]
+    np.testing.assert_allclose(after[104], expected[0], rtol=1e-6)
+    np.testing.assert_allclose(after[105], expected[1], rtol=1e-6)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Matching clusters to true labels.
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+def best_permutation_total(cm):
+    '''Largest number of matched objects over all one-to-one assignments, by
+    trying every permutation (the search match_clusters() replaced).'''
+    n_true, n_pred = cm.shape
+    best = 0
+    for cols in itertools.permutations(range(n_pred), min(n_true, n_pred)):
+        if n_true <= n_pred:
+            total = sum([cm[i, j] for i, j in enumerate(cols)])
+        else:
+            total = max([sum([cm[i, j] for j, i in enumerate(rows)]) \
+                         for rows in itertools.permutations(range(n_true),
+                                                            n_pred)])
+        best = max(best, total)
+    return best
+
+@pytest.mark.parametrize('shape', [(4, 4), (3, 5), (5, 3)])
+def test_hungarian_matches_brute_force(df, shape):
+    rng = np.random.default_rng(sum(shape))
+    for trial in range(5):
+        cm = rng.integers(0, 20, shape)
+        row_ind, col_ind = df.match_clusters(cm)
+        assert len(set(row_ind)) == len(row_ind) == min(shape)
+        assert len(set(col_ind)) == len(col_ind)
+        assert np.sum(cm[row_ind, col_ind]) == best_permutation_total(cm)
+
+def test_greedy_and_unknown_method(df):
+    cm = np.array([[5, 4, 0, 0],
+                   [0, 1, 0, 0],
+                   [0, 0, 0, 3]])
+    row_ind, col_ind = df.match_clusters(cm, method='greedy')
+    # >> empty cluster 2 is left out, clusters 0 and 1 share label 0
+    assert list(col_ind) == [0, 1, 3] and list(row_ind) == [0, 0, 2]
+    assert df.match_accuracy(cm, row_ind, col_ind) == 12 / 13
+    with pytest.raises(ValueError):
+        df.match_clusters(cm, method='factorial')
+
+def test_assign_clusters(df):
+    from sklearn.metrics.cluster import contingency_matrix
+    y_true = np.array(['EA', 'EA', 'RR', 'RR', 'RR', 'DSCT', 'EA', 'ROT'])
+    y_pred = np.array([2, 2, 0, 0, 1, 1, -1, 0])
+    assignments, accuracy, cm, label_true, label_pred = \
+        df.assign_clusters(y_true, y_pred)
+    np.testing.assert_array_equal(cm, contingency_matrix(y_true, y_pred))
+    assert sorted(map(tuple, assignments)) == \
+        [('-1', 'ROT'), ('0', 'RR'), ('1', 'DSCT'), ('2', 'EA')]
+    assert accuracy == 5 / 8
+    
+    cm_diag, label_true, label_pred = \
+        df.diagonal_confusion_matrix(cm, label_true, label_pred)
+    assert cm_diag.shape == (4, 4)
+    assert np.trace(cm_diag) == 5
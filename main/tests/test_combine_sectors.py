@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+combine_sectors_by_time_axis() on light curve stores of synthetic sectors.
+"""
+
+import numpy as np
+
+from conftest import write_metafiles
+
+def test_combine_two_sectors(df, data_dir):
+    for sector, seed in [(5, 0), (6, 10)]:
+        write_metafiles(data_dir, sector, [(1, 1)], num_lc=5, n=120,
+                        seed=seed)
+        df.convert_metafiles_to_store(data_dir, sector, cams=[1], ccds=[[1]])
+    flux, x, ticid, target_info, flux_median = \
+        df.combine_sectors_by_time_axis([5, 6], data_dir, debug=False,
+                                        output_dir=data_dir,
+                                        return_median_flux=True)
+    assert flux.shape == (len(ticid), 240) and len(x) == 240
+    assert flux.dtype == np.float64 # >> dtype of the stores
+    assert flux_median.shape == flux.shape
+    np.testing.assert_allclose(np.median(flux_median[:,:120], axis=1), 1)
+    np.testing.assert_allclose(np.median(flux_median[:,120:], axis=1), 1)
+    np.testing.assert_allclose(np.mean(flux[:,:120], axis=1), 0, atol=1e-8)
+    assert np.all(target_info['sector'] == [5, 6])
+
+    # >> default return is unchanged
+    out = df.combine_sectors_by_time_axis([5, 6], data_dir, debug=False,
+                                          output_dir=data_dir)
+    assert len(out) == 4
+    np.testing.assert_array_equal(out[0], flux)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed feature cache.
+"""
+
+import json
+
+import numpy as np
+
+from conftest import synthetic_flux
+
+class Counter:
+    '''compute() for cached_features() that records which light curves it
+    was asked for.'''
+    def __init__(self, flux):
+        self.flux, self.calls = flux, []
+    def __call__(self, inds):
+        self.calls.append(sorted(inds))
+        return np.array([[np.mean(self.flux[i]), np.std(self.flux[i])] \
+                         for i in inds])
+
+def test_only_new_or_changed_light_curves_are_computed(df, data_dir):
+    x, flux = synthetic_flux(5, 100, seed=7)
+    ticid = np.arange(5) + 100.
+    compute = Counter(flux)
+    features = df.cached_features(ticid, x, flux, compute, data_dir)
+    assert compute.calls == [[0, 1, 2, 3, 4]]
+    np.testing.assert_array_equal(features, compute(range(5)))
+    
+    # >> integer TICIDs give the same keys as float ones
+    compute.calls = []
+    again = df.cached_features(ticid.astype('int64'), x, flux, compute,
+                               data_dir)
+    assert compute.calls == []
+    np.testing.assert_array_equal(again, features)
+    
+    # >> a changed light curve and a duplicate of a new one
+    flux = np.concatenate([flux, flux[[1]] + 1, flux[[1]] + 1])
+    ticid = np.append(ticid, [101, 101])
+    compute.flux = flux
+    features = df.cached_features(ticid, x, flux, compute, data_dir)
+    assert compute.calls == [[5]]
+    np.testing.assert_array_equal(features[6], features[5])
+    np.testing.assert_allclose(features[5, 0], np.mean(flux[1]) + 1)
+
+def test_versions_and_params_are_cached_apart(df, data_dir):
+    x, flux = synthetic_flux(3, 100, seed=8)
+    compute = Counter(flux)
+    df.cached_features(None, x, flux, compute, data_dir, version=0)
+    df.cached_features(None, x, flux, compute, data_dir, version=1)
+    df.cached_features(None, x, flux, compute, data_dir, version=1,
+                       params={'num_sigma': 5})
+    df.cached_features(None, x, flux, compute, data_dir, version=1,
+                       params={'num_sigma': 5})
+    assert len(compute.calls) == 3
+
+def test_rows_past_num_rows_are_ignored(df, data_dir):
+    x, flux = synthetic_flux(4, 100, seed=9)
+    compute = Counter(flux)
+    df.cached_features(None, x, flux[:2], compute, data_dir)
+    subdir = df.feature_cache_subdir(data_dir)
+    # >> as if a run was interrupted after writing keys and features of the
+    # >> other two light curves, but before the info file
+    keys = df.lc_keys(None, x, flux)
+    info = json.load(open(subdir+'feature_cache_info.json'))
+    df.append_npy(subdir+'keys.npy', keys[2:], num_rows=2)
+    df.append_npy(subdir+'features.npy', np.zeros((2, 2)), num_rows=2)
+    json.dump(info, open(subdir+'feature_cache_info.json', 'w'))
+    
+    compute.calls = []
+    features = df.cached_features(None, x, flux, compute, data_dir)
+    assert compute.calls == [[2, 3]]
+    np.testing.assert_array_equal(features, compute(range(4)))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Engineered features and light curve statistics.
+"""
+
+import os
+
+import numpy as np
+
+from conftest import synthetic_flux
+
+def test_variability_statistics_match_loop(df, data_dir, monkeypatch):
+    # >> negative median for some light curves (e.g. background subtracted)
+    x, flux = synthetic_flux(6, 300, seed=3, nan_frac=0.05)
+    flux[:3] -= 2000
+    ticid = np.arange(len(flux)) + 1.
+    monkeypatch.setattr(df, 'load_data_from_metafiles',
+                        lambda *args, **kwargs: (flux, x, ticid, None))
+    for sector in range(1, 27):
+        os.makedirs(data_dir+'Sector'+str(sector))
+    df.calculate_variability_statistics(data_dir)
+
+    # >> loop of the original implementation
+    expected = []
+    for i in range(len(flux)):
+        norm = flux[i] / np.nanmedian(flux[i])
+        norm = np.delete(norm, np.nonzero(np.isnan(norm)))
+        expected.append(np.percentile(norm, 95) - np.percentile(norm, 5))
+    result = np.loadtxt(data_dir+'Sector26/Sector26variability_statistics.txt')
+    np.testing.assert_array_equal(result[0], ticid)
+    np.testing.assert_allclose(result[1], expected, rtol=1e-10)
+    assert np.all(result[1] > 0)
+
+def test_lombscargle_batch_matches_astropy(df):
+    from astropy.timeseries import LombScargle
+    x, flux = synthetic_flux(4, 500, seed=5)
+    freqs = np.linspace(0.6, 62.8, 300) # >> angular frequencies
+    tables = df.lombscargle_tables(x, freqs)
+    pg = df.lombscargle_batch(flux, tables)
+    
+    # >> masked points are left out, as if they were not in the time axis
+    rng = np.random.default_rng(0)
+    mask = rng.random(flux.shape) > 0.2
+    pg_masked = df.lombscargle_batch(flux, tables, mask=mask)
+    for i in range(len(flux)):
+        for m, result in [(np.ones(len(x), dtype='bool'), pg[i]),
+                          (mask[i], pg_masked[i])]:
+            # >> classical periodogram: no mean fit, no centering
+            ls = LombScargle(x[m], flux[i][m], fit_mean=False,
+                             center_data=False, normalization='standard')
+            expected = ls.power(freqs / (2*np.pi), method='slow')
+            np.testing.assert_allclose(result, expected, rtol=1e-7,
+                                       atol=1e-12)
+
+def test_chunked_tables_match_full_tables(df):
+    x, flux = synthetic_flux(3, 400, seed=8)
+    freqs = np.linspace(0.6, 62.8, 250)
+    full = df.lombscargle_tables(x, freqs)
+    chunked = df.lombscargle_tables(x, freqs, chunk_size=60)
+    assert 'cos' not in chunked and 'sin' not in chunked
+    np.testing.assert_allclose(chunked['cos2'], full['cos2'], rtol=1e-12,
+                               atol=1e-9)
+    np.testing.assert_allclose(chunked['sin2'], full['sin2'], rtol=1e-12,
+                               atol=1e-9)
+    mask = np.random.default_rng(1).random(flux.shape) > 0.1
+    for m in [None, mask]:
+        np.testing.assert_allclose(df.lombscargle_batch(flux, chunked, mask=m),
+                                   df.lombscargle_batch(flux, full, mask=m),
+                                   rtol=1e-10, atol=1e-14)
+    
+    x, flux = synthetic_flux(3, 600, seed=9)
+    flux = flux / np.median(flux, axis=1, keepdims=True)
+    np.testing.assert_allclose(
+        df.featvec_batch(x, flux, tables=df.featvec_tables(x, chunk_size=700)),
+        df.featvec_batch(x, flux, tables=df.featvec_tables(x, chunk_size=None)),
+        rtol=1e-9)
+
+def test_featvec_batch_matches_featvec(df):
+    x, flux = synthetic_flux(5, 600, seed=6)
+    flux = flux / np.median(flux, axis=1, keepdims=True)
+    expected = np.array([df.featvec(x, flux[i]) for i in range(len(flux))])
+    np.testing.assert_allclose(df.featvec_batch(x, flux, batch_size=2),
+                               expected, rtol=1e-6)
+
+def test_benchmark_featvec(df, capsys):
+    runtimes = df.benchmark_featvec(num_lc=30, n=2000, num_check=5,
+                                    batch_size=8)
+    assert list(runtimes.keys()) == ['per light curve', 'batched']
+    assert 'Same results: True' in capsys.readouterr().out
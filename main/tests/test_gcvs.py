@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Offline GCVS catalogue reader and sky cross-match.
+"""
+
+import os
+
+import numpy as np
+
+# >> lines in the fixed-width format of gcvs5.txt: the name field ends with
+# >> the remark flag column
+GCVS5 = [
+    '010001 |R          And *|002401.95+383437.3 |M          |  5.8    |\n',
+    '010002 |S          And  |004242.32+411608.4 |SN I       |  5.8    |\n',
+    '010003 |T          And *|002223.22+265951.3 |M          |  7.7    |\n',
+    '010004 |U          And  |                   |M          | 9.0     |\n',
+    '010005 |V0711      Tau *|034119.35+290418.6 |RS+BY      |  6.5    |\n',
+]
+
+def test_read_gcvs5(df, data_dir):
+    fname = data_dir + 'gcvs5.txt'
+    with open(fname, 'w') as f:
+        f.writelines(GCVS5)
+    gcvs = df.read_gcvs_dump(fname)
+    assert list(gcvs['VarName']) == ['R And', 'S And', 'T And', 'V0711 Tau']
+    assert list(gcvs['VarType']) == ['M', 'SN I', 'M', 'RS+BY']
+    np.testing.assert_allclose(gcvs['ra'][0], 15*(24/60 + 1.95/3600))
+    np.testing.assert_allclose(gcvs['dec'][0], 38 + 34/60 + 37.3/3600)
+
+def test_read_csv_dump(df, data_dir):
+    fname = data_dir + 'gcvs.csv'
+    with open(fname, 'w') as f:
+        f.write('ra,dec,VarType,VarName\n6.0,38.5,M,R And\n,,M,U And\n')
+    gcvs = df.read_gcvs_dump(fname)
+    assert list(gcvs['VarName']) == ['R And'] and gcvs['ra'][0] == 6.
+
+def test_sky_xmatch(df):
+    cat_ra, cat_dec = np.array([10., 200., 359.9995]), np.array([0., -45., 0.])
+    ra = np.array([10.001, 200., 0.0005, 50., np.nan])
+    dec = np.array([0., -45.002, 0., 0., 0.])
+    ind = df.sky_xmatch(ra, dec, cat_ra, cat_dec, radius=0.003)
+    assert list(ind) == [0, 1, 2, -1, -1]
+
+def test_offline_xmatch_makes_databases_dir(df, data_dir):
+    from test_tic_store import write_catalog
+    write_catalog(data_dir)
+    df.convert_tic_catalog(data_dir, sectors=None)
+    os.makedirs(data_dir+'Sector1/')
+    np.savetxt(data_dir+'Sector1/all_targets_S001_v1.txt',
+               np.array([[11, 1, 1], [13, 2, 3]]), fmt='%d')
+    with open(data_dir+'gcvs.csv', 'w') as f:
+        f.write('ra,dec,VarType,VarName\n10.501,-3.25,M,R And\n')
+    assert not os.path.exists(data_dir+'databases/')
+    ticid, otype, main_id = df.offline_gcvs_xmatch(data_dir, 1,
+                                                   data_dir+'gcvs.csv')
+    assert list(ticid) == [11] and list(otype) == ['M']
+    with open(data_dir+'databases/Sector1_GCVS.txt', 'r') as f:
+        assert f.readlines() == ['11,M,R And\n', '13,,\n']
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Batched interpolate_all() against the per light curve loop.
+"""
+
+import numpy as np
+import pytest
+
+def gappy_flux(num_lc=6, n=4000, seed=0):
+    '''Light curves with an orbit gap, short and long NaN gaps and outliers,
+    like benchmark_interpolate_all() makes.'''
+    rng = np.random.default_rng(seed)
+    time = np.arange(n) * 2. / (24*60)
+    flux = (1000. + 10*np.sin(time[None,:] * rng.uniform(1, 5, (num_lc, 1))) +\
+            rng.normal(0, 1, (num_lc, n))).astype('float32')
+    flux[:, n//2 : n//2 + 400] = np.nan # >> orbit gap
+    flux[:, :10] = np.nan
+    for i in range(num_lc):
+        for s in rng.integers(100, n-100, 10):
+            flux[i, s:s+rng.integers(1, 10)] = np.nan
+        for s in rng.integers(200, n-200, 2):
+            flux[i, s:s+rng.integers(20, 60)] = np.nan
+        flux[i, rng.integers(0, n, 3)] = 1e6
+    return time, flux
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_batched_matches_loop(df, n_workers):
+    time, flux = gappy_flux()
+    ticid = np.arange(len(flux))
+    res_loop = df.interpolate_all(np.copy(flux), time, ticid)
+    res_batch = df.interpolate_all(np.copy(flux), time, ticid, batched=True,
+                                   batch_size=4, n_workers=n_workers)
+    assert len(res_loop) == len(res_batch)
+    np.testing.assert_allclose(res_batch[0], res_loop[0], rtol=1e-6)
+    for a, b in zip(res_loop[1:], res_batch[1:]):
+        np.testing.assert_array_equal(a, b)
+    # >> short gaps are filled, the orbit gap is not
+    assert np.sum(np.isnan(res_batch[0])) < np.sum(np.isnan(flux))
+    assert np.all(np.isnan(res_batch[0][:, len(time)//2 + 200]))
+
+def test_benchmark(df, capsys):
+    runtimes = df.benchmark_interpolate_all(num_lc=6, n=4000, batch_size=4,
+                                            n_workers=2)
+    assert list(runtimes.keys()) == ['per light curve', 'batched, 1 workers',
+                                     'batched, 2 workers']
+    assert 'Same results: True' in capsys.readouterr().out
+
+def test_batched_orbit_gap_only(df):
+    time, flux = gappy_flux(num_lc=3)
+    n = len(time)
+    # >> rows with no gaps besides the orbit gap and the NaN windows at the
+    # >> beginning (and end)
+    rng = np.random.default_rng(1)
+    flux[1] = 1000. + rng.normal(0, 1, n)
+    flux[1, :10] = np.nan
+    flux[1, n//2 : n//2 + 400] = np.nan
+    flux[2] = flux[1]
+    flux[2, -20:] = np.nan
+    flux_interp, flags = df.interpolate_batch(flux, time)
+    assert not np.any(flags)
+    np.testing.assert_array_equal(flux_interp[1:], flux[1:])
+    # >> the other row is still interpolated
+    assert np.sum(np.isnan(flux_interp[0])) < np.sum(np.isnan(flux[0]))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Label database built from the GCVS and SIMBAD label text files.
+"""
+
+import os
+
+import numpy as np
+
+def write_labels(database_dir):
+    os.makedirs(database_dir, exist_ok=True)
+    with open(database_dir+'Sector1_GCVS.txt', 'w') as f:
+        f.write('11,RRAB,V0001 Aqr\n12,EA+DM:,V0002 Aqr\n13,DM,V0003 Aqr\n')
+    with open(database_dir+'Sector2_GCVS.txt', 'w') as f:
+        f.write('11,RRC,V0001 Aqr\n14,SRB,V0004 Aqr\n')
+    with open(database_dir+'Sector1_simbad.txt', 'w') as f:
+        f.write('11,RR*|*,HD 1\n15,IR|*,HD 5\n')
+
+def test_build_and_lookup(df, data_dir):
+    database_dir = data_dir + 'databases/'
+    write_labels(database_dir)
+    db = df.load_label_db(database_dir)
+    assert db['info']['num_rows'] == 6 # >> 4 GCVS and 2 SIMBAD TICIDs
+    
+    # >> the GCVS types of TICID 11 in both sectors merge into RR
+    rows = df.label_db_rows(db, [11], 'gcvs')
+    assert len(rows) == 1
+    assert db['columns']['otype'][rows[0]] == 'RRAB|RRC'
+    assert db['columns']['main_id'][rows[0]] == 'V0001 Aqr'
+    
+    codes = df.get_label_codes(db, [14, 11, 12, 13, 99])
+    classes = [db['classes'][c] if c > -1 else None for c in codes]
+    # >> DM is removed, and the uncertainty flag of EA
+    assert classes == ['SR', 'RR', 'EA', None, None]
+    
+    class_info = df.label_db_class_info(db, [11, 12, 15], source='simbad')
+    assert class_info.tolist() == [['11', 'RR', 'HD 1']]
+
+def test_rebuilt_when_text_files_change(df, data_dir):
+    database_dir = data_dir + 'databases/'
+    write_labels(database_dir)
+    info_file = df.get_label_db_dir(database_dir) + 'label_db_info.json'
+    df.load_label_db(database_dir)
+    os.utime(info_file, ns=(0, 0))
+    df.load_label_db(database_dir)
+    assert os.stat(info_file).st_mtime == 0 # >> not rebuilt
+    
+    with open(database_dir+'Sector3_GCVS.txt', 'w') as f:
+        f.write('16,DSCTC,V0006 Aqr\n')
+    db = df.load_label_db(database_dir)
+    assert os.stat(info_file).st_mtime > 0
+    assert db['classes'][df.get_label_codes(db, [16])[0]] == 'DSCT'
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Light curve store: metafile conversion and load_data_from_store().
+"""
+
+import os
+
+import numpy as np
+
+from conftest import write_metafiles
+
+GROUPS = [(1, 1), (1, 2)]
+
+def test_convert_and_load_round_trip(df, data_dir):
+    groups = write_metafiles(data_dir, 5, GROUPS)
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1,2]],
+                                  chunk_size=4)
+    flux, x, ticid, target_info = \
+        df.load_data_from_store(data_dir, 5, cams=[1], ccds=[[1,2]],
+                                nan_mask_check=False, output_dir=data_dir)
+    np.testing.assert_array_equal(flux, np.concatenate([groups[g][1] \
+                                                        for g in GROUPS]))
+    np.testing.assert_array_equal(ticid, np.concatenate([groups[g][0] \
+                                                         for g in GROUPS]))
+    assert x.shape == (flux.shape[1],)
+    assert list(np.unique(target_info['ccd'])) == [1, 2]
+    assert np.all(target_info['sector'] == 5)
+
+def test_selection_matches_metafiles(df, data_dir):
+    groups = write_metafiles(data_dir, 5, GROUPS)
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1,2]])
+    targets = groups[(1, 2)][0][1:4]
+    flux, x, ticid, _ = \
+        df.load_data_from_store(data_dir, 5, cams=[1], ccds=[[1,2]],
+                                targets=targets, custom_mask=[0, 1],
+                                nan_mask_check=False, output_dir=data_dir)
+    np.testing.assert_array_equal(ticid, targets)
+    np.testing.assert_array_equal(flux, groups[(1, 2)][1][1:4, 2:])
+
+def test_selection_cache_invalidated_by_rewrite(df, data_dir):
+    write_metafiles(data_dir, 5, GROUPS, seed=0)
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1,2]])
+    os.utime(df.get_lc_store_dir(data_dir, 5) + 'store_info.json',
+             ns=(0, 0)) # >> so the rewrite below has a different mtime
+    kwargs = dict(cams=[1], ccds=[[1]], nan_mask_check=False,
+                  output_dir=data_dir)
+    flux_old = np.array(df.load_data_from_store(data_dir, 5, **kwargs)[0])
+
+    # >> same targets and shape, different flux
+    groups = write_metafiles(data_dir, 5, GROUPS, seed=10)
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1,2]])
+    flux_new = df.load_data_from_store(data_dir, 5, **kwargs)[0]
+    np.testing.assert_array_equal(flux_new, groups[(1, 1)][1])
+    assert not np.array_equal(flux_new, flux_old)
+
+def test_debug_plot(df, data_dir):
+    write_metafiles(data_dir, 5, GROUPS)
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1,2]])
+    df.load_data_from_store(data_dir, 5, cams=[1], ccds=[[1]], DEBUG=True,
+                            debug_ind=2, output_dir=data_dir)
+    assert os.path.exists(data_dir + 'nanmask_debug.png')
+
+def test_packed_nan_mask_matches_nan_mask(df, data_dir):
+    from astropy.io import fits
+    groups = write_metafiles(data_dir, 5, [(1, 1)], num_lc=12, n=203)
+    flux = groups[(1, 1)][1]
+    # >> NaN columns, scattered NaNs and one mostly NaN light curve
+    flux[:, 50:60] = np.nan
+    flux[3, [7, 130, 202]] = np.nan
+    flux[8, 100:110] = np.nan
+    flux[10, 20:180] = np.nan
+    fname = data_dir + 'Sector5/Sector5Cam1CCD1/Sector5Cam1CCD1_lightcurves.fits'
+    with fits.open(fname, mode='update') as hdul:
+        hdul[1].data = flux
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1]],
+                                  chunk_size=5)
+    store = df.open_lc_store(df.get_lc_store_dir(data_dir, 5))
+    assert 'nan_mask' in store
+    np.testing.assert_array_equal(np.asarray(store['flux']), flux)
+    unpacked = dict(store)
+    del unpacked['nan_mask'] # >> reads flux instead
+    
+    custom_mask = np.arange(190, 203) # >> with a partial last byte
+    cols = np.delete(np.arange(203), custom_mask)
+    for tol1 in [0.05, 0.5]: # >> without and with removing TIC 1110
+        ref_flux, ref_time = df.nan_mask(flux, np.arange(203.),
+                                         ticid=groups[(1, 1)][0],
+                                         custom_mask=custom_mask, tol1=tol1,
+                                         output_dir=data_dir)
+        for s in [store, unpacked]:
+            rows, kept = df.nan_mask_store(s, cols=cols, tol1=tol1,
+                                           output_dir=data_dir, chunk_size=5)
+            np.testing.assert_array_equal(kept, ref_time)
+            np.testing.assert_array_equal(flux[rows][:, kept], ref_flux)
+        assert len(rows) == (11 if tol1 == 0.5 else 12)
+    
+    # >> a subset of rows
+    rows, kept = df.nan_mask_store(store, rows=np.array([0, 3, 5]), cols=cols,
+                                   output_dir=data_dir)
+    ref_flux, ref_time = df.nan_mask(flux[[0, 3, 5]], np.arange(203.),
+                                     custom_mask=custom_mask,
+                                     output_dir=data_dir)
+    np.testing.assert_array_equal(kept, ref_time)
+    assert list(rows) == [0, 3, 5]
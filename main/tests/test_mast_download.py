@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+download_mast_lcs() against a local stand-in for MAST, which answers the
+portal API queries (/api/v0/invoke) and serves the lc.fits downloads.
+"""
+
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from conftest import lc_fits_bytes
+
+class StandInMAST(BaseHTTPRequestHandler):
+    # >> TICID -> number of light curve products, 0 for no observations
+    targets = {11: 1, 12: 2, 13: 0}
+    # >> downloads that fail with a server error once before succeeding
+    flaky = set()
+    requests = []
+
+    def reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        request = json.loads(form['request'][0])
+        self.requests.append(request['service'])
+        if request['service'] == 'Mast.Caom.Filtered':
+            ticid = int(request['params']['filters'][2]['values'][0])
+            data = [{'obsid': ticid*10 + k} \
+                    for k in range(self.targets.get(ticid, 0))]
+        else:
+            data = []
+            for obsid in request['params']['obsid'].split(','):
+                ticid, k = divmod(int(obsid), 10)
+                uri = 'mast:TESS/tess-s%04d-%016d-lc.fits'%(k+1, ticid)
+                data.append({'dataURI': uri, 'description': 'Light curves'})
+                data.append({'dataURI': uri[:-7] + 'tp.fits',
+                             'description': 'Target pixel files'})
+        body = json.dumps({'status': 'COMPLETE', 'data': data}).encode()
+        self.reply(200, body, 'application/json')
+
+    def do_GET(self):
+        uri = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['uri'][0]
+        self.requests.append(uri)
+        if uri in self.flaky:
+            self.flaky.remove(uri)
+            self.reply(503, b'', 'text/plain')
+            return
+        ticid = int(uri.split('-')[2])
+        self.reply(200, lc_fits_bytes(ticid), 'application/fits')
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def mast_url():
+    StandInMAST.requests = []
+    StandInMAST.flaky = set()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInMAST)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d'%server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def test_mast_lc_urls(df, mast_url):
+    urls = df.mast_lc_urls(12, mast_url=mast_url)
+    assert len(urls) == 2
+    assert all([url.startswith(mast_url) and url.endswith('lc.fits') \
+                for url in urls])
+    assert df.mast_lc_urls(13, mast_url=mast_url) == []
+
+def test_download_resume_and_cache(df, data_dir, mast_url):
+    StandInMAST.flaky = {'mast:TESS/tess-s0001-%016d-lc.fits'%11}
+    fnames, failed = df.download_mast_lcs([11, 12, 13], data_dir, n_workers=2,
+                                          backoff=0.01, mast_url=mast_url)
+    assert failed == [13]
+    assert sorted(fnames.keys()) == [11, 12]
+    assert len(fnames[12]) == 2
+    time, flux, ticid = df.read_lc_fits(fnames[11][0])
+    assert ticid == 11 and len(flux) == len(time)
+
+    # >> resumed run: nothing is queried or downloaded again
+    num_requests = len(StandInMAST.requests)
+    fnames2, failed2 = df.download_mast_lcs([11, 12, 13], data_dir,
+                                            mast_url=mast_url)
+    assert fnames2 == fnames and failed2 == failed
+    assert len(StandInMAST.requests) == num_requests
+
+def test_injected_client(df, data_dir, mast_url):
+    calls = []
+    def lc_urls(ticid):
+        calls.append(ticid)
+        return [mast_url + '/api/v0.1/Download/file?uri=' + \
+                'mast:TESS/tess-s0005-%016d-lc.fits'%ticid]
+    fnames, failed = df.download_mast_lcs([21, 22], data_dir, lc_urls=lc_urls)
+    assert sorted(calls) == [21, 22] and failed == []
+    assert 'Mast.Caom.Filtered' not in StandInMAST.requests
+
+def test_lc_from_target_list_nothing_downloaded(df, data_dir, mast_url):
+    out = df.lc_from_target_list(data_dir, np.array([[13, 1, 1]]),
+                                 data_dir + 'lcs.fits', data_dir + 'ticid.txt',
+                                 data_dir + 'notes.txt', mast_url=mast_url)
+    assert 'no light curves' in out
+    with open(data_dir + 'notes.txt') as f:
+        assert '13' in f.read()
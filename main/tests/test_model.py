@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+CAE training: streamed input pipeline and performance mode, and the
+embedding API.
+"""
+
+import os
+
+import numpy as np
+
+from conftest import cae_params, synthetic_flux, write_metafiles
+
+def test_flux_dataset_shape_and_normalization(df, ml):
+    p = cae_params()
+    t, flux = synthetic_flux(20, 70, seed=1)
+    rows = np.array([3, 12, 0, 19, 7, 15, 11, 2, 9, 16])
+    # >> rows 0-9 in the first array, 10-19 in the second
+    dataset = ml.flux_dataset([flux[:10], flux[10:]], rows, p, shuffle=False)
+    
+    length = ml.truncated_length(70, p)
+    assert length == 68
+    batches = list(dataset.as_numpy_iterator())
+    assert [x.shape for x, y in batches] == [(8, length), (2, length)]
+    x = np.concatenate([x for x, y in batches])
+    assert x.dtype == np.float32
+    np.testing.assert_array_equal(x, np.concatenate([y for x, y in batches]))
+    # >> rows are read into float32 before they are normalized
+    expected = df.normalize_chunk(flux[rows].astype('float32'))[:, :length]
+    np.testing.assert_allclose(x, expected, rtol=1e-5, atol=1e-6)
+    
+    full = ml.flux_dataset(flux, rows, p, length=70, shuffle=False)
+    x = np.concatenate([x for x, y in full.as_numpy_iterator()])
+    np.testing.assert_allclose(np.mean(x, axis=1), 0, atol=1e-4)
+    np.testing.assert_allclose(np.std(x, axis=1), 1, rtol=1e-4)
+
+def test_streamed_training_without_validation(ml, data_dir):
+    p = cae_params()
+    t, flux = synthetic_flux(20, 70, seed=2)
+    train_rows, test_rows = ml.split_rows(len(flux))
+    model, history = ml.conv_autoencoder(ml.flux_dataset(flux, train_rows, p),
+                                         None, None, None, p, val=False,
+                                         output_dir=data_dir)
+    assert model.output_shape == (None, ml.truncated_length(70, p))
+    assert os.path.exists(data_dir+'training_time.txt')
+    assert os.path.exists(data_dir+'epoch_times.txt')
+
+def train_baseline(ml, x, p):
+    '''Trains the CAE the way conv_autoencoder() did before the performance
+    mode (float32, no XLA), returns the model and history.'''
+    from tensorflow import keras
+    keras.mixed_precision.set_global_policy('float32')
+    keras.utils.set_random_seed(0)
+    encoded = ml.encoder(x, p)
+    model = keras.models.Model(encoded.input,
+                               ml.decoder(x, encoded.output, p))
+    model.compile(optimizer=keras.optimizers.Adadelta(lr=p['lr']),
+                  loss=p['losses'])
+    history = model.fit(x, x, epochs=p['epochs'], batch_size=p['batch_size'],
+                        shuffle=True, callbacks=[ml.TimeHistory()])
+    return model, history
+
+def test_default_performance_mode_matches_baseline(ml, data_dir):
+    from tensorflow import keras
+    p = cae_params(epochs=2)
+    t, flux = synthetic_flux(24, 68, seed=3)
+    x = (flux - flux.mean(axis=1, keepdims=True)) / \
+        flux.std(axis=1, keepdims=True)
+    model_ref, history_ref = train_baseline(ml, x, dict(p))
+    
+    # >> a mixed precision model earlier in the session must not leak in
+    keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    keras.utils.set_random_seed(0)
+    model, history = ml.conv_autoencoder(x, x, x[:0], x[:0], dict(p),
+                                         val=False, output_dir=data_dir)
+    assert keras.mixed_precision.global_policy().name == 'float32'
+    assert not model.jit_compile
+    assert all([layer.dtype == 'float32' for layer in model.layers])
+    assert len(model.layers) == len(model_ref.layers)
+    np.testing.assert_allclose(history.history['loss'],
+                               history_ref.history['loss'], rtol=1e-6)
+    for w, w_ref in zip(model.get_weights(), model_ref.get_weights()):
+        np.testing.assert_allclose(w, w_ref, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(model.predict(x), model_ref.predict(x),
+                               rtol=1e-5, atol=1e-6)
+    with open(data_dir+'epoch_times.txt') as f:
+        assert f.read().startswith('policy=float32, xla=False')
+
+def test_embedder_store_matches_arrays(df, ml, data_dir):
+    p = cae_params()
+    write_metafiles(data_dir, 5, [(1, 1), (1, 2)])
+    df.convert_metafiles_to_store(data_dir, 5, cams=[1], ccds=[[1,2]])
+    store = df.open_lc_store(df.get_lc_store_dir(data_dir, 5))
+    flux = np.array(store['flux'])
+    
+    length = ml.truncated_length(flux.shape[1], p)
+    x = df.normalize_chunk(flux.astype('float32'))[:, :length]
+    model, history = ml.conv_autoencoder(x, x, x[:0], x[:0], dict(p),
+                                         val=False, save_model=True,
+                                         output_dir=data_dir)
+    ml.get_bottleneck(model, x, p, stats_out=data_dir+'bottleneck_stats.npz')
+    stats = ml.load_bottleneck_stats(data_dir+'bottleneck_stats.npz')
+    
+    cae = ml.CAEEmbedder(data_dir+'model.hdf5', p,
+                         data_dir+'bottleneck_stats.npz', batch_size=5)
+    assert cae.input_dim == length
+    for a, b in zip(cae.stats, stats):
+        np.testing.assert_array_equal(a, b)
+    
+    # >> streamed from the store, the same as arrays (in any batch size)
+    bottleneck = cae.embed(flux)
+    assert bottleneck.shape == (len(flux), p['latent_dim'])
+    np.testing.assert_allclose(cae.embed_store(store['flux']), bottleneck,
+                               rtol=1e-5, atol=1e-6)
+    rows = np.array([4, 0, 7])
+    np.testing.assert_allclose(cae.embed_store(store['flux'], rows=rows),
+                               bottleneck[rows], rtol=1e-5, atol=1e-6)
+    # >> standardized with the training statistics, not its own
+    raw = cae.embed(flux, standardize=False)
+    np.testing.assert_allclose(raw, ml.encoder_model(model, p).predict(x),
+                               rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(bottleneck, (raw - stats[0]) / stats[1],
+                               rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(cae.embed(flux[rows]), bottleneck[rows],
+                               rtol=1e-5, atol=1e-6)
+    
+    reconstruction = cae.reconstruct(flux)
+    assert reconstruction.shape == (len(flux), length)
+    np.testing.assert_allclose(reconstruction, model.predict(x), rtol=1e-5,
+                               atol=1e-6)
+    np.testing.assert_allclose(cae.reconstruct(x, preprocess=False),
+                               reconstruction, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy-only encoder runtime against Keras.
+"""
+
+import numpy as np
+import pytest
+
+from conftest import cae_params, synthetic_flux
+
+import numpy_encoder as ne
+
+def keras_encoder(layers, input_dim=64):
+    '''Keras model of light curves (input_dim,) through layers, ending in a
+    Dense bottleneck.'''
+    from tensorflow import keras
+    from tensorflow.keras import layers as kl
+    inputs = keras.Input(shape=(input_dim,))
+    x = kl.Reshape((input_dim, 1))(inputs)
+    for layer in layers:
+        x = layer(x)
+    x = kl.Flatten()(x)
+    return keras.models.Model(inputs, kl.Dense(3, activation='tanh')(x))
+
+def normalized_flux(num_lc, n, seed=0):
+    t, flux = synthetic_flux(num_lc, n, seed=seed)
+    return ((flux - flux.mean(axis=1, keepdims=True)) / \
+            flux.std(axis=1, keepdims=True)).astype('float32')
+
+def test_parity_with_trained_cae(ml, data_dir):
+    from tensorflow import keras
+    p = cae_params(epochs=2)
+    x = normalized_flux(24, 68, seed=4)
+    keras.utils.set_random_seed(1)
+    model, history = ml.conv_autoencoder(x, x, x[:0], x[:0], p, val=False,
+                                         output_dir=data_dir)
+    
+    ml.export_encoder_npz(model, p, data_dir+'encoder.npz')
+    encoder = ne.load_encoder(data_dir+'encoder.npz')
+    bottleneck = ne.encode(encoder, x, batch_size=10)
+    reference = ml.encoder_model(model, p).predict(x)
+    assert bottleneck.shape == reference.shape == (24, p['latent_dim'])
+    np.testing.assert_allclose(bottleneck, reference, rtol=1e-4, atol=1e-5)
+
+def test_parity_strides_and_paddings(ml, data_dir):
+    from tensorflow.keras import layers as kl
+    model = keras_encoder([kl.Conv1D(3, 5, strides=2, padding='valid',
+                                     activation='relu'),
+                           kl.BatchNormalization(),
+                           kl.Activation('swish'),
+                           kl.MaxPooling1D(3, strides=2, padding='same'),
+                           kl.Conv1D(2, 4, strides=3, padding='same',
+                                     activation='selu'),
+                           kl.MaxPooling1D(2, padding='valid'),
+                           kl.Dropout(0.5)], input_dim=61)
+    # >> non-trivial batch normalization statistics
+    bn = model.layers[3]
+    bn.moving_mean.assign(np.array([0.1, -0.2, 0.3], dtype='float32'))
+    bn.moving_variance.assign(np.array([0.5, 2., 1.5], dtype='float32'))
+    
+    p = {'fully_conv': False}
+    ml.export_encoder_npz(model, p, data_dir+'encoder.npz', DAE=False)
+    x = normalized_flux(7, 61, seed=5)
+    bottleneck = ne.encode(ne.load_encoder(data_dir+'encoder.npz'), x)
+    np.testing.assert_allclose(bottleneck, model.predict(x), rtol=1e-4,
+                               atol=1e-5)
+
+@pytest.mark.parametrize('layer', ['causal', 'dilated', 'activation',
+                                   'lstm'])
+def test_export_rejects_unsupported_layers(ml, data_dir, layer):
+    from tensorflow.keras import layers as kl
+    layers = {'causal': [kl.Conv1D(2, 3, padding='causal')],
+              'dilated': [kl.Conv1D(2, 3, dilation_rate=2)],
+              'activation': [kl.Activation('hard_sigmoid')],
+              'lstm': [kl.LSTM(2, return_sequences=True)]}[layer]
+    model = keras_encoder(layers)
+    with pytest.raises(ValueError):
+        ml.export_encoder_npz(model, {'fully_conv': False},
+                              data_dir+'encoder.npz', DAE=False)
+
+def test_runtime_rejects_unsupported_padding():
+    x = np.ones((2, 10, 1), dtype='float32')
+    with pytest.raises(ValueError):
+        ne.conv1d(x, np.ones((3, 1, 1), dtype='float32'), None,
+                  padding='causal')
+    with pytest.raises(ValueError):
+        ne.max_pool1d(x, 2, padding='causal')
+    encoder = {'layers': [{'type': 'upsample', 'weights': {}}]}
+    with pytest.raises(ValueError):
+        ne.forward(encoder, x[:, :, 0])
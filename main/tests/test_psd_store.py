@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Per sector PSD store of the CAE inputs.
+"""
+
+import numpy as np
+
+from conftest import synthetic_flux
+
+def test_changed_light_curves_are_recomputed(df, data_dir, monkeypatch):
+    t, flux = synthetic_flux(4, 200, seed=3)
+    ticid = np.arange(4) + 100
+    freq = df.psd_frequency_grid(t, 50)
+    computed = []
+    compute_psd = df.compute_psd
+    def counting_compute_psd(*args, inds=None, **kwargs):
+        computed.append(list(inds))
+        return compute_psd(*args, inds=inds, **kwargs)
+    monkeypatch.setattr(df, 'compute_psd', counting_compute_psd)
+
+    psd = df.cached_psd(data_dir, 1, ticid, t, flux, freq, block_size=3)
+    expected = np.concatenate([block for _, block in \
+                               compute_psd(t, flux, freq)])
+    np.testing.assert_allclose(psd, expected)
+    assert computed == [[0, 1, 2, 3]]
+
+    # >> gathered from the store, in any order
+    again = df.cached_psd(data_dir, 1, ticid[::-1], t, flux[::-1], freq)
+    np.testing.assert_array_equal(again, psd[::-1])
+    assert len(computed) == 1
+
+    # >> same TICID, different flux: a new row, not the stale PSD
+    flux[2] = flux[2][::-1]
+    psd = df.cached_psd(data_dir, 1, ticid, t, flux, freq)
+    assert computed[1] == [2]
+    np.testing.assert_allclose(psd[2], next(compute_psd(t, flux[[2]],
+                                                        freq))[1][0])
+    store = df.open_psd_store(df.get_psd_store_dir(data_dir, 1, freq))
+    assert store['info']['num_rows'] == 5
+    assert list(store['ticid']) == [100, 101, 102, 103, 102]
+
+    # >> the same light curves in another sector are other rows
+    df.cached_psd(data_dir, 2, ticid, t, flux, freq)
+    assert computed[2] == [0, 1, 2, 3]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Structured target_info and its conversion from and to the legacy string array.
+"""
+
+import numpy as np
+import pytest
+
+from conftest import write_metafiles
+
+def test_round_trip(df):
+    target_info = df.make_target_info([11, 12, 13], 5, [1, 2, 3], 4,
+                                      data_type=['SPOC', 'FFI', 'SPOC'],
+                                      cadence='20-second')
+    assert target_info.dtype == df.TARGET_INFO_DTYPE
+    legacy = df.to_legacy_target_info(target_info)
+    assert legacy.shape == (3, 5)
+    assert list(legacy[1]) == ['5', '2', '4', 'FFI', '20-second']
+    again = df.to_target_info(legacy, ticid=[11, 12, 13])
+    np.testing.assert_array_equal(again, target_info)
+    # >> structured and legacy target_info give the same (numeric) fields
+    for n in range(3):
+        fields = df.target_info_fields(target_info[n])
+        assert fields == df.target_info_fields(legacy[n])
+        assert fields[:3] == (5, n + 1, 4)
+        assert all([type(v) == int for v in fields[:3]])
+    assert df.target_info_fields(['6', '1', '2', 'SPOC', '2-minute']) == \
+        (6, 1, 2, 'SPOC', '2-minute')
+
+def test_legacy_conversion(df):
+    legacy = np.array([['5', '1', '2', 'SPOC', '2-minute'],
+                       ['5', '3', '4', 'FFI', '30-minute']])
+    target_info = df.to_target_info(legacy)
+    assert list(target_info['ticid']) == [0, 0]
+    assert list(target_info['ccd']) == [2, 4]
+    assert list(target_info['cadence']) == [0, 3]
+    # >> structured target_info is returned as it is, and so is legacy
+    assert df.to_target_info(target_info) is target_info
+    np.testing.assert_array_equal(df.to_legacy_target_info(legacy), legacy)
+    with pytest.raises(ValueError):
+        df.to_target_info([['5,6', '1,1', '2,2', 'SPOC', '2-minute']])
+    with pytest.raises(ValueError):
+        df.to_target_info([['5', '1', '2', 'TESS', '2-minute']])
+
+def test_combined_sectors(df, data_dir):
+    for sector, seed in [(5, 0), (6, 10)]:
+        write_metafiles(data_dir, sector, [(1, 1)], num_lc=5, n=120,
+                        seed=seed)
+        df.convert_metafiles_to_store(data_dir, sector, cams=[1], ccds=[[1]])
+    flux, x, ticid, target_info = \
+        df.combine_sectors_by_time_axis([5, 6], data_dir, debug=False,
+                                        output_dir=data_dir)
+    assert target_info.dtype == df.TARGET_INFO_DTYPE
+    assert target_info.shape == (len(ticid), 2)
+    np.testing.assert_array_equal(target_info['ticid'][:,0], ticid)
+    np.testing.assert_array_equal(target_info['ticid'][:,1], ticid)
+    assert np.all(target_info['sector'] == [5, 6])
+    assert df.target_info_fields(target_info[0]) == (5, 1, 1, 'SPOC',
+                                                    '2-minute')
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar TIC catalog store: conversion from the CTL CSV, gathers and
+appends.
+"""
+
+import os
+
+import numpy as np
+
+COLUMNS = ['ID', 'ra', 'dec', 'Teff', 'GAIA', 'objType', 'lum']
+ROWS = [['11', '10.5', '-3.25', '5800', '1234567890123456789', 'star', '1.5'],
+        ['12', '11.0', '-4.0', '', '', 'star', ''],
+        ['13', '12.0', '5.0', '6100', '22', 'star', '0.25'],
+        ['14', '13.0', '6.0', '4000', '', 'star', 'see notes'],
+        ['15', '14.0', '7.0', '3500', '9', 'star', '2']]
+
+def write_catalog(data_dir, rows=ROWS):
+    with open(data_dir+'exo_CTL_08.01xTIC_v8.1_header.csv', 'w') as f:
+        f.write(','.join(['['+col+']' for col in COLUMNS]) + '\n')
+    with open(data_dir+'exo_CTL_08.01xTIC_v8.1.csv', 'w') as f:
+        f.writelines([','.join(row) + '\n' for row in rows])
+
+def test_convert_and_gather(df, data_dir):
+    write_catalog(data_dir)
+    store_dir = df.convert_tic_catalog(data_dir, sectors=None, chunk_size=2)
+    store = df.open_tic_store(store_dir)
+    assert store['info']['num_rows'] == 5
+    assert not any([f.endswith('.0.npy') for f in os.listdir(store_dir)])
+
+    data = df.tic_gather(store, np.array([13., 99, 11]),
+                         ['ra', 'Teff', 'GAIA', 'lum'])
+    assert list(data['ID']) == [13, -1, 11]
+    np.testing.assert_array_equal(data['ra'], [12., np.nan, 10.5])
+    # >> identifiers stay exact strings
+    assert list(data['GAIA']) == ['22', '', '1234567890123456789']
+    assert store['columns']['Teff'].dtype == np.float64
+    assert np.isnan(df.tic_gather(store, [12], ['Teff'])['Teff'][0])
+
+def test_column_promoted_to_strings(df, data_dir):
+    # >> lum looks numeric in the first chunk, but not in the second
+    write_catalog(data_dir)
+    store = df.open_tic_store(df.convert_tic_catalog(data_dir, sectors=None,
+                                                     chunk_size=2))
+    assert store['columns']['lum'].dtype.kind == 'U'
+    lum = df.tic_gather(store, [11, 12, 13, 14, 15], ['lum'])['lum']
+    assert list(lum) == ['1.5', '', '0.25', 'see notes', '2']
+
+def test_sector_filter_and_append(df, data_dir):
+    write_catalog(data_dir)
+    os.makedirs(data_dir+'Sector1/')
+    np.savetxt(data_dir+'Sector1/all_targets_S001_v1.txt',
+               np.array([[12, 1, 1], [15, 2, 3]]), fmt='%d')
+    store_dir = df.convert_tic_catalog(data_dir, sectors=[1], chunk_size=2)
+    store = df.open_tic_store(store_dir)
+    assert sorted(store['columns']['ID']) == [12, 15]
+
+    df.append_tic_store(store_dir, {'ID': [16], 'ra': [1.25],
+                                    'GAIA': ['123456789012345678901234']})
+    store = df.open_tic_store(store_dir)
+    data = df.tic_gather(store, [16, 15], ['ra', 'GAIA', 'Teff'])
+    assert list(data['ID']) == [16, 15]
+    assert data['ra'][0] == 1.25 and np.isnan(data['Teff'][0])
+    assert list(data['GAIA']) == ['123456789012345678901234', '9']
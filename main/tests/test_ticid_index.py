@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+TICID index: lookups and joins on TICID.
+"""
+
+import numpy as np
+
+from conftest import write_bulk_download
+
+def test_lookup_missing(df):
+    index = df.ticid_index([30., 10., 20.]) # >> float TICIDs of older tables
+    np.testing.assert_array_equal(index['ticid'], [10, 20, 30])
+    rows = df.ticid_lookup(index, [20, 5, 30, 35, 10.0, 25])
+    np.testing.assert_array_equal(rows, [2, -1, 0, -1, 1, -1])
+    assert rows.dtype == np.int64
+    np.testing.assert_array_equal(df.ticid_lookup(index, [5, 10], missing=-9),
+                                  [-9, 1])
+    # >> 2D queries keep their shape
+    assert df.ticid_lookup(index, [[10, 11]]).shape == (1, 2)
+    empty = df.ticid_index(np.empty(0))
+    np.testing.assert_array_equal(df.ticid_lookup(empty, [1, 2]), [-1, -1])
+    np.testing.assert_array_equal(df.ticid_join([], [1]), [-1])
+    # >> TICIDs too large for float32 stay distinct as int64
+    big = np.array([2**40 + 1, 2**40 + 2], dtype='int64')
+    np.testing.assert_array_equal(df.ticid_join(big, big[::-1]), [1, 0])
+
+def test_duplicates_across_sectors(df):
+    # >> TICs 11 and 13 are in both sectors
+    target_info = np.concatenate([df.make_target_info([11, 12, 13], 5, 1, 1),
+                                  df.make_target_info([13, 14, 11], 6, 2, 3)])
+    index = df.ticid_index(target_info['ticid'])
+    rows = df.ticid_lookup(index, [11, 13, 14, 15])
+    # >> the first row, i.e. the first sector, of repeated TICIDs
+    np.testing.assert_array_equal(rows, [0, 2, 4, -1])
+    assert list(target_info['sector'][rows[:3]]) == [5, 5, 6]
+    # >> all rows of a TICID are next to each other in the index
+    first = np.searchsorted(index['ticid'], 13)
+    last = np.searchsorted(index['ticid'], 13, side='right')
+    assert list(index['rows'][first:last]) == [2, 3]
+    
+    # >> rows appended later come after the rows already in the index
+    more = df.make_target_info([12, 15], 7, 4, 4)
+    index = df.update_ticid_index(index, more['ticid'], [6, 7])
+    target_info = np.concatenate([target_info, more])
+    np.testing.assert_array_equal(index['ticid'],
+                                  np.sort(target_info['ticid']))
+    np.testing.assert_array_equal(target_info['ticid'][index['rows']],
+                                  index['ticid'])
+    np.testing.assert_array_equal(df.ticid_lookup(index, [12, 15]), [1, 7])
+    np.testing.assert_array_equal(
+        df.ticid_lookup(index, target_info['ticid']),
+        df.ticid_join(target_info['ticid'], target_info['ticid']))
+
+def test_join_after_store_is_extended(df, data_dir):
+    bulk_dir = data_dir + 'bulk/'
+    targets = [(101, 1, 1), (102, 1, 1), (103, 1, 2), (104, 1, 2),
+               (105, 1, 1)]
+    kwargs = dict(cams=[1], ccds=[[1,2]], chunk_size=2, n_workers=1,
+                  apply_nan_mask=False)
+    write_bulk_download(data_dir, bulk_dir, 5, targets[:3])
+    store_dir, _ = df.ingest_to_store(data_dir, 5, bulk_dir, **kwargs)
+    store = df.open_lc_store(store_dir)
+    np.testing.assert_array_equal(df.ticid_lookup(store['index'], [103, 105]),
+                                  [df.ticid_join(store['ticid'], [103])[0], -1])
+    
+    write_bulk_download(data_dir, bulk_dir, 5, targets[3:])
+    df.ingest_to_store(data_dir, 5, bulk_dir, **kwargs)
+    store = df.open_lc_store(store_dir)
+    query = np.array([105, 101, 106, 104])
+    rows = df.ticid_lookup(store['index'], query)
+    # >> the saved index matches one built from the extended TICID column
+    np.testing.assert_array_equal(rows, df.ticid_join(store['ticid'], query))
+    # >> appended rows are found
+    assert rows[2] == -1 and sorted(rows[[0, 3]]) == [3, 4]
+    np.testing.assert_array_equal(store['ticid'][rows[[0, 1, 3]]],
+                                  [105, 101, 104])
+    np.testing.assert_array_equal(store['target_info']['ticid'][rows[[0, 3]]],
+                                  [105, 104])
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Stellar parameters, worker setup and checkpointing of the parallel TLS
+features.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from conftest import synthetic_flux
+
+def blas_threads():
+    from threadpoolctl import threadpool_info
+    return [info['num_threads'] for info in threadpool_info() \
+            if info['user_api'] == 'blas']
+
+def test_limit_threads_in_workers(df):
+    if len(blas_threads()) == 0:
+        pytest.skip('no BLAS thread pool')
+    with ProcessPoolExecutor(max_workers=1, initializer=df.limit_threads,
+                             initargs=(3,)) as executor:
+        assert executor.submit(blas_threads).result() == \
+            [3]*len(blas_threads())
+
+def test_stellar_params_from_catalog_without_queries(df, data_dir,
+                                                      monkeypatch):
+    import transitleastsquares
+    def catalog_info(**kwargs):
+        raise AssertionError('catalog_info() should not be called')
+    monkeypatch.setattr(transitleastsquares, 'catalog_info', catalog_info)
+    
+    con = df.open_tls_db(data_dir+'tls.db')
+    catalog = {'ID': np.array([11, -1]), 'rad': np.array([0.5, np.nan]),
+               'mass': np.array([0.6, np.nan])}
+    params = df.tls_stellar_params([11., 12, 11], con, catalog=catalog)
+    np.testing.assert_array_equal(params, [[0.5, 0.6], [np.nan, np.nan],
+                                           [0.5, 0.6]])
+    # >> cached, so the catalog is no longer needed
+    np.testing.assert_array_equal(df.tls_stellar_params([11], con),
+                                  [[0.5, 0.6]])
+    con.close()
+
+def test_network_errors_fall_back_to_solar(df, data_dir, monkeypatch):
+    import transitleastsquares
+    calls = []
+    def catalog_info(TIC_ID=None):
+        calls.append(TIC_ID)
+        raise ConnectionError('no network')
+    monkeypatch.setattr(transitleastsquares, 'catalog_info', catalog_info)
+    
+    assert np.all(np.isnan(df.tls_catalog_params(5)))
+    with pytest.raises(ConnectionError):
+        df.tls_catalog_params(5, network_fallback=False)
+    
+    con = df.open_tls_db(data_dir+'tls.db')
+    params = df.tls_stellar_params([5, 6, 7], con, query=True)
+    assert np.all(np.isnan(params))
+    assert len(calls) == 3 # >> stops after the first failed query
+    # >> failures are not cached
+    assert con.execute('SELECT COUNT(*) FROM stellar_params').fetchone()[0] \
+        == 0
+    con.close()
+    assert df.tls_grid_params(np.linspace(0, 27, 100), *params[0]) == [1, 1]
+
+class CountingExecutor:
+    '''ProcessPoolExecutor stand-in (threads, no initializer) that records
+    the largest number of light curves in flight.'''
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+    def submit(self, func, *args):
+        cls = CountingExecutor
+        cls.in_flight += 1
+        cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        future = self.executor.submit(func, *args)
+        def finished(future):
+            cls.in_flight -= 1
+        future.add_done_callback(finished)
+        return future
+
+def test_featvec_tls_parallel_failures_and_checkpoint(df, data_dir,
+                                                      monkeypatch):
+    import concurrent.futures
+    def featvec(x, flux, v=1, **kwargs):
+        if flux[0] > 1010: # >> any error TLS may raise
+            raise RuntimeError('no transit')
+        return [len(x), np.mean(flux), 0.5, 1.]
+    monkeypatch.setattr(df, 'featvec', featvec)
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor',
+                        CountingExecutor)
+    CountingExecutor.max_in_flight = 0
+    
+    x, flux = synthetic_flux(9, 50, seed=4)
+    flux = flux.astype('float32')
+    flux[:, 0] = 1000.
+    flux[4, 0] = 1020.
+    flux[6, 5] = np.nan
+    db_file = data_dir + 'tls.db'
+    # >> identifiers=None, the default of the callers
+    features = df.featvec_tls_parallel(x, flux, None, db_file, n_workers=2,
+                                       max_pending=3)
+    assert CountingExecutor.max_in_flight <= 3
+    assert np.all(np.isnan(features[4]))
+    ok = np.arange(9) != 4
+    np.testing.assert_array_equal(features[ok, 0],
+                                  [50]*5 + [49] + [50]*2)
+    np.testing.assert_allclose(features[ok, 1],
+                               np.nanmean(flux[ok], axis=1), rtol=1e-6)
+    
+    # >> every light curve is checkpointed, failed ones with NaNs and the
+    # >> row index as identifier
+    con = df.open_tls_db(db_file)
+    rows = con.execute('SELECT identifier, period FROM tls_features').fetchall()
+    con.close()
+    assert sorted([int(r[0]) for r in rows]) == list(range(9))
+    assert [r[1] for r in rows if r[0] == '4'] == [None]
+    
+    def no_featvec(*args, **kwargs):
+        raise AssertionError('all light curves are in the checkpoint')
+    monkeypatch.setattr(df, 'featvec', no_featvec)
+    again = df.featvec_tls_parallel(x, flux, None, db_file)
+    np.testing.assert_array_equal(again, features)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-match cache and per-target SIMBAD queries, with stand-ins for the
+astroquery services.
+"""
+
+import time
+
+import pytest
+from astropy.table import Table
+
+class FakeCatalogs:
+    '''Catalogs.query_object() of a TIC with a few targets.'''
+    calls = []
+    known = {1: {'ID': 1, 'ra': 10., 'dec': -5., 'HIP': 123},
+             2: {'ID': 2, 'ra': 11., 'dec': -6., 'HIP': 456}}
+
+    @classmethod
+    def query_object(cls, target, radius=None, catalog=None):
+        cls.calls.append(target)
+        ticid = int(target.split()[1])
+        row = {col: '' for col in ['TYC', 'TWOMASS', 'SDSS', 'ALLWISE',
+                                   'GAIA', 'APASS', 'KIC']}
+        row.update(cls.known.get(ticid, {'ID': 0, 'ra': 0., 'dec': 0.,
+                                         'HIP': 0}))
+        table = Table({key: [value] for key, value in row.items()})
+        return table if ticid in cls.known else table[:0]
+
+class FakeSimbad:
+    '''Simbad() that fails with a connection error on the first query.'''
+    calls = []
+
+    def add_votable_fields(self, *fields):
+        pass
+
+    def query_object(self, target):
+        FakeSimbad.calls.append(target)
+        if len(FakeSimbad.calls) == 1:
+            raise ConnectionError('connection reset')
+        if target == 'HIP 456':
+            return Table({'MAIN_ID': ['V* XX Xxx'], 'OTYPES': ['RR*|V*']})
+        return None
+
+@pytest.fixture
+def fakes(df, monkeypatch):
+    FakeCatalogs.calls = []
+    FakeSimbad.calls = []
+    sleeps = []
+    monkeypatch.setattr(df, 'Catalogs', FakeCatalogs)
+    monkeypatch.setattr(df, 'Simbad', FakeSimbad)
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    return sleeps
+
+def test_query_tic_max_age(df, data_dir, fakes):
+    con = df.open_xmatch_cache(data_dir + 'cache.sqlite')
+    assert df.query_tic(1, con)['ra'] == 10.
+    assert df.query_tic(1, con, max_age=3600)['ra'] == 10.
+    assert len(FakeCatalogs.calls) == 1
+    con.execute('UPDATE xmatch SET time = time - 7200')
+    df.query_tic(1, con, max_age=3600) # >> expired, queried again
+    assert len(FakeCatalogs.calls) == 2
+    df.query_tic(1, con)
+    assert len(FakeCatalogs.calls) == 2
+    con.close()
+
+def test_simbad_retries_network_errors_only(df, data_dir, fakes):
+    out = data_dir + 'simbad.txt'
+    ticid, otypes, main_id = \
+        df.query_simbad_classifications([1, 2, 3], out_f=out,
+                                        data_dir=data_dir, query_mast=True,
+                                        backoff=3.)
+    # >> one connection error, retried after backoff**0 s
+    assert fakes == [1.]
+    # >> TIC 3 has no TIC entry: queried once, not retried
+    assert FakeCatalogs.calls.count('TIC 3') == 1
+    assert list(ticid) == [1, 2]
+    assert otypes == ['none', 'RR*|V*'] and main_id[1] == 'V* XX Xxx'
+    with open(out) as f:
+        assert f.read().splitlines() == ['1,,', '2,RR*|V*,V* XX Xxx']
+
+def test_simbad_gives_up_after_max_retries(df, data_dir, fakes, monkeypatch):
+    def query_object(self, target):
+        raise ConnectionError('down')
+    monkeypatch.setattr(FakeSimbad, 'query_object', query_object)
+    ticid, _, _ = df.query_simbad_classifications([1], out_f=data_dir+'s.txt',
+                                                  data_dir=data_dir,
+                                                  query_mast=True,
+                                                  max_retries=3)
+    assert ticid == [] and fakes == [1., 2.]
+
+class FakeBulkSimbad:
+    '''Simbad().query_objects() that knows 'HIP 456', and fails with a
+    connection error on the first fail_first requests.'''
+    def __init__(self, fail_first=0):
+        self.calls = []
+        self.fail_first = fail_first
+
+    def query_objects(self, identifiers):
+        self.calls.append(list(identifiers))
+        if len(self.calls) <= self.fail_first:
+            raise ConnectionError('connection reset')
+        rows = [n + 1 for n in range(len(identifiers)) \
+                if identifiers[n] == 'HIP 456']
+        return Table({'SCRIPT_NUMBER_ID': rows,
+                      'MAIN_ID': ['V* XX Xxx']*len(rows),
+                      'OTYPES': ['RR*|V*']*len(rows)})
+
+class FakeVizier:
+    '''Vizier().query_region() with one GCVS star at (11, -6), failing with a
+    connection error on the first fail_first requests.'''
+    def __init__(self, fail_first=0):
+        self.calls = []
+        self.fail_first = fail_first
+
+    def query_region(self, coords, radius=None, catalog=None):
+        self.calls.append(len(coords))
+        if len(self.calls) <= self.fail_first:
+            raise ConnectionError('connection reset')
+        rows = [n + 1 for n in range(len(coords)) \
+                if abs(coords[n].ra.deg - 11.) < 1e-3]
+        return [Table({'_q': rows, 'VarType': ['RRAB']*len(rows),
+                       'VarName': ['XX Xxx']*len(rows)})]
+
+def test_simbad_xmatch_cache_and_aliases(df, data_dir, fakes):
+    con = df.open_xmatch_cache(data_dir + 'cache.sqlite')
+    simbad = FakeBulkSimbad()
+    identifiers = [['TIC 1', 'HIP 123'], ['TIC 2', 'HIP 456'], ['TIC 3']]
+    res = df.simbad_xmatch(identifiers, simbad=simbad, con=con, chunk_size=2)
+    assert res[0] is None and res[2] is None
+    assert res[1] == {'otypes': 'RR*|V*', 'main_id': 'V* XX Xxx'}
+    # >> TICIDs first (two chunks), then the aliases of unmatched targets
+    assert simbad.calls == [['TIC 1', 'TIC 2'], ['TIC 3'],
+                            ['HIP 123', 'HIP 456']]
+    # >> everything is cached, including identifiers SIMBAD does not know
+    assert df.simbad_xmatch(identifiers, simbad=simbad, con=con) == res
+    assert len(simbad.calls) == 3
+    con.close()
+
+def test_simbad_xmatch_network_error(df, data_dir, fakes):
+    con = df.open_xmatch_cache(data_dir + 'cache.sqlite')
+    failed = []
+    res = df.simbad_xmatch([['TIC 2', 'HIP 456']],
+                           simbad=FakeBulkSimbad(fail_first=1), con=con,
+                           backoff=3., failed=failed)
+    assert fakes == [1.] and failed == []
+    assert res[0]['main_id'] == 'V* XX Xxx'
+    # >> a chunk that keeps failing is reported, and not cached
+    simbad = FakeBulkSimbad(fail_first=3)
+    res = df.simbad_xmatch([['TIC 1']], simbad=simbad, con=con,
+                           max_retries=3, failed=failed)
+    assert res == [None] and failed == [0]
+    assert df.xmatch_cache_get(con, 'simbad', 'otypes', ['TIC 1']) == {}
+    con.close()
+
+def test_vizier_query_region_cache_and_network_error(df, data_dir, fakes):
+    con = df.open_xmatch_cache(data_dir + 'cache.sqlite')
+    vizier = FakeVizier(fail_first=1)
+    failed = []
+    res = df.vizier_query_region([10., 11.], [-5., -6.], vizier=vizier,
+                                 con=con, failed=failed)
+    assert res == [None, {'VarType': 'RRAB', 'VarName': 'XX Xxx'}]
+    assert vizier.calls == [2, 2] and fakes == [1.] and failed == []
+    assert df.vizier_query_region([10., 11.], [-5., -6.], vizier=vizier,
+                                  con=con) == res
+    assert len(vizier.calls) == 2
+    res = df.vizier_query_region([12.], [-7.], vizier=FakeVizier(fail_first=2),
+                                 con=con, max_retries=2, failed=failed)
+    assert res == [None] and failed == [0]
+    con.close()
+
+def test_simbad_batched(df, data_dir, fakes):
+    out = data_dir + 'simbad.txt'
+    simbad = FakeBulkSimbad(fail_first=1)
+    ticid, otypes, main_id = \
+        df.query_simbad_classifications([1, 2, 3], out_f=out,
+                                        data_dir=data_dir, query_mast=True,
+                                        batched=True, simbad=simbad)
+    # >> TIC 3 has no TIC entry: skipped without retrying
+    assert FakeCatalogs.calls.count('TIC 3') == 1
+    assert list(ticid) == [1, 2] and fakes == [1.]
+    assert otypes == ['none', 'RR*|V*'] and main_id[1] == 'V* XX Xxx'
+    with open(out) as f:
+        assert f.read().splitlines() == ['1,,', '2,RR*|V*,V* XX Xxx']
+    # >> targets that keep failing are not written, so they are tried again
+    ticid, _, _ = \
+        df.query_simbad_classifications([4], out_f=out, data_dir=data_dir,
+                                        query_mast=True, batched=True,
+                                        simbad=FakeBulkSimbad(fail_first=5),
+                                        max_retries=2)
+    assert ticid == []
+    with open(out) as f:
+        assert len(f.read().splitlines()) == 2
+
+def test_vizier_batched(df, data_dir, fakes):
+    out = data_dir + 'gcvs.txt'
+    vizier = FakeVizier()
+    ticid, otypes, main_id = \
+        df.query_vizier([1, 2, 3], out=out, data_dir=data_dir,
+                        query_mast=True, batched=True, vizier=vizier)
+    assert FakeCatalogs.calls.count('TIC 3') == 1
+    assert list(ticid) == [2] and otypes == ['RRAB'] and vizier.calls == [2]
+    with open(out) as f:
+        assert f.read().splitlines() == ['1,,', '2,RRAB,XX Xxx']
+    # >> TIC entries and cone searches come from the cache
+    df.query_vizier([1, 2], out=data_dir+'gcvs2.txt', data_dir=data_dir,
+                    query_mast=True, batched=True, vizier=vizier)
+    assert len(FakeCatalogs.calls) == 3 and vizier.calls == [2]